@@ -1,240 +1,43 @@
 #!/usr/bin/env python3
 # backup-sync.py — Double-tap / long-press / web UI: sync backups to remote server
 #
+# With --restore DEVICE [--snapshot NAME] [--target NAME] it pulls that device's
+# backup back from a sync target instead (web UI restore). The status file
+# then carries job="restore"; guards, progress and cancel are the same.
+#
+# When the sync worker (sync_worker.py, sync-worker.service) is running, the
+# job is handed to its queue and this script exits at once. Otherwise, or with
+# --no-worker, the job runs here through the same sync_worker.run_job.
+#
 # Does NOT touch the e-paper display. iosbackupmachine.py owns the EPD and reads
-# this script's status writes from backup_status.json to render sync UI.
-import os, sys, time, json, subprocess, yaml, traceback
-from datetime import datetime
-
-CONFIG_PATH = os.getenv("IOSBACKUP_CONFIG", "/root/iosbackupmachine/config.yaml")
+# the status writes from backup_status.json to render sync UI.
+import os, sys, argparse
 
 # Make sibling modules importable when run via Popen from webui
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 if SCRIPT_DIR not in sys.path:
     sys.path.insert(0, SCRIPT_DIR)
 
-import logutil
-# Persistent logs on the rootfs; runtime status on the volatile zram /var/log.
-LOG_DIR = logutil.LOG_DIR
-RUNTIME_DIR = logutil.RUNTIME_DIR
-STATUS_FILE = os.path.join(RUNTIME_DIR, "backup_status.json")
-
-
-def load_config(path):
-    try:
-        with open(path, "r") as f:
-            cfg = yaml.safe_load(f) or {}
-    except Exception:
-        cfg = {}
-    cfg.setdefault("orientation", "landscape_right")
-    cfg.setdefault("env", {})
-    cfg.setdefault("sync", {"enabled": False})
-    return cfg
-
-
-def write_status(state, **extra):
-    """Atomic status write: tmp file + rename, so concurrent readers never see partial JSON."""
-    try:
-        os.makedirs(RUNTIME_DIR, exist_ok=True)
-        data = {"state": state, "timestamp": datetime.now().isoformat(), **extra}
-        tmp = STATUS_FILE + f".tmp.{os.getpid()}"
-        with open(tmp, "w") as f:
-            json.dump(data, f)
-            f.flush()
-            try:
-                os.fsync(f.fileno())
-            except Exception:
-                pass
-        os.replace(tmp, STATUS_FILE)
-    except Exception:
-        try:
-            if os.path.exists(tmp):
-                os.remove(tmp)
-        except Exception:
-            pass
-
-
-def backup_running():
-    try:
-        out = subprocess.run(["pgrep", "-f", "idevicebackup2"],
-                             capture_output=True, text=True)
-        return out.returncode == 0
-    except Exception:
-        return False
-
-
-def another_sync_running():
-    """True if another backup-sync.py process is running."""
-    try:
-        out = subprocess.run(["pgrep", "-f", "backup-sync.py"],
-                             capture_output=True, text=True)
-        if out.returncode != 0:
-            return False
-        my_pid = os.getpid()
-        my_ppid = os.getppid()
-        for pid_str in out.stdout.split():
-            try:
-                pid = int(pid_str)
-            except ValueError:
-                continue
-            if pid != my_pid and pid != my_ppid:
-                return True
-        return False
-    except Exception:
-        return False
-
-
-def sync_in_progress():
-    """True if a sync is already running — either another backup-sync.py or the
-    in-process auto-sync in iosbackupmachine.py (status 'syncing' + a live rsync).
-    Guards against kill_stale_rsync() killing an active auto-sync's rsync."""
-    try:
-        with open(STATUS_FILE, "r") as f:
-            if (json.load(f) or {}).get("state") != "syncing":
-                return False
-    except Exception:
-        return False
-    try:
-        return subprocess.run(["pgrep", "-f", "/usr/bin/rsync"],
-                              capture_output=True).returncode == 0
-    except Exception:
-        return False
-
-
-def kill_stale_rsync(logf):
-    """Kill orphaned rsync processes left behind by previous interrupted runs."""
-    try:
-        r = subprocess.run(["pkill", "-9", "-f", "/usr/bin/rsync"],
-                           capture_output=True, text=True)
-        if r.returncode == 0:
-            logf.write("[INFO] killed stale rsync processes\n")
-    except Exception as e:
-        logf.write(f"[WARN] kill_stale_rsync failed: {e}\n")
-
-
-# ---------- Setup ----------
-CFG = load_config(CONFIG_PATH)
-for k, v in CFG.get("env", {}).items():
-    os.environ[k] = str(v)
-
-os.makedirs(LOG_DIR, exist_ok=True)
-ts = datetime.now().strftime("%Y%m%d-%H%M%S")
-logpath = os.path.join(LOG_DIR, f"sync-{ts}.log")
-try:
-    logf = logutil.open_run_log(logpath)
-    logutil.prune_logs()   # trim old per-run logs (count + age)
-except Exception as e:
-    print(f"[FATAL] cannot open {logpath}: {e}", file=sys.stderr)
-    write_status("sync_error", message=f"Cannot write log: {e}")
-    sys.exit(1)
-
-logf.write(f"backup-sync.py starting (pid={os.getpid()})\n")
-
-# ---------- Guards ----------
-if not CFG.get("sync", {}).get("enabled", False):
-    logf.write("[SKIP] sync is disabled in config\n")
-    write_status("sync_error", message="Sync is disabled in settings.")
-    logf.close()
-    sys.exit(0)
-
-if another_sync_running():
-    logf.write("[SKIP] another backup-sync.py is already running\n")
-    logf.close()
-    sys.exit(0)
-
-if backup_running():
-    logf.write("[SKIP] backup (idevicebackup2) in progress\n")
-    write_status("sync_error", message="Backup in progress — sync skipped.")
-    logf.close()
-    sys.exit(0)
-
-if sync_in_progress():
-    logf.write("[SKIP] a sync is already in progress (in-process or external)\n")
-    logf.close()
-    sys.exit(0)
-
-# Power-aware: refuse to start a sync on low battery (unless charging).
-# Fail-open if the battery can't be read.
-try:
-    import power
-    _threshold = CFG.get("sync", {}).get("min_battery_percent", 35)
-    _batt_ok, _batt_reason = power.sync_allowed(_threshold)
-except Exception:
-    _batt_ok, _batt_reason = True, ""
-if not _batt_ok:
-    logf.write(f"[SKIP] {_batt_reason}\n")
-    write_status("sync_error", message=_batt_reason)
-    try:
-        from notifications import send_notification as _notify
-        _notify("sync_error", {"error": _batt_reason})
-    except Exception:
-        pass
-    logf.close()
-    sys.exit(0)
-
-# Clean up any orphaned rsync processes from previous interrupted runs
-kill_stale_rsync(logf)
-
-# Initial status: iosbackupmachine.py picks this up and starts drawing sync UI
-write_status("syncing", percent=0, bytes=0, total=0, speed="")
-logf.write("[INFO] status set to syncing — display owned by iosbackupmachine.py\n")
-
-# ---------- Notifications (non-fatal) ----------
-try:
-    from notifications import send_notification
-except ImportError:
-    def send_notification(*a, **kw): pass
-
-send_notification("sync_start")
-
-# ---------- Run sync ----------
-import sync_manager
-
-
-# Throttle progress logging: only on a percent change or every 30s, so a stuck
-# or slow sync leaves a sparse, readable trail instead of a line every second.
-# Scan and stall transitions are logged separately (once) by sync_manager.
-_last_log = {"pct": None, "t": 0.0}
-
-
-def on_progress(info):
-    pct = info.get("pct", 0)
-    elapsed = info.get("elapsed", 0.0)
-    write_status(
-        "syncing",
-        percent=pct,
-        bytes=info.get("bytes", 0),
-        total=info.get("total", 0),
-        speed=info.get("speed", ""),
-        stalled=bool(info.get("stalled", False)),
-        stalled_seconds=int(info.get("stalled_seconds", 0)),
-        scanning=bool(info.get("scanning", False)),
-        scan_seconds=int(info.get("scan_seconds", 0)),
-    )
-    if info.get("scanning") or info.get("stalled"):
-        return  # transitions are logged by sync_manager; don't spam here
-    if pct != _last_log["pct"] or (elapsed - _last_log["t"]) >= 30:
-        logf.write(f"[SYNC] {pct}% ({elapsed:.0f}s)\n")
-        _last_log["pct"] = pct
-        _last_log["t"] = elapsed
-
-
-try:
-    result = sync_manager.run_sync_with_progress(on_progress=on_progress, log_file=logf)
-except Exception as e:
-    tb = traceback.format_exc()
-    logf.write(f"[ERROR] sync raised: {e}\n{tb}")
-    result = {"success": False, "message": f"Sync error: {e}", "duration": 0}
-
-if result["success"]:
-    logf.write(f"[OK] {result['message']}\n")
-    write_status("sync_complete", message=result["message"])
-    send_notification("sync_complete", {"message": result["message"]})
-else:
-    msg = result["message"]
-    logf.write(f"[ERROR] {msg}\n")
-    write_status("sync_error", message=msg)
-    send_notification("sync_error", {"error": msg})
-
-logf.close()
+import sync_worker
+
+_parser = argparse.ArgumentParser()
+_parser.add_argument("--restore", metavar="DEVICE", help="pull this device folder back from a target")
+_parser.add_argument("--snapshot", help="snapshot of the device to restore (default: the live copy)")
+_parser.add_argument("--target", help="target to restore from (default: the primary)")
+_parser.add_argument("--no-worker", action="store_true", help="run here even if the sync worker is up")
+ARGS = _parser.parse_args()
+JOB = "restore" if ARGS.restore else "sync"
+JOB_ARGS = ({"device": ARGS.restore, "snapshot": ARGS.snapshot, "target": ARGS.target}
+            if JOB == "restore" else {})
+
+if not ARGS.no_worker:
+    reply = sync_worker.enqueue(JOB, source="backup-sync.py", **JOB_ARGS)
+    if reply is not None:
+        if reply.get("ok"):
+            print(f"{JOB} queued on the sync worker (job {reply['id']}, position {reply['position']})")
+            sys.exit(0)
+        print(f"sync worker refused the {JOB}: {reply.get('error')}", file=sys.stderr)
+        sys.exit(1)
+
+sync_worker.run_job(JOB, JOB_ARGS, source="backup-sync.py")
 sys.exit(0)
@@ -9,6 +9,9 @@ and every per-script loader. Provides:
 - ``apply_defaults``: deep-merge defaults under a config (existing values win).
 - ``migrate``       : versioned, ordered migration step run once on update.
 - ``load_config``   : read + migrate + default-fill.
+- ``ConfigCache``   : ``load_config`` parsed once and kept until the file's
+                      mtime, size or inode changes, as a read-only view or a
+                      private copy.
 - ``atomic_save``   : tmp + fsync + os.replace, so a power loss can't truncate
                       config.yaml (the bug this module fixes).
 
@@ -17,11 +20,16 @@ can be unit-tested on any machine.
 """
 import os
 import copy
+import threading
+from types import MappingProxyType
 
 import yaml
 
 CONFIG_PATH = os.getenv("IOSBACKUP_CONFIG", "/root/iosbackupmachine/config.yaml")
 
+# libyaml's C parser when PyYAML was built with it (several times faster).
+_Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 # Bump whenever the schema changes in a way that needs a migration step below.
 CONFIG_VERSION = 2
 
@@ -46,7 +54,11 @@ DEFAULTS = {
     # are kept for backward-compat reads; the v2 migration seeds networks from them.
     "wifi": {"enabled": False, "ssid": "", "password": "", "networks": []},
     "ntp": {"enabled": True, "servers": ["pool.ntp.org", "time.google.com"]},
-    "webui": {"enabled": True, "port": 8080, "bind_interfaces": ["all"], "secret_key": "change-me"},
+    # server: "production" (waitress with a pool of `threads` workers; the
+    # development server when waitress isn't installed) or "dev" (Flask's
+    # development server). compress: brotli/gzip for HTML and JSON responses.
+    "webui": {"enabled": True, "port": 8080, "bind_interfaces": ["all"], "secret_key": "change-me",
+              "server": "production", "threads": 8, "compress": True},
     "notifications": {
         "webhook": {"enabled": False, "url": "", "events": ["backup_complete", "backup_error"],
                     "auth_enabled": False, "auth_header": "Authorization"},
@@ -61,7 +73,17 @@ DEFAULTS = {
     "credential_encryption": {"passphrase_mode": "udid"},
     # min_battery_percent: power-aware sync refuses to start / auto-aborts below
     # this when not charging. Comfortably above PiSugar's 30% auto-shutdown.
-    "sync": {"enabled": False, "auto_sync": False, "allowed_network": "any", "min_battery_percent": 35},
+    # battery_forecast: also refuse a sync the battery won't last through
+    # (see sync_estimate.py).
+    # compression: auto (sync_tuner decides per run) | on | off.
+    # bandwidth_profiles: per-network bwlimit + monthly cap (see datausage.py).
+    # snapshots: versioned remote snapshots + retention (see sync_snapshots.py).
+    # audit: scheduled checksum audit of the remote copy (see sync_audit.py).
+    "sync": {"enabled": False, "auto_sync": False, "allowed_network": "any", "min_battery_percent": 35,
+             "battery_forecast": True, "compression": "auto", "bandwidth_profiles": [],
+             "snapshots": {"enabled": False, "keep_last": 7, "keep_daily": 14, "keep_monthly": 6},
+             "audit": {"enabled": False, "window": "01:00-05:00", "interval_days": 7,
+                       "max_mbps": 20, "shards": 4, "require_mains": True}},
 }
 
 
@@ -137,7 +159,7 @@ def load_config(path=None):
     path = path or CONFIG_PATH
     try:
         with open(path, "r") as f:
-            cfg = yaml.safe_load(f) or {}
+            cfg = yaml.load(f, Loader=_Loader) or {}
     except FileNotFoundError:
         cfg = {}
     cfg = migrate(cfg)
@@ -145,6 +167,51 @@ def load_config(path=None):
     return cfg
 
 
+def freeze(obj):
+    """A read-only copy of ``obj``: dicts become MappingProxyType, lists tuples."""
+    if isinstance(obj, dict):
+        return MappingProxyType({k: freeze(v) for k, v in obj.items()})
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+class ConfigCache:
+    """``load_config`` kept between calls: the file is parsed again only when
+    its mtime, size or inode changed (or after ``invalidate``), so a call is
+    otherwise one stat(). ``view`` hands out the shared read-only tree,
+    ``copy`` a private one to change and save."""
+
+    def __init__(self):
+        self._key = None
+        self._cfg = None
+        self._view = None
+        self._lock = threading.Lock()
+
+    def _current(self, path):
+        path = path or CONFIG_PATH
+        try:
+            st = os.stat(path)
+            key = (path, st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            key = (path, None)
+        with self._lock:
+            if self._cfg is None or key != self._key:
+                cfg = load_config(path)
+                self._key, self._cfg, self._view = key, cfg, freeze(cfg)
+            return self._cfg, self._view
+
+    def view(self, path=None):
+        return self._current(path)[1]
+
+    def copy(self, path=None):
+        return copy.deepcopy(self._current(path)[0])
+
+    def invalidate(self):
+        with self._lock:
+            self._cfg = None
+
+
 def atomic_save(cfg, path=None):
     """Write config atomically: tmp file + fsync + os.replace.
     A power loss mid-write leaves the previous config intact."""
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+datausage.py - Per-network bandwidth profiles and monthly data accounting for sync.
+
+``sync.bandwidth_profiles`` maps a network (as named by
+``netutil.network_label()``: ``wifi:<ssid>``, ``wifi`` for any WiFi,
+``usb_iphone``, or ``*``) to an rsync ``--bwlimit`` and an optional monthly
+cap. While a sync runs, the bytes moved on the physical uplink are counted
+from ``/proc/net/dev`` deltas and added to this month's total for that network
+(``data_usage.json`` in logutil.STATE_DIR).
+
+A network with a cap is metered. When its cap is reached the sync is paused
+(refused up front, or stopped mid-run with rsync's partial files kept) and a
+pause marker is left behind; the display daemon resumes the sync as soon as an
+unmetered network is up.
+
+Import-safe: stdlib only, so it can be unit-tested on any machine.
+"""
+import os
+import re
+import json
+import time
+import threading
+
+import logutil
+
+USAGE_FILE = "data_usage.json"
+MONTHS_KEEP = 12
+METER_FLUSH_SEC = 30
+
+_BWLIMIT_RE = re.compile(r"^\d+(\.\d+)?[kKmMgG]?$")
+
+
+def _month(ts=None):
+    return time.strftime("%Y-%m", time.localtime(ts))
+
+
+def _fmt(nbytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if nbytes < 1000:
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1000
+    return f"{nbytes:.1f} TB"
+
+
+# --- Profiles -----------------------------------------------------------------
+
+def match_profile(profiles, network):
+    """Most specific profile for ``network``: exact label, then ``wifi`` for
+    any WiFi network, then ``*``. None if nothing matches."""
+    if not network:
+        return None
+    by_name = {}
+    for p in profiles or []:
+        if isinstance(p, dict) and p.get("network"):
+            by_name.setdefault(str(p["network"]).strip(), p)
+    if network in by_name:
+        return by_name[network]
+    if network.startswith("wifi") and "wifi" in by_name:
+        return by_name["wifi"]
+    return by_name.get("*")
+
+
+def valid_bwlimit(limit):
+    """True for an empty limit or an rsync rate such as ``500``, ``500K``, ``2M``."""
+    limit = str(limit or "").strip()
+    return not limit or bool(_BWLIMIT_RE.match(limit))
+
+
+def bwlimit_flags(profile):
+    """``--bwlimit`` for a profile (rsync units: KiB/s, or a K/M/G suffix).
+    Empty / 0 / malformed means unlimited."""
+    limit = str((profile or {}).get("bwlimit") or "").strip()
+    if not limit or not valid_bwlimit(limit) or float(limit.rstrip("kKmMgG")) == 0:
+        return []
+    return [f"--bwlimit={limit}"]
+
+
+def bwlimit_kib(limit):
+    """An rsync rate as KiB/s (float), or None for unlimited / malformed."""
+    limit = str(limit or "").strip()
+    if not limit or not valid_bwlimit(limit):
+        return None
+    scale = {"k": 1, "m": 1024, "g": 1024 * 1024}.get(limit[-1].lower(), 1)
+    value = float(limit.rstrip("kKmMgG")) * scale
+    return value or None
+
+
+def target_bwlimit_flags(profile, target_limit="", shares=1):
+    """``--bwlimit`` for one of ``shares`` targets synced at once.
+
+    The network profile's limit caps the uplink, so it is split evenly between
+    the concurrent targets; a target's own ``bwlimit`` can only lower its
+    share. Unlimited when neither is set."""
+    net = bwlimit_kib((profile or {}).get("bwlimit"))
+    own = bwlimit_kib(target_limit)
+    limits = [v for v in (net / max(1, shares) if net else None, own) if v]
+    if not limits:
+        return []
+    return [f"--bwlimit={max(1, int(min(limits)))}"]
+
+
+def cap_bytes(profile):
+    """Monthly cap in bytes (``monthly_cap_mb`` is decimal MB, like a data
+    plan), or 0 for none."""
+    try:
+        return int(float((profile or {}).get("monthly_cap_mb") or 0) * 1_000_000)
+    except (TypeError, ValueError):
+        return 0
+
+
+def is_metered(profile):
+    return cap_bytes(profile) > 0 or bool((profile or {}).get("metered"))
+
+
+# --- Usage store --------------------------------------------------------------
+
+def _usage_path():
+    return logutil.state_path(USAGE_FILE)
+
+
+def load(path=None):
+    try:
+        with open(path or _usage_path(), "r") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data.setdefault("months", {})
+            return data
+    except Exception:
+        pass
+    return {"months": {}, "paused": None}
+
+
+def save(data, path=None):
+    """Atomic tmp + rename, trimming to the newest MONTHS_KEEP months."""
+    path = path or _usage_path()
+    months = data.get("months", {})
+    for m in sorted(months)[:-MONTHS_KEEP]:
+        months.pop(m, None)
+    tmp = f"{path}.tmp.{os.getpid()}"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def add_usage(network, nbytes, path=None, ts=None):
+    """Add ``nbytes`` to this month's total for ``network``."""
+    if not network or nbytes <= 0:
+        return
+    data = load(path)
+    month = data["months"].setdefault(_month(ts), {})
+    month[network] = month.get(network, 0) + int(nbytes)
+    save(data, path)
+
+
+def month_usage(network, data=None, ts=None):
+    data = data if data is not None else load()
+    return data.get("months", {}).get(_month(ts), {}).get(network, 0)
+
+
+def paused_info(data=None):
+    """The pause marker ({"network", "reason", "since"}) or None."""
+    data = data if data is not None else load()
+    return data.get("paused")
+
+
+def mark_paused(network, reason, path=None):
+    data = load(path)
+    data["paused"] = {"network": network, "reason": reason, "since": int(time.time())}
+    save(data, path)
+
+
+def clear_paused(path=None):
+    data = load(path)
+    if data.get("paused"):
+        data["paused"] = None
+        save(data, path)
+
+
+def admission(profiles, network, data=None):
+    """May a sync start on ``network`` this month? Returns (ok, reason)."""
+    profile = match_profile(profiles, network)
+    cap = cap_bytes(profile)
+    if not cap:
+        return True, ""
+    used = month_usage(network, data)
+    if used >= cap:
+        return False, (f"Monthly data cap reached on {network} ({_fmt(used)} of {_fmt(cap)}). "
+                       "Sync paused until an unmetered network is available.")
+    return True, ""
+
+
+def summary(profiles, data=None):
+    """This month's usage per network, for the dashboard and /api/health."""
+    data = data if data is not None else load()
+    month = _month()
+    used = data.get("months", {}).get(month, {})
+    names = set(used)
+    names.update(str(p.get("network")) for p in profiles or []
+                 if isinstance(p, dict) and p.get("network") and p.get("network") != "*")
+    networks = []
+    for name in sorted(names):
+        profile = match_profile(profiles, name)
+        cap = cap_bytes(profile)
+        b = used.get(name, 0)
+        networks.append({
+            "network": name,
+            "bytes": b,
+            "cap_bytes": cap,
+            "percent": round(b / cap * 100, 1) if cap else None,
+            "bwlimit": (profile or {}).get("bwlimit") or "",
+            "metered": is_metered(profile),
+        })
+    return {"month": month, "networks": networks, "paused": data.get("paused")}
+
+
+# --- Live meter ---------------------------------------------------------------
+
+class UsageMeter:
+    """Counts the bytes moved on the uplink during one sync run.
+
+    ``poll()`` reads /proc/net/dev, adds the rx+tx delta since the last poll and
+    persists it every METER_FLUSH_SEC, so a power cut loses at most that much
+    accounting. ``over_cap()`` tells the supervisor to pause the sync. One
+    meter is shared by the supervisors of every target of a run, so polling is
+    serialised.
+    """
+
+    def __init__(self, network, iface, profile=None, path=None, read_counters=None):
+        import netutil
+        self.network = network
+        self.iface = iface
+        self.cap = cap_bytes(profile)
+        self._path = path
+        self._read = read_counters or netutil.read_net_dev
+        self._used_before = month_usage(network, load(path)) if network else 0
+        self._last = self._counter()
+        self._pending = 0
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+        self.run_bytes = 0
+
+    def _counter(self):
+        rx_tx = self._read().get(self.iface) if self.iface else None
+        return sum(rx_tx) if rx_tx else None
+
+    def poll(self):
+        with self._lock:
+            now = self._counter()
+            if now is not None and self._last is not None:
+                delta = now - self._last
+                if delta < 0:          # counter reset (interface re-created)
+                    delta = now
+                self.run_bytes += delta
+                self._pending += delta
+            if now is not None:
+                self._last = now
+            if self._pending and time.time() - self._last_flush >= METER_FLUSH_SEC:
+                self._flush()
+            return self.run_bytes
+
+    def _flush(self):
+        if self._pending:
+            add_usage(self.network, self._pending, self._path)
+            self._pending = 0
+        self._last_flush = time.time()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def over_cap(self):
+        return bool(self.cap) and self._used_before + self.run_bytes >= self.cap
+
+    def finish(self):
+        self.poll()
+        self.flush()
+        return self.run_bytes
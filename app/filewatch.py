@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+filewatch.py - Wake up when a file changes, without polling it.
+
+``FileWatch(path)`` runs one thread that watches the directory of ``path``
+with inotify and counts the times the file was written (closed after a
+write) or replaced (the tmp-file-and-rename of an atomic write, as every
+writer of backup_status.json does). Any number of threads wait on it with
+``wait(version, timeout)``: one inotify descriptor and one thread serve every
+open dashboard, instead of one stat loop per client.
+
+Where inotify isn't available (not Linux, or the instance limit reached) the
+watch stats the file every POLL_SEC instead; callers see no difference.
+
+Import-safe: stdlib only (inotify through ctypes).
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+POLL_SEC = 1.0
+
+_IN_MODIFY = 0x002
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct("iIII")   # wd, mask, cookie, len; then the name
+
+
+def _inotify(directory, mask):
+    """An inotify descriptor watching ``directory``, or None."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def parse_events(buf):
+    """(mask, name) of each inotify event in ``buf``."""
+    events, pos = [], 0
+    while pos + _EVENT.size <= len(buf):
+        _wd, mask, _cookie, length = _EVENT.unpack_from(buf, pos)
+        pos += _EVENT.size
+        name = buf[pos:pos + length].split(b"\0", 1)[0]
+        pos += length
+        events.append((mask, os.fsdecode(name)))
+    return events
+
+
+class FileWatch:
+    """Counts changes of ``path``; ``wait`` blocks until the count moves.
+    ``modify`` also wakes on every write() rather than only on close or
+    rename (for a file that is appended to and kept open, like a log)."""
+
+    def __init__(self, path, modify=False, use_inotify=True):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.name = os.path.basename(path)
+        self.version = 0
+        self._cond = threading.Condition()
+        self._mask = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+        if modify:
+            self._mask |= _IN_MODIFY
+        self._fd = _inotify(self.directory, self._mask) if use_inotify else None
+        self.mode = "inotify" if self._fd is not None else "poll"
+        self._last = self._stamp()
+        self._thread = threading.Thread(target=self._run, name=f"watch-{self.name}", daemon=True)
+        self._thread.start()
+
+    def _bump(self):
+        with self._cond:
+            self.version += 1
+            self._cond.notify_all()
+
+    def wait(self, version, timeout):
+        """Block until the change count differs from ``version`` or
+        ``timeout`` seconds passed. Returns the current count."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            return None
+
+    def _run(self):
+        if self._fd is None:
+            while True:
+                time.sleep(POLL_SEC)
+                stamp = self._stamp()
+                if stamp != self._last:
+                    self._last = stamp
+                    self._bump()
+        while True:
+            try:
+                select.select([self._fd], [], [])
+                buf = os.read(self._fd, 65536)
+            except BlockingIOError:
+                continue
+            except OSError:
+                return
+            if any(name == self.name for _, name in parse_events(buf)):
+                self._bump()
@@ -22,6 +22,26 @@ try:
 except ImportError:
     _sync_manager = None
 
+try:
+    import sync_worker as _sync_worker
+except ImportError:
+    _sync_worker = None
+
+try:
+    import size_index as _size_index
+except ImportError:
+    _size_index = None
+
+try:
+    import sync_audit as _sync_audit
+except ImportError:
+    _sync_audit = None
+
+try:
+    import logsearch as _logsearch
+except ImportError:
+    _logsearch = None
+
 try:
     import config_schema as _config_schema
 except ImportError:
@@ -47,6 +67,8 @@ INFO_FILE = os.path.join(RUNTIME_DIR, "info_requested")     # single-tap -> show
 IDLE_REFRESH_SEC = 4
 WG_RECONCILE_SEC = 10   # how often the WireGuard auto-connect watcher re-checks
 WG_HANDSHAKE_GRACE_SEC = 45   # tolerate 'up but no handshake yet' this long before re-connecting
+SYNC_RESUME_CHECK_SEC = 30    # how often the data-cap resume watcher looks for an unmetered network
+SYNC_RESUME_RETRY_SEC = 900   # minimum gap between resume attempts (a failing resume doesn't loop)
 TITLE = "iOS Backup Machine"
 
 def load_config(path):
@@ -1047,13 +1069,20 @@ def _maybe_refresh_usbmux(logf=None, udids_seen=None):
 
 
 def _sync_running():
-    """True if a remote sync (backup-sync.py) is active — used to keep a backup
-    and a sync mutually exclusive (never run both / show both)."""
+    """True if a remote sync (backup-sync.py, or a job of the sync worker) is
+    active — used to keep a backup and a sync mutually exclusive (never run
+    both / show both)."""
+    return bool(_sync_worker and (_sync_worker.busy() or _sync_worker.slot_taken()))
+
+def _yield_audit():
+    """A backup goes first: cancel the sync worker's checksum audit if that
+    is the job it runs (it is due again later)."""
     try:
-        return subprocess.run(["pgrep", "-f", "backup-sync.py"],
-                              capture_output=True).returncode == 0
+        running = (_sync_worker.status() or {}).get("running") if _sync_worker else None
+        if running and running.get("job") == "audit":
+            _sync_worker.cancel(running["id"])
     except Exception:
-        return False
+        pass
 
 def device_allowed():
     """
@@ -1109,6 +1138,13 @@ def log_open():
     logutil.prune_logs()   # trim old per-run logs (count + age)
     return f, path
 
+def _index_logs():
+    """Bring the log search index up to date (best-effort, for a thread)."""
+    try:
+        _logsearch.update()
+    except Exception:
+        pass
+
 def check_backup_mount(logf, ui):
     """Return True if the backup folder is mounted; else show an error via the
     Animator and return False. The daemon stays alive (single EPD owner)."""
@@ -1392,6 +1428,21 @@ def run_backup(panel, logf, ui, _retry=0):
                center_block=center, show_header=False)
         ui.request_full()   # clean transition from backup progress
         if logf: logf.write(f"[OK] completed at {ts_end} usage={usage_str}\n")
+        # Bring the Backups page's size index up to date for the folder just
+        # written (only its changed subfolders are counted again).
+        if _size_index:
+            threading.Thread(target=_size_index.update_all, args=(CFG["backup_dir"],),
+                             daemon=True).start()
+        # With the checksum audit on, hash what the backup just wrote: the
+        # audit trusts only local hashes taken before it ran.
+        audit_cfg = CFG.get("sync", {}).get("audit") or {}
+        if _sync_audit and audit_cfg.get("enabled"):
+            limiter = _sync_audit.RateLimiter(
+                float(audit_cfg.get("max_mbps", _sync_audit.MAX_MBPS)) * 1e6)
+            threading.Thread(target=_sync_audit.update_all, args=(CFG["backup_dir"], limiter),
+                             daemon=True).start()
+        if _logsearch:
+            threading.Thread(target=_index_logs, daemon=True).start()
         send_notification("backup_complete", {
             "usage": usage_str, "timestamp": ts_end,
             "device": CFG.get("owner_lines", [""])[0],
@@ -1405,10 +1456,11 @@ def run_backup(panel, logf, ui, _retry=0):
         sync_cfg = CFG.get("sync", {})
         do_autosync = bool(sync_cfg.get("enabled") and sync_cfg.get("auto_sync") and _sync_manager)
         if do_autosync:
-            # Power-aware: skip auto-sync on low battery (unless charging).
+            # Power-aware: skip auto-sync on low battery (unless charging), or
+            # when the battery isn't expected to last through it.
             try:
-                import power as _power
-                _ok, _reason = _power.sync_allowed(sync_cfg.get("min_battery_percent", 35))
+                _ok, _reason = _sync_manager.admission(sync_cfg.get("min_battery_percent", 35),
+                                                       sync_cfg.get("battery_forecast", True))
             except Exception:
                 _ok, _reason = True, ""
             if not _ok:
@@ -1421,6 +1473,24 @@ def run_backup(panel, logf, ui, _retry=0):
 
         time.sleep(2)   # let the user see "Backup completed"
 
+        if do_autosync and _sync_worker:
+            # Hand the auto-sync to the sync worker when it runs: the slot is
+            # already claimed (status=syncing), and the main loop draws the
+            # worker's progress from the status file like any external sync.
+            reply = _sync_worker.enqueue("sync", source="auto-sync")
+            if reply is not None and reply.get("ok"):
+                if logf: logf.write(f"[SYNC] Auto-sync queued on the sync worker (job {reply['id']})\n")
+                return 0
+
+        _slot = None
+        if do_autosync and _sync_worker:
+            # Running here, the auto-sync takes the same slot as a worker job,
+            # so a one-shot backup-sync.py can't start over it.
+            _slot = _sync_worker.claim_slot()
+            if _slot is None:
+                if logf: logf.write("[SYNC] Skipped auto-sync: another sync is running\n")
+                do_autosync = False
+
         if do_autosync:
             # Auto-sync logs to its own sync-*.log (consistent with a manual sync),
             # not the backup log; the backup log just gets a pointer.
@@ -1445,7 +1515,9 @@ def run_backup(panel, logf, ui, _retry=0):
             def _sync_progress(info):
                 pct = info["pct"]
                 elapsed = info["elapsed"]
-                if info.get("total"):
+                if info.get("scanning") and info.get("resume_pct"):
+                    sub = f"Resuming at {info['resume_pct']}%"
+                elif info.get("total"):
                     sub = f"{fmt_bytes(info['bytes'])} / {fmt_bytes(info['total'])} | {info['speed']}"
                 else:
                     sub = f"{fmt_bytes(info['bytes'])} | {info['speed']}"
@@ -1453,7 +1525,9 @@ def run_backup(panel, logf, ui, _retry=0):
                 write_status("syncing", percent=pct,
                              bytes=info.get("bytes", 0),
                              total=info.get("total", 0),
-                             speed=info.get("speed", ""))
+                             speed=info.get("speed", ""),
+                             resume_pct=int(info.get("resume_pct", 0)),
+                             targets=info.get("targets") or {})
                 # Throttled: log only on a percent change or every 30s, so a
                 # stuck/scanning sync leaves a sparse trail (scan/stall transitions
                 # are logged separately by sync_manager) instead of a line/second.
@@ -1476,7 +1550,8 @@ def run_backup(panel, logf, ui, _retry=0):
                     send_notification("sync_complete", {"message": result["message"]})
                 else:
                     if synclogf: synclogf.write(f"[ERROR] {result['message']}\n")
-                    write_status("sync_error", message=result["message"])
+                    write_status("sync_error", message=result["message"],
+                                 paused=bool(result.get("paused")))
                     ui.set(screen="complete", subtitle="", percent=None, animate=False,
                            center_block=f"Sync failed.\n{result['message'][:60]}", show_header=True)
                     ui.request_full()
@@ -1486,9 +1561,13 @@ def run_backup(panel, logf, ui, _retry=0):
                 if synclogf: synclogf.write(f"[ERROR] sync raised: {e}\n")
                 write_status("sync_error", message=str(e))
             finally:
+                if _slot is not None:
+                    _slot.close()
                 if synclogf:
                     try: synclogf.close()
                     except Exception: pass
+                    if _logsearch:
+                        threading.Thread(target=_index_logs, daemon=True).start()
 
         return 0
     else:
@@ -1518,6 +1597,59 @@ def run_backup(panel, logf, ui, _retry=0):
         send_notification("backup_error", {"error": "Unknown error, rc!=0"})
         error_and_wait("Unknown error.\nCheck logs.", None, "rc!=0")
 
+# ---------------------------------------------------------------------------
+# Data-cap resume watcher
+# ---------------------------------------------------------------------------
+def _sync_resume_watcher(logf):
+    """Resume a sync that was paused because a metered network's monthly data
+    cap was reached (see datausage.py), as soon as the current network is
+    unmetered. Launches backup-sync.py exactly like the web UI's Sync Now, so
+    the run gets the same guards, log, status and notifications. The pause
+    marker is cleared by the sync itself on success; attempts are spaced by
+    SYNC_RESUME_RETRY_SEC so a resume that fails for another reason (server
+    down) doesn't relaunch every tick."""
+    try:
+        import datausage as _du
+    except ImportError:
+        return
+    last_attempt = 0.0
+    sync_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backup-sync.py")
+    while not SHUTDOWN.wait(SYNC_RESUME_CHECK_SEC):
+        try:
+            paused = _du.paused_info()
+            if not paused or not netutil or time.time() - last_attempt < SYNC_RESUME_RETRY_SEC:
+                continue
+            try:
+                with open(CONFIG_PATH, "r") as f:
+                    live = yaml.safe_load(f) or {}
+            except Exception:
+                live = {}
+            sync_cfg = live.get("sync", {})
+            if not sync_cfg.get("enabled"):
+                continue
+            network = netutil.network_label()
+            profile = _du.match_profile(sync_cfg.get("bandwidth_profiles") or [], network)
+            if not network or _du.is_metered(profile):
+                continue
+            try:
+                with open(STATUS_FILE, "r") as _sf:
+                    _state = json.load(_sf).get("state")
+            except Exception:
+                _state = None
+            if _backup_running or _state in ("syncing", "backing_up") or _sync_running():
+                continue
+            last_attempt = time.time()
+            if logf: logf.write(f"[SYNC] Resuming sync paused on {paused.get('network')} "
+                                f"(now on unmetered {network})\n")
+            if _sync_worker and _sync_worker.enqueue("sync", source="resume") is not None:
+                continue
+            subprocess.Popen([sys.executable, sync_script, "--no-worker"],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                             env={**os.environ, "IOSBACKUP_CONFIG": CONFIG_PATH})
+        except Exception as e:
+            if logf: logf.write(f"[SYNC] Resume watcher error: {e}\n")
+
+
 # ---------------------------------------------------------------------------
 # PiSugar button listener (single-tap → system-info screen for 30s)
 # ---------------------------------------------------------------------------
@@ -1731,6 +1863,11 @@ def main():
     wg_thread = threading.Thread(target=_wg_autoconnect_watcher, args=(logf,), daemon=True)
     wg_thread.start()
 
+    # Data-cap resume: relaunches a sync paused on a metered network once an
+    # unmetered one is up.
+    resume_thread = threading.Thread(target=_sync_resume_watcher, args=(logf,), daemon=True)
+    resume_thread.start()
+
     # Status-icon updater: samples VPN/internet/WiFi/iPhone for the on-screen icons.
     status_thread = threading.Thread(target=_status_icon_updater, args=(ui,), daemon=True)
     status_thread.start()
@@ -1779,15 +1916,9 @@ def main():
                 except Exception:
                     _age = 0
                 if _age > 60:
-                    try:
-                        _pg = subprocess.run(["pgrep", "-f", "backup-sync.py"],
-                                             capture_output=True, text=True)
-                        _alive = _pg.returncode == 0
-                    except Exception:
-                        _alive = True
-                    if not _alive:
+                    if not _sync_running():
                         if not _sync_dead_logged and logf:
-                            logf.write(f"[SYNC] backup-sync.py is gone but status stuck at 'syncing' (age={int(_age)}s); marking as failed\n")
+                            logf.write(f"[SYNC] no sync process (backup-sync.py or sync worker job) but status stuck at 'syncing' (age={int(_age)}s); marking as failed\n")
                             _sync_dead_logged = True
                         write_status("sync_error", message="Sync process died unexpectedly.")
                         _state = "sync_error"
@@ -1811,14 +1942,19 @@ def main():
                 stalled_sec = int(_st.get("stalled_seconds", 0))
                 scanning = bool(_st.get("scanning", False))
                 scan_sec = int(_st.get("scan_seconds", 0))
-                if scanning:
-                    sub = f"Syncing to remote server...\nBuilding file list ({scan_sec}s)"
+                resume_pct = int(_st.get("resume_pct", 0) or 0)
+                action = ("Restoring from remote..." if _st.get("job") == "restore"
+                          else "Syncing to remote server...")
+                if scanning and resume_pct:
+                    sub = f"Resuming at {resume_pct}%\nBuilding file list ({scan_sec}s)"
+                elif scanning:
+                    sub = f"{action}\nBuilding file list ({scan_sec}s)"
                 elif stalled:
                     sub = f"Sync STALLED\nNo progress for {stalled_sec}s ({pct}%)"
                 elif b and tot:
-                    sub = f"Syncing to remote server...\n{fmt_bytes(b)} / {fmt_bytes(tot)} | {spd}"
+                    sub = f"{action}\n{fmt_bytes(b)} / {fmt_bytes(tot)} | {spd}"
                 else:
-                    sub = "Syncing to remote server...\nPreparing..."
+                    sub = f"{action}\nPreparing..."
                 # ALWAYS set the ui state every iteration during a sync. ui.set just
                 # updates a dict (cheap) and guarantees the Animator's next 1Hz tick
                 # draws current sync state — protects against external overrides
@@ -1863,6 +1999,7 @@ def main():
             # running (and vice-versa — backup-sync.py checks for a live backup).
             # Prevents the two operations and their screens from overlapping.
             if allowed and _sync_running():
+                _yield_audit()
                 time.sleep(0.3)
                 continue
 
@@ -1909,7 +2046,8 @@ def main():
                 _last_reject_udid = None
                 if _state in ("sync_complete", "sync_error"):
                     msg = (_st.get("message", "") or "")[:60]
-                    head = "Sync complete" if _state == "sync_complete" else "Sync failed"
+                    job = "Restore" if _st.get("job") == "restore" else "Sync"
+                    head = f"{job} complete" if _state == "sync_complete" else f"{job} failed"
                     show(screen="complete", subtitle="", percent=None, animate=False,
                          center_block=f"{head}\n{msg}", show_header=True)
                 else:
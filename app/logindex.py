@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+logindex.py - Page through and search a large log without reading it whole.
+
+A sync log of a first full backup runs to tens of megabytes. The log viewer
+shows it a page of lines at a time instead: ``LineIndex`` memory-maps the
+file once to find where every line starts (an array of offsets, 8 bytes a
+line) and then reads just the lines of the page asked for.
+
+Indexes are kept per path (up to CACHE_MAX) and checked against the file's
+inode, size and mtime on every use. A log that only grew, as a running
+backup's does, is indexed on from its last line; one that was replaced or
+truncated is indexed again.
+
+``search`` runs a bytes regex over the map, so a level filter
+(``[ERROR]``, ``[STALL]``, ``[SYNC]`` ...) or a text search decodes only
+the lines that match.
+
+Import-safe: stdlib only.
+"""
+import mmap
+import os
+import re
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+PAGE_LINES = 500
+LINE_MAX = 4000                  # characters shown of one line
+CACHE_MAX = 8
+# The level tags the app writes, in the viewer's filter order.
+LEVELS = ("ERROR", "FATAL", "ABORT", "WARN", "STALL", "SYNC", "COPY", "VERIFY",
+          "AUDIT", "SNAPSHOT", "RESTORE", "NOTIFY", "INFO", "OK")
+ERROR_LEVELS = ("ERROR", "FATAL", "ABORT")
+
+
+def level_regex(levels):
+    """A bytes regex matching a ``[LEVEL]`` tag of any of ``levels``."""
+    names = "|".join(re.escape(lv) for lv in levels)
+    return re.compile(rf"\[(?:{names})\]".encode())
+
+
+def text_regex(pattern):
+    """``pattern`` (a regex, case-insensitive) compiled for bytes. Raises
+    re.error when it isn't valid."""
+    return re.compile(pattern.encode("utf-8"), re.IGNORECASE | re.MULTILINE)
+
+
+class _Map:
+    """The file mapped read-only (an empty file maps to b"")."""
+
+    def __init__(self, path):
+        self._f = open(path, "rb")
+        st = os.fstat(self._f.fileno())
+        self.stat = st
+        self.data = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self._f.close()
+
+
+class LineIndex:
+    """Start offset of every line of a log file. ``starts[-1]`` is where the
+    last (possibly unfinished) line starts, or the file size when the file
+    ends with a newline."""
+
+    def __init__(self, path):
+        self.path = path
+        self.key = None
+        self.size = 0
+        self.starts = array("Q", [0])
+        self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        return len(self.starts) - (1 if self.starts[-1] == self.size else 0)
+
+    def refresh(self):
+        """Bring the index up to date with the file. Raises OSError."""
+        with self._lock, _Map(self.path) as m:
+            st = m.stat
+            key = (st.st_ino, st.st_size, st.st_mtime_ns)
+            if key == self.key:
+                return self
+            if self.key is None or st.st_ino != self.key[0] or st.st_size < self.size:
+                self.starts = array("Q", [0])
+            starts, data, size = self.starts, m.data, st.st_size
+            pos = starts[-1]
+            find = data.find
+            while True:
+                nl = find(b"\n", pos, size)
+                if nl < 0:
+                    break
+                pos = nl + 1
+                starts.append(pos)
+            self.key, self.size = key, size
+        return self
+
+    def _line(self, data, n):
+        a = self.starts[n]
+        b = self.starts[n + 1] - 1 if n + 1 < len(self.starts) else self.size
+        text = bytes(data[a:b]).rstrip(b"\r").decode("utf-8", errors="replace")
+        return text if len(text) <= LINE_MAX else text[:LINE_MAX] + " [...]"
+
+    def lines(self, start, count=PAGE_LINES):
+        """[(line number, text)] of ``count`` lines from ``start`` (0-based)."""
+        start = max(0, start)
+        end = min(self.count, start + count)
+        if start >= end:
+            return []
+        with self._lock, _Map(self.path) as m:
+            if m.stat.st_size < self.size:          # truncated since the refresh
+                return []
+            return [(n, self._line(m.data, n)) for n in range(start, end)]
+
+    def line_of(self, offset):
+        """The line number holding byte ``offset``."""
+        return max(0, bisect_right(self.starts, offset) - 1)
+
+    def search(self, regex, also=None, start=0, limit=PAGE_LINES):
+        """Lines from ``start`` on where ``regex`` matches (and ``also``, when
+        given, matches too), at most ``limit`` of them: ([(line number,
+        text)], whether there are more)."""
+        found = []
+        start = max(0, start)
+        if start >= self.count:
+            return found, False
+        with self._lock, _Map(self.path) as m:
+            data, size = m.data, min(self.size, m.stat.st_size)
+            pos = self.starts[start]
+            while pos < size:
+                hit = regex.search(data, pos, size)
+                if hit is None:
+                    break
+                n = self.line_of(hit.start())
+                pos = self.starts[n + 1] if n + 1 < len(self.starts) else size
+                if also is not None and also.search(data, self.starts[n], pos) is None:
+                    continue
+                if len(found) == limit:
+                    return found, True
+                found.append((n, self._line(data, n)))
+        return found, False
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def index(path):
+    """The up-to-date LineIndex of ``path`` (cached). Raises OSError."""
+    path = os.path.abspath(path)
+    with _cache_lock:
+        idx = _cache.pop(path, None) or LineIndex(path)
+        _cache[path] = idx
+        while len(_cache) > CACHE_MAX:
+            _cache.popitem(last=False)
+    return idx.refresh()
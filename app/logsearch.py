@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+logsearch.py - Full-text search over every per-run log.
+
+"When did error 208 last happen" or "which syncs stalled" used to mean
+opening backup-*.log and sync-*.log files one by one. This keeps an SQLite
+FTS5 index of their lines in state/logsearch.db:
+
+- ``logs``: one row per log file (name, inode, bytes and lines indexed);
+- ``lines``: an FTS5 table of the line texts. A line's rowid is the log's id
+  shifted left 32 bits plus its line number, so the hits of a log and the
+  lines around a hit are rowid ranges, and a log's lines are deleted as one.
+
+``update`` indexes what was appended to each log since the last time (only
+complete lines; a log that was rotated or truncated is indexed again) and
+forgets logs that are gone. It runs before every search, so a search also
+finds the running backup's or sync's latest lines, and after each sync run.
+``logutil.prune_logs`` calls ``forget`` for the logs it deletes.
+
+Every indexer takes the database's write lock per log (BEGIN IMMEDIATE), so
+the web UI, the sync worker and the backup daemon can update it at the same
+time without indexing a line twice.
+
+Import-safe: stdlib only.
+"""
+import os
+import re
+import sqlite3
+
+import logutil
+
+DB_NAME = "logsearch.db"
+KINDS = ("backup-", "sync-")
+LINE_MAX = 4000                  # characters indexed of one line
+CONTEXT = 2                      # lines shown before and after a hit
+HIT = ("\x02", "\x03")           # highlight() markers around matched terms
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS logs (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    ino INTEGER,
+    offset INTEGER NOT NULL DEFAULT 0,
+    lines INTEGER NOT NULL DEFAULT 0,
+    mtime REAL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS lines USING fts5(text, tokenize='unicode61');
+"""
+
+
+def connect(path=None):
+    """A connection to the index, created if needed."""
+    conn = sqlite3.connect(path or logutil.state_path(DB_NAME), timeout=30,
+                           isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _rowid(log_id, line):
+    return (log_id << 32) | line
+
+
+def _drop(conn, log_id):
+    conn.execute("DELETE FROM lines WHERE rowid BETWEEN ? AND ?",
+                 (_rowid(log_id, 0), _rowid(log_id, 0xFFFFFFFF)))
+
+
+def _log_files(log_dir):
+    try:
+        names = os.listdir(log_dir)
+    except OSError:
+        return {}
+    return {n: os.path.join(log_dir, n) for n in names
+            if n.endswith(".log") and n.startswith(KINDS)}
+
+
+def _index_file(conn, name, path):
+    """Index what was appended to ``path`` since the last time; the number
+    of lines added."""
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return 0
+    with f:
+        st = os.fstat(f.fileno())
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT id, ino, offset, lines FROM logs WHERE name = ?",
+                               (name,)).fetchone()
+            if row is None:
+                log_id = conn.execute("INSERT INTO logs (name, ino, mtime) VALUES (?, ?, ?)",
+                                      (name, st.st_ino, st.st_mtime)).lastrowid
+                offset = line = 0
+            else:
+                log_id, ino, offset, line = row
+                if ino != st.st_ino or st.st_size < offset:       # rotated or truncated
+                    _drop(conn, log_id)
+                    offset = line = 0
+            f.seek(offset)
+            data = f.read(st.st_size - offset)
+            data = data[:data.rfind(b"\n") + 1]                   # complete lines only
+            rows = []
+            for raw in data.splitlines():
+                text = raw.decode("utf-8", errors="replace")[:LINE_MAX]
+                rows.append((_rowid(log_id, line), text))
+                line += 1
+            conn.executemany("INSERT INTO lines (rowid, text) VALUES (?, ?)", rows)
+            conn.execute("UPDATE logs SET ino = ?, offset = ?, lines = ?, mtime = ? WHERE id = ?",
+                         (st.st_ino, offset + len(data), line, st.st_mtime, log_id))
+            conn.execute("COMMIT")
+            return len(rows)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def forget(names, conn=None):
+    """Drop the logs ``names`` (file names) from the index."""
+    own = conn is None
+    conn = conn or connect()
+    try:
+        for name in names:
+            row = conn.execute("SELECT id FROM logs WHERE name = ?", (name,)).fetchone()
+            if row:
+                conn.execute("BEGIN IMMEDIATE")
+                _drop(conn, row[0])
+                conn.execute("DELETE FROM logs WHERE id = ?", (row[0],))
+                conn.execute("COMMIT")
+    finally:
+        if own:
+            conn.close()
+
+
+def update(log_dir=None, conn=None):
+    """Bring the index up to date with the per-run logs in ``log_dir``: the
+    number of lines added."""
+    log_dir = logutil.LOG_DIR if log_dir is None else log_dir
+    own = conn is None
+    conn = conn or connect()
+    try:
+        files = _log_files(log_dir)
+        known = {name: (offset, mtime) for name, offset, mtime
+                 in conn.execute("SELECT name, offset, mtime FROM logs")}
+        forget([n for n in known if n not in files], conn)
+        added = 0
+        stats = {}
+        for name, path in files.items():
+            try:
+                stats[name] = os.stat(path)
+            except OSError:
+                pass
+        # Oldest first, so a new log gets a higher id than the logs before it.
+        for name in sorted(stats, key=lambda n: stats[n].st_mtime):
+            st, path = stats[name], files[name]
+            if name in known and known[name] == (st.st_size, st.st_mtime):
+                continue
+            added += _index_file(conn, name, path)
+        return added
+    finally:
+        if own:
+            conn.close()
+
+
+def _segments(text):
+    """[(text, is a match)] of a highlight()ed line."""
+    out = []
+    for i, part in enumerate(re.split("[\x02\x03]", text)):
+        if part:
+            out.append((part, i % 2 == 1))
+    return out
+
+
+def _fts_query(query):
+    """The words of ``query``, each quoted: what is searched for when
+    ``query`` isn't valid FTS5 syntax (``error-208``, ``sync:``)."""
+    words = re.findall(r"\w+", query)
+    return " ".join(f'"{w}"' for w in words)
+
+
+def search(query, limit=50, order="rank", conn=None, context=CONTEXT):
+    """Lines matching ``query`` (FTS5 syntax, or plain words), best first
+    (``order="rank"``) or newest first (``"newest"``; log ids follow the
+    logs' age, see ``update``): [{"log", "line" (0-based), "segments",
+    "before", "after"}], and whether there are more."""
+    if not query.strip():
+        return [], False
+    own = conn is None
+    conn = conn or connect()
+    try:
+        sort = "rank" if order == "rank" else "rowid DESC"
+        sql = (f"SELECT rowid, highlight(lines, 0, ?, ?) FROM lines "
+               f"WHERE lines MATCH ? ORDER BY {sort} LIMIT ?")
+        try:
+            rows = conn.execute(sql, (*HIT, query, limit + 1)).fetchall()
+        except sqlite3.OperationalError:
+            fallback = _fts_query(query)
+            if not fallback:
+                return [], False
+            rows = conn.execute(sql, (*HIT, fallback, limit + 1)).fetchall()
+        names = dict(conn.execute("SELECT id, name FROM logs"))
+        hits = []
+        for rowid, text in rows[:limit]:
+            near = dict(conn.execute(
+                "SELECT rowid, text FROM lines WHERE rowid BETWEEN ? AND ?",
+                (max(rowid - context, rowid & ~0xFFFFFFFF), rowid + context)))
+            hits.append({
+                "log": names.get(rowid >> 32, ""), "line": rowid & 0xFFFFFFFF,
+                "segments": _segments(text),
+                "before": [near[r] for r in range(rowid - context, rowid) if r in near],
+                "after": [near[r] for r in range(rowid + 1, rowid + context + 1) if r in near],
+            })
+        return hits, len(rows) > limit
+    finally:
+        if own:
+            conn.close()
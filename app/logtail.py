@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+logtail.py - Read what was appended to a log since a byte offset.
+
+The live log view used to fetch the whole log page every 2 seconds; now it
+keeps the byte offset it has read up to and the log file's inode, and asks
+only for what follows (``/api/logs/<name>/tail``). ``read_tail`` handles the
+file changing under it:
+
+- rotated or re-created (a different inode), or truncated (shorter than the
+  offset): the reply is marked ``reset`` and carries the end of the new file,
+  which replaces what the page shows;
+- more than ``limit`` bytes appended since the offset: only the last
+  ``limit`` bytes are returned, starting at a line, and ``skipped`` says how
+  many were left out;
+- a line still being written: held back until its end arrives, so a line
+  (or a UTF-8 character) is never split across two replies.
+
+Import-safe: stdlib only.
+"""
+import os
+
+TAIL_MAX = 256 * 1024            # bytes per reply
+
+
+def _line_start(raw):
+    """Index just past the first line end in ``raw`` (0 if none)."""
+    ends = [i for i in (raw.find(b"\n"), raw.find(b"\r")) if i >= 0]
+    return min(ends) + 1 if ends else 0
+
+
+def _complete(raw):
+    """Length of ``raw`` up to and including its last line end (0 if none)."""
+    return max(raw.rfind(b"\n"), raw.rfind(b"\r")) + 1
+
+
+def read_tail(path, offset=None, inode=None, limit=TAIL_MAX):
+    """What was appended to ``path`` after byte ``offset`` of the file with
+    ``inode``: {"data", "offset", "inode", "reset", "skipped"}, where
+    ``offset`` is where the next call continues. ``offset`` None (or an
+    inode that isn't the file's anymore) starts over from the end of the
+    file. Raises OSError when the file can't be read."""
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        reset = (offset is None or offset < 0 or offset > st.st_size
+                 or (inode is not None and inode != st.st_ino))
+        pos = 0 if reset else offset
+        skipped = 0
+        if st.st_size - pos > limit:
+            skipped = st.st_size - limit - pos
+            pos = st.st_size - limit
+        f.seek(pos)
+        raw = f.read(st.st_size - pos)
+    if skipped:
+        cut = _line_start(raw)
+        skipped += cut
+        pos += cut
+        raw = raw[cut:]
+    # A line still being written waits for the next call, unless it alone
+    # fills a reply.
+    if len(raw) < limit:
+        raw = raw[:_complete(raw)]
+    return {"data": raw.decode("utf-8", errors="replace"), "offset": pos + len(raw),
+            "inode": st.st_ino, "reset": reset, "skipped": skipped}
@@ -9,6 +9,10 @@ Two directories, split by lifetime:
   compressed RAM disk synced to disk only periodically by armbian-ramlog) loses
   anything written since the last sync. The logs live here instead.
 
+- STATE_DIR (persistent, under LOG_DIR): small app state that must outlive a
+  reboot but is not a log — sync history, checkpoints, indexes. A subdirectory,
+  so the log viewer's ``*.log`` globs and Purge never touch it.
+
 - RUNTIME_DIR (volatile, zram-backed /var/log): high-frequency throwaway IPC
   (backup_status.json, start_requested, stop_requested). Status is rewritten on
   every progress tick, so keeping it in RAM avoids SD-card wear, and it is
@@ -25,6 +29,8 @@ from datetime import datetime
 
 # Persistent: survives reboots and power loss.
 LOG_DIR = os.getenv("IOSBACKUP_LOG_DIR", "/var/lib/iosbackupmachine")
+# Persistent app state (not logs). Create it with state_path().
+STATE_DIR = os.getenv("IOSBACKUP_STATE_DIR", os.path.join(LOG_DIR, "state"))
 # Volatile: zram-backed, cleared each boot. Throwaway runtime IPC only.
 RUNTIME_DIR = os.getenv("IOSBACKUP_RUNTIME_DIR", "/var/log/iosbackupmachine")
 
@@ -34,6 +40,12 @@ LOG_MAX_AGE_DAYS = int(os.getenv("IOSBACKUP_LOG_MAX_AGE_DAYS", "90"))
 _PRUNE_PREFIXES = ("backup-", "sync-")
 
 
+def state_path(name):
+    """Path of ``name`` inside STATE_DIR, creating the directory if needed."""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    return os.path.join(STATE_DIR, name)
+
+
 class TimestampedLog:
     """Line-timestamping wrapper around a text log file.
 
@@ -97,12 +109,14 @@ def open_run_log(path, mode="a"):
 def prune_logs(log_dir=None, keep_per_kind=None, max_age_days=None):
     """Delete old per-run logs: keep the newest ``keep_per_kind`` of each kind
     (backup / sync) and drop anything older than ``max_age_days``. The freshly
-    created log sorts newest, so it is always kept. Best-effort; never raises."""
+    created log sorts newest, so it is always kept. Deleted logs are dropped
+    from the log search index too. Best-effort; never raises."""
     log_dir = LOG_DIR if log_dir is None else log_dir
     keep_per_kind = LOG_KEEP_PER_KIND if keep_per_kind is None else keep_per_kind
     max_age_days = LOG_MAX_AGE_DAYS if max_age_days is None else max_age_days
     now = time.time()
     max_age = max_age_days * 86400
+    removed = []
     for prefix in _PRUNE_PREFIXES:
         try:
             files = glob.glob(os.path.join(log_dir, f"{prefix}*.log"))
@@ -115,5 +129,14 @@ def prune_logs(log_dir=None, keep_per_kind=None, max_age_days=None):
                 too_old = max_age_days > 0 and (now - os.path.getmtime(path)) > max_age
                 if too_many or too_old:
                     os.remove(path)
+                    removed.append(os.path.basename(path))
             except Exception:
                 pass
+    if removed and log_dir == LOG_DIR:
+        # Drop them from the log search index too (imported here: logsearch
+        # imports this module).
+        try:
+            import logsearch
+            logsearch.forget(removed)
+        except Exception:
+            pass
@@ -29,17 +29,19 @@ def get_all_interfaces():
         pass
     return result
 
-def get_wifi_ip():
-    """Return the first WiFi IP found, or None."""
-    ifaces = get_all_interfaces()
+def get_wifi_ip(ifaces=None):
+    """Return the first WiFi IP found, or None. ``ifaces`` is a
+    get_all_interfaces() result to reuse."""
+    ifaces = get_all_interfaces() if ifaces is None else ifaces
     for wif in WIFI_IFACES:
         if wif in ifaces and ifaces[wif]:
             return ifaces[wif][0]
     return None
 
-def get_usb_iphone_ip():
-    """Return the first USB iPhone hotspot IP found, or None."""
-    ifaces = get_all_interfaces()
+def get_usb_iphone_ip(ifaces=None):
+    """Return the first USB iPhone hotspot IP found, or None. ``ifaces`` is a
+    get_all_interfaces() result to reuse."""
+    ifaces = get_all_interfaces() if ifaces is None else ifaces
     for uif in USB_IPHONE_IFACES:
         for name, ips in ifaces.items():
             if name == uif or name.startswith(uif):
@@ -108,16 +110,69 @@ def get_wireguard_ip(iface="wg0"):
     ips = ifaces.get(iface, [])
     return ips[0] if ips else None
 
-def get_active_ip():
+def get_active_ip(ifaces=None):
     """Return (ip, interface_type) for the first active network connection."""
-    wifi = get_wifi_ip()
+    ifaces = get_all_interfaces() if ifaces is None else ifaces
+    wifi = get_wifi_ip(ifaces)
     if wifi:
         return wifi, "wifi"
-    usb = get_usb_iphone_ip()
+    usb = get_usb_iphone_ip(ifaces)
     if usb:
         return usb, "usb_iphone"
     return None, None
 
+def get_addresses():
+    """{"active": (ip, interface_type), "wifi": ip, "usb_iphone": ip} from a
+    single ``ip addr`` call."""
+    ifaces = get_all_interfaces()
+    return {"active": get_active_ip(ifaces), "wifi": get_wifi_ip(ifaces),
+            "usb_iphone": get_usb_iphone_ip(ifaces)}
+
+def network_label():
+    """Short key for the uplink a sync would use right now: ``wifi:<ssid>``
+    (``wifi`` if the SSID is unknown), ``usb_iphone``, or None when offline.
+    Sync history and per-network policies are keyed by it."""
+    if get_wifi_ip():
+        ssid = get_wifi_ssid()
+        return f"wifi:{ssid}" if ssid else "wifi"
+    if get_usb_iphone_ip():
+        return "usb_iphone"
+    return None
+
+def uplink_interface(label=None):
+    """Physical interface behind a ``network_label()`` (the one the carrier
+    bills), e.g. ``wlan0`` or ``usb0``. None if it can't be determined."""
+    label = network_label() if label is None else label
+    if not label:
+        return None
+    ifaces = get_all_interfaces()
+    if label.startswith("wifi"):
+        for wif in WIFI_IFACES:
+            if ifaces.get(wif):
+                return wif
+    elif label == "usb_iphone":
+        for uif in USB_IPHONE_IFACES:
+            for name, ips in ifaces.items():
+                if (name == uif or name.startswith(uif)) and ips:
+                    return name
+    return None
+
+def read_net_dev(path="/proc/net/dev"):
+    """Return {iface: (rx_bytes, tx_bytes)} from /proc/net/dev ({} on error)."""
+    counters = {}
+    try:
+        with open(path, "r") as f:
+            lines = f.readlines()[2:]          # two header lines
+        for line in lines:
+            if ":" not in line:
+                continue
+            name, data = line.split(":", 1)
+            fields = data.split()
+            counters[name.strip()] = (int(fields[0]), int(fields[8]))
+    except Exception:
+        pass
+    return counters
+
 def get_interface_ip(iface_name):
     """Return the IP of a specific interface, or None."""
     ifaces = get_all_interfaces()
@@ -72,14 +72,25 @@ def is_charging():
     return val.strip().lower() in ("true", "1", "yes")
 
 
+def on_mains():
+    """True/False if it is known whether external power is plugged in (a full
+    battery on mains no longer reports charging), else None."""
+    val = _parse_value(_query("get battery_power_plugged"), "battery_power_plugged")
+    if val is None:
+        return is_charging()
+    return val.strip().lower() in ("true", "1", "yes")
+
+
 def get_battery():
     """Return ``{'percent': float|None, 'charging': bool|None}``."""
     return {"percent": get_battery_percent(), "charging": is_charging()}
 
 
-def sync_allowed(threshold, battery=None):
+def sync_allowed(threshold, battery=None, need_pct=0):
     """Decide whether a sync may run given a battery ``threshold`` percent.
 
+    ``need_pct`` is the battery the sync is expected to use (see
+    sync_estimate); it is refused when it would end below ``threshold``.
     Returns ``(allowed: bool, reason: str)``. Fail-open: an unreadable battery
     or an active charge always allows the sync.
     """
@@ -93,4 +104,7 @@ def sync_allowed(threshold, battery=None):
         return True, ""              # plugged in — fine to run
     if pct < threshold:
         return False, f"Battery low ({pct:.0f}% < {threshold:g}%)."
+    if need_pct and pct - need_pct < threshold:
+        return False, (f"Battery too low to finish the sync ({pct:.0f}% now, "
+                       f"it needs about {need_pct:.0f}% and stops at {threshold:g}%).")
     return True, ""
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+probes.py - Run slow status probes side by side, and share their results.
+
+/api/health asks a dozen things that each take a process spawn, a socket
+round trip or a network timeout: systemctl for every unit, the PiSugar
+battery, ``ip addr``, the WiFi SSID (up to three tools), the internet check,
+``wg show``, a scan of the backup disk. Run one after the other their
+worst cases add up to tens of seconds.
+
+- ``run`` starts every probe at once on its own thread and waits for each
+  until its own deadline. A probe that is late or raises gives its fallback
+  value; the report says which and how long each one took. A late probe's
+  thread is left to finish, and while it runs no other thread is started for
+  that probe: the next ``run`` waits on the same call. A hung tool holds one
+  thread, however often /api/health is asked.
+- ``Shared`` keeps a collection's result for ``ttl`` seconds and lets only one
+  collection run at a time: callers that arrive while one is in flight wait
+  for it and get the same result, so N monitors polling at once cost one
+  collection.
+
+Import-safe: stdlib only.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+
+class Probe:
+    """``fn()`` with a ``deadline`` (seconds) and the ``fallback`` value used
+    when it is late or fails."""
+
+    def __init__(self, fn, deadline, fallback=None):
+        self.fn = fn
+        self.deadline = deadline
+        self.fallback = fallback
+
+
+def _timed(fn):
+    t = time.monotonic()
+    value = fn()
+    return value, time.monotonic() - t
+
+
+_inflight = {}                    # probe name -> Future of its running call
+_inflight_lock = threading.Lock()
+
+
+def run(probes):
+    """Run ``probes`` ({name: Probe}) concurrently: ({name: value},
+    {name: {"ms", "status" ("ok" | "timeout" | "error")}}). Returns by the
+    latest deadline. Names identify probes across calls: a probe whose
+    previous call is still running is not started again, its result is
+    awaited instead."""
+    values, timings = {}, {}
+    if not probes:
+        return values, timings
+    start = time.monotonic()
+    futures = {}
+    with _inflight_lock:
+        fresh = [name for name in probes
+                 if name not in _inflight or _inflight[name].done()]
+        if fresh:
+            pool = ThreadPoolExecutor(max_workers=len(fresh), thread_name_prefix="probe")
+            for name in fresh:
+                _inflight[name] = pool.submit(_timed, probes[name].fn)
+            pool.shutdown(wait=False)
+        for name in probes:
+            futures[name] = _inflight[name]
+    for name, fut in futures.items():
+        p = probes[name]
+        try:
+            values[name], took = fut.result(timeout=max(0, start + p.deadline - time.monotonic()))
+            status = "ok"
+        except FutureTimeout:
+            values[name], took, status = p.fallback, time.monotonic() - start, "timeout"
+        except Exception:
+            values[name], took, status = p.fallback, time.monotonic() - start, "error"
+        timings[name] = {"ms": round(took * 1000, 1), "status": status}
+    return values, timings
+
+
+class Shared:
+    """``fn()``'s result, collected at most once per ``ttl`` seconds and by
+    one caller at a time (single flight)."""
+
+    def __init__(self, fn, ttl):
+        self.fn = fn
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._value = None
+        self._at = None
+        self._flight = None
+
+    def get(self):
+        """(value, age in seconds). Raises what ``fn`` raised, to every
+        caller that waited for that collection."""
+        with self._lock:
+            if self._at is not None and time.monotonic() - self._at < self.ttl:
+                return self._value, time.monotonic() - self._at
+            flight = self._flight
+            if flight is None:
+                flight = self._flight = {"done": threading.Event(), "value": None, "error": None}
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            flight["done"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["value"], 0.0
+        try:
+            flight["value"] = self.fn()
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self._lock:
+                if flight["error"] is None:
+                    self._value, self._at = flight["value"], time.monotonic()
+                self._flight = None
+            flight["done"].set()
+        return flight["value"], 0.0
+
+    def clear(self):
+        with self._lock:
+            self._at = None
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+sync_audit.py - Checksum audit of the remote copy of each device backup.
+
+rsync's quick check (size + mtime) never looks at the bytes again once a file
+is on the server, so a file that rots there stays rotten. The audit compares
+content hashes instead:
+
+- a local hash index per device folder (state/hash_index/<device>.json)
+  keeps each file's SHA-256 with the size and mtime it had when it was hashed.
+  A refresh hashes only files that are new or changed since, so the hashes of
+  a backup's files are the ones taken of the files the backup wrote;
+- the server hashes its copy with ``sha256sum`` (``shasum -a 256`` where
+  there is none) at idle CPU and I/O priority, fed file lists over the sync's
+  SSH connection, in AUDIT_SHARDS parallel shards split by the backup's
+  two-hex-digit subfolders;
+- the daemon refreshes the index after each backup (``update_all``); a file
+  whose remote hash differs is hashed locally again. If the local file still
+  matches an index entry older than this audit it is good and is sent again
+  (rsync --ignore-times); if it doesn't, it is the local copy that changed,
+  and if the entry was only made by this audit nothing vouches for the local
+  copy, so both are only reported;
+- local and remote hashing share one rate limit (``max_mbps``) so an audit
+  can run overnight without starving anything, and a run of the audit is
+  recorded in state/sync_audit.json.
+
+The sync worker runs it as its ``audit`` job; ``due`` says when the schedule
+in ``sync.audit`` wants the next one.
+
+Import-safe: stdlib only, so it can be unit-tested on any machine.
+"""
+import hashlib
+import json
+import os
+import shlex
+import threading
+import time
+
+import logutil
+import sync_checkpoint
+
+HISTORY_FILE = "sync_audit.json"
+HISTORY_KEEP = 50
+INDEX_DIR = "hash_index"
+AUDIT_SHARDS = 4
+MAX_MBPS = 20                    # default combined hashing rate (MB/s)
+BATCH_BYTES = 64 * 1024 * 1024   # files per remote hashing command, by size
+BATCH_FILES = 2000
+REPORT_MAX = 20                  # file names kept per finding in the history
+RETRY_SEC = 3600                 # after an audit that did not finish
+READ_SIZE = 1024 * 1024
+
+# The hashing helper run on the server: idle priority, and the coreutils tool
+# or the Perl one macOS and the BSDs ship. File names arrive NUL-separated on
+# stdin, relative to the device folder.
+_REMOTE_HASH = ('if command -v sha256sum >/dev/null 2>&1; then H=sha256sum; else H="shasum -a 256"; fi; '
+                'P=""; command -v ionice >/dev/null 2>&1 && P="ionice -c3"; '
+                'cd {root} && xargs -0 -r $P nice -n 19 $H --')
+
+
+class RateLimiter:
+    """Caps the bytes/s of everything that ``consume``s from it, across
+    threads: a caller that got ahead sleeps until it is back on the rate."""
+
+    def __init__(self, rate_bps, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate_bps
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._next = clock()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+        with self._lock:
+            now = self.clock()
+            start = max(self._next, now)
+            self._next = start + nbytes / self.rate
+            wait = start - now
+        if wait > 0:
+            self.sleep(wait)
+
+
+# --- Local hash index -----------------------------------------------------------
+
+def _index_path(device):
+    directory = logutil.state_path(INDEX_DIR)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{device}.json")
+
+
+def load_index(device, path=None):
+    """{rel: [size, mtime_ns, sha256]} of a device folder, or {}."""
+    try:
+        with open(path or _index_path(device), "r") as f:
+            data = json.load(f)
+        return data.get("files") or {}
+    except Exception:
+        return {}
+
+
+def save_index(device, files, path=None):
+    path = path or _index_path(device)
+    tmp = f"{path}.tmp.{os.getpid()}"
+    try:
+        with open(tmp, "w") as f:
+            json.dump({"files": files, "updated": int(time.time())}, f)
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def hash_file(path, limiter=None):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            if limiter:
+                limiter.consume(len(chunk))
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def refresh_index(folder, files, limiter=None, cancel=None):
+    """Bring ``files`` (load_index) up to date with ``folder``: hash what is
+    new or changed, drop what is gone. Returns (files, hashed_count,
+    hashed_bytes); stops early, leaving the rest unhashed, once ``cancel``
+    is set."""
+    seen = {}
+    hashed = hashed_bytes = 0
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            entries = list(os.scandir(os.path.join(folder, rel_dir)))
+        except OSError:
+            continue
+        for entry in entries:
+            rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(rel)
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            old = files.get(rel)
+            if old and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+                seen[rel] = old
+                continue
+            if cancel is not None and cancel.is_set():
+                continue
+            try:
+                seen[rel] = [st.st_size, st.st_mtime_ns, hash_file(entry.path, limiter)]
+            except OSError:
+                continue
+            hashed += 1
+            hashed_bytes += st.st_size
+    return seen, hashed, hashed_bytes
+
+
+def update_all(backup_dir, limiter=None):
+    """``refresh_index`` every device folder of ``backup_dir`` right after a
+    backup wrote it, so an audit finds the hashes of the files the backup
+    wrote rather than taking them itself from a copy that may have changed
+    since. Never raises."""
+    for device in sync_checkpoint.list_shards(backup_dir):
+        try:
+            files, hashed, _ = refresh_index(os.path.join(backup_dir, device),
+                                             load_index(device), limiter)
+            if hashed or not os.path.exists(_index_path(device)):
+                save_index(device, files)
+        except Exception:
+            pass
+
+
+# --- Remote hashing -------------------------------------------------------------
+
+def shard_of(rel, shards):
+    """Shard of a file: by its two-hex-digit subfolder, so each shard reads
+    whole directories; top-level files go to shard 0."""
+    top, sep, _ = rel.partition("/")
+    if not sep:
+        return 0
+    try:
+        return int(top, 16) % shards
+    except ValueError:
+        return sum(top.encode()) % shards
+
+
+def batches(rels, sizes, max_bytes=BATCH_BYTES, max_files=BATCH_FILES):
+    """Split ``rels`` into lists of at most ``max_bytes`` / ``max_files``."""
+    out, cur, cur_bytes = [], [], 0
+    for rel in rels:
+        size = sizes.get(rel, 0)
+        if cur and (cur_bytes + size > max_bytes or len(cur) >= max_files):
+            out.append(cur)
+            cur, cur_bytes = [], 0
+        cur.append(rel)
+        cur_bytes += size
+    if cur:
+        out.append(cur)
+    return out
+
+
+def remote_hash_command(root):
+    return _REMOTE_HASH.format(root=shlex.quote(root))
+
+
+def parse_sums(text):
+    """``sha256sum`` output -> {rel: digest}. Names sha256sum had to escape
+    (a leading backslash) are unescaped."""
+    sums = {}
+    for line in text.splitlines():
+        escaped = line.startswith("\\")
+        if escaped:
+            line = line[1:]
+        digest, sep, name = line.partition("  ")
+        if not sep or len(digest) != 64:
+            continue
+        if escaped:
+            name = name.replace("\\n", "\n").replace("\\\\", "\\")
+        if name.startswith("./"):
+            name = name[2:]
+        sums[name] = digest.lower()
+    return sums
+
+
+def compare(files, sums, rels):
+    """(mismatched, missing) among ``rels`` of the index ``files``."""
+    mismatched, missing = [], []
+    for rel in rels:
+        got = sums.get(rel)
+        if got is None:
+            missing.append(rel)
+        elif got != files[rel][2]:
+            mismatched.append(rel)
+    return mismatched, missing
+
+
+# --- History and schedule -------------------------------------------------------
+
+def _history_path():
+    return logutil.state_path(HISTORY_FILE)
+
+
+def load_history(path=None):
+    try:
+        with open(path or _history_path(), "r") as f:
+            data = json.load(f)
+        return data if isinstance(data, list) else []
+    except Exception:
+        return []
+
+
+def record(entry, path=None):
+    """Append an audit run to the history (newest HISTORY_KEEP kept)."""
+    path = path or _history_path()
+    tmp = f"{path}.tmp.{os.getpid()}"
+    try:
+        runs = load_history(path)
+        runs.append({"ts": int(time.time()), **entry})
+        with open(tmp, "w") as f:
+            json.dump(runs[-HISTORY_KEEP:], f)
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def _in_window(window, now):
+    """``window`` "HH:MM-HH:MM" (may wrap past midnight) contains ``now``."""
+    try:
+        start, end = ((int(h) * 60 + int(m)) for h, m in
+                      (part.split(":") for part in window.split("-")))
+    except ValueError:
+        return False
+    t = time.localtime(now)
+    minute = t.tm_hour * 60 + t.tm_min
+    return start <= minute < end if start <= end else minute >= start or minute < end
+
+
+def due(audit_cfg, history, now=None, charging=None):
+    """Whether the schedule in ``sync.audit`` wants an audit now: enabled,
+    inside its window, on mains power (unless ``require_mains`` is off) and
+    no complete audit within ``interval_days``. An audit that did not finish
+    is retried after RETRY_SEC."""
+    now = time.time() if now is None else now
+    if not audit_cfg.get("enabled"):
+        return False
+    if not _in_window(audit_cfg.get("window", "01:00-05:00"), now):
+        return False
+    if audit_cfg.get("require_mains", True) and charging is not True:
+        return False
+    last = max((r.get("ts", 0) for r in history if r.get("complete")), default=0)
+    tried = max((r.get("ts", 0) for r in history), default=0)
+    return (now - last >= float(audit_cfg.get("interval_days", 7)) * 86400
+            and now - tried >= RETRY_SEC)
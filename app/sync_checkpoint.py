@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+sync_checkpoint.py - Which device folders each sync target already holds, and
+at which backup generation.
+
+A sync is split into shards, one per complete device folder of backup_dir
+(one per UDID), each sent by its own rsync. When a shard's rsync exits 0 it
+is recorded here, per target, with the shard's *generation ID* (see
+``generation_id``). The next run skips, for that target, every shard whose
+generation still matches and was confirmed within FULL_VERIFY_SEC:
+
+- a run cut short (battery, stall, scan timeout, power loss) resumes with the
+  shards it had not finished, and reports where it resumed;
+- a device that wasn't backed up since the last sync costs no rsync at all,
+  which is what keeps fanning out to several targets cheap. Once a week every
+  shard is sent again, so a target that lost data is repaired.
+
+``plan_targets`` does the local scan (generation IDs, and sizes for progress)
+once and derives each target's remaining work from it, and ``file_list`` is
+the one walk of a device folder that every target sending it shares. Records
+are keyed by target, so pointing sync at another server starts from scratch.
+
+Import-safe: stdlib only, so it can be unit-tested on any machine.
+"""
+import os
+import json
+import time
+import hashlib
+import plistlib
+import threading
+
+import logutil
+
+CHECKPOINT_FILE = "sync_checkpoint.json"
+# A confirmed shard is re-sent after this long even if unchanged locally.
+FULL_VERIFY_SEC = 7 * 86400
+
+# Files idevicebackup2 rewrites at the end of every backup of a device.
+_GENERATION_FILES = ("Status.plist", "Manifest.plist", "Manifest.db")
+
+_lock = threading.Lock()
+
+
+def _checkpoint_path():
+    return logutil.state_path(CHECKPOINT_FILE)
+
+
+def generation_id(folder):
+    """Identify the backup generation in a device folder.
+
+    Hashes Status.plist (it carries the backup's UUID and date) together with
+    the size and mtime of the manifests, so any new or partial backup of the
+    device changes it. None if the folder has none of those files."""
+    h = hashlib.sha1()
+    found = False
+    for name in _GENERATION_FILES:
+        path = os.path.join(folder, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        found = True
+        h.update(f"{name}:{st.st_size}:{st.st_mtime_ns};".encode())
+        if name == "Status.plist":
+            try:
+                with open(path, "rb") as f:
+                    h.update(f.read())
+            except OSError:
+                pass
+    return h.hexdigest()[:16] if found else None
+
+
+def backup_state(folder):
+    """State of an idevicebackup2 device folder, as the Backups page shows it:
+    "complete" (Manifest.plist present and Status.plist not mid-upload),
+    "backing_up" (SnapshotState "uploading") or "interrupted" (no manifest)."""
+    snapshot_state = ""
+    try:
+        with open(os.path.join(folder, "Status.plist"), "rb") as fp:
+            snapshot_state = plistlib.load(fp).get("SnapshotState", "")
+    except Exception:
+        pass
+    if snapshot_state == "uploading":
+        return "backing_up"
+    if os.path.exists(os.path.join(folder, "Manifest.plist")):
+        return "complete"
+    return "interrupted"
+
+
+def tree_size(path):
+    """Apparent size in bytes of everything under ``path`` (scandir walk)."""
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+    return total
+
+
+_sizes = {}                       # folder -> (generation, tree_size)
+_sizes_lock = threading.Lock()
+
+
+def _generation_size(folder, gen):
+    """``tree_size(folder)``, walked once per backup generation ``gen`` (every
+    time when it is None): until a target confirms the folder, each plan, such
+    as the web UI's sync estimate, would walk it again."""
+    with _sizes_lock:
+        cached = _sizes.get(folder)
+        if gen is not None and cached and cached[0] == gen:
+            return cached[1]
+        size = tree_size(folder)
+        _sizes[folder] = (gen, size)
+        return size
+
+
+def list_shards(backup_dir):
+    """Top-level folders of backup_dir (device folders), sorted by name.
+    Hidden folders (rsync partial dir, .Trash, ...) are left to the top-level
+    pass."""
+    try:
+        entries = sorted(os.scandir(backup_dir), key=lambda e: e.name)
+    except OSError:
+        return []
+    return [e.name for e in entries
+            if not e.name.startswith(".") and e.is_dir(follow_symlinks=False)]
+
+
+def file_list(folder):
+    """``(rel, path, stat)`` of everything under ``folder`` (directories,
+    files, symlinks; not following links), sorted by ``rel`` so a directory
+    comes before its contents. The one walk of a device folder a run makes:
+    every target of the run sends from it instead of walking the folder
+    again."""
+    out = []
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        try:
+            entries = list(os.scandir(os.path.join(folder, rel)))
+        except OSError:
+            continue
+        for e in entries:
+            r = f"{rel}/{e.name}" if rel else e.name
+            try:
+                st = e.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            out.append((r, e.path, st))
+            if e.is_dir(follow_symlinks=False):
+                stack.append(r)
+    out.sort(key=lambda x: x[0])
+    return out
+
+
+def _read(path):
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+        if isinstance(data, dict) and isinstance(data.get("targets"), dict):
+            return data
+    except Exception:
+        pass
+    return {"targets": {}}
+
+
+def _write(data, path):
+    """Atomic tmp + rename, fsynced: this is what a resume after power loss reads."""
+    tmp = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def _update(path, fn):
+    # Targets of one run confirm shards concurrently: serialise read-modify-write.
+    path = path or _checkpoint_path()
+    with _lock:
+        data = _read(path)
+        fn(data)
+        _write(data, path)
+
+
+def load(target, path=None):
+    """Confirmed shards {name: {"gen", "size", "verified"}} for ``target``."""
+    entry = _read(path or _checkpoint_path())["targets"].get(target) or {}
+    return entry.get("shards") or {}
+
+
+def confirm(target, shard, gen, size, path=None):
+    """Record ``shard`` as in sync on ``target`` at generation ``gen``."""
+    def fn(data):
+        entry = data["targets"].setdefault(target, {})
+        entry.setdefault("shards", {})[shard] = {"gen": gen, "size": size,
+                                                 "verified": int(time.time())}
+    _update(path, fn)
+
+
+def begin(target, path=None):
+    """Mark a run on ``target`` as in progress. Returns True if the previous
+    run on it never finished (so this one is a resume)."""
+    state = {}
+
+    def fn(data):
+        entry = data["targets"].setdefault(target, {})
+        state["interrupted"] = bool(entry.get("running"))
+        entry["running"] = True
+    _update(path, fn)
+    return state["interrupted"]
+
+
+def finish(target, path=None):
+    """Mark the run on ``target`` as complete."""
+    def fn(data):
+        data["targets"].setdefault(target, {})["running"] = False
+    _update(path, fn)
+
+
+def clear(path=None):
+    """Forget every target's records: the next run sends every shard."""
+    try:
+        os.remove(path or _checkpoint_path())
+    except OSError:
+        pass
+
+
+def plan_targets(backup_dir, targets, path=None, now=None):
+    """Scan backup_dir once and work out what each target still has to do.
+
+    Returns {"shards": [{"name", "state", "gen", "size"}], "skipped", "total",
+    "targets": {target: {"done": set of shard names, "done_bytes",
+    "resume_pct"}}}. Only complete backups (see ``backup_state``) are shards;
+    folders still backing up or interrupted are listed in ``skipped`` and never
+    sent, so the remote keeps its last good copy. A shard without a generation
+    ID is never skipped. ``resume_pct`` is the share already done when the
+    target's previous run was cut short, else 0; call ``begin`` after this.
+    """
+    now = time.time() if now is None else now
+    data = _read(path or _checkpoint_path())["targets"]
+    confirmed = {t: (data.get(t) or {}).get("shards") or {} for t in targets}
+    shards, skipped = [], []
+    for name in list_shards(backup_dir):
+        folder = os.path.join(backup_dir, name)
+        state = backup_state(folder)
+        if state != "complete":
+            skipped.append({"name": name, "state": state})
+            continue
+        gen = generation_id(folder)
+        sizes = [c[name]["size"] for c in confirmed.values()
+                 if gen is not None and (c.get(name) or {}).get("gen") == gen]
+        # Only walk a folder whose size no target has recorded for this generation.
+        size = sizes[0] if sizes else _generation_size(folder, gen)
+        shards.append({"name": name, "state": state, "gen": gen, "size": size})
+    total = sum(s["size"] for s in shards)
+    per_target = {}
+    for t in targets:
+        done = {s["name"] for s in shards
+                if s["gen"] is not None
+                and (confirmed[t].get(s["name"]) or {}).get("gen") == s["gen"]
+                and now - (confirmed[t][s["name"]].get("verified") or 0) < FULL_VERIFY_SEC}
+        done_bytes = sum(s["size"] for s in shards if s["name"] in done)
+        interrupted = bool((data.get(t) or {}).get("running"))
+        resume_pct = int(done_bytes * 100 / total) if interrupted and total and done_bytes else 0
+        per_target[t] = {"done": done, "done_bytes": done_bytes, "resume_pct": resume_pct}
+    return {"shards": shards, "skipped": skipped, "total": total, "targets": per_target}
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+sync_estimate.py - What the next sync will have to move, how long it will
+take and how much battery it will cost, worked out before it starts.
+
+Bytes and files: sync_checkpoint already knows, per target, which device
+folders are in sync at their current backup generation and when each was last
+confirmed. A folder a target still needs is walked once; every file written
+(mtime or ctime) after the target last confirmed that folder is new or
+changed since, and is what rsync will send. A folder the target never had is
+sent whole. idevicebackup2 writes every file it adds or changes, so this
+matches what rsync's quick check finds, without ``rsync --dry-run`` having to
+ask the server. A folder's walk is kept (16 bytes a file) until its backup
+generation changes, and only one walk runs at a time, so the dashboard
+polling the estimate walks each new backup once.
+
+Time: the data rate of past syncs on the same network, else the same kind of
+network, from the tuner history (state/sync_history.json); else the link rate
+sync_watchdog assumes. SSH, S3 and encrypted targets share the uplink; local
+disk targets copy at LOCAL_RATE in parallel with it.
+
+Energy: how fast the battery drains during a sync on battery, learnt from
+past syncs (state/sync_energy.json, see ``record_drain``); DEFAULT_DRAIN_PER_HOUR
+until there are samples. power.sync_allowed refuses a sync whose cost would
+take the battery below min_battery_percent before it finishes.
+
+Import-safe: stdlib only, so it can be unit-tested on any machine.
+"""
+import bisect
+import json
+import os
+import statistics
+import threading
+import time
+from array import array
+
+import logutil
+import sync_checkpoint
+import sync_tuner
+import sync_watchdog
+
+ENERGY_FILE = "sync_energy.json"
+ENERGY_KEEP = 20
+LOCAL_RATE = 30e6                 # bytes/s a USB disk target takes
+PER_FILE_SEC = 0.003              # rsync's per-file overhead on top of the bytes
+DEFAULT_DRAIN_PER_HOUR = 15.0     # % of battery an hour of syncing takes
+MIN_DRAIN_SAMPLE_SEC = 600        # shorter runs move the gauge by a percent or less
+SAFETY = 1.25                     # margin on the battery cost for admission
+
+
+def _energy_path():
+    return logutil.state_path(ENERGY_FILE)
+
+
+# --- Bytes and files ------------------------------------------------------------
+
+def scan_changes(folder):
+    """Walk ``folder`` once. Returns (times, after): file change times (max
+    of mtime and ctime) sorted ascending, and after[i] = bytes of the files
+    from index i on, so ``changed_since`` is a bisect."""
+    entries = []
+    stack = [folder]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            st = entry.stat(follow_symlinks=False)
+                            entries.append((max(st.st_mtime, st.st_ctime), st.st_size))
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+    entries.sort()
+    after = array("q", bytes(8 * (len(entries) + 1)))
+    for i in range(len(entries) - 1, -1, -1):
+        after[i] = after[i + 1] + entries[i][1]
+    return array("d", (t for t, _ in entries)), after
+
+
+def changed_since(scan, since=None):
+    """(bytes, files) written after ``since`` (all of them if None)."""
+    times, after = scan
+    i = 0 if since is None else bisect.bisect_right(times, since)
+    return after[i], len(times) - i
+
+
+_scans = {}                       # folder -> (generation, scan)
+_scan_lock = threading.Lock()
+
+
+def _scan(folder, gen):
+    """``scan_changes(folder)``, walked again only when the backup
+    generation ``gen`` changed (always when it is None). Callers wait for a
+    walk in progress instead of starting their own."""
+    with _scan_lock:
+        cached = _scans.get(folder)
+        if gen is not None and cached and cached[0] == gen:
+            return cached[1]
+        scan = scan_changes(folder)
+        _scans[folder] = (gen, scan)
+        return scan
+
+
+def pending(backup_dir, targets, checkpoint_path=None):
+    """Per target ``{"bytes", "files", "shards"}`` the next sync has to send.
+    ``targets`` maps a target name to its checkpoint key, or None when the key
+    can't be known before connecting (every folder counts as pending)."""
+    keys = sorted({k for k in targets.values() if k})
+    plan = sync_checkpoint.plan_targets(backup_dir, keys, checkpoint_path)
+    scans = {}
+    out = {}
+    for name, key in targets.items():
+        done = plan["targets"][key]["done"] if key else set()
+        records = sync_checkpoint.load(key, checkpoint_path) if key else {}
+        total_b = total_n = shards = 0
+        for shard in plan["shards"]:
+            if shard["name"] in done:
+                continue
+            if shard["name"] not in scans:
+                scans[shard["name"]] = _scan(os.path.join(backup_dir, shard["name"]),
+                                             shard["gen"])
+            since = (records.get(shard["name"]) or {}).get("verified")
+            b, n = changed_since(scans[shard["name"]], since)
+            total_b += b
+            total_n += n
+            shards += 1
+        out[name] = {"bytes": total_b, "files": total_n, "shards": shards}
+    walked = {os.path.join(backup_dir, n) for n in scans}
+    with _scan_lock:
+        for folder in [f for f in _scans if f not in walked]:
+            del _scans[folder]                  # in sync everywhere, or gone
+    return out
+
+
+# --- Time -----------------------------------------------------------------------
+
+def _data_rates(history, network):
+    return [h["data_bytes"] / h["seconds"] for h in history
+            if h.get("network") == network and h.get("seconds")
+            and (h.get("data_bytes") or 0) >= sync_tuner.MIN_SAMPLE_BYTES]
+
+
+def data_rate(history, network):
+    """Expected sync data rate (bytes/s) on ``network``: past runs on it, else
+    on the same kind of network, else the link rate sync_watchdog assumes."""
+    rates = _data_rates(history, network) if network else []
+    if not rates and network:
+        kind = sync_watchdog.network_kind(network)
+        names = {h.get("network") for h in history
+                 if h.get("network") and sync_watchdog.network_kind(h["network"]) == kind}
+        rates = [statistics.median(r) for r in (_data_rates(history, n) for n in names) if r]
+    return statistics.median(rates) if rates else sync_watchdog.expected_rate(history, network)
+
+
+# --- Energy ---------------------------------------------------------------------
+
+def load_drain(path=None):
+    """Recorded drain samples (% per hour), oldest first."""
+    try:
+        with open(path or _energy_path(), "r") as f:
+            data = json.load(f)
+        return [float(x) for x in data.get("drain_per_hour", [])]
+    except Exception:
+        return []
+
+
+def drain_rate(path=None):
+    """Median % of battery an hour of syncing takes."""
+    samples = load_drain(path)
+    return statistics.median(samples) if samples else DEFAULT_DRAIN_PER_HOUR
+
+
+def record_drain(before, after, seconds, path=None):
+    """Learn from a finished sync: ``before``/``after`` are power.get_battery()
+    readings. Kept only for a run long enough, on battery all along and
+    readable both times. Best-effort, never raises."""
+    try:
+        if seconds < MIN_DRAIN_SAMPLE_SEC:
+            return
+        if before.get("percent") is None or after.get("percent") is None:
+            return
+        if before.get("charging") is not False or after.get("charging") is not False:
+            return
+        used = before["percent"] - after["percent"]
+        if used < 0:
+            return
+        path = path or _energy_path()
+        samples = load_drain(path) + [round(used * 3600 / seconds, 2)]
+        tmp = f"{path}.tmp.{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump({"drain_per_hour": samples[-ENERGY_KEEP:], "updated": int(time.time())}, f)
+        os.replace(tmp, path)
+    except Exception:
+        pass
+
+
+# --- The estimate ---------------------------------------------------------------
+
+def estimate(backup_dir, targets, history, network, drain=None, checkpoint_path=None):
+    """Estimate the next sync. ``targets`` is a list of {"name", "key",
+    "uplink"} (uplink: the target goes over the network, not to a local disk).
+
+    Returns {"bytes", "files", "eta_sec", "battery_pct", "rate", "network",
+    "targets": {name: {"bytes", "files", "shards"}}}. ``battery_pct`` is the
+    expected cost in battery percent."""
+    todo = pending(backup_dir, {t["name"]: t.get("key") for t in targets}, checkpoint_path)
+    rate = data_rate(history, network)
+    up_bytes = sum(todo[t["name"]]["bytes"] for t in targets if t.get("uplink", True))
+    up_files = sum(todo[t["name"]]["files"] for t in targets if t.get("uplink", True))
+    eta = up_bytes / rate + up_files * PER_FILE_SEC
+    for t in targets:
+        if not t.get("uplink", True):
+            p = todo[t["name"]]
+            eta = max(eta, p["bytes"] / LOCAL_RATE + p["files"] * PER_FILE_SEC)
+    drain = DEFAULT_DRAIN_PER_HOUR if drain is None else drain
+    return {"bytes": sum(p["bytes"] for p in todo.values()),
+            "files": sum(p["files"] for p in todo.values()),
+            "eta_sec": int(eta), "battery_pct": round(eta / 3600 * drain, 1),
+            "rate": rate, "network": network, "targets": todo}
+
+
+def describe(est):
+    """One line for the sync log."""
+    if not est["bytes"] and not est["files"]:
+        return "nothing to send"
+    on = f" on {est['network']}" if est["network"] else ""
+    return (f"{est['bytes'] / 1e6:.1f} MB in {est['files']} files, "
+            f"about {_duration(est['eta_sec'])} at {est['rate'] / 1e6:.2f} MB/s{on}, "
+            f"~{est['battery_pct']:g}% battery")
+
+
+def _duration(sec):
+    if sec < 90:
+        return f"{sec}s"
+    if sec < 5400:
+        return f"{round(sec / 60)} min"
+    return f"{sec / 3600:.1f} h"
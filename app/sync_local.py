@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+sync_local.py - Sync target on a locally mounted disk (e.g. a second USB disk
+that is rotated offsite).
+
+Same layout and guarantees as an SSH target (see sync_snapshots): in mirror
+mode a device folder is built in ``<path>/.staging/<device>/`` and renamed
+into place once complete; with snapshots it is built in
+``<device>/.incomplete/`` and published as ``<device>/<timestamp>``, with
+``latest`` swapped to it.
+
+Copying is done here instead of by rsync:
+
+- a file whose size and mtime match the existing copy is skipped (a resumed
+  run) or hard-linked from the live copy / ``latest`` (an unchanged file), the
+  same rule rsync's quick check and ``--link-dest`` apply. The mtime is set
+  only after a copy completes, so a half-copied file never matches;
+- changed files are copied by a thread pool with ``os.copy_file_range``
+  (in-kernel, and a reflink on btrfs/XFS when source and destination share a
+  filesystem), falling back to ``os.sendfile`` and then a plain read/write;
+- instead of an fsync per file, the destination filesystem is flushed with
+  one ``syncfs(2)`` per SYNC_BATCH_BYTES written and before every publish.
+
+The target directory must be on a mounted filesystem other than the root
+one, so an unplugged disk never fills the SD card. A marker file identifies
+the disk, so rotating to another disk at the same mount point starts that
+disk's checkpoints from scratch.
+
+Import-safe: stdlib only, so it can be unit-tested on any machine.
+"""
+import os
+import stat
+import time
+import shutil
+import ctypes
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import sync_checkpoint
+import sync_snapshots
+
+COPY_WORKERS = 4
+SYNC_BATCH_BYTES = 256 * 1024 * 1024
+COPY_CHUNK = 8 * 1024 * 1024
+ID_FILE = ".iosbackup-target-id"
+
+
+def check_target(path, root="/"):
+    """Reason the local target at ``path`` can't be used, or "" if it can."""
+    if not path or not os.path.isabs(path):
+        return "Local target path must be absolute."
+    if not os.path.isdir(path):
+        return f"Local target {path} not found (disk not plugged in?)."
+    try:
+        if os.stat(path).st_dev == os.stat(root).st_dev:
+            return f"Local target {path} is not a mounted disk."
+    except OSError as e:
+        return f"Local target {path}: {e.strerror}"
+    if not os.access(path, os.W_OK):
+        return f"Local target {path} is not writable."
+    return ""
+
+
+def read_target_id(path):
+    """The ID of the disk mounted at ``path``, or None if it has none yet (or
+    isn't mounted). Never writes."""
+    try:
+        with open(os.path.join(path, ID_FILE), "r") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def target_id(path):
+    """Identity of the disk mounted at ``path``: a random ID kept in a marker
+    file at its root, created on first use."""
+    ident = read_target_id(path)
+    if ident:
+        return ident
+    marker = os.path.join(path, ID_FILE)
+    ident = uuid.uuid4().hex[:16]
+    tmp = f"{marker}.tmp"
+    with open(tmp, "w") as f:
+        f.write(ident + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, marker)
+    return ident
+
+
+def _libc_syncfs():
+    try:
+        fn = ctypes.CDLL(None, use_errno=True).syncfs
+        fn.argtypes = [ctypes.c_int]
+        return fn
+    except (OSError, AttributeError):
+        return None
+
+
+_syncfs_fn = _libc_syncfs()
+
+
+def syncfs(path):
+    """Flush the filesystem holding ``path`` (one syncfs(2); sync(2) where
+    syncfs is unavailable)."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _syncfs_fn is None or _syncfs_fn(fd) != 0:
+            os.sync()
+    finally:
+        os.close(fd)
+
+
+def same_file(a, b):
+    """rsync's quick check: same size and modification time."""
+    return a.st_size == b.st_size and a.st_mtime_ns == b.st_mtime_ns
+
+
+def copy_file(src, dst, st):
+    """Copy ``src`` (stat ``st``) to ``dst`` in-kernel where possible, then
+    set its mode and times. Returns bytes copied."""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        left = st.st_size
+        for method in ("copy_file_range", "sendfile"):
+            fn = getattr(os, method, None)
+            if fn is None or not left:
+                continue
+            try:
+                while left > 0:
+                    if method == "copy_file_range":
+                        n = fn(infd, outfd, min(left, COPY_CHUNK))
+                    else:
+                        n = fn(outfd, infd, st.st_size - left, min(left, COPY_CHUNK))
+                    if n == 0:
+                        break
+                    left -= n
+                break
+            except OSError:
+                # EXDEV/EINVAL/ENOSYS: not supported between these files.
+                pos = st.st_size - left
+                fsrc.seek(pos)
+                fdst.seek(pos)
+        if left > 0:
+            fsrc.seek(st.st_size - left)
+            fdst.seek(st.st_size - left)
+            shutil.copyfileobj(fsrc, fdst, COPY_CHUNK)
+    os.chmod(dst, st.st_mode & 0o7777)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return st.st_size
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class TreeCopier:
+    """Mirror one source tree into a destination, ``rsync -a --delete
+    --link-dest`` style, with a pool of copy workers.
+
+    ``on_progress(done_bytes, speed_bps)`` is called as files are handled
+    (skipped and linked files count as done). ``should_stop()`` returns a
+    truthy reason to stop early; pending copies are dropped and the result
+    has ``stopped`` set to it. The result also counts ``copied``, ``linked``
+    and ``skipped`` files, and ``copied_bytes``.
+    """
+
+    def __init__(self, workers=COPY_WORKERS, on_progress=None, should_stop=None,
+                 batch_bytes=SYNC_BATCH_BYTES):
+        self.workers = max(1, int(workers))
+        self.on_progress = on_progress
+        self.should_stop = should_stop
+        self.batch_bytes = batch_bytes
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self.result = {"copied": 0, "linked": 0, "skipped": 0, "copied_bytes": 0,
+                       "done_bytes": 0, "stopped": None}
+        self._unsynced = 0
+
+    def _done(self, nbytes, kind, copied=0):
+        with self._lock:
+            r = self.result
+            r[kind] += 1
+            r["done_bytes"] += nbytes
+            r["copied_bytes"] += copied
+            self._unsynced += copied
+            done, moved = r["done_bytes"], r["copied_bytes"]
+        if self.on_progress:
+            elapsed = time.time() - self._start
+            self.on_progress(done, moved / elapsed if elapsed > 0 else 0.0)
+
+    def _copy(self, src, dst, st):
+        copy_file(src, dst, st)
+        self._done(st.st_size, "copied", st.st_size)
+
+    def copy_tree(self, src, dst, link_dest=None, entries=None):
+        """Make ``dst`` a copy of ``src``, from ``entries`` (the run's shared
+        sync_checkpoint.file_list of ``src``) or a walk of its own. Unchanged
+        files are hard links to ``link_dest`` (same relative path) when given.
+        Returns ``result``."""
+        os.makedirs(dst, exist_ok=True)
+        if entries is None:
+            entries = sync_checkpoint.file_list(src)
+        names = {"": set()}           # directory -> names it holds in src
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for r_path, s_path, st in entries:
+                stop = self.should_stop() if self.should_stop else None
+                if stop:
+                    self.result["stopped"] = stop
+                    break
+                parent, _, name = r_path.rpartition("/")
+                names.setdefault(parent, set()).add(name)
+                d_path = os.path.join(dst, r_path)
+                if stat.S_ISDIR(st.st_mode):
+                    names.setdefault(r_path, set())
+                    if not os.path.isdir(d_path) or os.path.islink(d_path):
+                        _remove(d_path)
+                        os.makedirs(d_path, exist_ok=True)
+                    continue
+                if stat.S_ISLNK(st.st_mode):
+                    target = os.readlink(s_path)
+                    try:
+                        if os.readlink(d_path) == target:
+                            continue
+                    except OSError:
+                        pass
+                    _remove(d_path)
+                    os.symlink(target, d_path)
+                    continue
+                try:
+                    dst_st = os.stat(d_path, follow_symlinks=False)
+                except OSError:
+                    dst_st = None
+                if dst_st is not None and same_file(st, dst_st):
+                    self._done(st.st_size, "skipped")
+                    continue
+                if link_dest:
+                    l_path = os.path.join(link_dest, r_path)
+                    try:
+                        if same_file(st, os.stat(l_path, follow_symlinks=False)):
+                            if dst_st is not None:
+                                _remove(d_path)
+                            os.link(l_path, d_path)
+                            self._done(st.st_size, "linked")
+                            continue
+                    except OSError:
+                        pass     # missing, or no hard links on this fs: copy
+                if dst_st is not None and not os.path.isfile(d_path):
+                    _remove(d_path)
+                elif dst_st is not None and dst_st.st_nlink > 1:
+                    os.remove(d_path)   # never write through a hard link
+                pending.add(pool.submit(self._copy, s_path, d_path, st))
+                if len(pending) >= self.workers * 4:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in finished:
+                        f.result()
+                with self._lock:
+                    flush = self._unsynced >= self.batch_bytes
+                    if flush:
+                        self._unsynced = 0
+                if flush:
+                    syncfs(dst)
+            if self.result["stopped"]:
+                for f in pending:
+                    f.cancel()
+            for f in pending:
+                if not f.cancelled():
+                    f.result()
+        if not self.result["stopped"]:
+            # --delete: drop what the source no longer has.
+            for rel, keep in names.items():
+                ddir = os.path.join(dst, rel)
+                try:
+                    for name in os.listdir(ddir):
+                        if name not in keep:
+                            _remove(os.path.join(ddir, name))
+                except OSError:
+                    pass
+        return self.result
+
+
+def sync_root(backup_dir, path, keep, delete=True):
+    """Top-level pass: copy the files at the root of ``backup_dir`` and, with
+    ``delete``, remove top-level folders no longer present locally. Names in
+    ``keep`` (device folders of this run) and hidden entries are left alone."""
+    src_names = set()
+    for e in os.scandir(backup_dir):
+        src_names.add(e.name)
+        if e.name.startswith(".") or e.is_dir(follow_symlinks=False):
+            continue
+        st = e.stat(follow_symlinks=False)
+        d_path = os.path.join(path, e.name)
+        try:
+            if same_file(st, os.stat(d_path, follow_symlinks=False)):
+                continue
+        except OSError:
+            pass
+        if e.is_symlink():
+            _remove(d_path)
+            os.symlink(os.readlink(e.path), d_path)
+        else:
+            copy_file(e.path, d_path, st)
+    if delete:
+        for name in os.listdir(path):
+            if name.startswith(".") or name in keep or name in src_names:
+                continue
+            _remove(os.path.join(path, name))
+
+
+def stage_dirs(path, name):
+    """(staging dir, live dir) of a device folder in mirror mode."""
+    return (os.path.join(path, sync_snapshots.STAGING, name), os.path.join(path, name))
+
+
+def recover_staged(path, name):
+    """Put back the live folder a ``publish_staged`` cut short between its
+    two renames left at ``.staging/<name>.old``."""
+    staged, live = stage_dirs(path, name)
+    old = staged + ".old"
+    if not os.path.lexists(live) and os.path.isdir(old):
+        os.rename(old, live)
+
+
+def publish_staged(path, name):
+    """Rename ``.staging/<name>`` into place: the live folder is renamed aside
+    and the staged one renamed in, back to back, then the old one deleted.
+    A crash between the two renames leaves no live folder; ``recover_staged``
+    (run before each copy, and here) puts the old one back."""
+    staged, live = stage_dirs(path, name)
+    old = staged + ".old"
+    recover_staged(path, name)
+    _remove(old)
+    if os.path.lexists(live):
+        os.rename(live, old)
+    os.rename(staged, live)
+    _remove(old)
+
+
+def seed_snapshot(path, name):
+    """Move a mirrored backup found in the device folder into ``.mirror``
+    when it has no ``latest`` snapshot yet (see sync_snapshots.MIRROR)."""
+    device = os.path.join(path, name)
+    if os.path.lexists(os.path.join(device, sync_snapshots.LATEST)) \
+            or not os.path.exists(os.path.join(device, "Manifest.plist")):
+        return
+    mirror = os.path.join(device, sync_snapshots.MIRROR)
+    os.makedirs(mirror, exist_ok=True)
+    for entry in os.listdir(device):
+        if entry not in (sync_snapshots.INCOMPLETE, sync_snapshots.MIRROR,
+                         f".{sync_snapshots.LATEST}.tmp") \
+                and not sync_snapshots.is_snapshot(entry):
+            os.rename(os.path.join(device, entry), os.path.join(mirror, entry))
+
+
+def snapshot_dirs(path, name):
+    """(.incomplete dir, dir to link against) of a device folder in snapshot
+    mode: the ``latest`` link, or the mirror the first snapshot replaces."""
+    device = os.path.join(path, name)
+    mirror = os.path.join(device, sync_snapshots.MIRROR)
+    latest = os.path.join(device, sync_snapshots.LATEST)
+    return (os.path.join(device, sync_snapshots.INCOMPLETE),
+            mirror if not os.path.lexists(latest) and os.path.isdir(mirror) else latest)
+
+
+def commit_snapshot(path, name, stamp):
+    """Publish ``.incomplete`` as snapshot ``stamp``, point ``latest`` at it
+    and delete the mirror it was seeded from, if any."""
+    device = os.path.join(path, name)
+    os.rename(os.path.join(device, sync_snapshots.INCOMPLETE), os.path.join(device, stamp))
+    tmp = os.path.join(device, f".{sync_snapshots.LATEST}.tmp")
+    _remove(tmp)
+    os.symlink(stamp, tmp)
+    os.replace(tmp, os.path.join(device, sync_snapshots.LATEST))
+    _remove(os.path.join(device, sync_snapshots.MIRROR))
+
+
+def prune_snapshots(path, name, policy):
+    """Delete snapshots of ``name`` outside ``policy``. Returns deleted names."""
+    device = os.path.join(path, name)
+    doomed = sync_snapshots.prune_plan(os.listdir(device),
+                                       keep_last=int(policy.get("keep_last", 7)),
+                                       keep_daily=int(policy.get("keep_daily", 14)),
+                                       keep_monthly=int(policy.get("keep_monthly", 6)))
+    for snap in doomed:
+        _remove(os.path.join(device, snap))
+    return doomed
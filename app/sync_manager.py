@@ -4,10 +4,28 @@ sync_manager.py - Remote backup sync via rsync over SSH.
 
 Supports SSH key and password authentication.
 Credentials are decrypted from the encrypted sync config store.
+
+Every ssh/rsync invocation of a run goes through one SSH ControlMaster
+connection (see ``_SshSession``), so the handshake and key exchange are paid
+once per run instead of once per process.
 """
-import os, sys, re, select, socket, subprocess, tempfile, time, yaml
+import os, sys, re, glob, hashlib, select, shlex, socket, subprocess, tempfile, threading, time, yaml
+import http.client
+import urllib.parse
 
+import logutil
 import sync_crypto
+import sync_tuner
+import sync_checkpoint
+import sync_snapshots
+import sync_local
+import sync_s3
+import sync_vault
+import sync_restore
+import sync_watchdog
+import sync_estimate
+import sync_audit
+import datausage
 
 try:
     import power
@@ -16,6 +34,13 @@ except ImportError:
 
 CONFIG_PATH = os.getenv("IOSBACKUP_CONFIG", "/root/iosbackupmachine/config.yaml")
 
+# ControlMaster sockets and the temporary SSH key files live in a private (0700)
+# directory on the volatile runtime dir: nothing here must survive a reboot.
+SSH_RUNTIME_DIR = os.path.join(logutil.RUNTIME_DIR, "ssh")
+# Safety net only: an owned master is torn down explicitly at the end of its run;
+# this idle timeout reaps one orphaned by a SIGKILLed sync (e.g. Cancel Sync).
+SSH_CONTROL_PERSIST_SEC = 300
+
 
 def _load_config():
     try:
@@ -104,52 +129,501 @@ def _diagnose_unreachable(host, port):
         return "No internet connection."
     return f"Sync server unreachable ({host})."
 
+def _private_dir():
+    """Create (if needed) and return the 0700 runtime dir for sockets and keys."""
+    os.makedirs(SSH_RUNTIME_DIR, mode=0o700, exist_ok=True)
+    try:
+        os.chmod(SSH_RUNTIME_DIR, 0o700)
+    except OSError:
+        pass
+    return SSH_RUNTIME_DIR
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+
+
+def _sweep_stale_keys(directory):
+    """Remove key files left behind by a run that was SIGKILLed before its
+    cleanup ran (their owning pid is encoded in the name)."""
+    for path in glob.glob(os.path.join(directory, "key-*")):
+        try:
+            pid = int(os.path.basename(path).split("-")[1])
+        except (IndexError, ValueError):
+            continue
+        if pid != os.getpid() and not _pid_alive(pid):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class _SshSession:
+    """One SSH ControlMaster connection to the sync target, shared by every
+    ssh/rsync invocation of a run.
+
+    ``open()`` starts the session's own master. A short-lived caller (a
+    connection test, a backup listing) may instead ``borrow`` a live master
+    another process already holds for the same target and credentials, such as
+    a running sync's. Only an owned master is torn down by ``close()``, and a
+    sync, audit or restore never borrows, so no caller can cut the transfer of
+    a long-running one. Each owner uses its own pid-suffixed socket for the
+    same reason. The socket name carries a hash of the credentials, so a
+    changed key or password never rides on a master authenticated with the
+    old one.
+
+    Credentials never reach argv (and so never ``ps`` or the sync log): the key
+    is written to a 0600 file in the private runtime dir, and a password is
+    handed to ``sshpass -e`` through the environment.
+    """
+
+    def __init__(self, cfg, connect_timeout=15):
+        self.host = cfg.get("host", "")
+        self.port = cfg.get("port", 22)
+        self.username = cfg.get("username", "")
+        self.auth_method = cfg.get("auth_method", "key")
+        self._ssh_key = cfg.get("ssh_key", "")
+        self._password = cfg.get("password", "")
+        self.connect_timeout = connect_timeout
+        self.key_file = None
+        self.control_path = None
+        self.owned = False
+
+    @property
+    def dest(self):
+        return f"{self.username}@{self.host}"
+
+    @property
+    def has_credentials(self):
+        return bool((self.auth_method == "key" and self._ssh_key)
+                    or (self.auth_method == "password" and self._password))
+
+    @property
+    def env(self):
+        """Environment for subprocesses: carries SSHPASS for password auth."""
+        if self.auth_method == "password":
+            return {**os.environ, "SSHPASS": self._password}
+        return None
+
+    def _tag(self):
+        secret = self._ssh_key if self.auth_method == "key" else self._password
+        ident = f"{self.username}@{self.host}:{self.port}\0{self.auth_method}\0{secret}"
+        return hashlib.sha256(ident.encode("utf-8")).hexdigest()[:16]
+
+    def _write_key(self, directory):
+        # mkstemp creates the file 0600 with O_EXCL, so the key is never
+        # readable by anyone else, not even between create and chmod.
+        fd, path = tempfile.mkstemp(prefix=f"key-{os.getpid()}-", dir=directory)
+        with os.fdopen(fd, "w") as f:
+            clean_key = self._ssh_key.replace("\r\n", "\n").replace("\r", "\n")
+            f.write(clean_key)
+            if not clean_key.endswith("\n"):
+                f.write("\n")
+        return path
+
+    def ssh_args(self, control=True):
+        """Base ``ssh`` argv (no destination). ``control`` routes it through the
+        session's master socket."""
+        # ServerAliveInterval/CountMax detects dead connections in ~90s instead of
+        # waiting for the TCP-level keepalive (default 2h).
+        args = ["ssh", "-p", str(self.port),
+                "-o", "StrictHostKeyChecking=accept-new",
+                "-o", f"ConnectTimeout={self.connect_timeout}",
+                "-o", "ServerAliveInterval=30", "-o", "ServerAliveCountMax=3"]
+        if self.auth_method == "key":
+            # Never fall back to an interactive prompt that nobody can answer.
+            args += ["-o", "BatchMode=yes"]
+        if self.key_file:
+            args += ["-o", "IdentitiesOnly=yes", "-i", self.key_file]
+        if control and self.control_path:
+            args += ["-o", "ControlMaster=no", "-o", f"ControlPath={self.control_path}"]
+        return args
+
+    def rsync_rsh(self):
+        """The ``rsync -e`` value: ssh through the master socket."""
+        return " ".join(shlex.quote(a) for a in self.ssh_args())
+
+    def wrap(self, cmd):
+        """Prefix ``cmd`` with sshpass for password auth (password via env)."""
+        if self.auth_method == "password":
+            return ["sshpass", "-e"] + list(cmd)
+        return list(cmd)
+
+    def ssh_cmd(self, remote_command):
+        """Full argv running ``remote_command`` on the target over the master."""
+        return self.wrap(self.ssh_args() + [self.dest, remote_command])
+
+    def run(self, remote_command, timeout=30, input=None):
+        """Run ``remote_command`` on the target (``input`` on its stdin);
+        returns a CompletedProcess."""
+        return subprocess.run(self.ssh_cmd(remote_command), capture_output=True,
+                              text=True, timeout=timeout, env=self.env, input=input)
+
+    def _master_alive(self, path):
+        try:
+            r = subprocess.run(["ssh", "-o", f"ControlPath={path}", "-O", "check", self.dest],
+                               capture_output=True, timeout=5)
+            return r.returncode == 0
+        except Exception:
+            return False
+
+    def open(self, borrow=False):
+        """Start the ControlMaster, or with ``borrow`` use another process's
+        live one when there is one. Returns ``(ok, error_text)``.
+
+        Also serves as the pre-flight: a successful open proves the host is
+        reachable and the credentials work, without a separate probe.
+        """
+        directory = _private_dir()
+        _sweep_stale_keys(directory)
+        if self.auth_method == "key" and self._ssh_key:
+            self.key_file = self._write_key(directory)
+        prefix = os.path.join(directory, f"cm-{self._tag()}-")
+        for path in sorted(glob.glob(prefix + "*")) if borrow else ():
+            if self._master_alive(path):
+                self.control_path = path
+                return True, ""
+        path = f"{prefix}{os.getpid()}"
+        try:
+            os.remove(path)          # a dead master's leftover socket
+        except OSError:
+            pass
+        cmd = self.wrap(self.ssh_args(control=False) + [
+            "-o", "ControlMaster=yes", "-o", f"ControlPath={path}",
+            "-o", f"ControlPersist={SSH_CONTROL_PERSIST_SEC}",
+            "-N", "-f", self.dest])
+        # -f backgrounds the master after authentication. Its stderr goes to a
+        # temp file, not a pipe: the backgrounded master would otherwise hold
+        # the pipe open and block the read.
+        try:
+            with tempfile.TemporaryFile(mode="w+") as errf:
+                r = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                   stderr=errf, timeout=self.connect_timeout + 15,
+                                   env=self.env)
+                errf.seek(0)
+                err = errf.read().strip()
+        except subprocess.TimeoutExpired:
+            return False, "Connection timed out."
+        except FileNotFoundError as e:
+            tool = "sshpass" if "sshpass" in str(e) else "ssh"
+            return False, f"{tool} not found."
+        if r.returncode != 0:
+            return False, err[:200] or f"ssh exit code {r.returncode}"
+        self.control_path = path
+        self.owned = True
+        return True, ""
+
+    def close(self):
+        """Tear down an owned master and remove the key file. Idempotent."""
+        if self.owned and self.control_path:
+            try:
+                subprocess.run(["ssh", "-o", f"ControlPath={self.control_path}",
+                                "-O", "exit", self.dest], capture_output=True, timeout=10)
+            except Exception:
+                pass
+            try:
+                os.remove(self.control_path)
+            except OSError:
+                pass
+        self.owned = False
+        self.control_path = None
+        if self.key_file:
+            try:
+                os.remove(self.key_file)
+            except OSError:
+                pass
+            self.key_file = None
+
+
+class _SyncContext:
+    """What a run needs for one target once pre-flight has passed: the open
+    SSH session, the source and destination, and the rsync flags (including
+    the tuner's compression choice, kept in ``tuning`` for the run history),
+    the data-usage meter for the network the run goes out on, and the remote
+    snapshot policy (None in mirror mode). ``name`` labels the target in the
+    log and in the per-target progress breakdown."""
+
+    kind = "ssh"
+
+    def __init__(self, session, backup_dir, remote_path, rsync_flags, tuning, meter=None,
+                 snapshots=None, name="primary"):
+        self.session = session
+        self.backup_dir = backup_dir
+        self.remote_path = remote_path
+        self.rsync_flags = rsync_flags
+        self.tuning = tuning
+        self.meter = meter
+        self.snapshots = snapshots
+        self.name = name
+
+    def remote(self, path=""):
+        """``user@host:<remote_path>/<path>`` rsync destination spec."""
+        return f"{self.session.dest}:{self.remote_path}/{path}"
+
+    def rsync_cmd(self, src=None, dst=None, extra=()):
+        src = self.backup_dir if src is None else src
+        dst = self.remote() if dst is None else dst
+        return self.session.wrap(["/usr/bin/rsync"] + self.rsync_flags + list(extra)
+                                 + ["-e", self.session.rsync_rsh(), src, dst])
+
+
+class _LocalContext:
+    """A target on a locally mounted disk (see sync_local): copied by a
+    thread pool instead of rsync, with the same layout, checkpoints, progress
+    and battery guard as an SSH target."""
+
+    kind = "local"
+    session = None
+    meter = None
+
+    def __init__(self, backup_dir, path, disk_id, snapshots=None, workers=None, name="local"):
+        self.backup_dir = backup_dir
+        self.remote_path = path
+        self.disk_id = disk_id
+        self.snapshots = snapshots
+        self.workers = workers or sync_local.COPY_WORKERS
+        self.tuning = {}
+        self.name = name
+
+    def describe(self):
+        return self.remote_path
+
+    def sync_root(self, keep):
+        sync_local.sync_root(self.backup_dir, self.remote_path, keep, delete=not self.snapshots)
+
+    def transfer(self, name, report, should_stop, log_file=None, entries=None):
+        """Copy device folder ``name`` into its staging (or .incomplete) dir,
+        from ``entries`` (the run's shared file list of it) when given."""
+        if self.snapshots:
+            sync_local.seed_snapshot(self.remote_path, name)
+            dst, link_dest = sync_local.snapshot_dirs(self.remote_path, name)
+        else:
+            sync_local.recover_staged(self.remote_path, name)
+            dst, link_dest = sync_local.stage_dirs(self.remote_path, name)
+        if log_file:
+            log_file.write(f"[COPY] {name} -> {dst} ({self.workers} workers)\n")
+        copier = sync_local.TreeCopier(self.workers, report, should_stop)
+        res = copier.copy_tree(os.path.join(self.backup_dir, name), dst,
+                               link_dest if os.path.isdir(link_dest) else None, entries)
+        if not res["stopped"]:
+            sync_local.syncfs(self.remote_path)      # durable before it is published
+        return res
+
+    def publish(self, name, snap_name, log_file=None):
+        if not self.snapshots:
+            sync_local.publish_staged(self.remote_path, name)
+            return
+        sync_local.commit_snapshot(self.remote_path, name, snap_name)
+        if log_file:
+            log_file.write(f"[SNAPSHOT] {name}/{snap_name} published as latest\n")
+        pruned = sync_local.prune_snapshots(self.remote_path, name, self.snapshots)
+        if log_file and pruned:
+            log_file.write(f"[SNAPSHOT] pruned {name}: {', '.join(pruned)}\n")
+
+    def finish(self):
+        sync_local.syncfs(self.remote_path)
+
+
+class _S3Context:
+    """A target in an S3-compatible bucket (see sync_s3): objects under
+    ``prefix``, uploaded by a thread pool and tracked in a local manifest.
+    Always a mirror; there is nothing to publish after a device's upload."""
+
+    kind = "s3"
+    session = None
+    snapshots = None
+
+    def __init__(self, backup_dir, client, prefix, manifest, workers=None, meter=None, name="s3"):
+        self.backup_dir = backup_dir
+        self.client = client
+        self.remote_path = prefix.strip("/")
+        self.manifest = manifest
+        self.workers = workers or sync_s3.UPLOAD_WORKERS
+        self.meter = meter
+        self.tuning = {}
+        self.name = name
+
+    def describe(self):
+        return f"s3://{self.client.bucket}/{self.remote_path}"
+
+    def sync_root(self, keep):
+        sync_s3.sync_root(self.client, self.manifest, self.backup_dir, self.remote_path, keep)
+
+    def transfer(self, name, report, should_stop, log_file=None, entries=None):
+        if log_file:
+            log_file.write(f"[COPY] {name} -> {self.describe()}/{name} ({self.workers} workers)\n")
+        uploader = sync_s3.TreeUploader(self.client, self.manifest, self.workers, report, should_stop)
+        return uploader.upload_tree(os.path.join(self.backup_dir, name),
+                                    sync_s3.object_key(self.remote_path, name), entries)
+
+    def publish(self, name, snap_name, log_file=None):
+        pass
+
+    def finish(self):
+        self.manifest.save()
+
+    def close(self):
+        self.manifest.save()
+        self.client.close()
+
+
+class _VaultContext:
+    """A target with ``encrypt: true``: device folders go through sync_vault
+    into an encrypted, deduplicated chunk store on a local disk, S3 bucket or
+    SSH server. Always a mirror of the latest backups."""
+
+    kind = "vault"
+    snapshots = None
+
+    def __init__(self, backup_dir, store, keys, index, key, session=None, workers=None,
+                 meter=None, name="vault"):
+        self.backup_dir = backup_dir
+        self.store = store
+        self.keys = keys
+        self.index = index
+        self.key = key
+        self.session = session
+        self.workers = workers or sync_vault.VAULT_WORKERS
+        self.meter = meter
+        self.remote_path = key.split(":", 1)[1]
+        self.tuning = {}
+        self.name = name
+
+    def describe(self):
+        return f"encrypted {self.remote_path}"
+
+    def _uploader(self, report=None, should_stop=None):
+        return sync_vault.VaultUploader(self.keys, self.store, self.index, self.workers,
+                                        report, should_stop)
+
+    def sync_root(self, keep):
+        self._uploader().upload_tree(self.backup_dir, sync_vault.ROOT_TREE,
+                                     sync_vault.root_entries(self.backup_dir))
+        sync_vault.drop_trees(self.keys, self.store, self.index, keep)
+
+    def transfer(self, name, report, should_stop, log_file=None, entries=None):
+        if log_file:
+            log_file.write(f"[COPY] {name} -> {self.describe()} ({self.workers} workers)\n")
+        return self._uploader(report, should_stop).upload_tree(
+            os.path.join(self.backup_dir, name), name, entries)
+
+    def publish(self, name, snap_name, log_file=None):
+        pass
+
+    def finish(self):
+        sync_vault.collect_garbage(self.store, self.index)
 
-def _prepare_sync(passphrase=None, backup_dir=None, progress=False):
-    """Shared setup for run_sync and run_sync_with_progress.
-    Returns (cmd, key_file, error_dict) — error_dict is set on failure."""
+    def close(self):
+        self.index.save()
+        self.store.close()
+
+
+def _s3_manifest_path(key):
+    return logutil.state_path(f"s3_manifest_{hashlib.sha1(key.encode()).hexdigest()[:12]}.json")
+
+
+def _sync_targets(cfg):
+    """Sync targets in a decrypted sync config, primary first.
+
+    The top-level host/port/username/... fields are the primary target
+    (``name`` "primary" unless set); ``cfg["targets"]`` lists additional ones
+    as dicts with the same fields plus ``name``, ``type`` ("ssh"), an optional
+    per-target ``bwlimit`` and ``enabled``. A ``type`` "local" entry only has
+    ``path`` (a mounted disk) and optionally ``workers``. Disabled entries are
+    left out."""
+    primary = {k: v for k, v in cfg.items() if k != "targets"}
+    primary["name"] = primary.get("name") or "primary"
+    primary.setdefault("type", "ssh")
+    targets = [primary]
+    for i, t in enumerate(cfg.get("targets") or []):
+        if not isinstance(t, dict) or t.get("enabled") is False:
+            continue
+        targets.append({"type": "ssh", **t, "name": t.get("name") or f"target{i + 2}"})
+    return targets
+
+
+def _prepare_run(passphrase=None):
+    """Checks shared by every target of a run: allowed network, data cap and
+    the sync credentials.
+
+    Returns (run, error_dict). ``run`` holds the decrypted config (``cfg``),
+    the ``sync`` settings, and the ``network``/``iface``/``profile`` the run
+    goes out on."""
     net_ok, net_reason = _check_network_allowed()
     if not net_ok:
-        return None, None, {"success": False, "message": net_reason, "duration": 0}
+        return None, {"success": False, "message": net_reason, "duration": 0}
+
+    # Per-network bandwidth profile + monthly cap. A metered network whose cap
+    # is used up refuses the run and leaves a pause marker; the display daemon
+    # resumes the sync once an unmetered network is up.
+    try:
+        import netutil
+        network = netutil.network_label()
+        iface = netutil.uplink_interface(network)
+    except Exception:
+        network, iface = None, None
+    sync_cfg = _load_config().get("sync", {})
+    profiles = sync_cfg.get("bandwidth_profiles") or []
+    profile = datausage.match_profile(profiles, network)
+    cap_ok, cap_reason = datausage.admission(profiles, network)
+    if not cap_ok:
+        datausage.mark_paused(network, cap_reason)
+        return None, {"success": False, "message": cap_reason, "duration": 0, "paused": True}
 
     cfg = sync_crypto.decrypt_sync_config(passphrase=passphrase)
     if not cfg:
-        return None, None, {"success": False, "message": "Cannot decrypt sync credentials.", "duration": 0}
-
-    host = cfg.get("host", "")
-    port = cfg.get("port", 22)
-    username = cfg.get("username", "")
-    auth_method = cfg.get("auth_method", "key")
-    ssh_key = cfg.get("ssh_key", "")
-    password = cfg.get("password", "")
-    remote_path = cfg.get("remote_path", "")
-
-    if not host or not username or not remote_path:
-        return None, None, {"success": False, "message": "Incomplete sync configuration (host/user/path).", "duration": 0}
-
-    # Pre-flight reachability: turn a would-be cryptic rsync connection failure
-    # into a clear cause (no network / VPN down / no internet). Both the manual
-    # and auto-sync paths funnel through here, so the message reaches the e-ink,
-    # the dashboard, and notifications.
-    reason = _diagnose_unreachable(host, port)
-    if reason:
-        return None, None, {"success": False, "message": reason, "duration": 0}
+        return None, {"success": False, "message": "Cannot decrypt sync credentials.", "duration": 0}
+    return {"cfg": cfg, "sync_cfg": sync_cfg, "network": network, "iface": iface,
+            "profile": profile}, None
+
 
+def _open_target(tcfg, run, backup_dir=None, progress=False, meter=None, shares=1):
+    """Open one target (see ``_sync_targets``). Returns (context, error_text).
+
+    ``shares`` is the number of targets synced at once; the network's
+    bandwidth limit is split between them."""
     if backup_dir is None:
         backup_dir = _load_backup_dir()
     if not backup_dir.endswith("/"):
         backup_dir += "/"
+    snapshots = run["sync_cfg"].get("snapshots") or {}
+    snapshots = snapshots if snapshots.get("enabled") else None
+    if tcfg.get("encrypt"):
+        return _open_vault_target(tcfg, backup_dir, meter)
+    if tcfg.get("type") == "local":
+        path = tcfg.get("path", "")
+        disk_id, err = _check_local_target(path, backup_dir)
+        if err:
+            return None, err
+        return _LocalContext(backup_dir, path.rstrip("/") or "/", disk_id, snapshots,
+                             tcfg.get("workers"), name=tcfg.get("name", "local")), None
+    if tcfg.get("type") == "s3":
+        client, err = _s3_client(tcfg)
+        if err:
+            return None, err
+        prefix = tcfg.get("prefix", "").strip("/")
+        key = f"{tcfg['endpoint']}/{tcfg['bucket']}/{prefix}"
+        # S3 has no rename to publish with: always a plain mirror.
+        return _S3Context(backup_dir, client, prefix, sync_s3.Manifest(_s3_manifest_path(key)),
+                          tcfg.get("workers"), meter, name=tcfg.get("name", "s3")), None
+    if tcfg.get("type", "ssh") != "ssh":
+        return None, f"Unsupported sync target type '{tcfg.get('type')}'."
+    remote_path = tcfg.get("remote_path", "")
+    session, err = _open_session(tcfg)
+    if err:
+        return None, err
 
-    # ServerAliveInterval/CountMax detects dead connections in ~90s instead of
-    # waiting for the TCP-level keepalive (default 2h).
-    ssh_opts = (f"ssh -p {port} -o StrictHostKeyChecking=accept-new "
-                f"-o ConnectTimeout=15 -o ServerAliveInterval=30 -o ServerAliveCountMax=3")
-    key_file = None
-
-    # -a (archive) but NOT -z: iOS backups are encrypted / already-compressed, so
-    # gzip gains ~nothing and just burns the Radxa's weak CPU (and can bottleneck
-    # the transfer). --partial + --partial-dir keep incomplete files in a stable
-    # dir on the remote so a reboot mid-sync resumes; rsync excludes it from --delete.
+    # -a (archive); compression is decided per run by sync_tuner: encrypted
+    # backups and a CPU-bound link (gigabit LAN on the Radxa's weak CPU) stay
+    # uncompressed, a slow link (iPhone hotspot) with compressible data gets it.
+    # --partial + --partial-dir keep incomplete files in a stable dir on the
+    # remote so a reboot mid-sync resumes; rsync excludes it from --delete.
     rsync_flags = ["-a", "--delete", "--partial", "--partial-dir=.rsync-partial",
                    "--rsync-path=/usr/bin/rsync"]
     # Leave destination-managed metadata alone. The source never has these, so
@@ -162,35 +636,146 @@ def _prepare_sync(passphrase=None, backup_dir=None, progress=False):
         # --outbuf=L line-buffers rsync's output. Without it, rsync block-buffers
         # progress2 to the pipe and emits it in bursts with long gaps, which
         # trips the stall detector even though the transfer is alive.
-        rsync_flags += ["--info=progress2", "--no-inc-recursive", "--outbuf=L"]
+        # --stats gives the wire/data byte counts the tuner learns from.
+        rsync_flags += ["--info=progress2", "--no-inc-recursive", "--outbuf=L", "--stats"]
 
-    if auth_method == "key" and ssh_key:
-        fd, key_file = tempfile.mkstemp(prefix="sync_key_", suffix=".pem")
-        with os.fdopen(fd, "w") as f:
-            clean_key = ssh_key.replace("\r\n", "\n").replace("\r", "\n")
-            f.write(clean_key)
-            if not clean_key.endswith("\n"):
-                f.write("\n")
-        os.chmod(key_file, 0o600)
-        ssh_opts += f" -i {key_file}"
-        cmd = ["/usr/bin/rsync"] + rsync_flags + ["-e", ssh_opts, backup_dir, f"{username}@{host}:{remote_path}/"]
-    elif auth_method == "password" and password:
-        cmd = ["sshpass", "-p", password, "/usr/bin/rsync"] + rsync_flags + ["-e", ssh_opts, backup_dir, f"{username}@{host}:{remote_path}/"]
-    else:
-        return None, None, {"success": False, "message": "No SSH key or password configured.", "duration": 0}
+    rsync_flags += datausage.target_bwlimit_flags(run["profile"], tcfg.get("bwlimit"), shares)
 
-    return cmd, key_file, None
+    sync_cfg = run["sync_cfg"]
+    mode = sync_cfg.get("compression", "auto")
+    try:
+        tuning = sync_tuner.tune(session, backup_dir, mode=mode, network=run["network"],
+                                 metered=datausage.is_metered(run["profile"]))
+    except Exception as e:
+        tuning = {"network": run["network"], "compress": "", "level": None, "flags": [],
+                  "reason": f"tuner failed: {e}"}
+    rsync_flags += tuning.get("flags", [])
 
+    return _SyncContext(session, backup_dir, remote_path, rsync_flags, tuning, meter,
+                        snapshots, name=tcfg.get("name", "primary")), None
 
-def _cleanup_key(key_file):
-    if key_file and os.path.exists(key_file):
-        try:
-            os.remove(key_file)
-        except Exception:
-            pass
+
+def _check_local_target(path, backup_dir):
+    """Disk ID of the local target at ``path``. Returns (disk_id, error_text)."""
+    err = sync_local.check_target(path)
+    if err:
+        return None, err
+    real, src = os.path.realpath(path), os.path.realpath(backup_dir)
+    if real == src or real.startswith(src + os.sep) or src.startswith(real + os.sep):
+        return None, f"Local target {path} overlaps the backup directory."
+    try:
+        return sync_local.target_id(path), None
+    except OSError as e:
+        return None, f"Local target {path}: {e.strerror}"
+
+
+def _open_session(tcfg, borrow=False):
+    """Open the SSH session of an SSH target (see _SshSession.open for
+    ``borrow``). Returns (session, error_text)."""
+    host = tcfg.get("host", "")
+    port = tcfg.get("port", 22)
+    if not host or not tcfg.get("username") or not tcfg.get("remote_path"):
+        return None, "Incomplete sync configuration (host/user/path)."
+
+    session = _SshSession(tcfg)
+    if not session.has_credentials:
+        return None, "No SSH key or password configured."
+
+    # Pre-flight: bring up the ControlMaster every later ssh/rsync of this run
+    # multiplexes over. Success proves reachability + auth in one handshake; on
+    # failure, turn the would-be cryptic rsync error into a clear cause (no
+    # network / VPN down / no internet). Both the manual and auto-sync paths
+    # funnel through here, so the message reaches the e-ink, the dashboard, and
+    # notifications.
+    ok, ssh_err = session.open(borrow)
+    if not ok:
+        session.close()
+        return None, _diagnose_unreachable(host, port) or f"SSH connection failed: {ssh_err}"
+    return session, None
+
+
+def _open_vault_target(tcfg, backup_dir, meter=None):
+    """Open a target with ``encrypt: true`` (see sync_vault): the same target
+    types, written to as an encrypted chunk store. Returns (context,
+    error_text)."""
+    if not sync_vault.cipher_available():
+        return None, "Encrypted sync needs the python3 cryptography package."
+    if not tcfg.get("vault_password"):
+        return None, "Encrypted target without a vault password."
+    kind = tcfg.get("type", "ssh")
+    session = None
+    if kind == "local":
+        path = tcfg.get("path", "").rstrip("/") or "/"
+        disk_id, err = _check_local_target(path, backup_dir)
+        if err:
+            return None, err
+        store, key = sync_vault.DirStore(path), f"local:{disk_id}:{path}"
+    elif kind == "s3":
+        client, err = _s3_client(tcfg)
+        if err:
+            return None, err
+        prefix = tcfg.get("prefix", "").strip("/")
+        store = sync_vault.S3Store(client, prefix)
+        key = f"s3:{client.host}/{client.bucket}/{prefix}"
+    elif kind == "ssh":
+        session, err = _open_session(tcfg)
+        if err:
+            return None, err
+        store = sync_vault.SshStore(session, tcfg["remote_path"])
+        key = f"{session.dest}:{session.port}:{store.root}"
+    else:
+        return None, f"Unsupported sync target type '{kind}'."
+    try:
+        keys = sync_vault.open_vault(store, tcfg["vault_password"])
+    except (sync_vault.VaultError, sync_s3.S3Error, OSError) as e:
+        store.close()
+        _cleanup_key(session)
+        return None, f"Cannot open the vault: {e}"
+    index = sync_vault.Index(logutil.state_path(
+        f"vault_index_{hashlib.sha1(key.encode()).hexdigest()[:12]}.json"), keys.check)
+    return _VaultContext(backup_dir, store, keys, index, f"vault:{key}", session,
+                         tcfg.get("workers"), meter, name=tcfg.get("name", "vault")), None
+
+
+def _s3_client(tcfg):
+    """Client for an S3 target, checked with a HEAD on its bucket. Returns
+    (client, error_text)."""
+    missing = [k for k in ("endpoint", "bucket", "access_key", "secret_key") if not tcfg.get(k)]
+    if missing:
+        return None, f"Incomplete S3 configuration ({'/'.join(missing)})."
+    client = sync_s3.S3Client(tcfg["endpoint"], tcfg["bucket"], tcfg["access_key"],
+                              tcfg["secret_key"], tcfg.get("region") or "us-east-1")
+    try:
+        client.head_bucket()
+    except sync_s3.S3Error as e:
+        client.close()
+        if e.status == 404:
+            return None, f"S3 bucket {tcfg['bucket']} not found."
+        if e.status == 403:
+            return None, f"S3 access to {tcfg['bucket']} denied (check the keys)."
+        return None, f"S3 error: {e}"
+    except (OSError, http.client.HTTPException) as e:
+        client.close()
+        u = urllib.parse.urlsplit(f"{client.scheme}://{client.host}")
+        port = u.port or (443 if u.scheme == "https" else 80)
+        return None, _diagnose_unreachable(u.hostname, port) or f"S3 endpoint unreachable: {e}"
+    return client, None
+
+
+def _cleanup_key(session):
+    """Release a run's SSH session: tear down the ControlMaster it owns and
+    remove the temporary key file."""
+    if session is not None:
+        session.close()
 
 
 _PROGRESS_RE = re.compile(r"([\d,]+)\s+(\d+)%\s+([\d.]+[kKMGT]?B/s)")
+# One matcher for every complete rsync output record: a progress2 update
+# (groups 1-3) or one of the --stats totals the tuner's history is built from
+# (groups 4-5). Anything else is a file name / message for the log.
+_RECORD_RE = re.compile(
+    rb"\s*([\d,]+)\s+(\d+)%\s+([\d.]+[kKMGT]?B/s)"
+    rb"|(Total transferred file size|Total bytes sent|Literal data|Matched data):\s+([\d,]+)")
 
 # rsync exit codes (see rsync(1)), mapped to a short human reason so the log's
 # failure line is self-explanatory instead of a bare number.
@@ -237,6 +822,90 @@ def parse_progress_line(text):
     return {"bytes": bytes_transferred, "pct": pct, "speed": speed, "total": total}
 
 
+class _RsyncOutput:
+    """Incremental parser for rsync's merged stdout/stderr.
+
+    Reads up to READ_SIZE bytes at a time into one reusable bytearray, keeps an
+    incomplete trailing record in ``_pending`` until its ``\\r``/``\\n`` arrives
+    (so a progress update split across reads is never misparsed), and runs each
+    complete record through ``_RECORD_RE`` once. Of the progress updates in a
+    read only the newest is decoded and returned; rsync can print dozens a
+    second and the UI only needs the latest. Other lines are teed to
+    ``log_file``; --stats totals are collected in ``stats``.
+    """
+
+    READ_SIZE = 64 * 1024
+    MAX_PENDING = 1024 * 1024   # a record this long without a newline is flushed as-is
+
+    def __init__(self, log_file=None):
+        self.log_file = log_file
+        self.stats = {}
+        self._chunk = bytearray(self.READ_SIZE)
+        self._view = memoryview(self._chunk)
+        self._pending = bytearray()
+
+    def read(self, fd):
+        """Read what's available on ``fd``. Returns (nbytes, newest progress
+        dict or None); nbytes == 0 means EOF."""
+        n = os.readv(fd, [self._chunk])
+        if not n:
+            return 0, None
+        return n, self.feed(self._view[:n])
+
+    def feed(self, data):
+        """Add raw output; returns the newest complete progress record or None."""
+        buf = self._pending
+        buf += data
+        end = max(buf.rfind(b"\n"), buf.rfind(b"\r"))
+        if end < 0:
+            if len(buf) < self.MAX_PENDING:
+                return None
+            end = len(buf)
+        records = bytes(buf[:end]).replace(b"\r", b"\n").split(b"\n")
+        del buf[:end + 1]
+        return self._consume(records)
+
+    def flush(self):
+        """Process a trailing record with no line ending (e.g. a final error)."""
+        if not self._pending:
+            return None
+        records = [bytes(self._pending)]
+        self._pending.clear()
+        return self._consume(records)
+
+    def _consume(self, records):
+        newest = None
+        for rec in records:
+            if not rec.strip():
+                continue
+            m = _RECORD_RE.match(rec)
+            if m and m.group(1) is not None:
+                newest = m
+            elif m:
+                self.stats[m.group(4).decode()] = int(m.group(5).replace(b",", b""))
+                self._log(rec)
+            else:
+                self._log(rec)
+        if newest is None:
+            return None
+        bytes_transferred = int(newest.group(1).replace(b",", b""))
+        pct = int(newest.group(2))
+        total = int(bytes_transferred * 100 / pct) if pct > 0 else 0
+        return {"bytes": bytes_transferred, "pct": pct,
+                "speed": newest.group(3).decode(), "total": total}
+
+    def _log(self, rec):
+        # Drop the progress-bar updates (already surfaced via on_progress); keep
+        # file names and errors so the log stays useful without growing by tens
+        # of KB per minute.
+        if not self.log_file:
+            return
+        try:
+            self.log_file.write(rec.decode("utf-8", errors="replace").rstrip() + "\n")
+        except Exception:
+            pass
+
+
 def _resolve_min_battery(min_battery):
     """Resolve the power-aware sync threshold (config default 35; 0 disables)."""
     if min_battery is not None:
@@ -249,119 +918,123 @@ def _resolve_min_battery(min_battery):
 
 def run_sync(passphrase=None, backup_dir=None):
     """
-    Run rsync to sync backups to remote server (blocking, no progress).
+    Sync backups to every configured target (blocking, no progress): see
+    run_sync_with_progress.
     Returns dict: {success: bool, message: str, duration: float}
     """
-    cmd, key_file, err = _prepare_sync(passphrase=passphrase, backup_dir=backup_dir)
-    if err:
-        return err
-
-    start = time.time()
+    return run_sync_with_progress(passphrase=passphrase, backup_dir=backup_dir)
+
+
+# Rsync supervisor watchdog. Two phases per rsync:
+#   1. Initial scan phase — rsync is building the file list (--no-inc-recursive).
+#      No progress lines yet; the user just needs to know it's still working.
+#      Surface a "Building file list (Xs)" hint to dashboard/e-ink, and kill
+#      only after a generous SCAN_KILL_SEC to cover huge trees.
+#   2. Transfer phase — once we've parsed at least one progress line, switch
+#      to real stall detection (sync_watchdog.StallWatch): "stalled" once
+#      nothing moved for as long as the link's expected throughput allows,
+#      killed within seconds when the TCP link is dead, and otherwise only
+#      after STALL_KILL_SEC without any output, disk or network activity.
+SCAN_NOTIFY_SEC = 5      # how soon we tell the UI "we're scanning"
+SCAN_KILL_SEC = 1800     # 30 min — kill if rsync produces NO output at all
+# rsync's progress2 output is bursty on a many-small-files backup over SSH:
+# it can legitimately go silent for minutes between bursts (per-file overhead,
+# delete pass, remote fsync). The watch counts process I/O and socket queues
+# as signs of life too, so a slow-but-alive transfer is never aborted.
+STALL_KILL_SEC = 1800    # 30 min — kill only after a long, genuine silence
+
+BATTERY_CHECK_SEC = 30   # how often to poll the UPS for the abort guard
+METER_POLL_SEC = 5       # how often to sample /proc/net/dev for the data cap
+CANCEL_GRACE_SEC = 10    # a cancelled rsync gets SIGTERM this long before SIGKILL
+
+
+def _kill(proc, grace=0):
+    """Kill rsync. With ``grace`` it gets SIGTERM first, so it can save the
+    file it was writing into --partial-dir and exit cleanly."""
+    if grace:
+        try:
+            proc.terminate()
+            proc.wait(timeout=grace)
+            return
+        except Exception:
+            pass
     try:
-        print(f"[SYNC] Running: {' '.join(cmd[:4])}...", flush=True)
-        r = subprocess.run(cmd, capture_output=True, text=True, timeout=3600)
-        duration = time.time() - start
-        if r.returncode == 0:
-            return {"success": True, "message": f"Sync complete ({duration:.0f}s).", "duration": duration}
-        else:
-            err_msg = r.stderr.strip()[:200] if r.stderr else f"rsync exit code {r.returncode}"
-            return {"success": False, "message": f"rsync failed: {err_msg}", "duration": duration}
-    except subprocess.TimeoutExpired:
-        return {"success": False, "message": "Sync timed out (1h limit).", "duration": time.time() - start}
-    except FileNotFoundError as e:
-        tool = "sshpass" if "sshpass" in str(e) else "/usr/bin/rsync"
-        return {"success": False, "message": f"{tool} not found. Install it.", "duration": 0}
-    except Exception as e:
-        return {"success": False, "message": f"Sync error: {e}", "duration": time.time() - start}
-    finally:
-        _cleanup_key(key_file)
+        proc.kill()
+    except Exception:
+        pass
+    try:
+        proc.wait(timeout=5)
+    except Exception:
+        pass
 
 
-def run_sync_with_progress(passphrase=None, backup_dir=None, on_progress=None, log_file=None,
-                           min_battery=None):
-    """
-    Run rsync with real-time progress reporting.
-    on_progress(info: dict) is called as progress updates arrive.
-    log_file: optional writable file object — raw rsync output (stdout+stderr) is teed to it.
-    min_battery: power-aware abort threshold (percent). None → config default (35); 0 disables.
-    Returns dict: {success: bool, message: str, duration: float}
-    """
-    cmd, key_file, err = _prepare_sync(passphrase=passphrase, backup_dir=backup_dir, progress=True)
-    if err:
-        return err
+class _RunStop(threading.Event):
+    """A run's stop event: set by the run itself (one target hit the battery
+    or data-cap guard), and also reads as set once the caller's ``cancel``
+    event is (a cancel from the sync worker), without the run setting that."""
 
-    min_battery = _resolve_min_battery(min_battery)
+    def __init__(self, cancel=None):
+        super().__init__()
+        self._outer = cancel
 
-    # Two-phase watchdog:
-    #   1. Initial scan phase — rsync is building the file list (--no-inc-recursive).
-    #      No progress lines yet; the user just needs to know it's still working.
-    #      Surface a "Building file list (Xs)" hint to dashboard/e-ink, and kill
-    #      only after a generous SCAN_KILL_SEC to cover huge trees.
-    #   2. Transfer phase — once we've parsed at least one progress line, switch
-    #      to real stall detection: warn quickly, kill after STALL_KILL_SEC.
-    SCAN_NOTIFY_SEC = 5      # how soon we tell the UI "we're scanning"
-    SCAN_KILL_SEC = 1800     # 30 min — kill if rsync produces NO output at all
-    # rsync's progress2 output is bursty on a many-small-files backup over SSH:
-    # it can legitimately go silent for minutes between bursts (per-file overhead,
-    # delete pass, remote fsync). Keep the thresholds generous so a slow-but-alive
-    # transfer isn't flagged "stalled" or falsely aborted.
-    STALL_WARN_SEC = 300     # 5 min — only then surface "stalled" on the UI
-    STALL_KILL_SEC = 1800    # 30 min — kill only after a long, genuine silence
-
-    BATTERY_CHECK_SEC = 30   # how often to poll the UPS for the abort guard
+    def is_set(self):
+        return super().is_set() or (self._outer is not None and self._outer.is_set())
 
-    start = time.time()
-    proc = None
-    killed_for_stall = False
-    killed_for_scan = False
-    killed_for_battery = False
-    battery_reason = ""
-    try:
-        print(f"[SYNC] Running (progress): {' '.join(cmd[:4])}...", flush=True)
-        if log_file:
-            try:
-                log_file.write(f"[CMD] {' '.join(cmd)}\n")
-            except Exception:
-                pass
-        # Merge stderr into stdout so a single reader sees both progress and errors.
-        # Binary mode + raw fd lets us use select() reliably for stall detection.
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                bufsize=0)
-        fd = proc.stdout.fileno()
-
-        last_pct = -1
-        last_bytes = 0
-        last_total = 0
-        last_speed = ""
-        last_data_time = time.time()
-        seen_progress = False       # True once we've parsed a progress line
-        stall_warned = False
-        scan_notified = False
-        scan_start = time.time()
-        last_batt_check = time.time()
-
-        # Tee rsync output to the log a line at a time, dropping the progress-bar
-        # updates (the "1,234  45%  1.2MB/s" spam) — that data is already surfaced
-        # via on_progress. Keeps file names and errors so the log stays useful
-        # without growing by tens of KB per minute.
-        log_tail = ""
-
-        def _tee(text):
-            nonlocal log_tail
-            if not log_file or not text:
-                return
-            log_tail += text
-            parts = re.split(r"[\r\n]+", log_tail)
-            log_tail = parts.pop()
-            for line in parts:
-                line = line.rstrip()
-                if line and not _PROGRESS_RE.search(line):
-                    try:
-                        log_file.write(line + "\n")
-                    except Exception:
-                        pass
 
+def _stall_watch(session, rate):
+    """A StallWatch for one rsync over ``session``, expecting ``rate`` bytes/s
+    and watching the TCP connection to the SSH host."""
+    host = getattr(session, "host", "")
+    remote = (host, session.port) if host else None
+    return sync_watchdog.StallWatch(rate, remote, STALL_KILL_SEC)
+
+
+def _supervise_rsync(cmd, env, report=None, log_file=None, min_battery=0, meter=None,
+                     cancel=None, watch=None):
+    """Run one rsync and watch it: progress, scan/stall watchdog, battery and
+    data-cap guards.
+
+    report(info) receives this rsync's own progress (pct/bytes/total of this
+    pass only; the caller maps it onto the whole run). ``cancel`` is an
+    optional threading.Event; once set, rsync is stopped with SIGTERM (another
+    target of the run hit the battery or data-cap guard, or the run was
+    cancelled). ``watch`` is the sync_watchdog.StallWatch judging stalls (one
+    with the default link rate if None). Returns a dict with ``rc``,
+    ``abort`` (None, "battery", "cap", "scan", "stall" or "cancelled"),
+    ``reason``, ``stats`` (rsync --stats totals) and ``transfer_start``.
+    """
+    # Merge stderr into stdout so a single reader sees both progress and errors.
+    # Binary mode + raw fd lets us use select() reliably for stall detection.
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            bufsize=0, env=env)
+    fd = proc.stdout.fileno()
+    if watch is None:
+        watch = sync_watchdog.StallWatch(hard_kill_sec=STALL_KILL_SEC)
+    watch.start(proc.pid)
+    result = {"rc": None, "abort": None, "reason": "", "stats": {}, "transfer_start": None}
+
+    last_pct = -1
+    last_bytes = 0
+    last_total = 0
+    last_speed = ""
+    seen_progress = False       # True once we've parsed a progress line
+    stall_warned = False
+    scan_notified = False
+    scan_start = time.time()
+    last_batt_check = time.time()
+    last_meter_poll = time.time()
+    # Buffered, incremental record parser; also tees non-progress lines to
+    # the log and collects the --stats totals for the tuner history.
+    output = _RsyncOutput(log_file)
+    result["stats"] = output.stats
+
+    try:
         while True:
+            if cancel is not None and cancel.is_set():
+                result["abort"] = "cancelled"
+                _kill(proc, CANCEL_GRACE_SEC)
+                break
+
             # Power-aware abort: if the UPS drops below the threshold (and isn't
             # charging) mid-sync, kill rsync so it doesn't get cut by PiSugar's
             # own auto-shutdown — and so --partial-dir can resume it next time.
@@ -369,18 +1042,24 @@ def run_sync_with_progress(passphrase=None, backup_dir=None, on_progress=None, l
                 last_batt_check = time.time()
                 batt_ok, batt_reason = power.sync_allowed(min_battery)
                 if not batt_ok:
-                    killed_for_battery = True
-                    battery_reason = batt_reason
+                    result.update(abort="battery", reason=batt_reason)
                     if log_file:
                         log_file.write(f"[ABORT] {batt_reason} — killing rsync\n")
-                    try:
-                        proc.kill()
-                    except Exception:
-                        pass
-                    try:
-                        proc.wait(timeout=5)
-                    except Exception:
-                        pass
+                    _kill(proc)
+                    break
+
+            # Data cap: stop as soon as this month's usage on a metered network
+            # reaches its cap. --partial-dir keeps the half-sent file, so the
+            # resumed run on an unmetered network picks up where this stopped.
+            if meter and time.time() - last_meter_poll >= METER_POLL_SEC:
+                last_meter_poll = time.time()
+                meter.poll()
+                if meter.over_cap():
+                    result["abort"] = "cap"
+                    if log_file:
+                        log_file.write(f"[ABORT] monthly data cap reached on {meter.network} "
+                                       f"({meter.run_bytes / 1e6:.1f} MB this run) — killing rsync\n")
+                    _kill(proc)
                     break
 
             if proc.poll() is not None:
@@ -389,33 +1068,37 @@ def run_sync_with_progress(passphrase=None, backup_dir=None, on_progress=None, l
                     rest = proc.stdout.read()
                 except Exception:
                     rest = b""
-                if rest and log_file:
-                    _tee(rest.decode("utf-8", errors="replace"))
+                parsed = output.feed(rest) if rest else None
+                if parsed and report:
+                    # A short rsync can exit before the loop ever read its output.
+                    if result["transfer_start"] is None:
+                        result["transfer_start"] = time.time()
+                    report({"pct": parsed["pct"], "bytes": parsed["bytes"],
+                            "total": parsed["total"], "speed": parsed["speed"],
+                            "stalled": False, "scanning": False})
                 break
 
             r, _, _ = select.select([fd], [], [], 2.0)
             if r:
                 try:
-                    chunk_bytes = os.read(fd, 1024)
+                    nread, parsed = output.read(fd)
                 except OSError:
                     break
-                if not chunk_bytes:
+                if not nread:
                     break
-                chunk = chunk_bytes.decode("utf-8", errors="replace")
-                last_data_time = time.time()
+                watch.output(parsed["bytes"] if parsed else None)
                 if stall_warned:
                     stall_warned = False
                     if log_file:
                         log_file.write("[INFO] resumed receiving data from rsync\n")
-                _tee(chunk)
-                parsed = parse_progress_line(chunk)
-                if parsed and on_progress:
+                if parsed and report:
                     bytes_transferred = parsed["bytes"]
                     pct = parsed["pct"]
                     speed = parsed["speed"]
                     total = parsed["total"]
                     if not seen_progress:
                         seen_progress = True
+                        result["transfer_start"] = time.time()
                         if log_file:
                             log_file.write(f"[INFO] file list complete after {int(time.time() - scan_start)}s, transfer started\n")
                     if pct != last_pct or bytes_transferred != last_bytes:
@@ -423,9 +1106,8 @@ def run_sync_with_progress(passphrase=None, backup_dir=None, on_progress=None, l
                         last_bytes = bytes_transferred
                         last_total = total
                         last_speed = speed
-                        on_progress({
+                        report({
                             "pct": pct,
-                            "elapsed": time.time() - start,
                             "bytes": bytes_transferred,
                             "total": total,
                             "speed": speed,
@@ -433,31 +1115,29 @@ def run_sync_with_progress(passphrase=None, backup_dir=None, on_progress=None, l
                             "scanning": False,
                         })
             else:
-                idle = time.time() - last_data_time
+                verdict = watch.check()
                 scan_elapsed = int(time.time() - scan_start)
                 if not seen_progress:
                     # ---- Scan phase: rsync is building the file list ----
+                    if verdict["state"] == "dead":
+                        result.update(abort="stall", reason=verdict["reason"])
+                        if log_file:
+                            log_file.write(f"[STALL] {verdict['reason']} — killing rsync\n")
+                        _kill(proc)
+                        break
                     if scan_elapsed >= SCAN_KILL_SEC:
-                        killed_for_scan = True
+                        result["abort"] = "scan"
                         if log_file:
                             log_file.write(f"[ABORT] rsync produced no progress for {scan_elapsed}s — killing\n")
-                        try:
-                            proc.kill()
-                        except Exception:
-                            pass
-                        try:
-                            proc.wait(timeout=5)
-                        except Exception:
-                            pass
+                        _kill(proc)
                         break
-                    if scan_elapsed >= SCAN_NOTIFY_SEC and on_progress:
+                    if scan_elapsed >= SCAN_NOTIFY_SEC and report:
                         if not scan_notified:
                             scan_notified = True
                             if log_file:
                                 log_file.write(f"[SCAN] still building file list ({scan_elapsed}s)\n")
-                        on_progress({
+                        report({
                             "pct": 0,
-                            "elapsed": time.time() - start,
                             "bytes": 0,
                             "total": 0,
                             "speed": "",
@@ -467,144 +1147,818 @@ def run_sync_with_progress(passphrase=None, backup_dir=None, on_progress=None, l
                         })
                 else:
                     # ---- Transfer phase: real stall detection ----
-                    if idle >= STALL_KILL_SEC:
-                        killed_for_stall = True
+                    if verdict["kill"]:
+                        result.update(abort="stall", reason=verdict["reason"])
                         if log_file:
-                            log_file.write(f"[STALL] no output for {int(idle)}s — killing rsync\n")
-                        try:
-                            proc.kill()
-                        except Exception:
-                            pass
-                        try:
-                            proc.wait(timeout=5)
-                        except Exception:
-                            pass
+                            log_file.write(f"[STALL] {verdict['reason']} — killing rsync\n")
+                        _kill(proc)
                         break
-                    elif idle >= STALL_WARN_SEC:
+                    elif verdict["state"] != "ok":
                         if not stall_warned:
                             stall_warned = True
                             if log_file:
-                                log_file.write(f"[STALL] no output for {int(idle)}s\n")
-                        if on_progress:
-                            on_progress({
+                                log_file.write(f"[STALL] {verdict['reason']}\n")
+                        if report:
+                            report({
                                 "pct": last_pct if last_pct >= 0 else 0,
-                                "elapsed": time.time() - start,
                                 "bytes": last_bytes,
                                 "total": last_total,
                                 "speed": last_speed,
                                 "stalled": True,
-                                "stalled_seconds": int(idle),
+                                "stalled_seconds": int(verdict["idle"]),
+                                "scanning": False,
+                            })
+                    elif stall_warned:
+                        # Quiet output, but the disk or the socket moved again.
+                        stall_warned = False
+                        if log_file:
+                            log_file.write("[INFO] transfer is moving again\n")
+                        if report:
+                            report({
+                                "pct": last_pct if last_pct >= 0 else 0,
+                                "bytes": last_bytes,
+                                "total": last_total,
+                                "speed": last_speed,
+                                "stalled": False,
                                 "scanning": False,
                             })
+    except BaseException:
+        _kill(proc)      # never leave an unsupervised rsync behind
+        raise
+
+    # Flush any trailing buffered line (e.g. a final error without a newline).
+    output.flush()
+
+    # The read loop can break on EOF (os.read -> b"") or OSError before the
+    # top-of-loop proc.poll() ever observes the child's exit, leaving
+    # proc.returncode == None. Reap it here so we report the real exit status
+    # instead of a useless "exit None" — and so a clean exit-0 that happened
+    # to end via the EOF path isn't misreported as a failure.
+    if proc.returncode is None:
+        try:
+            proc.wait(timeout=10)
+        except Exception:
+            pass
+    result["rc"] = proc.returncode
+    return result
+
+
+def _estimate_key(tcfg, snapshots):
+    """The key _checkpoint_target gives ``tcfg`` once it is open, worked out
+    from the config alone. None if that needs the target itself (a local disk
+    that isn't mounted or has no ID yet)."""
+    kind = tcfg.get("type", "ssh")
+    if kind == "local":
+        path = tcfg.get("path", "").rstrip("/") or "/"
+        disk_id = sync_local.read_target_id(path)
+        if not disk_id:
+            return None
+        where = f"local:{disk_id}:{path}"
+    elif kind == "s3":
+        host = urllib.parse.urlparse(tcfg.get("endpoint", "")).netloc
+        where = f"s3:{host}/{tcfg.get('bucket', '')}/{tcfg.get('prefix', '').strip('/')}"
+    else:
+        remote_path = tcfg.get("remote_path", "")
+        if tcfg.get("encrypt"):
+            remote_path = remote_path.rstrip("/") or "/"
+        where = f"{tcfg.get('username', '')}@{tcfg.get('host', '')}:{tcfg.get('port', 22)}:{remote_path}"
+    if tcfg.get("encrypt"):
+        return f"vault:{where}"
+    mode = "snapshots" if snapshots and kind != "s3" else "mirror"
+    return f"{where}:{mode}"
+
+
+def estimate_sync(passphrase=None):
+    """Estimate the next sync (see sync_estimate): bytes and files each
+    target still needs, ETA and battery cost, from the local checkpoints and
+    run history, without connecting to any target. None without sync
+    credentials."""
+    cfg = sync_crypto.decrypt_sync_config(passphrase=passphrase)
+    if not cfg:
+        return None
+    snapshots = (_load_config().get("sync", {}).get("snapshots") or {}).get("enabled")
+    try:
+        import netutil
+        network = netutil.network_label()
+    except Exception:
+        network = None
+    targets = [{"name": t["name"], "key": _estimate_key(t, snapshots),
+                "uplink": t.get("type", "ssh") != "local" or bool(t.get("encrypt"))}
+               for t in _sync_targets(cfg)]
+    return sync_estimate.estimate(_load_backup_dir(), targets, sync_tuner.load_history(),
+                                  network, sync_estimate.drain_rate())
+
+
+def admission(min_battery, forecast=True, log_file=None):
+    """May a sync start on the battery? Refused below ``min_battery`` when
+    not charging and, with ``forecast``, when the estimated battery cost
+    (estimate_sync, with sync_estimate.SAFETY margin) would take it below
+    ``min_battery`` before the sync ends. Returns (ok, reason); fail-open."""
+    if not power or not min_battery:
+        return True, ""
+    battery = power.get_battery()
+    ok, reason = power.sync_allowed(min_battery, battery)
+    if not ok or not forecast or battery.get("percent") is None or battery.get("charging"):
+        return ok, reason
+    try:
+        est = estimate_sync()
+    except Exception:
+        est = None
+    if not est:
+        return True, ""
+    if log_file:
+        log_file.write(f"[ESTIMATE] {sync_estimate.describe(est)}\n")
+    return power.sync_allowed(min_battery, battery, est["battery_pct"] * sync_estimate.SAFETY)
+
+
+def _checkpoint_target(ctx):
+    """Checkpoint key: a checkpoint only applies to the remote (and layout:
+    mirror or snapshots) it was made for. A local target is keyed by the
+    disk's ID, so each rotated disk keeps its own; an S3 target by endpoint,
+    bucket and prefix."""
+    mode = "snapshots" if ctx.snapshots else "mirror"
+    if ctx.kind == "local":
+        return f"local:{ctx.disk_id}:{ctx.remote_path}:{mode}"
+    if ctx.kind == "s3":
+        return f"s3:{ctx.client.host}/{ctx.client.bucket}/{ctx.remote_path}:{mode}"
+    if ctx.kind == "vault":
+        return ctx.key
+    return f"{ctx.session.dest}:{ctx.session.port}:{ctx.remote_path}:{mode}"
+
+
+class _TargetLog:
+    """Sync log seen by one target's thread when several run at once: every
+    line is prefixed with ``[name]`` and written under a shared lock, so the
+    interleaved output of the targets stays readable."""
+
+    def __init__(self, log_file, name, lock):
+        self._f = log_file
+        self._prefix = f"[{name}] "
+        self._lock = lock
+        self._bol = True
+
+    def write(self, text):
+        out = []
+        for line in text.splitlines(keepends=True):
+            out.append(self._prefix + line if self._bol else line)
+            self._bol = line.endswith("\n")
+        with self._lock:
+            self._f.write("".join(out))
+
+    def flush(self):
+        with self._lock:
+            self._f.flush()
+
+
+_SPEED_RE = re.compile(r"([\d.]+)([kKMGT]?)B/s")
+_SPEED_UNITS = {"": 1, "k": 1024, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def _speed_bps(speed):
+    m = _SPEED_RE.match(speed or "")
+    return float(m.group(1)) * _SPEED_UNITS[m.group(2)] if m else 0.0
+
+
+def _format_speed(bps):
+    """Bytes/s in rsync's own progress2 notation (e.g. ``1.20MB/s``)."""
+    for unit in ("kB", "MB", "GB"):
+        bps /= 1024
+        if bps < 1024 or unit == "GB":
+            return f"{bps:.2f}{unit}/s"
+
+
+class _ProgressAggregator:
+    """Folds the progress of every target of a run into the one on_progress
+    dict that backup-sync.py, the dashboard and the e-ink read.
+
+    The top level is the aggregate (bytes and totals summed over targets,
+    speeds added up; stalled/scanning only when every running target is), and
+    ``info["targets"]`` is the per-target breakdown:
+    ``{name: {"pct", "bytes", "total", "speed", "state", "message"}}`` with
+    state one of pending, running, done, failed, paused or cancelled.
+    Updates arrive from the target threads and are serialised here.
+    """
 
-        # Flush any trailing buffered line (e.g. a final error without a newline).
-        if log_file and log_tail.strip() and not _PROGRESS_RE.search(log_tail):
-            try:
-                log_file.write(log_tail.rstrip() + "\n")
-            except Exception:
-                pass
+    EMIT_MIN_SEC = 0.5
+
+    def __init__(self, on_progress, start, total, names):
+        self._on_progress = on_progress
+        self._start = start
+        self._lock = threading.Lock()
+        self._emit_lock = threading.Lock()     # on_progress itself needn't be thread-safe
+        self._last_emit = 0.0
+        self._flags = {}
+        self._resume = {}
+        self.targets = {n: {"pct": 0, "bytes": 0, "total": total, "speed": "",
+                            "state": "pending", "message": ""} for n in names}
+
+    def begin(self, name, done_bytes, resume_pct):
+        with self._lock:
+            t = self.targets[name]
+            t.update(state="running", bytes=done_bytes,
+                     pct=int(done_bytes * 100 / t["total"]) if t["total"] else 0)
+            if resume_pct:
+                self._resume[name] = done_bytes
+        self._emit(force=bool(resume_pct), scanning=True)
+
+    def update(self, name, info):
+        with self._lock:
+            self.targets[name].update(pct=info["pct"], bytes=info["bytes"],
+                                      total=info["total"] or self.targets[name]["total"],
+                                      speed=info.get("speed", ""))
+            self._flags[name] = info
+        self._emit()
+
+    def finish(self, name, state, message=""):
+        with self._lock:
+            t = self.targets[name]
+            t.update(state=state, message=message, speed="")
+            if state == "done":
+                t.update(pct=100, bytes=t["total"])
+            self._flags.pop(name, None)
+        self._emit(force=True)
+
+    def snapshot(self, scanning=False):
+        """The aggregate on_progress dict (no side effects)."""
+        with self._lock:
+            targets = {n: dict(t) for n, t in self.targets.items()}
+            flags = [self._flags.get(n, {}) for n, t in targets.items() if t["state"] == "running"]
+            resume = sum(self._resume.values())
+        sent = sum(t["bytes"] for t in targets.values())
+        total = sum(t["total"] for t in targets.values())
+        pct = (int(sent * 100 / total) if total
+               else sum(t["pct"] for t in targets.values()) // max(1, len(targets)))
+        speeds = [t["speed"] for t in targets.values() if t["state"] == "running" and t["speed"]]
+        info = {"pct": min(pct, 100), "bytes": sent, "total": total,
+                "speed": speeds[0] if len(speeds) == 1
+                else _format_speed(sum(_speed_bps(v) for v in speeds)) if speeds else "",
+                "elapsed": time.time() - self._start,
+                "stalled": bool(flags) and all(f.get("stalled") for f in flags),
+                "scanning": bool(flags) and all(f.get("scanning", scanning) for f in flags),
+                "targets": targets}
+        if info["stalled"]:
+            info["stalled_seconds"] = min(f.get("stalled_seconds", 0) for f in flags)
+        if info["scanning"]:
+            info["scan_seconds"] = max(f.get("scan_seconds", 0) for f in flags)
+        if resume and total:
+            info["resume_pct"] = int(resume * 100 / total)
+        return info
+
+    def _emit(self, force=False, scanning=False):
+        if not self._on_progress:
+            return
+        with self._emit_lock:
+            now = time.time()
+            if not force and now - self._last_emit < self.EMIT_MIN_SEC:
+                return
+            self._last_emit = now
+            self._on_progress(self.snapshot(scanning))
+
+
+class _FileLists:
+    """The run's one walk of each device folder it sends
+    (sync_checkpoint.file_list), shared by all its targets: the first target
+    to reach a folder walks it, the others wait for that walk and reuse the
+    list, SSH targets as an rsync ``--files-from`` file written once. A list
+    is dropped once every target that had the folder pending has sent it; one
+    a failed target never got to is dropped when the run closes it."""
+
+    def __init__(self, backup_dir, plan):
+        self.backup_dir = backup_dir
+        self._lock = threading.Lock()
+        self._folders = {}            # name -> lock held while walking it
+        self._lists = {}
+        self._files = {}
+        self._users = {}              # name -> targets still to send it
+        for tplan in plan["targets"].values():
+            for s in plan["shards"]:
+                if s["name"] not in tplan["done"]:
+                    self._users[s["name"]] = self._users.get(s["name"], 0) + 1
+
+    def _folder(self, name):
+        with self._lock:
+            return self._folders.setdefault(name, threading.Lock())
+
+    def entries(self, name):
+        """``(rel, path, stat)`` of everything in device folder ``name``."""
+        with self._folder(name):
+            if name not in self._lists:
+                self._lists[name] = sync_checkpoint.file_list(
+                    os.path.join(self.backup_dir, name))
+            return self._lists[name]
+
+    def files_from(self, name):
+        """Path of ``name``'s list as an rsync ``--files-from`` file
+        (NUL-separated, for ``--from0``)."""
+        entries = self.entries(name)
+        with self._folder(name):
+            if name not in self._files:
+                fd, path = tempfile.mkstemp(prefix="sync-files-", suffix=".list")
+                with os.fdopen(fd, "w") as f:
+                    for rel, _, _ in entries:
+                        f.write(rel + "\0")
+                self._files[name] = path
+            return self._files[name]
+
+    def release(self, name):
+        """A target has sent ``name``; the last one drops its list."""
+        with self._lock:
+            self._users[name] = self._users.get(name, 1) - 1
+            if self._users[name] > 0:
+                return
+            self._lists.pop(name, None)
+            path = self._files.pop(name, None)
+        if path:
+            _remove_quietly(path)
 
-        # The read loop can break on EOF (os.read -> b"") or OSError before the
-        # top-of-loop proc.poll() ever observes the child's exit, leaving
-        # proc.returncode == None. Reap it here so we report the real exit status
-        # instead of a useless "exit None" — and so a clean exit-0 that happened
-        # to end via the EOF path isn't misreported as a failure.
-        if proc.returncode is None:
+    def close(self):
+        with self._lock:
+            paths = list(self._files.values())
+            self._lists.clear()
+            self._files.clear()
+        for path in paths:
+            _remove_quietly(path)
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _begin_target(ctx, plan, progress, log_file=None):
+    """Start a target's part of the run: mark it in progress in the
+    checkpoint, log what it skips and report its starting point.
+    Returns (checkpoint key, pending shards, bytes already done)."""
+    target = _checkpoint_target(ctx)
+    tplan = plan["targets"][target]
+    resume_pct = tplan["resume_pct"]
+    pending = [s for s in plan["shards"] if s["name"] not in tplan["done"]]
+    sync_checkpoint.begin(target)
+    print(f"[SYNC] Running (progress) to {ctx.name}: {len(pending)} of {len(plan['shards'])} shard(s)...",
+          flush=True)
+    if log_file:
+        try:
+            if ctx.tuning:
+                log_file.write(f"[TUNE] {sync_tuner.describe(ctx.tuning)}\n")
+            if tplan["done"]:
+                skipped = ", ".join(s["name"] for s in plan["shards"] if s["name"] in tplan["done"])
+                if resume_pct:
+                    log_file.write(f"[RESUME] resuming at {resume_pct}%: already in sync: {skipped}\n")
+                else:
+                    log_file.write(f"[INFO] unchanged since last sync: {skipped}\n")
+        except Exception:
+            pass
+    progress.begin(ctx.name, tplan["done_bytes"], resume_pct)
+    return target, pending, tplan["done_bytes"]
+
+
+def _fail(message, abort=None, **extra):
+    return {"success": False, "message": message, "abort": abort, **extra}
+
+
+def _run_target(ctx, plan, progress, log_file=None, min_battery=0, cancel=None, lists=None):
+    """Sync the shards ``plan`` (from sync_checkpoint.plan_targets) says this
+    target still needs: the top-level pass, then one rsync per pending device
+    folder, each published on the remote and checkpointed once it succeeds.
+    Each device folder is sent from the run's shared file list (``lists``, a
+    _FileLists; one of its own when None) with ``--files-from``.
+
+    Returns {"success", "message", "abort", "paused"}. Progress goes to
+    ``progress`` (a _ProgressAggregator) under ``ctx.name``."""
+    if lists is None:
+        lists = _FileLists(ctx.backup_dir, plan)
+        try:
+            return _run_target(ctx, plan, progress, log_file, min_battery, cancel, lists)
+        finally:
+            lists.close()
+    if ctx.kind != "ssh":
+        return _run_copy_target(ctx, plan, progress, log_file, min_battery, cancel, lists)
+    session = ctx.session
+    meter = ctx.meter
+    name_ = ctx.name
+    start = time.time()
+    total = plan["total"]
+    target, pending, done_bytes = _begin_target(ctx, plan, progress, log_file)
+
+    # The top-level pass runs first: it also creates remote_path, which
+    # the per-device rsyncs need to exist. Each device folder is excluded
+    # from it (and so protected from its --delete); its own pass mirrors it.
+    # In snapshot mode every top-level folder is excluded, so the snapshot
+    # history of a device that is gone locally is never deleted.
+    snap = ctx.snapshots
+    snap_name = sync_snapshots.stamp(start)
+    stats = {}
+    rate = sync_watchdog.expected_rate(sync_tuner.load_history(), ctx.tuning.get("network"))
+    transfer_start = None
+    for shard in [None] + pending:
+        if shard is None:
+            if snap:
+                extra = ["--exclude=/*/"]
+            else:
+                extra = [f"--exclude=/{s['name']}/" for s in plan["shards"] + plan["skipped"]]
+                extra.append(f"--exclude=/{sync_snapshots.STAGING}/")
+                # An unfinished restore is kept locally to resume; never push it.
+                extra.append(f"--exclude=/{sync_restore.RESTORE_DIR}/")
+            cmd = ctx.rsync_cmd(extra=extra)
+            base, size = done_bytes, 0
+        else:
+            name = shard["name"]
+            src = os.path.join(ctx.backup_dir, name) + "/"
+            if snap:
+                # Into <device>/.incomplete, hard-linking unchanged files
+                # against <device>/latest (or the mirror it replaces);
+                # published after the rsync succeeds.
+                device_dir = f"{ctx.remote_path}/{name}"
+                link_base, snap_err = sync_snapshots.prepare(session, device_dir)
+                if snap_err:
+                    return _fail(f"Cannot prepare remote snapshot for {name}: {snap_err}")
+                dst_rel = f"{name}/{sync_snapshots.INCOMPLETE}"
+                extra = sync_snapshots.link_dest_flags(link_base)
+            else:
+                # Into .staging/<device>, hard-linking unchanged files
+                # against the live copy; renamed into place on success.
+                has_live, snap_err = sync_snapshots.stage_prepare(session, ctx.remote_path, name)
+                if snap_err:
+                    return _fail(f"Cannot prepare remote staging for {name}: {snap_err}")
+                dst_rel = f"{sync_snapshots.STAGING}/{name}"
+                extra = sync_snapshots.stage_link_dest_flags(name, has_live)
+            # The folder goes out as the run's shared file list, which rsync
+            # takes as is instead of walking the folder again. rsync deletes
+            # nothing then, so what an interrupted run left in the
+            # destination that is gone locally is removed first.
+            entries = lists.entries(name)
+            snap_err = sync_snapshots.prune_extra(session, f"{ctx.remote_path}/{dst_rel}",
+                                                  [rel for rel, _, _ in entries])
+            if snap_err:
+                return _fail(f"Cannot clear the leftovers of {name} on the remote: {snap_err}")
+            cmd = ctx.rsync_cmd(src=src, dst=ctx.remote(f"{dst_rel}/"),
+                                extra=extra + ["--from0", f"--files-from={lists.files_from(name)}"])
+            base, size = done_bytes, shard["size"]
+        if log_file:
             try:
-                proc.wait(timeout=10)
+                log_file.write(f"[CMD] {' '.join(cmd)}\n")
             except Exception:
                 pass
 
-        duration = time.time() - start
-
-        if killed_for_battery:
-            return {"success": False,
-                    "message": f"Sync aborted: {battery_reason} Will resume next time.",
-                    "duration": duration}
-        if killed_for_scan:
-            mins = SCAN_KILL_SEC // 60
-            return {"success": False,
-                    "message": f"No progress {mins} min, aborted.",
-                    "duration": duration}
-        if killed_for_stall:
-            mins = STALL_KILL_SEC // 60
-            return {"success": False,
-                    "message": f"Sync stalled {mins} min, aborted.",
-                    "duration": duration}
-        if proc.returncode == 0:
-            if on_progress:
-                on_progress({
-                    "pct": 100,
-                    "elapsed": duration,
-                    "bytes": last_total or last_bytes,
-                    "total": last_total or last_bytes,
-                    "speed": last_speed,
-                    "stalled": False,
-                })
-            return {"success": True, "message": f"Sync complete ({duration:.0f}s).", "duration": duration}
-        else:
+        def report(info, base=base, size=size):
+            # Map this pass's progress onto the whole run.
+            if total:
+                sent = base + min(info["pct"], 100) * size // 100
+                info = {**info, "pct": int(sent * 100 / total), "bytes": sent, "total": total}
+            progress.update(name_, info)
+
+        res = _supervise_rsync(cmd, session.env, report, log_file, min_battery, meter, cancel,
+                               _stall_watch(session, rate))
+        for key, val in res["stats"].items():
+            stats[key] = stats.get(key, 0) + val
+        if transfer_start is None:
+            transfer_start = res["transfer_start"]
+
+        if res["abort"] == "cancelled":
+            return _fail("Stopped with the other targets.", "cancelled")
+        if res["abort"] == "battery":
+            return _fail(f"Sync aborted: {res['reason']} Will resume next time.", "battery")
+        if res["abort"] == "cap":
+            msg = (f"Monthly data cap reached on {meter.network}. "
+                   "Sync paused until an unmetered network is available.")
+            datausage.mark_paused(meter.network, msg)
+            return _fail(msg, "cap", paused=True)
+        if res["abort"] == "scan":
+            return _fail(f"No progress {SCAN_KILL_SEC // 60} min, aborted.", "scan")
+        if res["abort"] == "stall":
+            return _fail(f"Sync stalled ({res['reason']}), aborted. Will resume next time.",
+                         "stall")
+        if res["rc"] != 0:
             # stderr was merged into stdout and written to log_file already;
             # the caller logs this message (with the code + reason) to the log.
-            rc = proc.returncode
-            return {"success": False,
-                    "message": f"rsync failed (exit {rc}: {_rsync_exit_detail(rc)}). See sync log.",
-                    "duration": duration}
-    except subprocess.TimeoutExpired:
-        proc.kill()
-        return {"success": False, "message": "Sync timed out (1h limit).", "duration": time.time() - start}
-    except FileNotFoundError as e:
-        tool = "sshpass" if "sshpass" in str(e) else "/usr/bin/rsync"
-        return {"success": False, "message": f"{tool} not found. Install it.", "duration": 0}
+            rc = res["rc"]
+            return _fail(f"rsync failed (exit {rc}: {_rsync_exit_detail(rc)}). See sync log.")
+        if shard is not None and not snap:
+            ok, snap_err = sync_snapshots.publish_staged(session, ctx.remote_path, shard["name"])
+            if not ok:
+                return _fail(f"Cannot publish {shard['name']} on the remote: {snap_err}")
+        if shard is not None and snap:
+            ok, snap_err = sync_snapshots.commit(session, device_dir, snap_name)
+            if not ok:
+                return _fail(f"Cannot publish remote snapshot for {name}: {snap_err}")
+            if log_file:
+                log_file.write(f"[SNAPSHOT] {name}/{snap_name} published as latest\n")
+            pruned, snap_err = sync_snapshots.prune(session, device_dir, snap)
+            if log_file and (pruned or snap_err):
+                log_file.write(f"[SNAPSHOT] pruned {name}: {', '.join(pruned)}\n" if pruned
+                               else f"[WARN] snapshot pruning for {name} failed: {snap_err}\n")
+        if shard is not None:
+            sync_checkpoint.confirm(target, shard["name"], shard["gen"], shard["size"])
+            lists.release(shard["name"])
+            done_bytes += shard["size"]
+            if log_file:
+                log_file.write(f"[CHECKPOINT] {shard['name']} in sync "
+                               f"({done_bytes * 100 // total if total else 100}% of backup)\n")
+
+    # Every shard verified: the next run is not a resume.
+    sync_checkpoint.finish(target)
+    _record_tuning(ctx.tuning, stats, transfer_start, log_file)
+    return {"success": True, "message": f"Sync complete ({time.time() - start:.0f}s).",
+            "abort": None}
+
+
+def _copy_guard(min_battery, cancel, meter=None):
+    """should_stop() for the local and S3 copiers: the run's cancel event and
+    the battery and data-cap guards _supervise_rsync applies to rsync, polled
+    as the copier works. Returns (abort, reason) or None."""
+    last = {"batt": 0.0, "meter": time.time()}
+
+    def should_stop():
+        if cancel is not None and cancel.is_set():
+            return ("cancelled", "")
+        now = time.time()
+        if min_battery and power and now - last["batt"] >= BATTERY_CHECK_SEC:
+            last["batt"] = now
+            ok, reason = power.sync_allowed(min_battery)
+            if not ok:
+                return ("battery", reason)
+        if meter and now - last["meter"] >= METER_POLL_SEC:
+            last["meter"] = now
+            meter.poll()
+            if meter.over_cap():
+                return ("cap", "")
+        return None
+    return should_stop
+
+
+def _run_copy_target(ctx, plan, progress, log_file=None, min_battery=0, cancel=None,
+                     lists=None):
+    """_run_target for targets that copy files themselves instead of through
+    rsync (a local disk, an S3 bucket): the same passes, checkpoints and
+    guards, with the transfer and publish steps supplied by ``ctx``, which
+    sends each device folder from the run's shared file list."""
+    start = time.time()
+    total = plan["total"]
+    target, pending, done_bytes = _begin_target(ctx, plan, progress, log_file)
+    should_stop = _copy_guard(min_battery, cancel, ctx.meter)
+    snap_name = sync_snapshots.stamp(start)
+    try:
+        ctx.sync_root({s["name"] for s in plan["shards"] + plan["skipped"]})
     except Exception as e:
-        return {"success": False, "message": f"Sync error: {e}", "duration": time.time() - start}
-    finally:
-        _cleanup_key(key_file)
+        return _fail(f"Cannot write to {ctx.describe()}: {e}")
 
+    for shard in pending:
+        name = shard["name"]
+        base = done_bytes
 
-def test_connection(passphrase=None):
+        def report(sent, bps, base=base, size=shard["size"]):
+            sent = base + min(sent, size)
+            progress.update(ctx.name, {
+                "pct": int(sent * 100 / total) if total else 100, "bytes": sent, "total": total,
+                "speed": _format_speed(bps) if bps else "", "stalled": False, "scanning": False})
+
+        try:
+            res = ctx.transfer(name, report, should_stop, log_file, lists.entries(name))
+        except Exception as e:
+            return _fail(f"Copy of {name} to {ctx.describe()} failed: {e}")
+        if log_file:
+            log_file.write(f"[COPY] {name}: {res['copied']} copied ({res['copied_bytes'] / 1e6:.1f} MB), "
+                           f"{res.get('linked', 0)} linked, {res['skipped']} already there\n")
+        if res["stopped"]:
+            abort, reason = res["stopped"]
+            if abort == "cancelled":
+                return _fail("Stopped with the other targets.", "cancelled")
+            if abort == "cap":
+                msg = (f"Monthly data cap reached on {ctx.meter.network}. "
+                       "Sync paused until an unmetered network is available.")
+                datausage.mark_paused(ctx.meter.network, msg)
+                return _fail(msg, "cap", paused=True)
+            return _fail(f"Sync aborted: {reason} Will resume next time.", abort)
+        try:
+            ctx.publish(name, snap_name, log_file)
+        except Exception as e:
+            return _fail(f"Cannot publish {name} on {ctx.describe()}: {e}")
+        sync_checkpoint.confirm(target, name, shard["gen"], shard["size"])
+        lists.release(name)
+        done_bytes += shard["size"]
+        if log_file:
+            log_file.write(f"[CHECKPOINT] {name} in sync "
+                           f"({done_bytes * 100 // total if total else 100}% of backup)\n")
+
+    ctx.finish()
+    sync_checkpoint.finish(target)
+    return {"success": True, "message": f"Sync complete ({time.time() - start:.0f}s).",
+            "abort": None}
+
+
+def _summarize(results, duration):
+    """One result dict for a run from the per-target results (in target order)."""
+    if len(results) == 1:
+        res = next(iter(results.values()))
+        out = {"success": res["success"], "message": res["message"], "duration": duration}
+        if res["success"]:
+            out["message"] = f"Sync complete ({duration:.0f}s)."
+    else:
+        ok = [n for n, r in results.items() if r["success"]]
+        bad = [f"{n}: {r['message']}" for n, r in results.items()
+               if not r["success"] and r.get("abort") != "cancelled"]
+        if not bad:
+            bad = [f"{n}: {r['message']}" for n, r in results.items() if not r["success"]]
+        if not bad:
+            out = {"success": True, "duration": duration,
+                   "message": f"Sync complete to {len(ok)} targets ({duration:.0f}s)."}
+        else:
+            synced = f"Synced to {', '.join(ok)}; " if ok else ""
+            out = {"success": False, "duration": duration,
+                   "message": f"{synced}failed on {'; '.join(bad)}"}
+    if any(r.get("paused") for r in results.values()):
+        out["paused"] = True
+    return out
+
+
+def run_sync_with_progress(passphrase=None, backup_dir=None, on_progress=None, log_file=None,
+                           min_battery=None, cancel=None):
     """
-    Test SSH connection to the remote server.
-    Returns dict: {success: bool, message: str}
+    Run rsync to every configured target with real-time progress reporting.
+    on_progress(info: dict) is called as progress updates arrive.
+    log_file: optional writable file object — raw rsync output (stdout+stderr) is teed to it.
+    min_battery: power-aware abort threshold (percent). None → config default (35); 0 disables.
+    Returns dict: {success: bool, message: str, duration: float}
+
+    The local backup tree is scanned once (sync_checkpoint.plan_targets) and
+    the targets are then synced concurrently, one thread each. Per target the
+    run is split into shards: a top-level pass for files at the root of
+    backup_dir and for removing folders of devices that are gone, then one
+    rsync per device folder that target doesn't already hold at the current
+    generation. Each completed shard is checkpointed, so a run cut short
+    resumes with the shards still pending; ``info["resume_pct"]`` is then set
+    to the share already done. ``info["targets"]`` carries the per-target
+    breakdown (see _ProgressAggregator). A battery or data-cap abort on one
+    target stops them all; any other failure only fails its own target.
+    ``cancel`` (a threading.Event, set by the sync worker) stops every target
+    the same way: rsync gets SIGTERM, finished shards stay checkpointed.
     """
-    cfg = sync_crypto.decrypt_sync_config(passphrase=passphrase)
-    if not cfg:
-        return {"success": False, "message": "Cannot decrypt sync credentials."}
+    run, err = _prepare_run(passphrase)
+    if err:
+        return err
+    min_battery = _resolve_min_battery(min_battery)
+    targets = _sync_targets(run["cfg"])
+    multi = len(targets) > 1
+    meter = (datausage.UsageMeter(run["network"], run["iface"], run["profile"])
+             if run["network"] else None)
 
-    host = cfg.get("host", "")
-    port = cfg.get("port", 22)
-    username = cfg.get("username", "")
-    auth_method = cfg.get("auth_method", "key")
-    ssh_key = cfg.get("ssh_key", "")
-    password = cfg.get("password", "")
+    # Only rsync targets share the uplink's bandwidth limit (--bwlimit).
+    shares = sum(1 for t in targets if t.get("type", "ssh") == "ssh" and not t.get("encrypt"))
+    start = time.time()
+    battery = power.get_battery() if power else None     # to learn the battery drain
+    contexts, results, lists = [], {}, None
+    try:
+        for tcfg in targets:
+            ctx, msg = _open_target(tcfg, run, backup_dir, progress=True, meter=meter,
+                                    shares=shares)
+            if msg:
+                results[tcfg["name"]] = {"success": False, "message": msg, "abort": None}
+                if log_file and multi:
+                    log_file.write(f"[{tcfg['name']}] [ERROR] {msg}\n")
+            else:
+                contexts.append(ctx)
+        if not contexts:
+            return {**_summarize(results, 0), "duration": 0}
+
+        # The one local scan of the run: generation IDs and sizes of every
+        # device folder, and which of them each target already holds.
+        plan = sync_checkpoint.plan_targets(contexts[0].backup_dir,
+                                            [_checkpoint_target(c) for c in contexts])
+        if log_file:
+            for s in plan["skipped"]:
+                log_file.write(f"[SKIP] {s['name']}: backup {s['state'].replace('_', ' ')}, "
+                               "not synced (remote keeps its last complete copy)\n")
+        # ...and the one walk of each device folder some target still needs,
+        # shared by every target that sends it.
+        lists = _FileLists(contexts[0].backup_dir, plan)
+        progress = _ProgressAggregator(on_progress, start, plan["total"],
+                                       [t["name"] for t in targets])
+        for name, res in results.items():
+            progress.finish(name, "failed", res["message"])
+
+        stop = _RunStop(cancel)
+        log_lock = threading.Lock()
+
+        def work(ctx):
+            logf = _TargetLog(log_file, ctx.name, log_lock) if multi and log_file else log_file
+            try:
+                res = _run_target(ctx, plan, progress, logf, min_battery, stop, lists)
+            except FileNotFoundError as e:
+                tool = "sshpass" if "sshpass" in str(e) else "/usr/bin/rsync"
+                res = {"success": False, "message": f"{tool} not found. Install it.", "abort": None}
+            except Exception as e:
+                res = {"success": False, "message": f"Sync error: {e}", "abort": None}
+            if res["abort"] in ("battery", "cap"):
+                stop.set()            # the whole box is affected, not just this target
+            results[ctx.name] = res
+            state = ("done" if res["success"] else "paused" if res.get("paused")
+                     else "cancelled" if res["abort"] == "cancelled" else "failed")
+            progress.finish(ctx.name, state, "" if res["success"] else res["message"])
+
+        if multi:
+            threads = [threading.Thread(target=work, args=(c,), name=f"sync-{c.name}", daemon=True)
+                       for c in contexts]
+            for t in threads:
+                t.start()
+            try:
+                for t in threads:
+                    t.join()
+            except BaseException:
+                stop.set()        # the supervisors kill their rsyncs
+                for t in threads:
+                    t.join(timeout=15)
+                raise
+        else:
+            work(contexts[0])
+
+        results = {t["name"]: results[t["name"]] for t in targets}
+        out = _summarize(results, time.time() - start)
+        if out["success"]:
+            datausage.clear_paused()
+        return out
+    except Exception as e:
+        return {"success": False, "message": f"Sync error: {e}", "duration": time.time() - start}
+    finally:
+        if lists:
+            lists.close()
+        for ctx in contexts:
+            _cleanup_key(ctx.session)
+            if ctx.kind in ("s3", "vault"):
+                ctx.close()
+        if meter:
+            used = meter.finish()
+            if log_file:
+                try:
+                    log_file.write(f"[DATA] {used / 1e6:.1f} MB on {meter.network} ({meter.iface})\n")
+                except Exception:
+                    pass
+        if battery:
+            sync_estimate.record_drain(battery, power.get_battery(), time.time() - start)
+
+
+def _record_tuning(tuning, stats, transfer_start, log_file=None):
+    """Log the run's achieved throughput and append it to the tuner history."""
+    data = stats.get("Total transferred file size", 0)
+    wire = stats.get("Total bytes sent", 0)
+    seconds = time.time() - transfer_start if transfer_start else 0
+    if not seconds or not data:
+        return
+    if log_file:
+        try:
+            ratio = f", wire/data {wire / data:.2f}" if wire else ""
+            log_file.write(f"[TUNE] result: {data / 1e6:.1f} MB in {seconds:.0f}s = "
+                           f"{data / seconds / 1e6:.2f} MB/s{ratio}\n")
+        except Exception:
+            pass
+    sync_tuner.record_run({
+        "network": tuning.get("network"),
+        "compress": tuning.get("compress", ""),
+        "level": tuning.get("level"),
+        "rtt_ms": tuning.get("rtt_ms"),
+        "probe_mbs": tuning.get("probe_mbs"),
+        "cpu_idle": tuning.get("cpu_idle"),
+        "data_bytes": data,
+        "wire_bytes": wire,
+        "seconds": round(seconds, 1),
+    })
+
+
+def _test_target(tcfg):
+    """Connection test for one target (see ``_sync_targets``)."""
+    if tcfg.get("encrypt"):
+        ctx, err = _open_vault_target(tcfg, _load_backup_dir())
+        if err:
+            return {"success": False, "message": err}
+        ctx.close()
+        _cleanup_key(ctx.session)
+        return {"success": True, "message": f"Vault on {ctx.remote_path} ready."}
+    if tcfg.get("type") == "local":
+        err = sync_local.check_target(tcfg.get("path", ""))
+        return {"success": not err, "message": err or "Local disk ready."}
+    if tcfg.get("type") == "s3":
+        client, err = _s3_client(tcfg)
+        if err:
+            return {"success": False, "message": err}
+        client.close()
+        return {"success": True, "message": f"S3 bucket {tcfg['bucket']} reachable."}
+    if tcfg.get("type", "ssh") != "ssh":
+        return {"success": False, "message": f"Unsupported sync target type '{tcfg.get('type')}'."}
+    host = tcfg.get("host", "")
+    username = tcfg.get("username", "")
 
     if not host or not username:
         return {"success": False, "message": "Incomplete configuration (host/user)."}
 
-    key_file = None
+    session = _SshSession(tcfg, connect_timeout=10)
+    if not session.has_credentials:
+        return {"success": False, "message": "No SSH key or password configured."}
     try:
-        ssh_base = [
-            "ssh", "-p", str(port),
-            "-o", "StrictHostKeyChecking=accept-new",
-            "-o", "ConnectTimeout=10",
-            "-o", "BatchMode=yes",
-        ]
-
-        if auth_method == "key" and ssh_key:
-            fd, key_file = tempfile.mkstemp(prefix="sync_test_", suffix=".pem")
-            with os.fdopen(fd, "w") as f:
-                clean_key = ssh_key.replace("\r\n", "\n").replace("\r", "\n")
-                f.write(clean_key)
-                if not clean_key.endswith("\n"):
-                    f.write("\n")
-            os.chmod(key_file, 0o600)
-            ssh_base += ["-i", key_file]
-            cmd = ssh_base + [f"{username}@{host}", "echo ok"]
-        elif auth_method == "password" and password:
-            cmd = ["sshpass", "-p", password] + ssh_base + [f"{username}@{host}", "echo ok"]
-        else:
-            return {"success": False, "message": "No SSH key or password configured."}
-
-        r = subprocess.run(cmd, capture_output=True, text=True, timeout=15)
+        ok, err = session.open(borrow=True)
+        if not ok:
+            return {"success": False, "message": f"Connection failed: {err}"}
+        r = session.run("echo ok", timeout=15)
         if r.returncode == 0 and "ok" in r.stdout:
             return {"success": True, "message": "Connection successful."}
         else:
@@ -619,4 +1973,509 @@ def test_connection(passphrase=None):
     except Exception as e:
         return {"success": False, "message": f"Error: {e}"}
     finally:
-        _cleanup_key(key_file)
+        _cleanup_key(session)
+
+
+def test_connection(passphrase=None):
+    """
+    Test the SSH connection to every sync target.
+    Rides on a running sync's ControlMaster when there is one.
+    Returns dict: {success: bool, message: str}; with several targets the
+    message lists each one's outcome.
+    """
+    cfg = sync_crypto.decrypt_sync_config(passphrase=passphrase)
+    if not cfg:
+        return {"success": False, "message": "Cannot decrypt sync credentials."}
+
+    targets = _sync_targets(cfg)
+    if len(targets) == 1:
+        return _test_target(targets[0])
+    results = [(t["name"], _test_target(t)) for t in targets]
+    return {"success": all(r["success"] for _, r in results),
+            "message": " ".join(f"{n}: {r['message']}" for n, r in results)}
+
+
+# --- Checksum audit of the remote copy (see sync_audit) ---
+
+AUDIT_BATCH_TIMEOUT = 1800   # one remote hashing command (BATCH_BYTES at idle I/O priority)
+
+
+def _remote_sums(session, root, files, shards, limiter, cancel=None):
+    """SHA-256 of the ``files`` (a hash index) under ``root`` on the server,
+    hashed by ``shards`` parallel remote commands. Returns ({rel: digest},
+    error_text or "")."""
+    groups = [[] for _ in range(shards)]
+    for rel in sorted(files):
+        groups[sync_audit.shard_of(rel, shards)].append(rel)
+    sizes = {rel: entry[0] for rel, entry in files.items()}
+    command = sync_audit.remote_hash_command(root)
+    sums, errors = {}, []
+    lock = threading.Lock()
+
+    def shard(rels):
+        for batch in sync_audit.batches(rels, sizes):
+            if cancel is not None and cancel.is_set():
+                return
+            limiter.consume(sum(sizes[rel] for rel in batch))
+            try:
+                r = session.run(command, timeout=AUDIT_BATCH_TIMEOUT,
+                                input="\0".join(batch) + "\0")
+            except subprocess.TimeoutExpired:
+                with lock:
+                    errors.append("remote hashing timed out")
+                return
+            got = sync_audit.parse_sums(r.stdout)
+            with lock:
+                sums.update(got)
+                # Files missing on the server make the hasher exit non-zero
+                # too; that is a finding, not an error. No output at all is.
+                if r.returncode and not got:
+                    errors.append(r.stderr.strip()[:200] or f"exit {r.returncode}")
+
+    threads = [threading.Thread(target=shard, args=(g,), daemon=True) for g in groups if g]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sums, errors[0] if errors else ""
+
+
+def _resend(session, folder, root, rels, log_file=None, cancel=None):
+    """Send ``rels`` of ``folder`` to ``root`` on the server again, whatever
+    their size and mtime say. Returns the rsync exit code (-1 if stopped)."""
+    with tempfile.NamedTemporaryFile("w", prefix="audit-", suffix=".list") as f:
+        f.write("\n".join(rels) + "\n")
+        f.flush()
+        cmd = session.wrap(["/usr/bin/rsync", "-a", "--ignore-times", "--partial",
+                            "--partial-dir=.rsync-partial", "--rsync-path=/usr/bin/rsync",
+                            f"--files-from={f.name}", "--outbuf=L",
+                            "-e", session.rsync_rsh(), folder + "/", f"{session.dest}:{root}/"])
+        res = _supervise_rsync(cmd, session.env, None, log_file, cancel=cancel,
+                               watch=_stall_watch(session, None))
+    return -1 if res["abort"] else res["rc"]
+
+
+def _audit_target(tcfg, backup_dir, snapshots, limiter, shards, log_file=None, cancel=None):
+    """Audit one SSH target. Returns its history entry (see sync_audit.record)."""
+    start = time.time()
+    entry = {"target": tcfg["name"], "complete": False, "devices": 0, "files": 0, "bytes": 0,
+             "hashed_local": 0, "mismatched": [], "missing": [], "local_changed": [],
+             "unconfirmed": [], "resent": 0, "skipped": [], "message": ""}
+    key = _estimate_key(tcfg, snapshots)
+    confirmed = sync_checkpoint.load(key)
+    session, err = _open_session(tcfg)
+    if err:
+        entry["message"] = err
+        return entry
+    try:
+        stopped = False
+        for device in sync_checkpoint.list_shards(backup_dir):
+            if cancel is not None and cancel.is_set():
+                stopped = True
+                break
+            folder = os.path.join(backup_dir, device)
+            rec = confirmed.get(device)
+            # Only a folder the target holds at its current generation can be
+            # compared; anything else is for the next sync to send.
+            if not rec or rec.get("gen") != sync_checkpoint.generation_id(folder):
+                entry["skipped"].append(device)
+                continue
+            known = sync_audit.load_index(device)
+            files, hashed, _ = sync_audit.refresh_index(folder, known, limiter, cancel)
+            sync_audit.save_index(device, files)
+            entry["hashed_local"] += hashed
+            root = f"{tcfg['remote_path'].rstrip('/')}/{device}"
+            if snapshots:
+                root = f"{root}/{sync_snapshots.LATEST}"
+            sums, err = _remote_sums(session, root, files, shards, limiter, cancel)
+            if cancel is not None and cancel.is_set():
+                stopped = True
+                break
+            if err:
+                entry["message"] = f"{device}: {err}"
+                stopped = True
+                break
+            mismatched, missing = sync_audit.compare(files, sums, files)
+            entry["devices"] += 1
+            entry["files"] += len(files)
+            entry["bytes"] += sum(f[0] for f in files.values())
+            resend, unconfirmed = [], []
+            for rel in mismatched + missing:
+                try:
+                    same = sync_audit.hash_file(os.path.join(folder, rel), limiter) == files[rel][2]
+                except OSError:
+                    same = False
+                if not same:
+                    entry["local_changed"].append(f"{device}/{rel}")
+                elif rel in missing or known.get(rel) == files[rel]:
+                    resend.append(rel)
+                else:
+                    # First hashed by this audit: the local copy may be the
+                    # one that rotted, so it never overwrites the server's.
+                    unconfirmed.append(rel)
+            entry["mismatched"] += [f"{device}/{rel}" for rel in mismatched]
+            entry["missing"] += [f"{device}/{rel}" for rel in missing]
+            entry["unconfirmed"] += [f"{device}/{rel}" for rel in unconfirmed]
+            if log_file:
+                log_file.write(f"[AUDIT] {tcfg['name']}/{device}: {len(files)} files, "
+                               f"{len(mismatched)} mismatched, {len(missing)} missing\n")
+                for rel in mismatched:
+                    log_file.write(f"[AUDIT] mismatch: {device}/{rel}\n")
+                for rel in missing:
+                    log_file.write(f"[AUDIT] missing: {device}/{rel}\n")
+                for rel in unconfirmed:
+                    log_file.write(f"[AUDIT] not re-sent, no earlier local hash: {device}/{rel}\n")
+            if resend:
+                rc = _resend(session, folder, root, resend, log_file, cancel)
+                if rc:
+                    entry["message"] = (f"{device}: re-sending {len(resend)} file(s) failed "
+                                        f"(exit {rc}: {_rsync_exit_detail(rc)})" if rc > 0 else
+                                        f"{device}: re-sending stopped")
+                    stopped = True
+                    break
+                entry["resent"] += len(resend)
+        entry["complete"] = not stopped
+    finally:
+        _cleanup_key(session)
+        entry["seconds"] = round(time.time() - start, 1)
+    return entry
+
+
+def audit_remote(target=None, log_file=None, cancel=None):
+    """Checksum audit of the remote copy (see sync_audit) of every SSH
+    mirror/snapshot target, or of ``target``: the server hashes its copy of
+    each device folder the target holds at its current generation, files
+    whose hash differs from the local index are sent again. Each target's
+    findings go to the audit history. Returns {success, message, duration}."""
+    start = time.time()
+    net_ok, net_reason = _check_network_allowed()
+    if not net_ok:
+        return {"success": False, "message": net_reason, "duration": 0}
+    cfg = sync_crypto.decrypt_sync_config()
+    if not cfg:
+        return {"success": False, "message": "Cannot decrypt sync credentials.", "duration": 0}
+    sync_cfg = _load_config().get("sync", {})
+    audit_cfg = sync_cfg.get("audit") or {}
+    snapshots = (sync_cfg.get("snapshots") or {}).get("enabled")
+    targets = [t for t in _sync_targets(cfg)
+               if t.get("type", "ssh") == "ssh" and not t.get("encrypt")
+               and (not target or t["name"] == target)]
+    if not targets:
+        return {"success": False, "duration": 0,
+                "message": f"No SSH target named '{target}' to audit." if target
+                           else "No SSH target to audit."}
+    limiter = sync_audit.RateLimiter(float(audit_cfg.get("max_mbps", sync_audit.MAX_MBPS)) * 1e6)
+    shards = max(1, int(audit_cfg.get("shards", sync_audit.AUDIT_SHARDS)))
+    backup_dir = _load_backup_dir()
+    parts, ok = [], True
+    for tcfg in targets:
+        entry = _audit_target(tcfg, backup_dir, snapshots, limiter, shards, log_file, cancel)
+        sync_audit.record({**entry, **{k: entry[k][:sync_audit.REPORT_MAX] for k in
+                                       ("mismatched", "missing", "local_changed",
+                                        "unconfirmed", "skipped")},
+                           "mismatched_count": len(entry["mismatched"]),
+                           "missing_count": len(entry["missing"]),
+                           "local_changed_count": len(entry["local_changed"]),
+                           "unconfirmed_count": len(entry["unconfirmed"])})
+        bad = len(entry["mismatched"]) + len(entry["missing"])
+        text = (f"{entry['files']} files in {entry['devices']} device(s) checked, "
+                f"{bad} bad, {entry['resent']} re-sent")
+        if entry["local_changed"]:
+            text += f", {len(entry['local_changed'])} changed locally"
+        if entry["unconfirmed"]:
+            text += f", {len(entry['unconfirmed'])} not re-sent (no earlier local hash)"
+        if not entry["complete"]:
+            ok = False
+            text = f"{entry['message'] or 'stopped'} ({text})"
+        parts.append(f"{tcfg['name']}: {text}.")
+    return {"success": ok, "message": " ".join(parts), "duration": time.time() - start}
+
+
+# --- Restore: pull a device backup back from a target ---
+
+_LIST_BACKUPS_CMD = ('cd {path} && for d in *; do [ -d "$d" ] || continue; printf "D %s\\n" "$d"; '
+                     'for s in "$d"/*; do [ -d "$s" ] && [ ! -L "$s" ] && printf "S %s\\n" "$s"; '
+                     'done; done; true')
+
+
+def _pick_target(cfg, name=None):
+    """The target called ``name`` (the primary if None) that a restore can
+    read from. Returns (target config, error_text)."""
+    for t in _sync_targets(cfg):
+        if not name or t["name"] == name:
+            if t.get("encrypt"):
+                return None, (f"'{t['name']}' is encrypted: restore it with "
+                              "sync_vault.py restore (see the Remote Sync guide).")
+            if t.get("type", "ssh") not in ("ssh", "local"):
+                return None, f"Restore from {t['type']} targets is not supported."
+            return t, None
+    return None, f"No sync target named '{name}'."
+
+
+def _parse_backup_list(lines):
+    """Device folders and their snapshots from _LIST_BACKUPS_CMD output."""
+    devices = {}
+    for line in lines:
+        kind, _, rest = line.partition(" ")
+        if kind == "D" and sync_restore.valid_name(rest):
+            devices.setdefault(rest, [])
+        elif kind == "S":
+            device, _, snap = rest.partition("/")
+            if device in devices and sync_snapshots.is_snapshot(snap):
+                devices[device].append(snap)
+    return [{"name": d, "snapshots": sorted(s, reverse=True)} for d, s in sorted(devices.items())]
+
+
+def list_remote_backups(passphrase=None, target=None):
+    """Device folders (and their snapshots, newest first) on a sync target.
+    Returns {success, message, target, devices: [{name, snapshots}]}."""
+    cfg = sync_crypto.decrypt_sync_config(passphrase=passphrase)
+    if not cfg:
+        return {"success": False, "message": "Cannot decrypt sync credentials.", "devices": []}
+    tcfg, err = _pick_target(cfg, target)
+    if err:
+        return {"success": False, "message": err, "devices": []}
+    if tcfg.get("type") == "local":
+        path = tcfg.get("path", "")
+        err = sync_local.check_target(path)
+        if err:
+            return {"success": False, "message": err, "devices": []}
+        lines = []
+        for d in sorted(os.listdir(path)):
+            if d.startswith(".") or not os.path.isdir(os.path.join(path, d)):
+                continue
+            lines.append(f"D {d}")
+            lines += [f"S {d}/{s}" for s in os.listdir(os.path.join(path, d))
+                      if os.path.isdir(os.path.join(path, d, s))
+                      and not os.path.islink(os.path.join(path, d, s))]
+    else:
+        session, err = _open_session(tcfg, borrow=True)
+        if err:
+            return {"success": False, "message": err, "devices": []}
+        try:
+            r = session.run(_LIST_BACKUPS_CMD.format(path=shlex.quote(tcfg["remote_path"])),
+                            timeout=60)
+        except subprocess.TimeoutExpired:
+            return {"success": False, "message": "Listing the remote timed out.", "devices": []}
+        finally:
+            _cleanup_key(session)
+        if r.returncode != 0:
+            return {"success": False, "devices": [],
+                    "message": f"Cannot list {tcfg['remote_path']}: {r.stderr.strip()[:200]}"}
+        lines = r.stdout.splitlines()
+    devices = _parse_backup_list(lines)
+    return {"success": True, "target": tcfg["name"], "devices": devices,
+            "message": f"{len(devices)} device backup(s) on {tcfg['name']}."}
+
+
+class _RestoreProgress:
+    """Progress of the parallel streams of one restore, summed and emitted to
+    ``on_progress`` at most every EMIT_MIN_SEC."""
+
+    EMIT_MIN_SEC = 0.5
+
+    def __init__(self, on_progress, start, total, resume_bytes, streams):
+        self.on_progress = on_progress
+        self.start = start
+        self.total = total
+        self.resume = resume_bytes
+        self.bytes = [0] * streams
+        self.speeds = [0.0] * streams
+        self._lock = threading.Lock()
+        self._last = 0.0
+
+    def update(self, i, done, bps):
+        with self._lock:
+            self.bytes[i] = done
+            self.speeds[i] = bps
+            self._emit(False)
+
+    def flush(self):
+        with self._lock:
+            self.speeds = [0.0] * len(self.speeds)
+            self._emit(True)
+
+    def _emit(self, force):
+        now = time.time()
+        if not self.on_progress or (not force and now - self._last < self.EMIT_MIN_SEC):
+            return
+        self._last = now
+        done = min(self.total, self.resume + sum(self.bytes))
+        speed = sum(self.speeds)
+        self.on_progress({
+            "pct": int(done * 100 / self.total) if self.total else 100,
+            "bytes": done, "total": self.total, "speed": _format_speed(speed) if speed else "",
+            "stalled": False, "scanning": False, "elapsed": now - self.start,
+            "resume_pct": int(self.resume * 100 / self.total) if self.total else 0})
+
+
+def _restore_local(tcfg, src_rel, staged, live, progress, min_battery, cancel=None):
+    """Copy ``src_rel`` from a local disk target into ``staged``."""
+    src = os.path.join(tcfg.get("path", ""), src_rel)
+    err = sync_local.check_target(tcfg.get("path", ""))
+    if err or not os.path.isdir(src):
+        return _fail(err or f"{src} not found on the disk.")
+    progress.total = sync_checkpoint.tree_size(src)
+    copier = sync_local.TreeCopier(tcfg.get("workers") or sync_local.COPY_WORKERS,
+                                   lambda done, bps: progress.update(0, done, bps),
+                                   _copy_guard(min_battery, cancel))
+    res = copier.copy_tree(src, staged, live if os.path.isdir(live) else None)
+    progress.flush()
+    if res["stopped"]:
+        if res["stopped"][0] == "cancelled":
+            return _fail("Restore cancelled. Start it again to resume.", "cancelled")
+        return _fail(f"Restore aborted: {res['stopped'][1]} Will resume next time.", res["stopped"][0])
+    return {"success": True, "message": "", "abort": None}
+
+
+def _restore_ssh(tcfg, src_rel, staged, live, progress, log_file, min_battery, meter, streams,
+                 cancel=None, network=None):
+    """Pull ``src_rel`` from an SSH target into ``staged`` with parallel rsyncs."""
+    session, err = _open_session(tcfg)
+    if err:
+        return _fail(err)
+    try:
+        src = f"{tcfg['remote_path'].rstrip('/')}/{src_rel}"
+        r = session.run(f"cd {shlex.quote(src)} && find . -type f -printf '%s %P\\n'", timeout=300)
+        if r.returncode != 0:
+            return _fail(f"Cannot list {src}: {r.stderr.strip()[:200]}")
+        files = []
+        for line in r.stdout.splitlines():
+            size, _, rel = line.partition(" ")
+            if rel and not rel.startswith(".rsync-partial/"):
+                files.append((rel, int(size)))
+        lists = sync_restore.split_streams(files, streams)
+        progress.total = sum(size for _, size in files)
+        progress.resume = sync_restore.present_bytes(staged, files)
+        progress.bytes = [0] * len(lists)
+        progress.speeds = [0.0] * len(lists)
+        if log_file:
+            log_file.write(f"[RESTORE] {len(files)} files, {progress.total / 1e6:.1f} MB from "
+                           f"{session.dest}:{src} in {len(lists)} streams"
+                           f"{f', {progress.resume / 1e6:.1f} MB already here' if progress.resume else ''}\n")
+        stop = _RunStop(cancel)
+        # The streams share the link, so each is expected to get its share of it.
+        rate = sync_watchdog.expected_rate(sync_tuner.load_history(), network) / max(len(lists), 1)
+        results = [None] * len(lists)
+        log_lock = threading.Lock()
+        with tempfile.TemporaryDirectory(prefix="restore-") as tmp:
+            def stream(i, names):
+                list_file = os.path.join(tmp, f"files{i}")
+                with open(list_file, "w") as f:
+                    f.write("\n".join(names) + "\n")
+                flags = ["-a", "--partial", "--partial-dir=.rsync-partial",
+                         "--rsync-path=/usr/bin/rsync", f"--files-from={list_file}",
+                         "--info=progress2", "--no-inc-recursive", "--outbuf=L"]
+                if os.path.isdir(live):
+                    flags.append(f"--link-dest={live}")   # unchanged local files aren't pulled
+                cmd = session.wrap(["/usr/bin/rsync"] + flags
+                                   + ["-e", session.rsync_rsh(), f"{session.dest}:{src}/", staged + "/"])
+                res = _supervise_rsync(
+                    cmd, session.env,
+                    lambda info: progress.update(i, info.get("bytes", 0), _speed_bps(info.get("speed", ""))),
+                    _TargetLog(log_file, f"stream{i + 1}", log_lock) if log_file else None,
+                    min_battery, meter, stop,
+                    _stall_watch(session, rate))
+                if res["abort"] in ("battery", "cap", "stall", "scan") or res["rc"]:
+                    stop.set()            # the others would only have to be resumed too
+                results[i] = res
+
+            threads = [threading.Thread(target=stream, args=(i, names), daemon=True)
+                       for i, names in enumerate(lists)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        progress.flush()
+        for res in results:
+            abort = res["abort"]
+            if abort == "battery":
+                return _fail(f"Restore aborted: {res['reason']} Will resume next time.", abort)
+            if abort == "cap":
+                return _fail(f"Monthly data cap reached on {meter.network}. Restore stopped; "
+                             "it resumes when started again on another network.", abort)
+            if abort in ("stall", "scan"):
+                return _fail("Restore stalled. Start it again to resume.", abort)
+            if abort == "cancelled":
+                return _fail("Restore cancelled. Start it again to resume.", abort)
+        for res in results:
+            if res["rc"] and res["abort"] is None:
+                return _fail(f"rsync failed (exit {res['rc']}: {_rsync_exit_detail(res['rc'])}). "
+                             "See sync log.")
+        return {"success": True, "message": "", "abort": None}
+    finally:
+        _cleanup_key(session)
+
+
+def restore_with_progress(device, snapshot=None, target=None, passphrase=None,
+                          on_progress=None, log_file=None, min_battery=None, streams=None,
+                          cancel=None):
+    """
+    Pull a device backup (``snapshot`` of it, for a target with snapshots)
+    from a sync target back into backup_dir, where idevicebackup2 can restore
+    from it.
+
+    SSH targets are pulled by ``streams`` parallel rsyncs (RESTORE_STREAMS
+    by default) over one ControlMaster; files still in the local copy of the
+    device are hard-linked instead of pulled. The restore is built in
+    ``backup_dir/.restore/<device>``, verified against its Manifest.db (see
+    sync_restore) and only then swapped in; a restore cut short resumes from
+    what it already has. Battery and data-cap guards and ``cancel`` apply as
+    for a sync. Returns {success, message, duration}.
+    """
+    if not sync_restore.valid_name(device) or (
+            snapshot and snapshot != "latest" and not sync_snapshots.is_snapshot(snapshot)):
+        return {"success": False, "message": "Invalid device or snapshot name.", "duration": 0}
+    run, err = _prepare_run(passphrase)
+    if err:
+        return err
+    tcfg, err = _pick_target(run["cfg"], target)
+    if err:
+        return {"success": False, "message": err, "duration": 0}
+    min_battery = _resolve_min_battery(min_battery)
+    backup_dir = _load_backup_dir()
+    staged = sync_restore.staging_dir(backup_dir, device)
+    live = os.path.join(backup_dir, device)
+    src_rel = f"{device}/{snapshot}" if snapshot else device
+    meter = (datausage.UsageMeter(run["network"], run["iface"], run["profile"])
+             if run["network"] else None)
+    start = time.time()
+    what = f"{device}{f' ({snapshot})' if snapshot else ''} from {tcfg['name']}"
+    try:
+        os.makedirs(staged, exist_ok=True)
+        progress = _RestoreProgress(on_progress, start, 0, 0, 1)
+        if log_file:
+            log_file.write(f"[RESTORE] {what} into {staged}\n")
+        if tcfg.get("type") == "local":
+            res = _restore_local(tcfg, src_rel, staged, live, progress, min_battery, cancel)
+        else:
+            res = _restore_ssh(tcfg, src_rel, staged, live, progress, log_file, min_battery,
+                               meter, streams or sync_restore.RESTORE_STREAMS, cancel,
+                               run["network"])
+        if not res["success"]:
+            return {"success": False, "message": res["message"], "duration": time.time() - start}
+        check = sync_restore.verify_backup(staged)
+        if log_file:
+            log_file.write(f"[VERIFY] {check['message']}\n")
+            for rel in check["missing"]:
+                log_file.write(f"[VERIFY] missing: {rel}\n")
+            for rel in check["wrong_size"]:
+                log_file.write(f"[VERIFY] wrong size: {rel}\n")
+        if not check["ok"]:
+            return {"success": False, "duration": time.time() - start,
+                    "message": f"Restored backup failed verification: {check['message']} "
+                               "Start the restore again to fetch what is missing."}
+        sync_restore.publish(backup_dir, device)
+        duration = time.time() - start
+        return {"success": True, "duration": duration,
+                "message": f"Restored {what} ({duration:.0f}s). {check['message']}"}
+    except Exception as e:
+        return {"success": False, "message": f"Restore error: {e}", "duration": time.time() - start}
+    finally:
+        if meter:
+            used = meter.finish()
+            if log_file:
+                try:
+                    log_file.write(f"[DATA] {used / 1e6:.1f} MB on {meter.network} ({meter.iface})\n")
+                except Exception:
+                    pass
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+sync_s3.py - Sync target in an S3-compatible bucket (MinIO, Garage, AWS S3...).
+
+Talks S3's REST API directly (path-style URLs, Signature V4) over keep-alive
+http.client connections, one per worker thread, so no SDK is needed on the
+box. Each device folder maps to ``<prefix>/<device>/<relative path>``.
+
+- Files below MULTIPART_THRESHOLD are sent with a single PUT, several at
+  once from a thread pool. Larger files are streamed as a multipart upload,
+  one PART_SIZE part in memory at a time, so memory stays bounded by
+  workers x PART_SIZE whatever the file size.
+- A local manifest records each uploaded object's (size, mtime, etag) and
+  is saved every MANIFEST_FLUSH_SEC, so the next run only uploads files whose
+  size or mtime changed, and a run cut short resumes file by file.
+- Objects of files that are gone locally are deleted once a device folder's
+  upload has completed (mirror semantics; S3 has no atomic rename, so there
+  is no staged publish or snapshot layout for this target type).
+
+Import-safe: stdlib only, so it can be unit-tested on any machine.
+"""
+import os
+import hmac
+import stat
+import json
+import time
+import hashlib
+import threading
+import http.client
+import urllib.parse
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import sync_checkpoint
+
+UPLOAD_WORKERS = 4
+PART_SIZE = 16 * 1024 * 1024
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+MANIFEST_FLUSH_SEC = 30
+RETRIES = 3
+TIMEOUT_SEC = 60
+
+_EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+
+class S3Error(Exception):
+    def __init__(self, status, code="", message=""):
+        super().__init__(f"S3 {status} {code}: {message}".strip(": "))
+        self.status = status
+        self.code = code
+
+
+def _quote(s, safe="/"):
+    return urllib.parse.quote(s, safe=safe + "-_.~")
+
+
+def _xml_find(body, tag):
+    """Text of the first element named ``tag`` (any namespace), or ""."""
+    try:
+        root = ET.fromstring(body)
+    except ET.ParseError:
+        return ""
+    for el in root.iter():
+        if el.tag.rsplit("}", 1)[-1] == tag:
+            return el.text or ""
+    return ""
+
+
+class S3Client:
+    """Minimal S3 client: the object and multipart calls a sync needs.
+
+    ``endpoint`` is ``http(s)://host[:port]``. Requests are signed with
+    Signature V4 and carry the payload's SHA-256, so they also work on plain
+    HTTP inside a LAN."""
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region="us-east-1"):
+        u = urllib.parse.urlsplit(endpoint if "://" in endpoint else f"https://{endpoint}")
+        self.scheme = u.scheme
+        self.host = u.netloc
+        self.bucket = bucket
+        self.region = region or "us-east-1"
+        self._access_key = access_key
+        self._secret_key = secret_key
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            conn = self._local.conn = cls(self.host, timeout=TIMEOUT_SEC)
+        return conn
+
+    def _drop_conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def close(self):
+        self._drop_conn()
+
+    def _headers(self, method, path, query, payload_hash, extra=None, now=None):
+        """Signature V4 headers for one request."""
+        t = time.gmtime(now)
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", t)
+        date = amz_date[:8]
+        headers = {"host": self.host, "x-amz-content-sha256": payload_hash,
+                   "x-amz-date": amz_date}
+        for k, v in (extra or {}).items():
+            headers[k.lower()] = str(v)
+        signed = ";".join(sorted(headers))
+        canonical_query = "&".join(f"{_quote(k, '')}={_quote(str(v), '')}"
+                                   for k, v in sorted(query.items()))
+        canonical = "\n".join([
+            method, _quote(path), canonical_query,
+            "".join(f"{k}:{headers[k].strip()}\n" for k in sorted(headers)),
+            signed, payload_hash])
+        scope = f"{date}/{self.region}/s3/aws4_request"
+        to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope,
+                             hashlib.sha256(canonical.encode()).hexdigest()])
+        key = f"AWS4{self._secret_key}".encode()
+        for part in (date, self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["authorization"] = (f"AWS4-HMAC-SHA256 Credential={self._access_key}/{scope}, "
+                                    f"SignedHeaders={signed}, Signature={signature}")
+        return headers
+
+    def request(self, method, key="", query=None, body=b"", ok=(200,)):
+        """Send one signed request; returns (status, headers, body). Retries
+        connection errors and 5xx with a fresh connection."""
+        query = query or {}
+        path = f"/{self.bucket}/{key}" if key else f"/{self.bucket}"
+        payload_hash = hashlib.sha256(body).hexdigest() if body else _EMPTY_SHA256
+        url = _quote(path)
+        if query:
+            url += "?" + "&".join(f"{_quote(k, '')}={_quote(str(v), '')}" if v != "" else _quote(k, '')
+                                  for k, v in sorted(query.items()))
+        for attempt in range(RETRIES):
+            headers = self._headers(method, path, query, payload_hash,
+                                    {"content-length": len(body)} if body or method in ("PUT", "POST") else None)
+            try:
+                conn = self._conn()
+                conn.request(method, url, body=body or None, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (OSError, http.client.HTTPException):
+                self._drop_conn()
+                if attempt == RETRIES - 1:
+                    raise
+                time.sleep(2 ** attempt)
+                continue
+            if resp.status >= 500 and attempt < RETRIES - 1:
+                time.sleep(2 ** attempt)
+                continue
+            if resp.status not in ok:
+                raise S3Error(resp.status, _xml_find(data, "Code"), _xml_find(data, "Message"))
+            return resp.status, {k.lower(): v for k, v in resp.getheaders()}, data
+        raise S3Error(0, "Retries", "exhausted")
+
+    def head_bucket(self):
+        self.request("HEAD")
+
+    def put_object(self, key, data):
+        return self.request("PUT", key, body=data)[1].get("etag", "").strip('"')
+
+    def delete_object(self, key):
+        self.request("DELETE", key, ok=(200, 204))
+
+    def create_multipart(self, key):
+        upload_id = _xml_find(self.request("POST", key, {"uploads": ""})[2], "UploadId")
+        if not upload_id:
+            raise S3Error(0, "NoUploadId", "CreateMultipartUpload returned no UploadId")
+        return upload_id
+
+    def upload_part(self, key, upload_id, number, data):
+        return self.request("PUT", key, {"partNumber": number, "uploadId": upload_id},
+                            body=data)[1].get("etag", "").strip('"')
+
+    def complete_multipart(self, key, upload_id, etags):
+        parts = "".join(f"<Part><PartNumber>{i}</PartNumber><ETag>\"{e}\"</ETag></Part>"
+                        for i, e in enumerate(etags, 1))
+        body = f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode()
+        data = self.request("POST", key, {"uploadId": upload_id}, body=body)[2]
+        if _xml_find(data, "Code"):         # S3 can report errors in a 200 body
+            raise S3Error(200, _xml_find(data, "Code"), _xml_find(data, "Message"))
+        return _xml_find(data, "ETag").strip('"')
+
+    def abort_multipart(self, key, upload_id):
+        try:
+            self.request("DELETE", key, {"uploadId": upload_id}, ok=(200, 204))
+        except (S3Error, OSError, http.client.HTTPException):
+            pass
+
+    def upload_file(self, key, path, size, should_stop=None):
+        """Upload ``path``: one PUT, or a streamed multipart upload for a large
+        file (aborted if it fails or ``should_stop()`` turns truthy). Returns
+        the ETag, or None if stopped."""
+        with open(path, "rb") as f:
+            if size < MULTIPART_THRESHOLD:
+                return self.put_object(key, f.read())
+            upload_id = self.create_multipart(key)
+            etags = []
+            try:
+                while True:
+                    chunk = f.read(PART_SIZE)
+                    if not chunk:
+                        break
+                    if should_stop and should_stop():
+                        self.abort_multipart(key, upload_id)
+                        return None
+                    etags.append(self.upload_part(key, upload_id, len(etags) + 1, chunk))
+                return self.complete_multipart(key, upload_id, etags)
+            except BaseException:
+                self.abort_multipart(key, upload_id)
+                raise
+
+
+class Manifest:
+    """What a bucket holds, as far as this box uploaded it:
+    ``{key: [size, mtime_ns, etag]}`` in a JSON file (atomic save)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._last_save = time.time()
+        self.entries = {}
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self.entries = data.get("objects") or {}
+        except Exception:
+            pass
+
+    def matches(self, key, st):
+        e = self.entries.get(key)
+        return bool(e) and e[0] == st.st_size and e[1] == st.st_mtime_ns
+
+    def record(self, key, st, etag):
+        with self._lock:
+            self.entries[key] = [st.st_size, st.st_mtime_ns, etag]
+        if time.time() - self._last_save >= MANIFEST_FLUSH_SEC:
+            self.save()
+
+    def forget(self, key):
+        with self._lock:
+            self.entries.pop(key, None)
+
+    def keys_under(self, prefix):
+        with self._lock:
+            return [k for k in self.entries if k.startswith(prefix)]
+
+    def save(self):
+        with self._lock:
+            data = json.dumps({"objects": self.entries}, separators=(",", ":"))
+            self._last_save = time.time()
+        tmp = f"{self.path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        try:
+            with open(tmp, "w") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def object_key(prefix, *parts):
+    """Bucket key for a path relative to backup_dir (always ``/``-separated).
+    ``object_key(prefix, "")`` is the key prefix of everything synced."""
+    rel = "/".join(p.strip("/") for p in parts)
+    prefix = prefix.strip("/")
+    return f"{prefix}/{rel}" if prefix else rel
+
+
+class TreeUploader:
+    """Upload one device folder to ``<prefix>/<device>/``: unchanged files
+    (per the manifest) are skipped, the rest uploaded by ``workers`` threads,
+    and objects of files gone locally deleted at the end.
+
+    Same callbacks and result as sync_local.TreeCopier: ``on_progress(done,
+    speed_bps)``, ``should_stop()``; the result counts ``copied`` (uploaded),
+    ``skipped``, ``deleted``, ``copied_bytes``, ``done_bytes`` and ``stopped``.
+    """
+
+    def __init__(self, client, manifest, workers=UPLOAD_WORKERS, on_progress=None,
+                 should_stop=None):
+        self.client = client
+        self.manifest = manifest
+        self.workers = max(1, int(workers))
+        self.on_progress = on_progress
+        self.should_stop = should_stop
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self.result = {"copied": 0, "skipped": 0, "deleted": 0, "copied_bytes": 0,
+                       "done_bytes": 0, "stopped": None}
+
+    def _done(self, nbytes, kind, copied=0):
+        with self._lock:
+            r = self.result
+            r[kind] += 1
+            r["done_bytes"] += nbytes
+            r["copied_bytes"] += copied
+            done, moved = r["done_bytes"], r["copied_bytes"]
+        if self.on_progress:
+            elapsed = time.time() - self._start
+            self.on_progress(done, moved / elapsed if elapsed > 0 else 0.0)
+
+    def _upload(self, key, path, st):
+        etag = self.client.upload_file(key, path, st.st_size, self.should_stop)
+        if etag is None:
+            return
+        self.manifest.record(key, st, etag)
+        self._done(st.st_size, "copied", st.st_size)
+
+    def upload_tree(self, src, key_prefix, entries=None):
+        """Mirror the tree ``src`` to keys under ``key_prefix/``, from
+        ``entries`` (the run's shared sync_checkpoint.file_list of ``src``) or
+        a walk of its own."""
+        if entries is None:
+            entries = sync_checkpoint.file_list(src)
+        seen = set()
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for r_path, path, st in entries:
+                if not stat.S_ISREG(st.st_mode):
+                    continue              # directories and symlinks have no object form
+                stop = self.should_stop() if self.should_stop else None
+                if stop:
+                    self.result["stopped"] = stop
+                    break
+                key = f"{key_prefix}/{r_path}"
+                seen.add(key)
+                if self.manifest.matches(key, st):
+                    self._done(st.st_size, "skipped")
+                    continue
+                pending.add(pool.submit(self._upload, key, path, st))
+                if len(pending) >= self.workers * 2:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in finished:
+                        f.result()
+            if self.result["stopped"]:
+                for f in pending:
+                    f.cancel()
+            for f in pending:
+                if not f.cancelled():
+                    f.result()
+        if not self.result["stopped"] and self.should_stop:
+            self.result["stopped"] = self.should_stop()
+        if not self.result["stopped"]:
+            for key in self.manifest.keys_under(key_prefix + "/"):
+                if key not in seen:
+                    self.client.delete_object(key)
+                    self.manifest.forget(key)
+                    self.result["deleted"] += 1
+        self.manifest.save()
+        return self.result
+
+
+def sync_root(client, manifest, backup_dir, prefix, keep):
+    """Top-level pass: upload the files at the root of ``backup_dir`` and
+    delete the objects of top-level folders no longer present locally. Names
+    in ``keep`` (device folders of this run) and hidden entries are left
+    alone."""
+    top = set()
+    for e in os.scandir(backup_dir):
+        if e.name.startswith("."):
+            continue
+        top.add(e.name)
+        if not e.is_file(follow_symlinks=False):
+            continue
+        key = object_key(prefix, e.name)
+        st = e.stat(follow_symlinks=False)
+        if not manifest.matches(key, st):
+            manifest.record(key, st, client.upload_file(key, e.path, st.st_size))
+    base = object_key(prefix, "")
+    for key in manifest.keys_under(base):
+        name = key[len(base):].split("/", 1)[0]
+        if name.startswith(".") or name in keep or name in top:
+            continue
+        client.delete_object(key)
+        manifest.forget(key)
+    manifest.save()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+sync_snapshots.py - How a device folder lands on the remote: atomic publish
+through a staging area (mirror mode) or versioned snapshots.
+
+Mirror mode (the default) keeps one copy per device at
+``remote_path/<device>/``. A device is rsynced into
+``remote_path/.staging/<device>/`` with ``--link-dest`` against the live copy
+(unchanged files are hard links), and only after that rsync succeeds is the
+staged folder renamed into place by one remote command. The live folder is
+therefore always a complete backup, never one half-overwritten by a sync that
+was cut short.
+
+With ``sync.snapshots.enabled`` each device folder is synced into its own
+snapshot on the remote instead of being mirrored over the previous copy, so a
+corrupted or wiped local backup can no longer overwrite the only remote one::
+
+    remote_path/<device>/20261019-153000/
+    remote_path/<device>/20261018-091512/
+    remote_path/<device>/latest -> 20261019-153000
+
+rsync writes into ``<device>/.incomplete/`` with ``--link-dest`` pointing at
+``latest``, so unchanged files are hard links: they cost neither transfer nor
+space. Only after the rsync succeeds is ``.incomplete`` renamed to its
+timestamp and ``latest`` swapped to it with one atomic ``mv -T``. A run that is
+cut short leaves ``.incomplete`` behind, and the next run continues filling it
+once ``prune_extra`` has removed what is gone locally since (as it does for a
+leftover staged folder in mirror mode).
+
+When snapshots are turned on over a mirror, ``<device>/`` still holds the
+mirrored backup. The first run moves it into ``<device>/.mirror/`` and links
+the first snapshot against it; once that snapshot is published the old mirror
+is deleted.
+
+Old snapshots are pruned over the run's SSH connection by a keep-last /
+keep-daily / keep-monthly policy. ``prune_plan`` is pure so it can be
+unit-tested.
+"""
+import re
+import shlex
+import time
+
+STAMP_FMT = "%Y%m%d-%H%M%S"
+INCOMPLETE = ".incomplete"
+LATEST = "latest"
+STAGING = ".staging"
+MIRROR = ".mirror"
+
+_STAMP_RE = re.compile(r"^\d{8}-\d{6}$")
+
+
+def stamp(ts=None):
+    """Snapshot name for a run started at ``ts`` (local time)."""
+    return time.strftime(STAMP_FMT, time.localtime(ts))
+
+
+def is_snapshot(name):
+    return bool(_STAMP_RE.match(name))
+
+
+def prune_plan(names, keep_last=7, keep_daily=14, keep_monthly=6):
+    """Snapshots to delete from ``names`` (snapshot directory names).
+
+    Keeps the newest ``keep_last``, then the newest snapshot of each of the
+    newest ``keep_daily`` days and ``keep_monthly`` months. The newest snapshot
+    is always kept, whatever the policy. Names that aren't snapshots are
+    ignored. Returns the names to delete, oldest first.
+    """
+    snaps = sorted((n for n in names if is_snapshot(n)), reverse=True)
+    keep = set(snaps[:max(1, keep_last)])
+    for width, limit in ((8, keep_daily), (6, keep_monthly)):   # YYYYMMDD / YYYYMM
+        periods = set()
+        for name in snaps:
+            period = name[:width]
+            if period in periods:
+                continue
+            if len(periods) >= limit:
+                break
+            periods.add(period)
+            keep.add(name)
+    return sorted(n for n in snaps if n not in keep)
+
+
+def _q(path):
+    """Shell-quote a remote path, keeping a leading ``~/`` expandable."""
+    if path.startswith("~/"):
+        return '"$HOME"/' + shlex.quote(path[2:])
+    return shlex.quote(path)
+
+
+# Entries of a device folder in snapshot mode; anything else is a mirror.
+_SNAPSHOT_ENTRIES = (INCOMPLETE, MIRROR, LATEST, f".{LATEST}.tmp")
+_STAMP_GLOB = "[0-9]" * 8 + "-" + "[0-9]" * 6
+
+
+def _seed_cmd():
+    """Shell: move a mirrored backup found in the device folder (run from it)
+    into MIRROR, unless there is a ``latest`` snapshot already."""
+    keep = "|".join(_SNAPSHOT_ENTRIES + (_STAMP_GLOB,))
+    return (f"if [ ! -e {LATEST} ] && [ -e Manifest.plist ]; then mkdir -p {MIRROR} && "
+            f"for f in * .[!.]* ..?*; do [ -e \"$f\" ] || continue; "
+            f"case \"$f\" in {keep}) ;; *) mv -- \"$f\" {MIRROR}/ || exit 1;; esac; done; fi")
+
+
+def prepare(session, device_dir):
+    """Create ``device_dir`` on the remote, moving a mirrored backup found
+    there aside (see MIRROR). Returns (what to link against: LATEST, MIRROR
+    or "", error)."""
+    d = _q(device_dir)
+    r = session.run(f"mkdir -p {d} && cd {d} && {{ {_seed_cmd()}; }} && "
+                    f"if [ -d {LATEST} ]; then echo {LATEST}; "
+                    f"elif [ -d {MIRROR} ]; then echo {MIRROR}; fi")
+    if r.returncode != 0:
+        return "", (r.stderr or r.stdout or "").strip()[:200] or f"exit {r.returncode}"
+    out = r.stdout.strip()
+    return out if out in (LATEST, MIRROR) else "", ""
+
+
+def link_dest_flags(base):
+    """rsync flags hard-linking unchanged files against ``base`` (from
+    ``prepare``). Relative, so rsync resolves it from the destination
+    (``.incomplete``)."""
+    return [f"--link-dest=../{base}/"] if base else []
+
+
+def commit(session, device_dir, name):
+    """Publish ``.incomplete`` as snapshot ``name`` and point ``latest`` at it.
+
+    The rename and the symlink swap run in one remote command; ``mv -T`` over
+    the old link is a single rename(2), so ``latest`` always resolves to a
+    complete snapshot. A mirror the snapshot was seeded from is deleted
+    after that. Returns (ok, error)."""
+    d = _q(device_dir)
+    n = shlex.quote(name)
+    r = session.run(f"cd {d} && mv -T {INCOMPLETE} {n} && "
+                    f"ln -sfn {n} .{LATEST}.tmp && mv -T .{LATEST}.tmp {LATEST} && "
+                    f"rm -rf -- {MIRROR}", timeout=600)
+    if r.returncode != 0:
+        return False, (r.stderr or r.stdout or "").strip()[:200] or f"exit {r.returncode}"
+    return True, ""
+
+
+def prune(session, device_dir, policy):
+    """Delete snapshots outside ``policy`` (the ``sync.snapshots`` dict).
+    Returns (deleted names, error)."""
+    d = _q(device_dir)
+    r = session.run(f"ls -1 {d}")
+    if r.returncode != 0:
+        return [], (r.stderr or "").strip()[:200] or f"exit {r.returncode}"
+    doomed = prune_plan(r.stdout.split(),
+                        keep_last=int(policy.get("keep_last", 7)),
+                        keep_daily=int(policy.get("keep_daily", 14)),
+                        keep_monthly=int(policy.get("keep_monthly", 6)))
+    if not doomed:
+        return [], ""
+    targets = " ".join(shlex.quote(n) for n in doomed)
+    r = session.run(f"cd {d} && rm -rf -- {targets}", timeout=600)
+    if r.returncode != 0:
+        return [], (r.stderr or "").strip()[:200] or f"exit {r.returncode}"
+    return doomed, ""
+
+
+# --- Mirror mode: staged publish ---------------------------------------------
+
+def _recover_cmd(n):
+    """Shell: put back a live folder left at ``.staging/<n>.old`` by a
+    publish cut short between its two renames (run from remote_path)."""
+    old = f"{STAGING}/{n}.old"
+    return f"{{ [ -e {n} ] || [ ! -d {old} ] || mv -T {old} {n}; }}"
+
+
+def stage_prepare(session, remote_path, name):
+    """Create ``remote_path/.staging``, first recovering a live copy that an
+    interrupted publish left aside. Returns (live copy exists, error)."""
+    r_ = _q(remote_path)
+    n = shlex.quote(name)
+    r = session.run(f"mkdir -p {r_}/{STAGING} && cd {r_} && {_recover_cmd(n)} && "
+                    f"if [ -d {n} ]; then echo live; fi")
+    if r.returncode != 0:
+        return False, (r.stderr or r.stdout or "").strip()[:200] or f"exit {r.returncode}"
+    return "live" in r.stdout, ""
+
+
+def stage_link_dest_flags(name, has_live):
+    """Hard-link unchanged files against the live copy. Relative to the
+    destination ``.staging/<name>/``."""
+    return [f"--link-dest=../../{name}/"] if has_live else []
+
+
+def publish_staged(session, remote_path, name):
+    """Move ``.staging/<name>`` into place as ``<name>``, in one remote command.
+
+    Uses ``mv --exchange`` (one renameat2 RENAME_EXCHANGE) where coreutils has
+    it, which is atomic. Otherwise the live folder is renamed aside to
+    ``.staging/<name>.old`` and the staged one renamed in: two renames back to
+    back, so there is never a partial folder in place, but a crash between
+    them leaves no live folder at all. The next run's ``stage_prepare`` (and
+    this command itself) then renames the old copy back first. The replaced
+    copy is deleted afterwards. Returns (ok, error)."""
+    r_ = _q(remote_path)
+    n = shlex.quote(name)
+    staged, old = f"{STAGING}/{n}", f"{STAGING}/{n}.old"
+    r = session.run(
+        f"cd {r_} && {_recover_cmd(n)} && rm -rf -- {old} && "
+        f"if [ -d {n} ] && mv --exchange -T {staged} {n} 2>/dev/null; then rm -rf -- {staged}; "
+        f"else {{ [ ! -e {n} ] || mv -T {n} {old}; }} && mv -T {staged} {n} && rm -rf -- {old}; fi",
+        timeout=600)
+    if r.returncode != 0:
+        return False, (r.stderr or r.stdout or "").strip()[:200] or f"exit {r.returncode}"
+    return True, ""
+
+
+# --- Both modes: leftovers of an interrupted run --------------------------------
+
+# awk: the wanted paths come first on stdin, then "//", then find's listing of
+# the folder; print what find found that isn't wanted, rsync's partial files
+# (kept for the resume) excepted.
+_EXTRA_AWK = ("seen == 0 && $0 == \"//\" { seen = 1; next } !seen { want[$0] = 1; next } "
+              "{ p = substr($0, 3) } p ~ /(^|\\/)\\.rsync-partial(\\/|$)/ { next } "
+              "!(p in want) { print p }")
+
+
+def prune_extra(session, directory, rels):
+    """Delete from ``directory`` on the remote (a ``.staging/<device>`` or
+    ``.incomplete`` an interrupted run left behind) whatever is not in
+    ``rels``, the paths the run's ``--files-from`` list sends into it: rsync
+    deletes nothing when it is given a file list, so a file removed locally
+    since that run would otherwise be published. Costs one remote test when
+    there is no leftover folder, which is the usual case. Returns error text,
+    or ""."""
+    d = _q(directory)
+    r = session.run(f"if [ -d {d} ]; then echo leftover; fi")
+    if r.returncode != 0:
+        return (r.stderr or r.stdout or "").strip()[:200] or f"exit {r.returncode}"
+    if "leftover" not in r.stdout:
+        return ""
+    r = session.run(f"cd {d} && {{ cat; echo //; find . -mindepth 1; }} | "
+                    f"awk {shlex.quote(_EXTRA_AWK)} | "
+                    "while IFS= read -r p; do rm -rf -- \"$p\"; done",
+                    timeout=600, input="".join(f"{rel}\n" for rel in rels))
+    if r.returncode != 0:
+        return (r.stderr or r.stdout or "").strip()[:200] or f"exit {r.returncode}"
+    return ""
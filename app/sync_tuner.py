@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+sync_tuner.py - Per-run choice of rsync compression from the measured link,
+CPU headroom and recent sync history.
+
+Compression only pays when the link, not the CPU, is the bottleneck: over an
+iPhone hotspot it can multiply the effective rate, on gigabit LAN the Radxa's
+single rsync core becomes the limit and it slows the transfer down. An
+encrypted iOS backup is incompressible, so it is never compressed.
+
+Every run is appended to a small history (``sync_history.json`` in
+logutil.STATE_DIR) with the settings used and the throughput achieved. Once a
+network has enough runs both with and without compression, the measured winner
+of its recent runs overrides the static model. Every EXPLORE_EVERY-th run on
+that network tries the other setting, so a verdict that stopped being true
+(a faster uplink, a backup that compresses differently) is found out and the
+choice keeps improving over time. On a metered network (see datausage) the
+link is not probed; its rate comes from the history.
+
+Import-safe: stdlib only; ``choose()`` is pure so it can be unit-tested.
+"""
+import os
+import json
+import time
+import plistlib
+import statistics
+import subprocess
+
+import logutil
+
+HISTORY_FILE = "sync_history.json"
+HISTORY_KEEP = 200
+
+# Rough single-core compression throughput (MB/s of input) on the Radxa's
+# Cortex-A55 at the levels used below. Only the ordering and the order of
+# magnitude matter: history overrides the model once it has data.
+CODEC_MBS = {"zstd": 45.0, "lz4": 120.0, "zlib": 12.0}
+CODEC_ORDER = ("zstd", "lz4", "zlib")
+# Expected compressed/raw size for an unencrypted backup (SQLite + plists
+# compress well, photos and videos not at all) until history knows better.
+DEFAULT_RATIO = 0.75
+# Compression must beat the plain link rate by this factor to be worth it.
+GAIN_MARGIN = 1.15
+# Runs moving less than this are too small to say anything about throughput.
+MIN_SAMPLE_BYTES = 8 * 1024 * 1024
+MIN_SAMPLES = 3
+# Runs per setting the learned verdict looks at (the most recent ones).
+LEARN_WINDOW = 10
+# With a verdict, every this-many-th run on the network tries the other setting.
+EXPLORE_EVERY = 10
+PROBE_BYTES = 512 * 1024
+
+# Already-compressed media and archives. iOS backup blobs are named by hash with
+# no extension, so this mostly covers files stored under their real name.
+SKIP_COMPRESS = ("heic/heif/jpg/jpeg/png/gif/mov/mp4/m4v/m4a/mp3/aac/"
+                 "zip/gz/tgz/bz2/xz/zst/7z/rar/ipa/pdf")
+
+
+# --- History ------------------------------------------------------------------
+
+def _history_path():
+    return logutil.state_path(HISTORY_FILE)
+
+
+def load_history(path=None):
+    """Return the recorded runs (oldest first), or [] if none/unreadable."""
+    try:
+        with open(path or _history_path(), "r") as f:
+            data = json.load(f)
+        return data if isinstance(data, list) else []
+    except Exception:
+        return []
+
+
+def record_run(entry, path=None):
+    """Append ``entry`` (a dict) to the history, keeping the newest
+    HISTORY_KEEP. Atomic tmp + rename; best-effort, never raises."""
+    path = path or _history_path()
+    tmp = f"{path}.tmp.{os.getpid()}"
+    try:
+        hist = load_history(path)
+        hist.append({"ts": int(time.time()), **entry})
+        with open(tmp, "w") as f:
+            json.dump(hist[-HISTORY_KEEP:], f)
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def _samples(history, network, compressed):
+    out = []
+    for h in history:
+        if h.get("network") != network or not h.get("seconds"):
+            continue
+        if bool(h.get("compress")) != compressed:
+            continue
+        if (h.get("data_bytes") or 0) < MIN_SAMPLE_BYTES:
+            continue
+        out.append(h)
+    return out
+
+
+def learned_preference(history, network):
+    """"on" / "off" once the network has MIN_SAMPLES qualifying runs both with
+    and without compression (whichever moved data faster over the last
+    LEARN_WINDOW runs of each), else None."""
+    on = _samples(history, network, True)[-LEARN_WINDOW:]
+    off = _samples(history, network, False)[-LEARN_WINDOW:]
+    if len(on) < MIN_SAMPLES or len(off) < MIN_SAMPLES:
+        return None
+    rate = lambda runs: statistics.median(r["data_bytes"] / r["seconds"] for r in runs)
+    return "on" if rate(on) > rate(off) else "off"
+
+
+def exploring(history, network):
+    """Whether this run on ``network`` should try the setting its history
+    doesn't favour: every EXPLORE_EVERY-th run."""
+    runs = sum(1 for h in history if h.get("network") == network)
+    return runs > 0 and (runs + 1) % EXPLORE_EVERY == 0
+
+
+def expected_ratio(history, network):
+    """Median wire/data ratio of past compressed runs on ``network``."""
+    ratios = [h["wire_bytes"] / h["data_bytes"] for h in _samples(history, network, True)
+              if h.get("wire_bytes")]
+    return statistics.median(ratios) if ratios else DEFAULT_RATIO
+
+
+def link_rate(history, network):
+    """Median measured link rate (MB/s on the wire) of past runs on ``network``."""
+    rates = [h["wire_bytes"] / h["seconds"] / 1e6
+             for h in history
+             if h.get("network") == network and h.get("seconds") and
+             (h.get("wire_bytes") or 0) >= MIN_SAMPLE_BYTES]
+    return statistics.median(rates) if rates else None
+
+
+# --- Measurements -------------------------------------------------------------
+
+def _cpu_times():
+    with open("/proc/stat", "r") as f:
+        parts = f.readline().split()[1:]
+    vals = [int(v) for v in parts]
+    idle = vals[3] + (vals[4] if len(vals) > 4 else 0)   # idle + iowait
+    return idle, sum(vals)
+
+
+def cpu_idle_cores(sample_sec=0.25):
+    """Idle capacity right now, in cores (e.g. 3.2 of 4). None if unknown."""
+    try:
+        i0, t0 = _cpu_times()
+        time.sleep(sample_sec)
+        i1, t1 = _cpu_times()
+        if t1 <= t0:
+            return None
+        return (i1 - i0) / (t1 - t0) * (os.cpu_count() or 1)
+    except Exception:
+        return None
+
+
+def backups_encrypted(backup_dir):
+    """True if every device folder's Manifest.plist says IsEncrypted, False if
+    any says it is not, None if there is nothing to tell from."""
+    seen = False
+    try:
+        entries = list(os.scandir(backup_dir))
+    except OSError:
+        return None
+    for e in entries:
+        mp = os.path.join(e.path, "Manifest.plist")
+        if not e.is_dir() or not os.path.exists(mp):
+            continue
+        try:
+            with open(mp, "rb") as fp:
+                if not plistlib.load(fp).get("IsEncrypted", False):
+                    return False
+            seen = True
+        except Exception:
+            continue
+    return True if seen else None
+
+
+def parse_compressors(version_text):
+    """Compression algorithms from ``rsync --version`` (3.2+ prints a
+    "Compress list:" section). Returns [] for an older rsync."""
+    lines = (version_text or "").splitlines()
+    for i, line in enumerate(lines):
+        if line.strip().lower().startswith("compress list"):
+            algos = []
+            for nxt in lines[i + 1:]:
+                if not nxt.startswith((" ", "\t")) or not nxt.strip():
+                    break
+                algos += nxt.split()
+            return [a for a in algos if a != "none"]
+    return []
+
+
+def available_compressors(session):
+    """(algorithms both ends support, choice_supported). Falls back to
+    (["zlib"], False) when either rsync predates --compress-choice."""
+    try:
+        local = subprocess.run(["/usr/bin/rsync", "--version"], capture_output=True,
+                               text=True, timeout=5).stdout
+    except Exception:
+        local = ""
+    try:
+        remote = session.run("/usr/bin/rsync --version", timeout=15).stdout
+    except Exception:
+        remote = ""
+    lc, rc = parse_compressors(local), parse_compressors(remote)
+    if lc and rc:
+        common = [a for a in lc if a in rc]
+        return common, True
+    return ["zlib"], False
+
+
+def probe_link(session, nbytes=PROBE_BYTES):
+    """Measure RTT (ms) and wire throughput (MB/s) over the session's master.
+    Returns {"rtt_ms", "mbs"}; either may be None if the probe failed."""
+    out = {"rtt_ms": None, "mbs": None}
+    try:
+        t0 = time.monotonic()
+        if session.run("true", timeout=15).returncode != 0:
+            return out
+        rtt = time.monotonic() - t0
+        out["rtt_ms"] = round(rtt * 1000, 1)
+        payload = os.urandom(nbytes)      # incompressible, like the worst case
+        t0 = time.monotonic()
+        r = subprocess.run(session.ssh_cmd("cat > /dev/null"), input=payload,
+                           capture_output=True, timeout=60, env=session.env)
+        took = time.monotonic() - t0 - rtt
+        if r.returncode == 0 and took > 0:
+            out["mbs"] = round(nbytes / took / 1e6, 3)
+    except Exception:
+        pass
+    return out
+
+
+# --- Decision -----------------------------------------------------------------
+
+def _codec_ratio(algo, ratio):
+    # lz4 trades ratio for speed; zlib and zstd at low levels are comparable.
+    if algo == "lz4":
+        return ratio + (1.0 - ratio) * 0.35
+    return ratio
+
+
+def choose(link_mbs, idle_cores, available, encrypted=False, history=(), network=None):
+    """Pick rsync compression settings. Pure.
+
+    Returns {"compress": algo|"", "level": int|None, "reason": str,
+    "expected_mbs": float|None}.
+    """
+    off = lambda reason: {"compress": "", "level": None, "reason": reason, "expected_mbs": link_mbs}
+    if encrypted:
+        return off("backups are encrypted (incompressible)")
+    if not available:
+        return off("no common compression algorithm")
+    learned = learned_preference(history, network)
+    explore = learned is not None and exploring(history, network)
+    if explore:
+        learned = "on" if learned == "off" else "off"
+    if learned == "off":
+        return off("exploring: history favours compression, trying without" if explore
+                   else "history: faster without compression on this network")
+    if link_mbs is None:
+        link_mbs = link_rate(history, network)
+    if link_mbs is None:
+        return off("link rate unknown")
+
+    ratio = expected_ratio(history, network)
+    # rsync compresses on a single core: at most one core of headroom helps.
+    headroom = 1.0 if idle_cores is None else max(0.05, min(1.0, idle_cores))
+    best, best_eff = None, 0.0
+    for algo in CODEC_ORDER:
+        if algo not in available:
+            continue
+        eff = min(CODEC_MBS[algo] * headroom, link_mbs / _codec_ratio(algo, ratio))
+        if eff > best_eff:
+            best, best_eff = algo, eff
+    if best is None:
+        return off("no supported codec")
+    if learned != "on" and best_eff < link_mbs * GAIN_MARGIN:
+        return off(f"CPU-bound (link {link_mbs:.1f} MB/s, {best} would reach {best_eff:.1f})")
+    level = None
+    if best == "zstd":
+        level = 3 if link_mbs < 2.0 else 1
+    elif best == "zlib":
+        level = 6 if link_mbs < 2.0 else 1
+    if explore:
+        reason = "exploring: history favours no compression, trying it"
+    elif learned == "on":
+        reason = "history: faster with compression on this network"
+    else:
+        reason = f"link-bound ({link_mbs:.1f} MB/s, expect {best_eff:.1f})"
+    return {"compress": best, "level": level, "reason": reason,
+            "expected_mbs": round(best_eff, 3)}
+
+
+def flags_for(settings, choice_supported=True):
+    """rsync flags for the settings returned by ``choose()``/``tune()``."""
+    algo = settings.get("compress")
+    if not algo:
+        return []
+    flags = ["--compress"]
+    if choice_supported:
+        flags.append(f"--compress-choice={algo}")
+    if settings.get("level") is not None:
+        flags.append(f"--compress-level={settings['level']}")
+    flags.append(f"--skip-compress={SKIP_COMPRESS}")
+    return flags
+
+
+def tune(session, backup_dir, mode="auto", network=None, metered=False):
+    """Decide compression for this run. ``mode``: auto | on | off. On a
+    ``metered`` network the link is not probed.
+
+    Returns the ``choose()`` dict plus "flags", "network" and the measurements
+    taken, ready to be logged and later passed to ``record_run``.
+    """
+    base = {"network": network, "rtt_ms": None, "probe_mbs": None, "cpu_idle": None}
+    if mode == "off":
+        return {**base, "compress": "", "level": None, "reason": "disabled in config",
+                "expected_mbs": None, "flags": []}
+    available, choice_supported = available_compressors(session)
+    if mode == "on":
+        algo = next((a for a in CODEC_ORDER if a in available), "")
+        settings = {"compress": algo, "level": 1 if algo in ("zstd", "zlib") else None,
+                    "reason": "forced on in config", "expected_mbs": None}
+        return {**base, **settings, "flags": flags_for(settings, choice_supported)}
+
+    encrypted = backups_encrypted(backup_dir)
+    if encrypted:
+        settings = choose(None, None, available, encrypted=True)
+        return {**base, **settings, "flags": []}
+    history = load_history()
+    probe = {"rtt_ms": None, "mbs": None} if metered else probe_link(session)
+    idle = cpu_idle_cores()
+    settings = choose(probe["mbs"], idle, available, history=history, network=network)
+    base.update(rtt_ms=probe["rtt_ms"], probe_mbs=probe["mbs"],
+                cpu_idle=None if idle is None else round(idle, 2))
+    return {**base, **settings, "flags": flags_for(settings, choice_supported)}
+
+
+def describe(settings):
+    """One-line summary for the sync log."""
+    algo = settings.get("compress") or "off"
+    if settings.get("compress") and settings.get("level") is not None:
+        algo += f" level {settings['level']}"
+    meas = []
+    if settings.get("network"):
+        meas.append(f"network={settings['network']}")
+    if settings.get("rtt_ms") is not None:
+        meas.append(f"rtt={settings['rtt_ms']:.0f}ms")
+    if settings.get("probe_mbs") is not None:
+        meas.append(f"link={settings['probe_mbs']:.1f}MB/s")
+    if settings.get("cpu_idle") is not None:
+        meas.append(f"cpu_idle={settings['cpu_idle']:.1f}")
+    return f"compression {algo} ({settings.get('reason', '')})" + (
+        f" [{' '.join(meas)}]" if meas else "")
@@ -0,0 +1,600 @@
+#!/usr/bin/env python3
+"""
+sync_vault.py - Client-side encrypted sync target ("vault").
+
+iOS backups are often unencrypted. A target with ``encrypt: true`` never
+receives them as-is: every file is cut into CHUNK_SIZE chunks, each chunk is
+compressed (when it pays off) and sealed with AES-256-GCM on this box, and
+only the sealed chunks leave it. On the target a vault looks like::
+
+    vault.json              salt, KDF iterations and a key check (no secrets)
+    chunks/<ab>/<id>        one sealed chunk, named by its keyed content hash
+    trees/<tid>             sealed file list of one device folder
+
+- Keys: the vault password is stretched with ``wg_crypto.derive_key`` and the
+  vault's random salt. Separate subkeys seal data and name chunks, so a
+  chunk's name (an HMAC of its plaintext) reveals nothing without the key.
+- Dedupe: a chunk whose name the target already holds is never sent again,
+  whether it belongs to an unchanged file, a file moved between devices or an
+  attachment backed up from two phones.
+- Pipeline: the walk reads chunks and hands them to VAULT_WORKERS threads
+  that hash, compress, seal and store them, so compression and encryption
+  (zlib, hashlib and OpenSSL release the GIL) overlap with the upload. At most
+  workers + 2 chunks are in flight, which bounds memory whatever the file
+  sizes.
+- A local index (state dir) records which chunks the target holds and each
+  device's file list, so an unchanged file is not even read. Chunks are
+  recorded only after the store has flushed them, every FLUSH_BYTES, so a run
+  cut short resumes without resending what already arrived.
+
+Stores are thin: ``DirStore`` (a local disk), ``S3Store`` (sync_s3) and
+``SshStore`` (one ``tar -x`` stream per flush over the sync's SSH session).
+Run ``python3 sync_vault.py restore <vault dir> <dest>`` on a local copy of a
+vault to get the device folders back.
+
+Import-safe: stdlib only (AES-GCM comes from the ``cryptography`` package,
+imported on use), so it can be unit-tested on any machine.
+"""
+import os
+import io
+import stat
+import hmac
+import json
+import zlib
+import time
+import base64
+import shlex
+import tarfile
+import hashlib
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import wg_crypto
+import sync_local
+import sync_s3
+
+CHUNK_SIZE = 2 * 1024 * 1024
+VAULT_WORKERS = 4
+FLUSH_BYTES = 256 * 1024 * 1024
+KDF_ITERATIONS = 200000
+# Compress a chunk only if its first COMPRESS_SAMPLE bytes shrink below this
+# ratio: encrypted backups and media are not worth the CPU.
+COMPRESS_SAMPLE = 64 * 1024
+COMPRESS_RATIO = 0.9
+VAULT_FILE = "vault.json"
+ROOT_TREE = "."       # the files at the top of backup_dir
+
+_MAGIC = b"IBV1"
+_FLAG_ZLIB = 1
+
+
+class VaultError(Exception):
+    pass
+
+
+def cipher_available():
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class VaultKeys:
+    """Subkeys of one vault: ``seal``/``unseal`` blobs, name chunks and trees."""
+
+    def __init__(self, master):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self._aead = AESGCM(hmac.new(master, b"iosbackupmachine vault seal", hashlib.sha256).digest())
+        self._ident = hmac.new(master, b"iosbackupmachine vault ident", hashlib.sha256).digest()
+        self.check = hmac.new(master, b"iosbackupmachine vault check", hashlib.sha256).hexdigest()
+
+    @classmethod
+    def derive(cls, password, salt, iterations=KDF_ITERATIONS):
+        return cls(wg_crypto.derive_key(password, salt, iterations))
+
+    def chunk_id(self, data):
+        return hmac.new(self._ident, data, hashlib.sha256).hexdigest()[:32]
+
+    def tree_id(self, name):
+        return hmac.new(self._ident, b"tree:" + name.encode(), hashlib.sha256).hexdigest()[:32]
+
+    def seal(self, data, aad):
+        flags = 0
+        sample = data[:COMPRESS_SAMPLE]
+        if sample and len(zlib.compress(sample, 1)) < len(sample) * COMPRESS_RATIO:
+            packed = zlib.compress(data, 1)
+            if len(packed) < len(data):
+                data, flags = packed, _FLAG_ZLIB
+        header = _MAGIC + bytes([flags])
+        nonce = os.urandom(12)
+        return header + nonce + self._aead.encrypt(nonce, data, header + aad)
+
+    def unseal(self, blob, aad):
+        header, nonce, body = blob[:5], blob[5:17], blob[17:]
+        if header[:4] != _MAGIC:
+            raise VaultError("not a vault object")
+        try:
+            data = self._aead.decrypt(nonce, body, header + aad)
+        except Exception:
+            raise VaultError("vault object failed authentication")
+        return zlib.decompress(data) if header[4] & _FLAG_ZLIB else data
+
+
+def chunk_path(cid):
+    return f"chunks/{cid[:2]}/{cid}"
+
+
+def tree_path(tid):
+    return f"trees/{tid}"
+
+
+def open_vault(store, password, create=True):
+    """Keys of the vault in ``store``, creating the vault if it has none.
+    Raises VaultError on a wrong password (so a vault is never written to with
+    a second key)."""
+    if not password:
+        raise VaultError("No vault password configured.")
+    raw = store.get(VAULT_FILE)
+    if raw is None:
+        if not create:
+            raise VaultError("No vault found.")
+        salt = os.urandom(16)
+        keys = VaultKeys.derive(password, salt, KDF_ITERATIONS)
+        meta = {"format": "iosbackupmachine-vault", "version": 1,
+                "salt": base64.b64encode(salt).decode(), "iterations": KDF_ITERATIONS,
+                "check": keys.check}
+        store.put(VAULT_FILE, json.dumps(meta, indent=2).encode())
+        store.flush()
+        return keys
+    try:
+        meta = json.loads(raw)
+        keys = VaultKeys.derive(password, base64.b64decode(meta["salt"]),
+                                int(meta.get("iterations", KDF_ITERATIONS)))
+    except (ValueError, KeyError, TypeError):
+        raise VaultError("Unreadable vault.json on the target.")
+    if not hmac.compare_digest(keys.check, meta.get("check", "")):
+        raise VaultError("Wrong vault password for the vault on this target.")
+    return keys
+
+
+# -- stores ------------------------------------------------------------------
+
+class DirStore:
+    """Vault in a directory (a mounted disk, or a local copy for restore)."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def put(self, name, data):
+        path = os.path.join(self.root, name)
+        tmp = f"{path}.tmp.{threading.get_ident()}"
+        try:
+            f = open(tmp, "wb")
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = open(tmp, "wb")
+        with f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def get(self, name):
+        try:
+            with open(os.path.join(self.root, name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def list(self, prefix):
+        try:
+            return sorted(f"{prefix}/{n}" for n in os.listdir(os.path.join(self.root, prefix)))
+        except OSError:
+            return []
+
+    def delete(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+
+    def flush(self):
+        # One syncfs per flush instead of an fsync per chunk (see sync_local).
+        sync_local.syncfs(self.root)
+
+    def close(self):
+        pass
+
+
+class S3Store:
+    """Vault under ``prefix`` in an S3 bucket. Every put is durable on return."""
+
+    def __init__(self, client, prefix):
+        self.client = client
+        self.prefix = prefix.strip("/")
+
+    def put(self, name, data):
+        self.client.put_object(sync_s3.object_key(self.prefix, name), data)
+
+    def get(self, name):
+        try:
+            return self.client.request("GET", sync_s3.object_key(self.prefix, name))[2]
+        except sync_s3.S3Error as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def delete(self, names):
+        for name in names:
+            self.client.delete_object(sync_s3.object_key(self.prefix, name))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.client.close()
+
+
+class SshStore:
+    """Vault in ``root`` on an SSH server. Puts are appended to a tar stream
+    piped into ``tar -x`` on the server; ``flush`` ends the stream and waits
+    for the server to have written it. ``session`` is sync_manager's
+    _SshSession (``ssh_cmd``, ``env``)."""
+
+    def __init__(self, session, root):
+        self.session = session
+        self.root = root.rstrip("/") or "/"
+        self._lock = threading.Lock()
+        self._proc = None
+        self._tar = None
+
+    def _ssh(self, remote_command, **kw):
+        return subprocess.run(self.session.ssh_cmd(remote_command), capture_output=True,
+                              env=self.session.env, **kw)
+
+    def put(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o600
+        with self._lock:
+            if self._proc is None:
+                root = shlex.quote(self.root)
+                self._proc = subprocess.Popen(
+                    self.session.ssh_cmd(f"mkdir -p {root} && tar -xf - -C {root}"),
+                    stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                    env=self.session.env)
+                self._tar = tarfile.open(fileobj=self._proc.stdin, mode="w|")
+            try:
+                self._tar.addfile(info, io.BytesIO(data))
+            except OSError:
+                self._abort()
+                raise VaultError("SSH connection lost while sending chunks.")
+
+    def _abort(self):
+        proc, self._proc, self._tar = self._proc, None, None
+        proc.kill()
+        proc.wait()
+
+    def flush(self):
+        with self._lock:
+            if self._proc is None:
+                return
+            proc, tar = self._proc, self._tar
+            self._proc = self._tar = None
+            try:
+                tar.close()
+                proc.stdin.close()
+            except OSError:
+                pass
+            err = proc.stderr.read().decode(errors="replace").strip()
+            if proc.wait() != 0:
+                raise VaultError(f"Remote tar failed: {err[:200] or f'exit {proc.returncode}'}")
+
+    def get(self, name):
+        path = shlex.quote(f"{self.root}/{name}")
+        r = self._ssh(f"if [ -f {path} ]; then cat {path}; else exit 44; fi", timeout=300)
+        if r.returncode == 44:
+            return None
+        if r.returncode != 0:
+            raise VaultError(f"Cannot read {name}: {r.stderr.decode(errors='replace')[:200]}")
+        return r.stdout
+
+    def delete(self, names):
+        if names:
+            r = self._ssh(f"cd {shlex.quote(self.root)} && xargs -0 rm -f",
+                          input=b"\0".join(n.encode() for n in names), timeout=300)
+            if r.returncode != 0:
+                raise VaultError(f"Cannot delete old chunks: {r.stderr.decode(errors='replace')[:200]}")
+
+    def close(self):
+        with self._lock:
+            if self._proc is not None:
+                self._abort()
+
+
+# -- local index and upload --------------------------------------------------
+
+class Index:
+    """What this box has stored in one vault: chunk names, and per device
+    folder its file list ``{rel: [size, mtime_ns, mode, [chunk ids]]}``. Reset
+    when the vault's key check changes (new vault or password)."""
+
+    def __init__(self, path, check):
+        self.path = path
+        self.check = check
+        self._lock = threading.Lock()
+        self._pending = set()
+        data = {}
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except Exception:
+            pass
+        if not isinstance(data, dict) or data.get("check") != check:
+            data = {}
+        self.chunks = set(data.get("chunks") or [])
+        self.trees = data.get("trees") or {}
+
+    def has_all(self, ids):
+        return all(i in self.chunks for i in ids)
+
+    def stored(self, cid):
+        """``cid`` was handed to the store; it counts once the store flushed."""
+        with self._lock:
+            self._pending.add(cid)
+
+    def take_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        return pending
+
+    def commit(self, ids):
+        with self._lock:
+            self.chunks |= ids
+
+    def referenced(self):
+        return {cid for files in self.trees.values() for meta in files.values() for cid in meta[3]}
+
+    def save(self):
+        with self._lock:
+            data = json.dumps({"check": self.check, "chunks": sorted(self.chunks),
+                               "trees": self.trees}, separators=(",", ":"))
+        tmp = f"{self.path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        try:
+            with open(tmp, "w") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def _walk(src):
+    """(rel, path, stat) of every regular file under ``src``, sorted."""
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        try:
+            entries = sorted(os.scandir(os.path.join(src, rel)), key=lambda e: e.name)
+        except OSError:
+            continue
+        for e in entries:
+            r = f"{rel}/{e.name}" if rel else e.name
+            if e.is_dir(follow_symlinks=False):
+                stack.append(r)
+            elif e.is_file(follow_symlinks=False):
+                yield r, e.path, e.stat(follow_symlinks=False)
+
+
+class VaultUploader:
+    """Send one device folder into the vault and record its file list.
+
+    Same callbacks and result as sync_local.TreeCopier: ``on_progress(done,
+    speed_bps)``, ``should_stop()``; ``copied`` counts files read and sent (or
+    deduplicated), ``copied_bytes`` the sealed bytes that went to the store."""
+
+    def __init__(self, keys, store, index, workers=VAULT_WORKERS, on_progress=None,
+                 should_stop=None):
+        self.keys = keys
+        self.store = store
+        self.index = index
+        self.workers = max(1, int(workers))
+        self.on_progress = on_progress
+        self.should_stop = should_stop
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.workers + 2)
+        self._claimed = set()
+        self._unflushed = 0
+        self._error = None
+        self._start = time.time()
+        self.result = {"copied": 0, "skipped": 0, "copied_bytes": 0, "done_bytes": 0,
+                       "stopped": None}
+
+    def _progress(self, nbytes, sent=0, kind=None):
+        with self._lock:
+            r = self.result
+            if kind:
+                r[kind] += 1
+            r["done_bytes"] += nbytes
+            r["copied_bytes"] += sent
+            self._unflushed += sent
+            done, moved = r["done_bytes"], r["copied_bytes"]
+        if self.on_progress:
+            elapsed = time.time() - self._start
+            self.on_progress(done, moved / elapsed if elapsed > 0 else 0.0)
+
+    def _put_chunk(self, data):
+        try:
+            cid = self.keys.chunk_id(data)
+            with self._lock:
+                new = cid not in self.index.chunks and cid not in self._claimed
+                self._claimed.add(cid)
+            sent = 0
+            if new:
+                blob = self.keys.seal(data, cid.encode())
+                self.store.put(chunk_path(cid), blob)
+                self.index.stored(cid)
+                sent = len(blob)
+            self._progress(len(data), sent)
+            return cid
+        except Exception as e:
+            self._error = e
+            raise
+        finally:
+            self._slots.release()
+
+    def _flush(self):
+        pending = self.index.take_pending()
+        self.store.flush()
+        self.index.commit(pending)
+        with self._lock:
+            self._unflushed = 0
+
+    def upload_tree(self, src, name, entries=None):
+        """Send the files of ``src`` (or the regular files among the
+        ``(rel, path, stat)`` in ``entries``, such as the run's shared
+        sync_checkpoint.file_list) as tree ``name``. The tree is written, and the index
+        updated, only if the whole folder made it."""
+        prev = self.index.trees.get(name) or {}
+        files, sent = {}, []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for rel, path, st in (entries if entries is not None else _walk(src)):
+                if not stat.S_ISREG(st.st_mode):
+                    continue              # a shared file list also has directories
+                stop = self.should_stop() if self.should_stop else None
+                if stop:
+                    self.result["stopped"] = stop
+                    break
+                old = prev.get(rel)
+                if (old and old[0] == st.st_size and old[1] == st.st_mtime_ns
+                        and self.index.has_all(old[3])):
+                    files[rel] = old
+                    self._progress(st.st_size, kind="skipped")
+                    continue
+                if self._error:
+                    break
+                futures = []
+                try:
+                    f = open(path, "rb")
+                except FileNotFoundError:
+                    continue
+                with f:
+                    while True:
+                        self._slots.acquire()
+                        data = f.read(CHUNK_SIZE)
+                        if not data:
+                            self._slots.release()
+                            break
+                        futures.append(pool.submit(self._put_chunk, data))
+                files[rel] = [st.st_size, st.st_mtime_ns, st.st_mode & 0o7777, futures]
+                sent.append(rel)
+                self.result["copied"] += 1
+                if self._unflushed >= FLUSH_BYTES:
+                    self._flush()
+        if self._error:
+            self._flush()               # keep what did arrive for the next run
+            self.index.save()
+            raise self._error
+        for rel in sent:
+            files[rel][3] = [f.result() for f in files[rel][3]]
+        self._flush()
+        if not self.result["stopped"] and self.should_stop:
+            self.result["stopped"] = self.should_stop()
+        if not self.result["stopped"]:
+            tree = {"name": name, "created": int(time.time()), "files": files}
+            tid = self.keys.tree_id(name)
+            self.store.put(tree_path(tid), self.keys.seal(json.dumps(tree).encode(),
+                                                          f"tree:{tid}".encode()))
+            self.store.flush()
+            self.index.trees[name] = files
+        self.index.save()
+        return self.result
+
+
+def root_entries(backup_dir):
+    """``(rel, path, stat)`` of the regular files at the top of backup_dir."""
+    out = []
+    for e in sorted(os.scandir(backup_dir), key=lambda e: e.name):
+        if not e.name.startswith(".") and e.is_file(follow_symlinks=False):
+            out.append((e.name, e.path, e.stat(follow_symlinks=False)))
+    return out
+
+
+def drop_trees(keys, store, index, keep):
+    """Delete the trees of device folders no longer in ``keep``."""
+    gone = [n for n in index.trees if n != ROOT_TREE and n not in keep]
+    store.delete([tree_path(keys.tree_id(n)) for n in gone])
+    for n in gone:
+        del index.trees[n]
+    return gone
+
+
+def collect_garbage(store, index):
+    """Delete chunks no tree refers to any more. Returns how many."""
+    unused = index.chunks - index.referenced()
+    store.delete([chunk_path(c) for c in sorted(unused)])
+    index.chunks -= unused
+    index.save()
+    return len(unused)
+
+
+# -- restore -----------------------------------------------------------------
+
+def restore(store, keys, dest, names=None):
+    """Rebuild the folders of a vault (``store`` must support ``list``) under
+    ``dest``. Every chunk is authenticated and its name checked against its
+    content. Returns {tree name: files restored}."""
+    out = {}
+    for path in store.list("trees"):
+        tid = path.rsplit("/", 1)[-1]
+        tree = json.loads(keys.unseal(store.get(path), f"tree:{tid}".encode()))
+        name = tree["name"]
+        if names and name not in names:
+            continue
+        base = dest if name == ROOT_TREE else os.path.join(dest, name)
+        for rel, (size, mtime_ns, mode, ids) in tree["files"].items():
+            target = os.path.join(base, rel)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as f:
+                for cid in ids:
+                    blob = store.get(chunk_path(cid))
+                    if blob is None:
+                        raise VaultError(f"Missing chunk {cid} of {name}/{rel}")
+                    data = keys.unseal(blob, cid.encode())
+                    if keys.chunk_id(data) != cid:
+                        raise VaultError(f"Corrupt chunk {cid} of {name}/{rel}")
+                    f.write(data)
+            os.chmod(target, mode)
+            os.utime(target, ns=(mtime_ns, mtime_ns))
+        out[name] = len(tree["files"])
+    return out
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    import getpass
+    parser = argparse.ArgumentParser(description="Restore an encrypted sync vault.")
+    sub = parser.add_subparsers(dest="cmd")
+    r = sub.add_parser("restore", help="restore device folders from a local copy of a vault")
+    r.add_argument("vault_dir")
+    r.add_argument("dest")
+    r.add_argument("--device", action="append", help="only this device folder (repeatable)")
+    args = parser.parse_args()
+    if args.cmd != "restore":
+        parser.print_help()
+        sys.exit(1)
+    store = DirStore(args.vault_dir)
+    try:
+        keys = open_vault(store, getpass.getpass("Vault password: "), create=False)
+        for tree, count in restore(store, keys, args.dest, args.device).items():
+            print(f"{tree}: {count} files")
+    except VaultError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
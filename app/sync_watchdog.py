@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+sync_watchdog.py - Stall detection for a running rsync, from what the transfer
+is doing rather than only from how long its output has been quiet.
+
+Signals, sampled on every quiet tick of sync_manager._supervise_rsync:
+
+- rsync's own output (any line, progress bytes);
+- the I/O of the rsync process tree (``rchar + wchar`` from /proc/<pid>/io of
+  rsync, its ssh child and an sshpass wrapper). A big file being checksummed
+  or written moves these while --info=progress2 prints nothing;
+- the TCP connection to the target (/proc/net/tcp and tcp6): send and receive
+  queue sizes and the kernel's RTO retransmit count. Through a ControlMaster
+  the socket belongs to the master, so it is found by the target's address.
+
+The model: the link rate expected on the current network comes from the sync
+history (sync_tuner): that network's own runs, else runs on the same kind of
+network (``wifi``, ``usb_iphone``), else DEFAULT_RATES. It is lowered to the
+rate this run has actually shown. When nothing moved for as long as the link
+needs to move STALL_QUANTUM bytes (clamped to STALL_MIN_SEC..STALL_MAX_SEC),
+the run shows as stalled.
+
+A run is killed only when
+- the link is dead: data waits in the send queue, the kernel has retransmitted
+  it DEAD_RETRANSMITS times and nothing moved for DEAD_LINK_SEC; or the
+  connection it had is gone; or
+- no signal at all moved for the hard limit (sync_manager.STALL_KILL_SEC).
+A transfer whose counters keep moving is never killed, however slow.
+
+Import-safe: stdlib only; the /proc readers can be swapped for tests.
+"""
+import os
+import socket
+import statistics
+import time
+
+import sync_tuner
+
+STALL_QUANTUM = 8 * 1024 * 1024   # bytes the link should move between two signs of life
+STALL_MIN_SEC = 10
+STALL_MAX_SEC = 300
+DEAD_RETRANSMITS = 3              # unacknowledged RTO retransmits of the send queue
+DEAD_LINK_SEC = 15
+# Link rates (bytes/s) assumed for a kind of network with no history yet.
+DEFAULT_RATES = {"wifi": 2e6, "usb_iphone": 1e6}
+DEFAULT_RATE = 1e6
+MIN_RATE = 16 * 1024              # below this every wait would hit STALL_MAX_SEC anyway
+
+_TCP_ESTABLISHED = "01"
+
+
+def network_kind(network):
+    return (network or "").split(":", 1)[0]
+
+
+def expected_rate(history, network):
+    """Expected link rate (bytes/s) on ``network``: the median of its own
+    past runs, else of the networks of the same kind, else DEFAULT_RATES."""
+    kind = network_kind(network)
+    rate = sync_tuner.link_rate(history, network) if network else None
+    if rate is None and kind:
+        same_kind = {h.get("network") for h in history
+                     if h.get("network") and network_kind(h.get("network")) == kind}
+        rates = [r for r in (sync_tuner.link_rate(history, n) for n in same_kind) if r]
+        rate = statistics.median(rates) if rates else None
+    return rate * 1e6 if rate else DEFAULT_RATES.get(kind, DEFAULT_RATE)
+
+
+# --- /proc readers --------------------------------------------------------------
+
+def process_tree(pid, proc="/proc"):
+    """``pid`` and all its descendants (from the ppid field of /proc/*/stat)."""
+    children = {}
+    try:
+        entries = os.listdir(proc)
+    except OSError:
+        return [pid]
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"{proc}/{entry}/stat", "r") as f:
+                stat = f.read()
+            ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        tree.append(p)
+        todo.extend(children.get(p, ()))
+    return tree
+
+
+def read_io(pids, proc="/proc"):
+    """Sum of rchar + wchar over ``pids`` (processes that are gone count 0)."""
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"{proc}/{pid}/io", "r") as f:
+                for line in f:
+                    key, _, val = line.partition(":")
+                    if key in ("rchar", "wchar"):
+                        total += int(val)
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+def _hex_addr(text):
+    """An address as /proc/net/tcp{,6} writes it (hex, 32-bit words in host
+    order) -> (ip string, port)."""
+    addr, _, port = text.partition(":")
+    raw = bytes.fromhex(addr)
+    raw = b"".join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4))
+    if len(raw) == 4:
+        ip = socket.inet_ntop(socket.AF_INET, raw)
+    else:
+        ip = socket.inet_ntop(socket.AF_INET6, raw)
+        if ip.startswith("::ffff:") and "." in ip:
+            ip = ip[7:]
+    return ip, int(port, 16)
+
+
+def read_tcp(ips, port, proc="/proc"):
+    """Established connections to any of ``ips`` on ``port``:
+    [(tx_queue, rx_queue, retransmits)]."""
+    conns = []
+    for name in ("tcp", "tcp6"):
+        try:
+            with open(f"{proc}/net/{name}", "r") as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 7 or fields[3] != _TCP_ESTABLISHED:
+                continue
+            try:
+                ip, rport = _hex_addr(fields[2])
+                if rport != port or ip not in ips:
+                    continue
+                tx, _, rx = fields[4].partition(":")
+                conns.append((int(tx, 16), int(rx, 16), int(fields[6], 16)))
+            except ValueError:
+                continue
+    return conns
+
+
+def resolve(host, port):
+    """The addresses ``host`` resolves to (as /proc/net/tcp shows them)."""
+    try:
+        return {ai[4][0] for ai in socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)}
+    except (OSError, UnicodeError):
+        return set()
+
+
+# --- The watch ------------------------------------------------------------------
+
+class StallWatch:
+    """Liveness of one rsync. ``start(pid)`` once it runs, ``output(nbytes)``
+    on every line it prints (with the progress byte count when it has one),
+    ``check()`` on quiet ticks. ``remote`` is (host, port) of an SSH target;
+    without it only output and process I/O count."""
+
+    def __init__(self, rate=None, remote=None, hard_kill_sec=1800, clock=time.monotonic,
+                 io_reader=read_io, tcp_reader=read_tcp, tree=process_tree):
+        self.rate = max(rate or DEFAULT_RATE, MIN_RATE)
+        self.hard_kill_sec = hard_kill_sec
+        self.clock = clock
+        self._read_io = io_reader
+        self._read_tcp = tcp_reader
+        self._tree = tree
+        self.port = remote[1] if remote else None
+        self.ips = resolve(*remote) if remote else set()
+        self.pid = None
+        self._start = self._last_move = clock()
+        self._io = None
+        self._tcp = None
+        self._had_conn = False
+        self._bytes0 = None
+        self.observed_rate = None
+
+    def start(self, pid):
+        self.pid = pid
+        self._start = self._last_move = self.clock()
+
+    def output(self, nbytes=None):
+        """rsync printed something; ``nbytes`` is its progress byte count."""
+        now = self.clock()
+        self._last_move = now
+        if nbytes is None:
+            return
+        if self._bytes0 is None:
+            self._bytes0 = (nbytes, now)
+        elif now - self._bytes0[1] >= 10:
+            self.observed_rate = (nbytes - self._bytes0[0]) / (now - self._bytes0[1])
+
+    def warn_after(self):
+        """Seconds without any sign of life after which the run looks stalled."""
+        rate = self.rate
+        if self.observed_rate is not None:
+            rate = max(min(rate, self.observed_rate), MIN_RATE)
+        return min(max(STALL_QUANTUM / rate, STALL_MIN_SEC), STALL_MAX_SEC)
+
+    def check(self):
+        """Sample the signals. Returns {"state": "ok"|"stalled"|"dead",
+        "idle": seconds since anything moved, "kill": bool, "reason": str}."""
+        now = self.clock()
+        if self.pid is not None:
+            io = self._read_io(self._tree(self.pid))
+            if io != self._io:
+                if self._io is not None:
+                    self._last_move = now
+                self._io = io
+        dead_reason = ""
+        if self.ips:
+            conns = self._read_tcp(self.ips, self.port)
+            sig = sorted((tx, rx) for tx, rx, _ in conns)
+            if conns and self._tcp is not None and sig != self._tcp:
+                self._last_move = now     # (a connection going away is no progress)
+            self._tcp = sig
+            if conns:
+                self._had_conn = True
+                stuck = [c for c in conns if c[0] and c[2] >= DEAD_RETRANSMITS]
+                if stuck and len(stuck) == len(conns):
+                    dead_reason = (f"{stuck[0][0]} bytes unacknowledged after "
+                                   f"{stuck[0][2]} retransmits")
+            elif self._had_conn:
+                dead_reason = "the connection to the target is gone"
+        idle = now - self._last_move
+        if dead_reason and idle >= DEAD_LINK_SEC:
+            return {"state": "dead", "idle": idle, "kill": True,
+                    "reason": f"link dead ({dead_reason}), nothing moved for {int(idle)}s"}
+        if idle >= self.hard_kill_sec:
+            return {"state": "stalled", "idle": idle, "kill": True,
+                    "reason": f"no output, disk or network activity for {int(idle)}s"}
+        if idle >= self.warn_after() or dead_reason:
+            return {"state": "stalled", "idle": idle, "kill": False,
+                    "reason": dead_reason or f"nothing moved for {int(idle)}s "
+                                             f"(expected within {int(self.warn_after())}s)"}
+        return {"state": "ok", "idle": idle, "kill": False, "reason": ""}
@@ -0,0 +1,684 @@
+#!/usr/bin/env python3
+"""
+sync_worker.py - Long-lived sync worker (sync-worker.service).
+
+Runs every sync, restore and checksum audit of the box, one at a time, from a
+queue, in one process that stays up. The interpreter, sync_manager and its
+optional imports (cryptography, the S3 client) and the credential key are set
+up once, not by a fresh ``backup-sync.py`` per sync, and the config is re-read
+only when it changed. The web UI, the display daemon and ``backup-sync.py`` (button, long
+press) hand jobs to it over a Unix socket. When the service isn't running they
+fall back to a one-shot ``backup-sync.py``, which runs the same ``run_job``.
+
+Control socket ``<RUNTIME_DIR>/sync_worker.sock`` (root only), one JSON
+object per line each way:
+
+    {"cmd": "enqueue", "job": "sync"|"restore"|"audit", "args": {...}, "source": "webui"}
+        -> {"ok": true, "id": 4, "position": 0}       position 0: starts now
+    {"cmd": "cancel"}  or  {"cmd": "cancel", "id": 4}  the running job, or a queued one
+    {"cmd": "status"}  -> {"ok": true, "running": {...}|null, "queue": [...], "last": {...}|null}
+    {"cmd": "subscribe"}
+        -> one event per line until the client hangs up: "status" first, then
+           "queued", "started", "progress", "cancelling", "dropped", "finished",
+           and a "heartbeat" every HEARTBEAT_SEC
+
+A cancel is graceful: the run's stop event is set, rsync gets SIGTERM (so
+--partial keeps the file it was writing), finished device folders stay
+checkpointed, and the run closes its SSH master, data-usage meter and log as
+on any other end. The status file stays what the dashboard and the e-ink
+read; the worker writes it as backup-sync.py always has.
+
+The checksum audit of the remote copy (sync_manager.audit_remote) is
+background work: the worker queues it itself when ``sync.audit`` says it is
+due (see sync_audit.due), it leaves the status file alone, and a sync or
+restore asked for (or a backup starting) cancels it.
+"""
+import os, sys, json, time, fcntl, queue, socket, argparse, threading, subprocess, traceback
+import collections
+from datetime import datetime
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, SCRIPT_DIR)
+
+import yaml
+import logutil
+import logsearch
+
+CONFIG_PATH = os.getenv("IOSBACKUP_CONFIG", "/root/iosbackupmachine/config.yaml")
+LOG_DIR = logutil.LOG_DIR
+RUNTIME_DIR = logutil.RUNTIME_DIR
+STATUS_FILE = os.path.join(RUNTIME_DIR, "backup_status.json")
+SOCKET_PATH = os.path.join(RUNTIME_DIR, "sync_worker.sock")
+JOB_LOCK = os.path.join(RUNTIME_DIR, "sync_job.lock")
+
+# Arguments each job accepts (anything else in a request is dropped).
+JOB_ARGS = {"sync": (), "restore": ("device", "snapshot", "target"), "audit": ("target",)}
+QUEUE_MAX = 8
+AUDIT_CHECK_SEC = 300      # how often the worker asks whether an audit is due
+HEARTBEAT_SEC = 15
+SUBSCRIBER_BACKLOG = 256   # events held for a slow subscriber; the oldest go first
+STOP_GRACE_SEC = 60        # on SIGTERM, how long the running job gets to wind down
+
+
+# --- One job: what backup-sync.py runs ---
+
+_config = {"key": None, "cfg": None}
+
+
+def load_config(path=None):
+    """The config with backup-sync's defaults. Parsed again only when the
+    file's mtime, size or inode changed."""
+    path = path or CONFIG_PATH
+    try:
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size, st.st_ino)
+    except OSError:
+        key = None
+    if key is None or key != _config["key"]:
+        try:
+            with open(path, "r") as f:
+                cfg = yaml.safe_load(f) or {}
+        except Exception:
+            cfg = {}
+        cfg.setdefault("orientation", "landscape_right")
+        cfg.setdefault("env", {})
+        cfg.setdefault("sync", {"enabled": False})
+        _config.update(key=key, cfg=cfg)
+    return _config["cfg"]
+
+
+def write_status(state, **extra):
+    """Atomic status write: tmp file + rename, so concurrent readers never see partial JSON."""
+    tmp = STATUS_FILE + f".tmp.{os.getpid()}"
+    try:
+        os.makedirs(RUNTIME_DIR, exist_ok=True)
+        data = {"state": state, "timestamp": datetime.now().isoformat(), **extra}
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            try:
+                os.fsync(f.fileno())
+            except Exception:
+                pass
+        os.replace(tmp, STATUS_FILE)
+    except Exception:
+        try:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        except Exception:
+            pass
+
+
+def backup_running():
+    try:
+        out = subprocess.run(["pgrep", "-f", "idevicebackup2"],
+                             capture_output=True, text=True)
+        return out.returncode == 0
+    except Exception:
+        return False
+
+
+def claim_slot():
+    """Take the box's one sync slot: returns the open, locked ``JOB_LOCK`` file
+    (close it to give the slot back), or None while another process holds it.
+    Inside the worker the queue already runs one job at a time; the slot keeps
+    a one-shot ``backup-sync.py`` and the display daemon's in-process
+    auto-sync off a running job. The kernel drops the lock when its holder
+    exits, however it ends, so a killed run never leaves the slot taken."""
+    try:
+        os.makedirs(RUNTIME_DIR, exist_ok=True)
+        f = open(JOB_LOCK, "a")
+    except OSError:
+        return open(os.devnull)     # fail-open: no runtime dir, no lock to take
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def slot_taken():
+    """True while a sync, restore or audit holds the slot (see claim_slot)."""
+    slot = claim_slot()
+    if slot is None:
+        return True
+    slot.close()
+    return False
+
+
+def _notify(event, data=None):
+    try:
+        from notifications import send_notification
+        send_notification(event, data)
+    except Exception:
+        pass
+
+
+def run_job(job="sync", args=None, cancel=None, on_progress=None, source=""):
+    """Run one sync, restore or audit: the guards, a sync-*.log, status-file
+    updates and notifications. ``args`` are the restore's device/snapshot/target
+    or the audit's target. ``cancel`` (a threading.Event) stops the run
+    gracefully; ``on_progress`` gets each progress dict as well. Returns {success, message, duration}
+    plus ``skipped`` when a guard refused the run."""
+    args = args or {}
+    cfg = load_config()
+    for k, v in cfg.get("env", {}).items():
+        os.environ[k] = str(v)
+    os.makedirs(LOG_DIR, exist_ok=True)
+    ts = datetime.now().strftime("%Y%m%d-%H%M%S")
+    logpath = os.path.join(LOG_DIR, f"sync-{ts}.log")
+    try:
+        logf = logutil.open_run_log(logpath)
+        logutil.prune_logs()   # trim old per-run logs (count + age)
+    except Exception as e:
+        print(f"[FATAL] cannot open {logpath}: {e}", file=sys.stderr)
+        write_status("sync_error", message=f"Cannot write log: {e}")
+        return {"success": False, "message": f"Cannot write log: {e}", "duration": 0}
+    slot = claim_slot()
+    try:
+        logf.write(f"{job} starting (pid={os.getpid()}{f', from {source}' if source else ''})\n")
+        if slot is None:
+            return _skip(logf, "another sync, restore or audit is running")
+        return _run_logged(job, args, cfg, logf, cancel, on_progress)
+    finally:
+        if slot is not None:
+            slot.close()
+        logf.close()
+        # Index the finished log for search now, not on the next search. The
+        # paths are read here, not when the thread gets to run.
+        threading.Thread(target=_index_logs, daemon=True,
+                         args=(LOG_DIR, logutil.state_path(logsearch.DB_NAME))).start()
+
+
+def _index_logs(log_dir, db_path):
+    try:
+        conn = logsearch.connect(db_path)
+        try:
+            logsearch.update(log_dir, conn)
+        finally:
+            conn.close()
+    except Exception:
+        pass
+
+
+def _skip(logf, reason, status=None):
+    logf.write(f"[SKIP] {reason}\n")
+    if status:
+        write_status("sync_error", message=status)
+    return {"success": False, "message": status or reason, "duration": 0, "skipped": True}
+
+
+def _run_logged(job, args, cfg, logf, cancel, on_progress):
+    # ---------- Guards ----------
+    if job in ("sync", "audit") and not cfg.get("sync", {}).get("enabled", False):
+        return _skip(logf, "sync is disabled in config", "Sync is disabled in settings.")
+    if backup_running():
+        return _skip(logf, "backup (idevicebackup2) in progress",
+                     "Backup in progress — sync skipped.")
+
+    # Power-aware: refuse to start a sync on low battery (unless charging), or
+    # one the battery is not expected to last through (sync_estimate).
+    # Fail-open if the battery can't be read.
+    sync_cfg = cfg.get("sync", {})
+    try:
+        if job == "sync":
+            import sync_manager
+            batt_ok, batt_reason = sync_manager.admission(
+                sync_cfg.get("min_battery_percent", 35),
+                sync_cfg.get("battery_forecast", True), logf)
+        else:
+            import power
+            batt_ok, batt_reason = power.sync_allowed(sync_cfg.get("min_battery_percent", 35))
+    except Exception:
+        batt_ok, batt_reason = True, ""
+    if not batt_ok:
+        _notify("sync_error", {"error": batt_reason})
+        return _skip(logf, batt_reason, batt_reason)
+
+    if job == "audit":
+        return _run_audit(args, logf, cancel)
+
+    # Initial status: iosbackupmachine.py picks this up and starts drawing sync UI
+    write_status("syncing", percent=0, bytes=0, total=0, speed="", job=job)
+    logf.write("[INFO] status set to syncing — display owned by iosbackupmachine.py\n")
+    if job == "sync":
+        _notify("sync_start")
+
+    import sync_manager
+
+    # Throttle progress logging: only on a percent change or every 30s, so a stuck
+    # or slow sync leaves a sparse, readable trail instead of a line every second.
+    # Scan and stall transitions are logged separately (once) by sync_manager.
+    last_log = {"pct": None, "t": 0.0}
+
+    def progress(info):
+        pct = info.get("pct", 0)
+        elapsed = info.get("elapsed", 0.0)
+        write_status(
+            "syncing",
+            percent=pct,
+            bytes=info.get("bytes", 0),
+            total=info.get("total", 0),
+            speed=info.get("speed", ""),
+            stalled=bool(info.get("stalled", False)),
+            stalled_seconds=int(info.get("stalled_seconds", 0)),
+            scanning=bool(info.get("scanning", False)),
+            scan_seconds=int(info.get("scan_seconds", 0)),
+            resume_pct=int(info.get("resume_pct", 0)),
+            targets=info.get("targets") or {},
+            job=job,
+        )
+        if on_progress:
+            on_progress(info)
+        if info.get("scanning") or info.get("stalled"):
+            return  # transitions are logged by sync_manager; don't spam here
+        if pct != last_log["pct"] or (elapsed - last_log["t"]) >= 30:
+            logf.write(f"[SYNC] {pct}% ({elapsed:.0f}s)\n")
+            last_log["pct"] = pct
+            last_log["t"] = elapsed
+
+    try:
+        if job == "restore":
+            result = sync_manager.restore_with_progress(
+                args.get("device"), snapshot=args.get("snapshot"), target=args.get("target"),
+                on_progress=progress, log_file=logf, cancel=cancel)
+        else:
+            result = sync_manager.run_sync_with_progress(on_progress=progress, log_file=logf,
+                                                         cancel=cancel)
+    except Exception as e:
+        tb = traceback.format_exc()
+        logf.write(f"[ERROR] sync raised: {e}\n{tb}")
+        result = {"success": False, "message": f"Sync error: {e}", "duration": 0}
+
+    if cancel is not None and cancel.is_set() and not result["success"]:
+        result = {**result, "message": "Cancelled by user.", "cancelled": True}
+    if result["success"]:
+        logf.write(f"[OK] {result['message']}\n")
+        write_status("sync_complete", message=result["message"], job=job)
+        _notify("sync_complete", {"message": result["message"]})
+    else:
+        msg = result["message"]
+        logf.write(f"[ERROR] {msg}\n")
+        # paused: a metered network's monthly cap was hit; the display daemon
+        # starts the sync again once an unmetered network is available.
+        write_status("sync_error", message=msg, paused=bool(result.get("paused")), job=job)
+        if not result.get("cancelled"):
+            _notify("sync_error", {"error": msg})
+    return result
+
+
+def _run_audit(args, logf, cancel):
+    """The checksum audit: background work, so no status-file updates and no
+    sync notifications; its findings go to the log and the audit history."""
+    import sync_manager
+    try:
+        result = sync_manager.audit_remote(args.get("target"), log_file=logf, cancel=cancel)
+    except Exception as e:
+        logf.write(f"[ERROR] audit raised: {e}\n{traceback.format_exc()}")
+        result = {"success": False, "message": f"Audit error: {e}", "duration": 0}
+    if cancel is not None and cancel.is_set() and not result["success"]:
+        result = {**result, "message": f"Audit cancelled. {result['message']}", "cancelled": True}
+    logf.write(f"[{'OK' if result['success'] else 'ERROR'}] {result['message']}\n")
+    return result
+
+
+# --- The worker: queue, running job, events ---
+
+def _public(entry):
+    return {k: entry[k] for k in ("id", "job", "args", "source", "queued_at", "started_at")
+            if k in entry}
+
+
+class Worker:
+    """The queue, the one running job and the event fan-out of the worker.
+    ``run()`` executes jobs on the calling thread; ``serve()`` answers the
+    control socket. ``runner`` is run_job (replaced in tests)."""
+
+    def __init__(self, runner=None):
+        self.runner = runner or run_job
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._running = None
+        self._cancel = None
+        self._last = None
+        self._next_id = 1
+        self._subs = []
+        self._stopping = threading.Event()
+
+    def enqueue(self, job, args=None, source=""):
+        if job not in JOB_ARGS:
+            return {"ok": False, "error": f"Unknown job '{job}'."}
+        args = {k: v for k, v in (args or {}).items() if k in JOB_ARGS[job] and v}
+        if job == "restore" and not args.get("device"):
+            return {"ok": False, "error": "A restore needs a device."}
+        with self._cond:
+            if self._stopping.is_set():
+                return {"ok": False, "error": "The sync worker is shutting down."}
+            # The same job already waiting covers this request too.
+            for i, queued in enumerate(self._queue):
+                if queued["job"] == job and queued["args"] == args:
+                    return {"ok": True, "id": queued["id"], "duplicate": True,
+                            "position": i + (1 if self._running else 0)}
+            if len(self._queue) >= QUEUE_MAX:
+                return {"ok": False, "error": "The sync queue is full."}
+            # A running audit gives way to a sync or restore; it is due again later.
+            preempt = (job != "audit" and self._running is not None
+                       and self._running["job"] == "audit" and not self._cancel.is_set())
+            if preempt:
+                self._cancel.set()
+            entry = {"id": self._next_id, "job": job, "args": args, "source": source,
+                     "queued_at": time.time()}
+            self._next_id += 1
+            self._queue.append(entry)
+            position = len(self._queue) - (0 if self._running else 1)
+            running = self._running
+            self._cond.notify_all()
+        if preempt:
+            self._publish({"event": "cancelling", "job": _public(running)})
+        self._publish({"event": "queued", "job": _public(entry), "position": position})
+        return {"ok": True, "id": entry["id"], "position": position}
+
+    def cancel(self, job_id=None):
+        """Cancel the running job (``job_id`` None or its id) or drop a queued one."""
+        with self._cond:
+            running = self._running
+            if running and job_id in (None, running["id"]):
+                if self._cancel.is_set():
+                    return {"ok": True}         # already winding down
+                self._cancel.set()
+                event = {"event": "cancelling", "job": _public(running)}
+            elif job_id is None:
+                return {"ok": False, "error": "No job is running."}
+            else:
+                entry = next((e for e in self._queue if e["id"] == job_id), None)
+                if entry is None:
+                    return {"ok": False, "error": f"No job {job_id}."}
+                self._queue.remove(entry)
+                event = {"event": "dropped", "job": _public(entry)}
+        self._publish(event)
+        return {"ok": True}
+
+    def status(self):
+        with self._cond:
+            return {"ok": True,
+                    "running": _public(self._running) if self._running else None,
+                    "queue": [_public(e) for e in self._queue],
+                    "last": self._last}
+
+    def run(self):
+        """Run queued jobs one after the other until stop()."""
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopping.is_set():
+                    self._cond.wait()
+                if self._stopping.is_set():
+                    return
+                entry = self._queue.popleft()
+                entry["started_at"] = time.time()
+                self._running, self._cancel = entry, threading.Event()
+                cancel = self._cancel
+            self._publish({"event": "started", "job": _public(entry)})
+            try:
+                result = self.runner(
+                    entry["job"], entry["args"], cancel=cancel, source=entry["source"],
+                    on_progress=lambda info, i=entry["id"]: self._publish(
+                        {"event": "progress", "id": i, "info": info}))
+            except Exception as e:
+                result = {"success": False, "message": f"Sync worker error: {e}", "duration": 0}
+            with self._cond:
+                self._running = self._cancel = None
+                self._last = {**_public(entry), "finished_at": time.time(), "result": result}
+                self._cond.notify_all()
+            self._publish({"event": "finished", "job": _public(entry), "result": result})
+
+    def stop(self):
+        """Stop taking jobs and cancel the running one; run() returns once it ended."""
+        with self._cond:
+            self._stopping.set()
+            if self._cancel is not None:
+                self._cancel.set()
+            self._cond.notify_all()
+
+    # Subscribers each get a bounded queue of events.
+
+    def _subscribe(self):
+        q = queue.Queue(SUBSCRIBER_BACKLOG)
+        with self._cond:
+            self._subs.append(q)
+        return q
+
+    def _unsubscribe(self, q):
+        with self._cond:
+            if q in self._subs:
+                self._subs.remove(q)
+
+    def _publish(self, event):
+        event["time"] = time.time()
+        with self._cond:
+            subs = list(self._subs)
+        for q in subs:
+            while True:
+                try:
+                    q.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait()      # a slow reader loses old progress, not new
+                    except queue.Empty:
+                        pass
+
+    # Control socket.
+
+    def serve(self, path=None):
+        """Answer the control socket at ``path`` until stop(). Refuses to
+        start when another worker already listens there."""
+        path = path or SOCKET_PATH
+        if request({"cmd": "status"}, timeout=2, path=path) is not None:
+            raise RuntimeError(f"another sync worker is listening on {path}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)       # the socket is root's only: it starts and stops syncs
+        try:
+            srv.bind(path)
+        finally:
+            os.umask(old_umask)
+        srv.listen(16)
+        srv.settimeout(1.0)
+        try:
+            while not self._stopping.is_set():
+                try:
+                    conn, _ = srv.accept()
+                except socket.timeout:
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            srv.close()
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _handle(self, conn):
+        try:
+            conn.settimeout(10)
+            line = conn.makefile("rb").readline(65536)
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                msg = None
+            cmd = msg.get("cmd") if isinstance(msg, dict) else None
+            if cmd == "subscribe":
+                self._stream(conn)
+                return
+            if cmd == "enqueue":
+                reply = self.enqueue(msg.get("job", "sync"), msg.get("args"),
+                                     str(msg.get("source", "")))
+            elif cmd == "cancel":
+                reply = self.cancel(msg.get("id"))
+            elif cmd == "status":
+                reply = self.status()
+            else:
+                reply = {"ok": False, "error": "Unknown command."}
+            conn.sendall(json.dumps(reply).encode() + b"\n")
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def _stream(self, conn):
+        q = self._subscribe()
+        try:
+            conn.settimeout(HEARTBEAT_SEC)
+            conn.sendall(json.dumps({"event": "status", **self.status(), "time": time.time()})
+                         .encode() + b"\n")
+            while not self._stopping.is_set():
+                try:
+                    event = q.get(timeout=HEARTBEAT_SEC)
+                except queue.Empty:
+                    event = {"event": "heartbeat", "time": time.time()}
+                conn.sendall(json.dumps(event).encode() + b"\n")
+        except OSError:
+            pass          # the client went away
+        finally:
+            self._unsubscribe(q)
+
+
+# --- Client side ---
+
+def request(msg, timeout=5.0, path=None):
+    """Send one command to the worker. Its reply, or None when no worker is listening."""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(path or SOCKET_PATH)
+        s.sendall(json.dumps(msg).encode() + b"\n")
+        line = s.makefile("rb").readline()
+    except OSError:
+        return None
+    finally:
+        s.close()
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def enqueue(job="sync", source="", **args):
+    """Queue a job on the worker; None when it isn't running."""
+    return request({"cmd": "enqueue", "job": job, "args": args, "source": source})
+
+
+def cancel(job_id=None):
+    return request({"cmd": "cancel", "id": job_id})
+
+
+def status():
+    return request({"cmd": "status"})
+
+
+def busy():
+    """True while the worker runs a job (False when it isn't running)."""
+    st = status()
+    return bool(st and st.get("running"))
+
+
+def subscribe(path=None, timeout=None):
+    """Yield the worker's events until it closes the stream. ``timeout``
+    defaults to a bit over the heartbeat, so a hung worker ends the loop."""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout or HEARTBEAT_SEC * 2)
+    try:
+        s.connect(path or SOCKET_PATH)
+        s.sendall(b'{"cmd": "subscribe"}\n')
+        for line in s.makefile("rb"):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+    except OSError:
+        return
+    finally:
+        s.close()
+
+
+def _schedule_audits(worker):
+    """Queue the checksum audit whenever ``sync.audit`` says it is due and
+    the worker and the box are otherwise idle, until the worker stops."""
+    import sync_audit
+    try:
+        import power
+    except ImportError:
+        power = None
+    while not worker._stopping.wait(AUDIT_CHECK_SEC):
+        try:
+            sync_cfg = load_config().get("sync", {})
+            audit_cfg = sync_cfg.get("audit") or {}
+            if not sync_cfg.get("enabled") or not audit_cfg.get("enabled"):
+                continue
+            st = worker.status()
+            if st["running"] or st["queue"] or backup_running():
+                continue
+            mains = power.on_mains() if power else None
+            if sync_audit.due(audit_cfg, sync_audit.load_history(), charging=mains):
+                worker.enqueue("audit", source="schedule")
+        except Exception:
+            pass
+
+
+def _serve():
+    import signal
+    import sync_manager   # noqa: F401 — load it (and its optional imports) once, up front
+    worker = Worker()
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    signal.signal(signal.SIGINT, lambda *_: worker.stop())
+    runner = threading.Thread(target=worker.run, name="sync-jobs", daemon=True)
+    runner.start()
+    threading.Thread(target=_schedule_audits, args=(worker,), name="audit-schedule",
+                     daemon=True).start()
+    try:
+        worker.serve()
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        worker.stop()
+        runner.join()
+        return 1
+    runner.join(STOP_GRACE_SEC)   # a cancelled rsync is terminated, then the run cleans up
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Long-lived sync worker and its control commands.")
+    sub = parser.add_subparsers(dest="cmd")
+    sub.add_parser("serve", help="run the worker (default)")
+    sub.add_parser("status", help="print the worker's queue")
+    p = sub.add_parser("cancel", help="cancel the running job, or a queued one by id")
+    p.add_argument("id", nargs="?", type=int)
+    sub.add_parser("watch", help="print the worker's events as they happen")
+    p = sub.add_parser("audit", help="queue a checksum audit of the remote copy now")
+    p.add_argument("target", nargs="?")
+    args = parser.parse_args(argv)
+    if args.cmd in (None, "serve"):
+        return _serve()
+    if args.cmd == "watch":
+        for event in subscribe():
+            print(json.dumps(event), flush=True)
+        return 0
+    if args.cmd == "audit":
+        reply = enqueue("audit", source="cli", target=args.target)
+    else:
+        reply = status() if args.cmd == "status" else cancel(args.id)
+    if reply is None:
+        print("sync worker is not running", file=sys.stderr)
+        return 1
+    print(json.dumps(reply, indent=2))
+    return 0 if reply.get("ok") else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+webserve.py - Serve the web UI in production.
+
+Flask's development server (``app.run``) starts a thread per request without
+limit, speaks HTTP/1.0 (a new connection for every request) and sends every
+response uncompressed and without validators. ``serve`` runs the app on
+waitress instead:
+
+- a fixed pool of ``threads`` worker threads; further requests queue;
+- HTTP/1.1 keep-alive, so the dashboard's polling reuses one connection;
+- ``install`` adds response handling that works under either server:
+  HTML, JSON, CSS, JS and SVG bodies of 1 KiB or more are compressed (brotli
+  when the ``brotli`` module is installed and the browser accepts it, gzip
+  otherwise), rendered pages and API replies get an ETag and
+  ``Cache-Control: private, no-cache`` (a repeat request with If-None-Match
+  is answered 304 before anything is compressed), and static files are
+  cacheable for a day (Flask already sends their ETag).
+
+Streamed responses (the SSE status stream, the NDJSON size stream) are left
+alone. Without waitress ``serve`` falls back to the development server, so a
+missing package never takes the web UI down.
+
+``python3 webserve.py bench`` measures p50/p99 latency of a running web UI.
+
+Import-safe: stdlib + Flask; waitress and brotli are optional.
+"""
+import gzip
+import http.client
+import threading
+import time
+import urllib.parse
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
+COMPRESS_MIN = 1024
+COMPRESS_TYPES = ("text/html", "application/json", "text/css", "text/javascript",
+                  "application/javascript", "image/svg+xml", "text/plain")
+STATIC_MAX_AGE = 86400
+THREADS = 8
+CHANNEL_TIMEOUT = 60             # seconds an idle keep-alive connection stays open
+CONNECTION_LIMIT = 64
+
+
+def _encoding(request):
+    """The content coding to use for ``request``, or None."""
+    accept = request.accept_encodings
+    if brotli is not None and accept["br"]:
+        return "br"
+    if accept["gzip"]:
+        return "gzip"
+    return None
+
+
+def _compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=4)
+    return gzip.compress(body, compresslevel=6)
+
+
+def finish_response(response, request, compress=True):
+    """Validators, caching headers and compression for ``response``."""
+    if response.direct_passthrough or response.is_streamed:     # files, SSE, NDJSON
+        return response
+    if request.method != "GET" or response.status_code != 200 \
+            or "Content-Encoding" in response.headers:
+        return response
+    if response.mimetype not in COMPRESS_TYPES:
+        return response
+    if not response.cache_control:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    body = response.get_data()
+    encoding = _encoding(request) if compress and len(body) >= COMPRESS_MIN else None
+    response.vary.add("Accept-Encoding")
+    # One tag per representation: the compressed body differs from the plain one.
+    etag, _ = response.get_etag()
+    if not etag:
+        response.add_etag()
+        etag, _ = response.get_etag()
+    if encoding:
+        response.set_etag(f"{etag}-{encoding}")
+    response.make_conditional(request)
+    if response.status_code == 304 or not encoding:
+        return response
+    response.set_data(_compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def install(app, compress=True):
+    """Cache static files for STATIC_MAX_AGE and run ``finish_response`` on
+    every response of ``app``."""
+    app.config["SEND_FILE_MAX_AGE_DEFAULT"] = STATIC_MAX_AGE
+
+    @app.after_request
+    def _finish(response):
+        return finish_response(response, request, compress)
+
+
+def serve(app, host, port, threads=THREADS, logger=None):
+    """Run ``app`` on waitress with ``threads`` workers; on the development
+    server when waitress isn't installed. Blocks."""
+    if waitress is None:
+        if logger:
+            logger.warning("waitress not installed; using the development server")
+        app.run(host=host, port=port, debug=False, threaded=True)
+        return
+    if logger:
+        logger.info(f"Serving on waitress with {threads} threads")
+    waitress.serve(app, host=host, port=port, threads=threads,
+                   connection_limit=CONNECTION_LIMIT, channel_timeout=CHANNEL_TIMEOUT,
+                   ident="ios-backup-machine", asyncore_use_poll=True,
+                   expose_tracebacks=False)
+
+
+# --- Benchmark ------------------------------------------------------------------
+
+def _login(base, password):
+    """The session cookie after logging in with ``password`` (or None)."""
+    u = urllib.parse.urlsplit(base)
+    conn = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=30)
+    body = urllib.parse.urlencode({"password": password})
+    conn.request("POST", "/login", body, {"Content-Type": "application/x-www-form-urlencoded"})
+    resp = conn.getresponse()
+    resp.read()
+    cookie = resp.getheader("Set-Cookie")
+    conn.close()
+    return cookie.split(";", 1)[0] if cookie else None
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def bench(base, paths, requests=200, concurrency=8, cookie=None, encoding="gzip, br"):
+    """Fetch each of ``paths`` ``requests`` times from ``concurrency``
+    keep-alive connections: {path: {"p50", "p99" (ms), "rps", "bytes",
+    "errors"}}."""
+    u = urllib.parse.urlsplit(base)
+    headers = {"Accept-Encoding": encoding}
+    if cookie:
+        headers["Cookie"] = cookie
+    results = {}
+    for path in paths:
+        times, sizes, errors = [], [], [0]
+        lock = threading.Lock()
+        per = max(1, requests // concurrency)
+
+        def client():
+            conn = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=30)
+            for _ in range(per):
+                start = time.perf_counter()
+                try:
+                    conn.request("GET", path, headers=headers)
+                    resp = conn.getresponse()
+                    data = resp.read()
+                    ok = resp.status < 400
+                except (OSError, http.client.HTTPException):
+                    conn.close()
+                    conn = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=30)
+                    ok, data = False, b""
+                with lock:
+                    if ok:
+                        times.append(time.perf_counter() - start)
+                        sizes.append(len(data))
+                    else:
+                        errors[0] += 1
+            conn.close()
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target=client) for _ in range(concurrency)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        wall = time.perf_counter() - start
+        results[path] = {
+            "p50": round(_percentile(times, 50) * 1000, 1) if times else None,
+            "p99": round(_percentile(times, 99) * 1000, 1) if times else None,
+            "rps": round(len(times) / wall, 1),
+            "bytes": sizes[0] if sizes else 0,
+            "errors": errors[0],
+        }
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Web UI serving tools.")
+    sub = parser.add_subparsers(dest="cmd")
+    b = sub.add_parser("bench", help="p50/p99 latency of a running web UI")
+    b.add_argument("--url", default="http://127.0.0.1:8080")
+    b.add_argument("--requests", type=int, default=200, help="per path")
+    b.add_argument("--concurrency", type=int, default=8)
+    b.add_argument("--password", help="log in first (when the web UI has a password)")
+    b.add_argument("--identity", action="store_true", help="ask for uncompressed responses")
+    b.add_argument("paths", nargs="*", default=["/", "/api/backup-status", "/api/status",
+                                                "/api/health", "/static/icon.svg"])
+    args = parser.parse_args()
+    if args.cmd != "bench":
+        parser.print_help()
+        raise SystemExit(1)
+    cookie = _login(args.url, args.password) if args.password else None
+    res = bench(args.url, args.paths, args.requests, args.concurrency, cookie,
+                "identity" if args.identity else "gzip, br")
+    print(f"{'path':<24} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8} {'bytes':>8} {'errors':>6}")
+    for path, r in res.items():
+        print(f"{path:<24} {r['p50']!s:>8} {r['p99']!s:>8} {r['rps']:>8} {r['bytes']:>8} {r['errors']:>6}")
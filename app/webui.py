@@ -11,13 +11,13 @@ Provides a web interface to configure:
 - Web UI interface binding
 All configuration is saved directly to config.yaml.
 """
-import os, sys, time, subprocess, json, secrets, yaml, copy, hashlib, glob, plistlib, logging
+import os, sys, re, time, subprocess, json, secrets, yaml, copy, hashlib, glob, plistlib, logging, threading
 from functools import wraps
 from logging.handlers import RotatingFileHandler
 
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    flash, jsonify, send_from_directory, session
+    flash, jsonify, send_from_directory, session, Response, g, has_request_context
 )
 
 import netutil
@@ -26,6 +26,18 @@ import wg_manager
 import wifi_manager
 import sync_crypto
 import sync_manager
+import sync_restore
+import sync_worker
+import sync_checkpoint
+import sync_estimate
+import size_index
+import filewatch
+import logtail
+import logindex
+import logsearch
+import webserve
+import probes
+import datausage
 import notify_crypto
 import config_schema
 import power
@@ -69,9 +81,22 @@ logging.getLogger("werkzeug").setLevel(logging.WARNING)
 # Config helpers
 # ---------------------------------------------------------------------------
 
+# config_schema is the single source of defaults + the migration step. The
+# parsed config is kept until the file changes: a call costs one stat().
+_config_cache = config_schema.ConfigCache()
+
 def load_config():
-    # config_schema is the single source of defaults + the migration step.
-    return config_schema.load_config(CONFIG_PATH)
+    """A private copy of the config, for a handler that changes and saves it."""
+    return _config_cache.copy(CONFIG_PATH)
+
+def config_view():
+    """The config, read-only (dicts are mappingproxies, lists tuples). Within
+    a request it is looked up once and kept in ``g``."""
+    if not has_request_context():
+        return _config_cache.view(CONFIG_PATH)
+    if "config" not in g:
+        g.config = _config_cache.view(CONFIG_PATH)
+    return g.config
 
 def _apply_defaults(cfg):
     # Kept for backward compatibility; defaults now live in config_schema.
@@ -95,7 +120,7 @@ def _verify_password(password, stored_hash):
     return hashlib.sha256((salt + password).encode("utf-8")).hexdigest() == h
 
 def _auth_enabled():
-    cfg = load_config()
+    cfg = config_view()
     return bool(cfg.get("auth", {}).get("password_hash", ""))
 
 def login_required(f):
@@ -112,6 +137,9 @@ def save_config(cfg):
     # Atomic write (tmp + fsync + rename) — a power loss mid-save can no longer
     # truncate config.yaml.
     config_schema.atomic_save(cfg, CONFIG_PATH)
+    _config_cache.invalidate()
+    if has_request_context():
+        g.pop("config", None)
 
 
 # ---------------------------------------------------------------------------
@@ -165,7 +193,7 @@ def _ensure_secret_key():
 
 def _setup_needed():
     """Return True if the guided first-start wizard should be shown."""
-    cfg = load_config()
+    cfg = config_view()
     return not cfg.get("setup_completed", False)
 
 # ---------------------------------------------------------------------------
@@ -377,7 +405,7 @@ def login():
         return redirect(url_for("index"))
     if request.method == "POST":
         pw = request.form.get("password", "")
-        cfg = load_config()
+        cfg = config_view()
         stored = cfg.get("auth", {}).get("password_hash", "")
         if _verify_password(pw, stored):
             session["authenticated"] = True
@@ -407,7 +435,7 @@ def _read_backup_status():
 def _get_storage_info():
     """Get storage info for backup drive and root."""
     info = {}
-    for name, path in [("root", "/"), ("backup", load_config().get("backup_dir", "/media/iosbackup/"))]:
+    for name, path in [("root", "/"), ("backup", config_view().get("backup_dir", "/media/iosbackup/"))]:
         try:
             st = os.statvfs(path)
             total = st.f_blocks * st.f_frsize
@@ -432,9 +460,11 @@ def index():
     backup_status = _read_backup_status()
     storage = _get_storage_info()
     wifi_ssid = netutil.get_wifi_ssid()
+    data_usage = datausage.summary(cfg.get("sync", {}).get("bandwidth_profiles") or [])
     return render_template("index.html", cfg=cfg, ip=ip, iface_type=iface_type,
                            wg_status=wg_status, backup_status=backup_status, storage=storage,
-                           wifi_ssid=wifi_ssid, wifi_nickname=_wifi_nickname_for(cfg, wifi_ssid))
+                           wifi_ssid=wifi_ssid, wifi_nickname=_wifi_nickname_for(cfg, wifi_ssid),
+                           data_usage=data_usage)
 
 @app.route("/favicon.ico")
 def favicon():
@@ -785,6 +815,10 @@ def settings_wireguard():
                            has_enc_file=has_enc_file, passphrase_mode=mode)
 
 # --- Remote Sync ---
+# Additional sync target names: shown in logs and the dashboard breakdown.
+_TARGET_NAME_RE = re.compile(r"^[A-Za-z0-9._-]{1,32}$")
+
+
 @app.route("/settings/sync", methods=["GET", "POST"])
 @login_required
 def settings_sync():
@@ -793,6 +827,7 @@ def settings_sync():
     udid = wg_crypto.get_iphone_udid()
     has_enc_file = os.path.exists(sync_crypto.ENC_FILE)
 
+    remote_backups = None
     if request.method == "POST":
         action = request.form.get("action", "")
         if action == "save_settings":
@@ -800,9 +835,47 @@ def settings_sync():
             sync["auto_sync"] = request.form.get("auto_sync") == "on"
             sync["allowed_network"] = request.form.get("allowed_network", "any")
             sync["allowed_ssid"] = request.form.get("allowed_ssid", "").strip()
+            compression = request.form.get("compression", "auto")
+            sync["compression"] = compression if compression in ("auto", "on", "off") else "auto"
+            snaps = sync.get("snapshots") or {}
+            snaps["enabled"] = request.form.get("snapshots_enabled") == "on"
+            for key, default in (("keep_last", 7), ("keep_daily", 14), ("keep_monthly", 6)):
+                try:
+                    snaps[key] = max(0, int(request.form.get(f"snapshots_{key}", default)))
+                except ValueError:
+                    snaps[key] = default
+            snaps["keep_last"] = max(1, snaps["keep_last"])
+            sync["snapshots"] = snaps
             cfg["sync"] = sync
             save_config(cfg)
             flash("Sync settings saved.", "success")
+        elif action == "save_bandwidth":
+            # Parallel lists, one entry per profile row; a row needs a network.
+            nets = request.form.getlist("profile_network")
+            limits = request.form.getlist("profile_bwlimit")
+            caps = request.form.getlist("profile_cap_mb")
+            profiles, bad = [], []
+            for i, net in enumerate(nets):
+                net = (net or "").strip()
+                if not net:
+                    continue
+                limit = (limits[i] if i < len(limits) else "").strip()
+                if not datausage.valid_bwlimit(limit):
+                    bad.append(net)
+                    limit = ""
+                try:
+                    cap = max(0, int(float(caps[i]))) if i < len(caps) and caps[i].strip() else 0
+                except ValueError:
+                    cap = 0
+                profiles.append({"network": net, "bwlimit": limit, "monthly_cap_mb": cap})
+            sync["bandwidth_profiles"] = profiles
+            cfg["sync"] = sync
+            save_config(cfg)
+            if bad:
+                flash(f"Bandwidth profiles saved; ignored an invalid limit for {', '.join(bad)} "
+                      "(use e.g. 500K, 2M).", "error")
+            else:
+                flash("Bandwidth profiles saved.", "success")
         elif action == "upload_credentials":
             mode = cfg.get("credential_encryption", {}).get("passphrase_mode", "udid")
             pw = wg_crypto.get_iphone_serial() if mode == "udid" else request.form.get("master_password", "").strip()
@@ -824,14 +897,14 @@ def settings_sync():
                     port_int = 22
                 existing_key = ""
                 existing_pw = ""
-                if not ssh_key.strip() or not password:
-                    try:
-                        prev = sync_crypto.decrypt_sync_config(passphrase=pw)
-                        if prev:
-                            existing_key = prev.get("ssh_key", "")
-                            existing_pw = prev.get("password", "")
-                    except Exception:
-                        pass
+                prev = None
+                try:
+                    prev = sync_crypto.decrypt_sync_config(passphrase=pw)
+                    if prev:
+                        existing_key = prev.get("ssh_key", "")
+                        existing_pw = prev.get("password", "")
+                except Exception:
+                    pass
                 final_key = ssh_key if ssh_key.strip() else existing_key
                 final_pw = password if password else existing_pw
                 if auth_method == "key" and not final_key.strip():
@@ -847,10 +920,128 @@ def settings_sync():
                     "password": final_pw if auth_method == "password" else "",
                     "remote_path": remote_path,
                 }
+                if prev and prev.get("targets"):
+                    cred["targets"] = prev["targets"]   # additional targets are edited separately
                 if sync_crypto.encrypt_sync_config(cred, passphrase=pw):
                     flash("Sync credentials encrypted and saved.", "success")
                 else:
                     flash("Failed to encrypt sync credentials.", "error")
+        elif action in ("add_target", "remove_target"):
+            mode = cfg.get("credential_encryption", {}).get("passphrase_mode", "udid")
+            pw = wg_crypto.get_iphone_serial() if mode == "udid" else request.form.get("master_password", "").strip()
+            name = request.form.get("target_name", "").strip()
+            vault = ({"encrypt": True, "vault_password": request.form.get("vault_password", "")}
+                     if request.form.get("encrypt") else {})
+            prev = sync_crypto.decrypt_sync_config(passphrase=pw) if pw else None
+            if not pw:
+                flash("Connect iPhone first." if mode == "udid" else "Password required.", "error")
+            elif not prev:
+                flash("Save the primary SSH credentials first.", "error")
+            elif action == "remove_target":
+                prev["targets"] = [t for t in prev.get("targets") or [] if t.get("name") != name]
+                if sync_crypto.encrypt_sync_config(prev, passphrase=pw):
+                    flash(f"Sync target '{name}' removed.", "success")
+                else:
+                    flash("Failed to encrypt sync credentials.", "error")
+            elif vault and len(vault["vault_password"]) < 8:
+                flash("The vault password must be at least 8 characters.", "error")
+            elif request.form.get("target_type") == "local":
+                path = request.form.get("path", "").strip()
+                existing = [t.get("name") for t in prev.get("targets") or []]
+                if not _TARGET_NAME_RE.match(name) or name == "primary" or name in existing:
+                    flash("Target name must be unique: letters, digits, '.', '_' or '-'.", "error")
+                elif not os.path.isabs(path):
+                    flash("Local disk path must be absolute (e.g. /media/usb2/ios).", "error")
+                else:
+                    prev["targets"] = (prev.get("targets") or []) + [
+                        {"name": name, "type": "local", "path": path, "enabled": True, **vault}]
+                    if sync_crypto.encrypt_sync_config(prev, passphrase=pw):
+                        flash(f"Sync target '{name}' added.", "success")
+                    else:
+                        flash("Failed to encrypt sync credentials.", "error")
+            elif request.form.get("target_type") == "s3":
+                target = {
+                    "name": name, "type": "s3",
+                    "endpoint": request.form.get("endpoint", "").strip().rstrip("/"),
+                    "bucket": request.form.get("bucket", "").strip(),
+                    "prefix": request.form.get("prefix", "").strip().strip("/"),
+                    "region": request.form.get("region", "").strip() or "us-east-1",
+                    "access_key": request.form.get("access_key", "").strip(),
+                    "secret_key": request.form.get("secret_key", "").strip(),
+                    "enabled": True,
+                    **vault,
+                }
+                existing = [t.get("name") for t in prev.get("targets") or []]
+                if not _TARGET_NAME_RE.match(name) or name == "primary" or name in existing:
+                    flash("Target name must be unique: letters, digits, '.', '_' or '-'.", "error")
+                elif not target["endpoint"].startswith(("http://", "https://")):
+                    flash("S3 endpoint must be a URL (e.g. http://nas.lan:9000).", "error")
+                elif not target["bucket"] or not target["access_key"] or not target["secret_key"]:
+                    flash("Bucket, access key and secret key are required.", "error")
+                else:
+                    prev["targets"] = (prev.get("targets") or []) + [target]
+                    if sync_crypto.encrypt_sync_config(prev, passphrase=pw):
+                        flash(f"Sync target '{name}' added.", "success")
+                    else:
+                        flash("Failed to encrypt sync credentials.", "error")
+            else:
+                target = {
+                    "name": name, "type": "ssh",
+                    "host": request.form.get("host", "").strip(),
+                    "username": request.form.get("username", "").strip(),
+                    "auth_method": request.form.get("auth_method", "key"),
+                    "ssh_key": request.form.get("ssh_key", "").replace("\r\n", "\n").replace("\r", "\n"),
+                    "password": request.form.get("password", ""),
+                    "remote_path": request.form.get("remote_path", "").strip(),
+                    "bwlimit": request.form.get("bwlimit", "").strip(),
+                    "enabled": True,
+                    **vault,
+                }
+                try:
+                    target["port"] = int(request.form.get("port", "22"))
+                except ValueError:
+                    target["port"] = 22
+                existing = [t.get("name") for t in prev.get("targets") or []]
+                if not _TARGET_NAME_RE.match(name) or name == "primary" or name in existing:
+                    flash("Target name must be unique: letters, digits, '.', '_' or '-'.", "error")
+                elif not target["host"] or not target["username"] or not target["remote_path"]:
+                    flash("Host, username, and remote path are required.", "error")
+                elif not (target["ssh_key"].strip() if target["auth_method"] == "key" else target["password"]):
+                    flash("An SSH key or password is required.", "error")
+                elif not datausage.valid_bwlimit(target["bwlimit"]):
+                    flash("Invalid bandwidth limit (use e.g. 500K, 2M).", "error")
+                else:
+                    if target["auth_method"] == "key":
+                        target["password"] = ""
+                    else:
+                        target["ssh_key"] = ""
+                    prev["targets"] = (prev.get("targets") or []) + [target]
+                    if sync_crypto.encrypt_sync_config(prev, passphrase=pw):
+                        flash(f"Sync target '{name}' added.", "success")
+                    else:
+                        flash("Failed to encrypt sync credentials.", "error")
+        elif action == "list_remote":
+            mode = cfg.get("credential_encryption", {}).get("passphrase_mode", "udid")
+            pw = wg_crypto.get_iphone_serial() if mode == "udid" else request.form.get("master_password", "").strip()
+            name = request.form.get("target_name", "primary")
+            remote_backups = sync_manager.list_remote_backups(passphrase=pw, target=name)
+            if not remote_backups["success"]:
+                flash(remote_backups["message"], "error")
+            elif not remote_backups["devices"]:
+                flash(f"No device backups on {name}.", "error")
+        elif action == "restore":
+            device, _, snapshot = request.form.get("restore_choice", "").partition("|")
+            if (_read_backup_status() or {}).get("state") == "syncing":
+                flash("A sync or restore is already in progress.", "error")
+            elif not sync_restore.valid_name(device) or (snapshot and not sync_restore.valid_name(snapshot)):
+                flash("Choose a backup to restore.", "error")
+            else:
+                err = _start_sync_job("restore", device=device, snapshot=snapshot,
+                                      target=request.form.get("target_name", "primary"))
+                if err:
+                    flash(err, "error")
+                else:
+                    flash(f"Restore of {device} started. Check the dashboard for progress.", "success")
         elif action == "test_connection":
             mode = cfg.get("credential_encryption", {}).get("passphrase_mode", "udid")
             pw = wg_crypto.get_iphone_serial() if mode == "udid" else request.form.get("master_password", "").strip()
@@ -861,25 +1052,16 @@ def settings_sync():
             if _cur.get("state") == "syncing":
                 flash("Sync is already in progress.", "error")
             else:
-                # Nuke leftovers from a cancelled/crashed sync before relaunching
-                try:
-                    subprocess.run(["pkill", "-9", "-f", "backup-sync.py"],
-                                   capture_output=True, timeout=5)
-                    subprocess.run(["pkill", "-9", "-f", "/usr/bin/rsync"],
-                                   capture_output=True, timeout=5)
-                    time.sleep(0.3)
-                except Exception:
-                    pass
-                sync_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backup-sync.py")
-                subprocess.Popen(
-                    [sys.executable, sync_script],
-                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-                    env={**os.environ, "IOSBACKUP_CONFIG": CONFIG_PATH},
-                )
-                flash("Sync started. Check the dashboard for progress.", "success")
-        return redirect(url_for("settings_sync"))
+                err = _start_sync_job()
+                if err:
+                    flash(err, "error")
+                else:
+                    flash("Sync started. Check the dashboard for progress.", "success")
+        if action != "list_remote":
+            return redirect(url_for("settings_sync"))
     mode = cfg.get("credential_encryption", {}).get("passphrase_mode", "udid")
     saved_cred = None
+    saved_targets = []
     if has_enc_file:
         try:
             pw = wg_crypto.get_iphone_serial() if mode == "udid" else None
@@ -893,12 +1075,20 @@ def settings_sync():
                         "auth_method": dec.get("auth_method", "key"),
                         "remote_path": dec.get("remote_path", ""),
                     }
+                    saved_targets = [{k: t.get(k, "") for k in ("name", "type", "host", "port", "username",
+                                                                 "remote_path", "path", "bwlimit",
+                                                                 "endpoint", "bucket", "prefix", "encrypt")}
+                                     for t in dec.get("targets") or []]
         except Exception:
             pass
     return render_template("settings_sync.html",
                            cfg=cfg, udid=udid, has_enc_file=has_enc_file,
                            passphrase_mode=mode, saved_cred=saved_cred,
-                           backup_status=_read_backup_status())
+                           saved_targets=saved_targets,
+                           remote_backups=remote_backups,
+                           backup_status=_read_backup_status(),
+                           data_usage=datausage.summary(sync.get("bandwidth_profiles") or []),
+                           current_network=netutil.network_label())
 
 @app.route("/api/sync/decrypt", methods=["POST"])
 @login_required
@@ -1165,20 +1355,20 @@ def settings_encryption():
 
 # --- Backup List ---
 
-def _dir_size(path):
-    """Return total size in bytes of all files under *path*."""
-    total = 0
-    try:
-        for dirpath, _dirnames, filenames in os.walk(path):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                try:
-                    total += os.path.getsize(fp)
-                except OSError:
-                    pass
-    except OSError:
-        pass
-    return total
+# Device folders whose size index is being brought up to date in the
+# background (see size_index); one refresh thread at a time.
+_size_refresh = {"thread": None}
+_size_lock = threading.Lock()
+
+def _refresh_sizes(backup_dir):
+    with _size_lock:
+        thread = _size_refresh["thread"]
+        if thread is not None and thread.is_alive():
+            return
+        thread = threading.Thread(target=size_index.update_all, args=(backup_dir,),
+                                  name="size-index", daemon=True)
+        _size_refresh["thread"] = thread
+    thread.start()
 
 def _human_size(nbytes):
     for unit in ("B", "KB", "MB", "GB", "TB"):
@@ -1212,6 +1402,9 @@ def _parse_info_plist(plist_path):
         pass
     return info
 
+_BACKUP_STATE_LABELS = {"complete": "Complete", "backing_up": "Backing up",
+                        "interrupted": "Interrupted"}
+
 @app.route("/backups")
 @login_required
 def backups():
@@ -1236,31 +1429,10 @@ def backups():
                 folder_mtime = ""
                 folder_mtime_ts = 0
             # Size calculated asynchronously via /api/backup-sizes
-            # Check for Manifest.plist (indicates a completed backup)
-            has_manifest = os.path.exists(os.path.join(entry_path, "Manifest.plist"))
-            # Check for Status.plist snapshot state
-            status_plist = os.path.join(entry_path, "Status.plist")
-            snapshot_state = ""
-            if os.path.exists(status_plist):
-                try:
-                    with open(status_plist, "rb") as fp:
-                        st = plistlib.load(fp)
-                    snapshot_state = st.get("SnapshotState", "")
-                except Exception:
-                    pass
-            # Determine human-readable status
-            if has_manifest and snapshot_state != "uploading":
-                status = "complete"
-                status_label = "Complete"
-            elif snapshot_state == "uploading":
-                status = "backing_up"
-                status_label = "Backing up"
-            elif has_manifest:
-                status = "complete"
-                status_label = "Complete"
-            else:
-                status = "interrupted"
-                status_label = "Interrupted"
+            # Complete / backing up / interrupted, from Manifest.plist and
+            # Status.plist — the same test the sync planner uses to skip folders.
+            status = sync_checkpoint.backup_state(entry_path)
+            status_label = _BACKUP_STATE_LABELS[status]
 
             backup_list.append({
                 "folder": entry,
@@ -1312,19 +1484,109 @@ def logs():
 @app.route("/logs/<filename>")
 @login_required
 def view_log(filename):
+    """A page of a log (see logindex): by default its last PAGE_LINES lines,
+    which the live tail then follows; ``start`` pages through it, ``q`` (a
+    regex) and ``level`` filter it, ``line`` opens the page around a line (a
+    search hit) and ``error`` around the first error line after ``after``."""
     # Sanitize filename
     safe = os.path.basename(filename)
     path = os.path.join(LOG_DIR, safe)
-    content = ""
-    if os.path.isfile(path):
+    page = logindex.PAGE_LINES
+    q = request.args.get("q", "").strip()
+    levels = [lv for lv in request.args.getlist("level") if lv in logindex.LEVELS]
+    start = request.args.get("start", type=int)
+    view = {"filename": safe, "levels": logindex.LEVELS, "lines_per_page": page, "q": q,
+            "selected": levels, "lines": [], "total": 0, "start": 0, "more": False, "mark": None,
+            "filtered": bool(q or levels), "offset": None, "inode": None, "error": None}
+    if not os.path.isfile(path):
+        view["error"] = "Log file not found."
+        return render_template("log_view.html", **view)
+    try:
+        idx = logindex.index(path)
+        total = view["total"] = idx.count
+        if view["filtered"]:
+            try:
+                text = logindex.text_regex(q) if q else None
+            except re.error as e:
+                view["error"] = f"Invalid search pattern: {e}"
+                return render_template("log_view.html", **view)
+            regex = logindex.level_regex(levels) if levels else text
+            view["start"] = start or 0
+            view["lines"], view["more"] = idx.search(regex, text if levels else None,
+                                                     view["start"], page)
+        else:
+            line = request.args.get("line", type=int)
+            if line is not None:                          # a search hit
+                view["mark"] = line
+                start = max(0, line - 10)
+            elif request.args.get("error"):
+                after = request.args.get("after", 0, type=int)
+                hit, _ = idx.search(logindex.level_regex(logindex.ERROR_LEVELS), start=after, limit=1)
+                if hit:
+                    view["mark"] = hit[0][0]
+                    start = max(0, hit[0][0] - 10)
+                else:
+                    flash("No more errors in this log." if after else "No errors in this log.", "warning")
+            if start is None:
+                start = max(0, total - page)
+            view["start"] = start = min(max(0, start), max(0, total - 1))
+            view["lines"] = idx.lines(start, page)
+            if start + page >= total:                     # the end: the live tail follows it
+                view["offset"], view["inode"] = idx.size, idx.key[0]
+    except Exception as e:
+        view["error"] = f"Error reading log: {e}"
+    return render_template("log_view.html", **view)
+
+def _search_logs():
+    """(query, order, hits, more, error) of a log search request; the index
+    is brought up to date first (see logsearch.update)."""
+    q = request.args.get("q", "").strip()
+    # Newest first by default: it stops at the first page of hits, where
+    # ranking has to score every line that matches.
+    order = "rank" if request.args.get("order") == "rank" else "newest"
+    hits, more, error = [], False, None
+    if q:
         try:
-            with open(path, "r", errors="replace") as f:
-                content = f.read()
+            logsearch.update(LOG_DIR)
+            hits, more = logsearch.search(q, order=order)
         except Exception as e:
-            content = f"Error reading log: {e}"
-    else:
-        content = "Log file not found."
-    return render_template("log_view.html", filename=safe, content=content)
+            app.logger.warning("log search failed: %s", e)
+            error = f"Search failed: {e}"
+    return q, order, hits, more, error
+
+@app.route("/logs/search")
+@login_required
+def search_logs():
+    q, order, hits, more, error = _search_logs()
+    return render_template("logs_search.html", q=q, order=order, hits=hits,
+                           more=more, error=error)
+
+@app.route("/api/logs/search")
+@login_required
+def api_search_logs():
+    """Ranked (or newest-first) hits of ``q`` across every per-run log, each
+    with the lines around it."""
+    q, order, hits, more, error = _search_logs()
+    if error:
+        return jsonify({"error": error}), 500
+    return jsonify({"query": q, "order": order, "more": more, "hits": [
+        {**h, "text": "".join(t for t, _ in h["segments"]),
+         "url": url_for("view_log", filename=h["log"], line=h["line"])} for h in hits]})
+
+@app.route("/api/logs/<filename>/tail")
+@login_required
+def api_log_tail(filename):
+    """What was appended to a log after ``offset`` (see logtail.read_tail);
+    the live log view polls this instead of reloading the page."""
+    path = os.path.join(LOG_DIR, os.path.basename(filename))
+    offset = request.args.get("offset", type=int)
+    inode = request.args.get("inode", type=int)
+    try:
+        return jsonify(logtail.read_tail(path, offset, inode))
+    except FileNotFoundError:
+        return jsonify({"error": "Log file not found."}), 404
+    except OSError as e:
+        return jsonify({"error": f"Error reading log: {e}"}), 500
 
 @app.route("/logs/<filename>/delete", methods=["POST"])
 @login_required
@@ -1444,22 +1706,52 @@ def system_update():
                            update_log=update_log)
 
 # --- API endpoints ---
+# /api/status and /api/health run their probes concurrently (see probes.py),
+# each with a deadline, and share one collection between the callers of a
+# few seconds: a monitor polling them every few seconds, or several at once,
+# costs one round of probes.
+STATUS_TTL = 5
+HEALTH_TTL = 10
+
+
+def _network_probes(cfg):
+    wg = cfg.get("wireguard", {})
+    return {
+        "addresses": probes.Probe(netutil.get_addresses, 4,
+                                  {"active": (None, None), "wifi": None, "usb_iphone": None}),
+        "wifi_ssid": probes.Probe(netutil.get_wifi_ssid, 6),
+        "wireguard": probes.Probe(
+            lambda: wg_manager.get_wireguard_status(wg.get("interface_name", "wg0")), 6),
+    }
+
+
+def _collect_status():
+    values, timings = probes.run(_network_probes(config_view()))
+    return {"values": values, "timings": timings}
+
+
+_status_shared = probes.Shared(_collect_status, STATUS_TTL)
+
+
 @app.route("/api/status")
 @login_required
 def api_status():
-    cfg = load_config()
-    ip, iface_type = netutil.get_active_ip()
-    wg = cfg.get("wireguard", {})
-    wifi_ssid = netutil.get_wifi_ssid()
+    cfg = config_view()
+    result, age = _status_shared.get()
+    v = result["values"]
+    addrs = v["addresses"]
+    ip, iface_type = addrs["active"]
     return jsonify({
         "ip": ip,
         "interface": iface_type,
-        "wifi_ip": netutil.get_wifi_ip(),
-        "wifi_ssid": wifi_ssid,
-        "wifi_nickname": _wifi_nickname_for(cfg, wifi_ssid),
-        "usb_iphone_ip": netutil.get_usb_iphone_ip(),
-        "wireguard": wg_manager.get_wireguard_status(wg.get("interface_name", "wg0")),
+        "wifi_ip": addrs["wifi"],
+        "wifi_ssid": v["wifi_ssid"],
+        "wifi_nickname": _wifi_nickname_for(cfg, v["wifi_ssid"]),
+        "usb_iphone_ip": addrs["usb_iphone"],
+        "wireguard": v["wireguard"],
         "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "probes": result["timings"],
+        "age": round(age, 1),
     })
 
 # --- Health endpoint ---
@@ -1493,7 +1785,7 @@ def _last_backup_info():
         "last_backup_time": None,
     }
     try:
-        bd = load_config().get("backup_dir", "/media/iosbackup/")
+        bd = config_view().get("backup_dir", "/media/iosbackup/")
         latest = None
         if os.path.isdir(bd):
             for e in os.scandir(bd):
@@ -1525,29 +1817,56 @@ def _last_sync_info():
     return {"state": None, "timestamp": None}
 
 
+def _collect_health():
+    """One round of the health probes: {"values", "timings"}."""
+    cfg = load_config()
+    checks = {f"service:{u}": probes.Probe(lambda u=u: _service_states([u])[u], 6, "unknown")
+              for u in _HEALTH_UNITS}
+    checks.update(_network_probes(cfg))
+    checks.update({
+        "storage": probes.Probe(_get_storage_info, 5, {}),
+        "battery": probes.Probe(power.get_battery, 4, {"percent": None, "charging": None}),
+        "internet": probes.Probe(lambda: netutil.have_connectivity(timeout=2), 5, False),
+        "backup": probes.Probe(_last_backup_info, 5, {}),
+        "sync": probes.Probe(_last_sync_info, 3, {"state": None, "timestamp": None}),
+        "data_usage": probes.Probe(
+            lambda: datausage.summary(cfg.get("sync", {}).get("bandwidth_profiles") or []),
+            3, {}),
+    })
+    values, timings = probes.run(checks)
+    return {"values": values, "timings": timings}
+
+
+_health_shared = probes.Shared(_collect_health, HEALTH_TTL)
+
+
 @app.route("/api/health")
 def api_health():
     """Aggregate health for external monitoring. Login-exempt and free of
-    secrets (no owner info, credentials, or keys)."""
-    cfg = load_config()
-    services = _service_states()
-    storage = _get_storage_info()
-    battery = power.get_battery()
-    ip, iface_type = netutil.get_active_ip()
-    wg = cfg.get("wireguard", {})
-    wifi_ssid = netutil.get_wifi_ssid()
+    secrets (no owner info, credentials, or keys). ``probes`` has how long
+    each check took (and whether it timed out), ``age`` how old the shared
+    collection is."""
+    cfg = config_view()
+    result, age = _health_shared.get()
+    v = result["values"]
+    services = {u: v[f"service:{u}"] for u in _HEALTH_UNITS}
+    storage = v["storage"]
+    battery = v["battery"]
+    addrs = v["addresses"]
+    ip, iface_type = addrs["active"]
     network = {
         "active_ip": ip,
         "interface": iface_type,
-        "wifi_ip": netutil.get_wifi_ip(),
-        "wifi_ssid": wifi_ssid,
-        "wifi_nickname": _wifi_nickname_for(cfg, wifi_ssid),
-        "usb_iphone_ip": netutil.get_usb_iphone_ip(),
-        "internet": netutil.have_connectivity(timeout=2),
-        "wireguard": wg_manager.get_wireguard_status(wg.get("interface_name", "wg0")),
+        "wifi_ip": addrs["wifi"],
+        "wifi_ssid": v["wifi_ssid"],
+        "wifi_nickname": _wifi_nickname_for(cfg, v["wifi_ssid"]),
+        "usb_iphone_ip": addrs["usb_iphone"],
+        "internet": v["internet"],
+        "wireguard": v["wireguard"],
     }
-    backup = _last_backup_info()
-    sync = _last_sync_info()
+    backup = v["backup"]
+    sync = v["sync"]
+    data_usage = v["data_usage"]
 
     # Overall rollup
     status, warnings = "ok", []
@@ -1564,6 +1883,11 @@ def api_health():
         status = "warning"; warnings.append("no internet")
     if backup.get("state") == "error" and status != "error":
         status = "warning"; warnings.append("last backup error")
+    if data_usage.get("paused") and status == "ok":
+        status = "warning"; warnings.append("sync paused: data cap reached")
+    late = sorted(name for name, t in result["timings"].items() if t["status"] != "ok")
+    if late and status == "ok":
+        status = "warning"; warnings.append("checks timed out or failed: " + ", ".join(late))
 
     return jsonify({
         "status": status,
@@ -1576,6 +1900,9 @@ def api_health():
         "network": network,
         "backup": backup,
         "sync": sync,
+        "data_usage": data_usage,
+        "probes": result["timings"],
+        "age": round(age, 1),
     })
 
 
@@ -1621,18 +1948,116 @@ def api_backup_status():
     status = _read_backup_status()
     return jsonify(status or {"state": "idle"})
 
+# /api/events: one FileWatch on the status file serves every open dashboard.
+# Each stream holds a server thread, so past SSE_MAX_CLIENTS a client is
+# turned away and polls /api/backup-status instead.
+SSE_HEARTBEAT_SEC = 15
+
+def _sse_max_clients(threads):
+    """Event streams served at once: half the worker threads, so the other
+    half is left for requests."""
+    return max(1, threads // 2)
+
+SSE_MAX_CLIENTS = _sse_max_clients(webserve.THREADS)
+_events = {"watch": None, "clients": 0}
+_events_lock = threading.Lock()
+
+def _status_watch():
+    with _events_lock:
+        if _events["watch"] is None:
+            _events["watch"] = filewatch.FileWatch(os.path.join(RUNTIME_DIR, "backup_status.json"))
+        return _events["watch"]
+
+@app.route("/api/events")
+@login_required
+def api_events():
+    """Server-sent events: a ``status`` event with the status file whenever
+    it changes (the first one at once), and a ``heartbeat`` event every
+    SSE_HEARTBEAT_SEC while it doesn't."""
+    with _events_lock:
+        if _events["clients"] >= SSE_MAX_CLIENTS:
+            return jsonify({"error": "Too many event streams."}), 503
+        _events["clients"] += 1
+    watch = _status_watch()
+
+    def stream():
+        try:
+            yield f"retry: {SSE_HEARTBEAT_SEC * 1000}\n\n"
+            last, version = None, watch.version
+            while True:
+                text = json.dumps(_read_backup_status() or {"state": "idle"})
+                if text != last:
+                    last = text
+                    yield f"event: status\ndata: {text}\n\n"
+                new = watch.wait(version, SSE_HEARTBEAT_SEC)
+                if new == version:
+                    yield f"event: heartbeat\ndata: {int(time.time())}\n\n"
+                version = new
+        finally:
+            with _events_lock:
+                _events["clients"] -= 1
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# The next sync's estimate walks the device folders a target still needs: keep
+# it for a minute, or until a sync confirms folders (the checkpoint changes).
+# One request works it out; the others wait for its result.
+_ESTIMATE_TTL = 60
+_estimate_cache = {"key": None, "at": 0.0, "value": None}
+_estimate_lock = threading.Lock()
+
+
+@app.route("/api/sync-estimate")
+@login_required
+def api_sync_estimate():
+    """What the next sync has to send, its ETA and battery cost (see
+    sync_estimate), and whether the battery admits it."""
+    cfg = config_view()
+    sync_cfg = cfg.get("sync", {})
+    if not sync_cfg.get("enabled"):
+        return jsonify({"enabled": False})
+    try:
+        key = os.stat(logutil.state_path(sync_checkpoint.CHECKPOINT_FILE)).st_mtime_ns
+    except OSError:
+        key = None
+    with _estimate_lock:
+        now = time.time()
+        if _estimate_cache["key"] != key or now - _estimate_cache["at"] > _ESTIMATE_TTL:
+            try:
+                est = sync_manager.estimate_sync()
+            except Exception as e:
+                app.logger.warning("sync estimate failed: %s", e)
+                est = None
+            _estimate_cache.update(key=key, at=time.time(), value=est)
+        est = _estimate_cache["value"]
+    if est is None:
+        return jsonify({"enabled": True, "available": False})
+    battery = power.get_battery()
+    thr = sync_cfg.get("min_battery_percent", 35)
+    need = (est["battery_pct"] * sync_estimate.SAFETY
+            if sync_cfg.get("battery_forecast", True) else 0)
+    ok, reason = power.sync_allowed(thr, battery, need) if thr else (True, "")
+    return jsonify({"enabled": True, "available": True, **est, "battery": battery,
+                    "admit": ok, "reason": reason})
+
 @app.route("/sync/cancel", methods=["POST"])
 @login_required
 def sync_cancel():
-    """Kill any running rsync + backup-sync.py so a stuck/stalled sync stops immediately."""
+    """Stop the running sync. A job of the sync worker is cancelled gracefully
+    (rsync gets SIGTERM, the run closes down and writes the final status);
+    otherwise kill any running rsync + backup-sync.py so a stuck/stalled sync
+    stops immediately."""
     cur = _read_backup_status() or {}
     if cur.get("state") != "syncing":
         flash("No sync is running.", "error")
         return redirect(request.referrer or url_for("index"))
+    reply = sync_worker.cancel()
+    if reply and reply.get("ok"):
+        flash("Cancelling sync. Files already sent are kept for the next run.", "success")
+        return redirect(request.referrer or url_for("index"))
     try:
-        # SIGKILL both — SIGTERM on the python process can leave it in the proc
-        # table long enough that the very next "Sync Now" gets blocked by its
-        # own another_sync_running() guard.
+        # SIGKILL both so a stuck sync stops at once; the sync slot it held
+        # (sync_worker.claim_slot) is free as soon as the process is gone.
         subprocess.run(["pkill", "-9", "-f", "/usr/bin/rsync"],
                        capture_output=True, timeout=5)
         subprocess.run(["pkill", "-9", "-f", "backup-sync.py"],
@@ -1656,10 +2081,34 @@ def sync_cancel():
         flash(f"Failed to cancel sync: {e}", "error")
     return redirect(request.referrer or url_for("index"))
 
+def _start_sync_job(job="sync", **args):
+    """Queue a sync (or a restore with device/snapshot/target) on the sync
+    worker. Without the worker running, launch a one-shot backup-sync.py as
+    before. Returns an error text, or "" once the job is on its way."""
+    reply = sync_worker.enqueue(job, source="webui", **args)
+    if reply is not None:
+        return "" if reply.get("ok") else reply.get("error", "The sync worker refused the job.")
+    sync_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backup-sync.py")
+    if not os.path.isfile(sync_script):
+        return "backup-sync.py not found on disk."
+    cmd = [sys.executable, sync_script, "--no-worker"]
+    if job == "restore":
+        cmd += ["--restore", args["device"]]
+        for opt in ("snapshot", "target"):
+            if args.get(opt):
+                cmd += [f"--{opt}", args[opt]]
+    try:
+        subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         env={**os.environ, "IOSBACKUP_CONFIG": CONFIG_PATH})
+    except Exception as e:
+        return f"Failed to start sync: {e}"
+    return ""
+
 @app.route("/sync/start", methods=["POST"])
 @login_required
 def sync_start():
-    """Launch backup-sync.py as a subprocess from anywhere (e.g. dashboard button)."""
+    """Start a sync from anywhere (e.g. dashboard button): on the sync worker,
+    or as a backup-sync.py subprocess when the worker isn't running."""
     cfg = load_config()
     if not cfg.get("sync", {}).get("enabled"):
         flash("Remote sync is disabled. Enable it in Remote Sync settings.", "error")
@@ -1672,45 +2121,51 @@ def sync_start():
     if _backup_in_progress():
         flash("A backup is in progress. Wait for it to finish (or use auto-sync).", "error")
         return redirect(request.referrer or url_for("index"))
-    sync_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backup-sync.py")
-    if not os.path.isfile(sync_script):
-        flash("backup-sync.py not found on disk.", "error")
-        return redirect(request.referrer or url_for("index"))
-    # State is not 'syncing' — safe to nuke any leftover backup-sync.py / rsync
-    # processes from a cancelled or crashed sync, so the new launch isn't
-    # blocked by its own another_sync_running() guard.
-    try:
-        subprocess.run(["pkill", "-9", "-f", "backup-sync.py"],
-                       capture_output=True, timeout=5)
-        subprocess.run(["pkill", "-9", "-f", "/usr/bin/rsync"],
-                       capture_output=True, timeout=5)
-        time.sleep(0.3)
-    except Exception:
-        pass
-    try:
-        subprocess.Popen(
-            [sys.executable, sync_script],
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-            env={**os.environ, "IOSBACKUP_CONFIG": CONFIG_PATH},
-        )
+    err = _start_sync_job()
+    if err:
+        flash(err, "error")
+    else:
         flash("Sync started. Watch the dashboard or live log for progress.", "success")
-    except Exception as e:
-        flash(f"Failed to start sync: {e}", "error")
     return redirect(request.referrer or url_for("index"))
 
 @app.route("/api/backup-sizes")
 @login_required
 def api_backup_sizes():
-    """Calculate backup folder sizes (slow — called via AJAX after page load)."""
-    cfg = load_config()
+    """Backup folder sizes from the size index (see size_index). Folders whose
+    index is missing or out of date are listed under ``pending`` and counted
+    again in the background; the page asks again until none are."""
+    cfg = config_view()
     backup_dir = cfg.get("backup_dir", "/media/iosbackup/")
-    sizes = {}
+    sizes, pending = {}, []
     if os.path.isdir(backup_dir):
         for entry in os.listdir(backup_dir):
             entry_path = os.path.join(backup_dir, entry)
             if os.path.isdir(entry_path) and os.path.exists(os.path.join(entry_path, "Info.plist")):
-                sizes[entry] = _human_size(_dir_size(entry_path))
-    return jsonify(sizes)
+                data = size_index.load(entry)
+                if data:
+                    sizes[entry] = _human_size(data["bytes"])
+                if not size_index.is_current(entry_path, data):
+                    pending.append(entry)
+    if pending:
+        _refresh_sizes(backup_dir)
+    return jsonify({"sizes": sizes, "pending": pending})
+
+@app.route("/api/backup-sizes/stream")
+@login_required
+def api_backup_sizes_stream():
+    """Backup folder sizes as NDJSON, one line per device folder as soon as
+    its size is known: indexed folders at once, the others as each has been
+    counted again (see size_index.iter_sizes)."""
+    backup_dir = config_view().get("backup_dir", "/media/iosbackup/")
+
+    def lines():
+        for folder, data in size_index.iter_sizes(backup_dir):
+            yield json.dumps({"folder": folder, "bytes": data["bytes"],
+                              "allocated": data["allocated"], "files": data["files"],
+                              "size": _human_size(data["bytes"]),
+                              "on_disk": _human_size(data["allocated"])}) + "\n"
+    return Response(lines(), mimetype="application/x-ndjson",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route("/api/export-config")
 @login_required
@@ -1858,7 +2313,14 @@ def main():
     bind = netutil.get_bind_address(webui_cfg.get("bind_interfaces", ["all"]))
 
     app.logger.info(f"Starting on {bind}:{port}")
-    app.run(host=bind, port=port, debug=False)
+    webserve.install(app, compress=webui_cfg.get("compress", True))
+    if webui_cfg.get("server", "production") == "dev":
+        app.run(host=bind, port=port, debug=False)
+        return
+    global SSE_MAX_CLIENTS
+    threads = max(2, int(webui_cfg.get("threads", webserve.THREADS)))
+    SSE_MAX_CLIENTS = _sse_max_clients(threads)
+    webserve.serve(app, bind, port, threads, logger=app.logger)
 
 if __name__ == "__main__":
     main()
@@ -6,7 +6,7 @@ Supports two passphrase modes:
 - "udid": uses iPhone UDID (auto-decrypt when iPhone connected)
 - "custom": uses a user-chosen password (manual entry required)
 """
-import os, sys, json, hashlib, base64, subprocess
+import os, sys, json, hashlib, base64, subprocess, threading
 
 ENC_FILE = os.getenv("WG_ENC_FILE", "/root/iosbackupmachine/wireguard.enc")
 SALT = b"iosbackupmachine-credential-salt-v2"
@@ -36,8 +36,24 @@ def get_iphone_serial():
         pass
     return None
 
-def derive_key(passphrase):
-    return hashlib.pbkdf2_hmac("sha256", passphrase.encode("utf-8"), SALT, 100000)
+def derive_key(passphrase, salt=SALT, iterations=100000):
+    return hashlib.pbkdf2_hmac("sha256", passphrase.encode("utf-8"), salt, iterations)
+
+_key_cache = {"id": None, "key": None}
+_key_lock = threading.Lock()
+
+def _file_key(passphrase):
+    """derive_key for the credential files. A long-lived process (sync worker,
+    web UI) runs the PBKDF2 rounds once: the key of the last passphrase is
+    kept, recognised by a hash of it, never by the passphrase itself."""
+    ident = hashlib.sha256(passphrase.encode("utf-8")).digest()
+    with _key_lock:
+        if _key_cache["id"] == ident:
+            return _key_cache["key"]
+    key = derive_key(passphrase)
+    with _key_lock:
+        _key_cache.update(id=ident, key=key)
+    return key
 
 def _xor_bytes(data, key):
     key_stream = (key * ((len(data) // len(key)) + 1))[:len(data)]
@@ -46,7 +62,7 @@ def _xor_bytes(data, key):
 def _encrypt_dict(config_dict, passphrase, enc_file):
     if not passphrase:
         return False
-    key = derive_key(passphrase)
+    key = _file_key(passphrase)
     plaintext = json.dumps(config_dict).encode("utf-8")
     try:
         from cryptography.hazmat.primitives.ciphers.aead import AESGCM
@@ -63,7 +79,7 @@ def _encrypt_dict(config_dict, passphrase, enc_file):
 def _decrypt_file(passphrase, enc_file):
     if not passphrase or not os.path.exists(enc_file):
         return None
-    key = derive_key(passphrase)
+    key = _file_key(passphrase)
     with open(enc_file, "r") as f:
         payload = json.load(f)
     method = payload.get("method", "")
@@ -58,6 +58,25 @@ APP_FILES=(
     "app/config_schema.py:config_schema.py"
     "app/power.py:power.py"
     "app/logutil.py:logutil.py"
+    "app/sync_tuner.py:sync_tuner.py"
+    "app/datausage.py:datausage.py"
+    "app/sync_checkpoint.py:sync_checkpoint.py"
+    "app/sync_snapshots.py:sync_snapshots.py"
+    "app/sync_local.py:sync_local.py"
+    "app/sync_s3.py:sync_s3.py"
+    "app/sync_vault.py:sync_vault.py"
+    "app/sync_restore.py:sync_restore.py"
+    "app/sync_worker.py:sync_worker.py"
+    "app/sync_watchdog.py:sync_watchdog.py"
+    "app/sync_estimate.py:sync_estimate.py"
+    "app/sync_audit.py:sync_audit.py"
+    "app/size_index.py:size_index.py"
+    "app/filewatch.py:filewatch.py"
+    "app/logtail.py:logtail.py"
+    "app/logindex.py:logindex.py"
+    "app/logsearch.py:logsearch.py"
+    "app/webserve.py:webserve.py"
+    "app/probes.py:probes.py"
     "scripts/unplug-notify.sh:unplug-notify.sh"
     "scripts/shutdown.sh:shutdown.sh"
     "scripts/long-press-backup.sh:long-press-backup.sh"
@@ -72,6 +91,7 @@ APP_FILES=(
 ENABLE_SERVICES=(
     iosbackupmachine.service
     webui.service
+    sync-worker.service
     ntp-sync.service
     rtc-sync.service
     wg-autoconnect.service
@@ -88,6 +108,7 @@ ALL_SERVICES=(
     unplug-notify.service
     button-info.service
     backup-sync.service
+    sync-worker.service
     wg-autoconnect.service
     usbmux-refresh.service
 )
@@ -538,6 +559,12 @@ if [ -f /etc/systemd/system/webui.service ]; then
         warn "Could not start webui.service (will start on next boot)"
 fi
 
+if [ -f /etc/systemd/system/sync-worker.service ]; then
+    systemctl restart sync-worker.service 2>/dev/null && \
+        info "Restarted sync-worker.service" || \
+        warn "Could not start sync-worker.service (syncs run one-shot until it starts)"
+fi
+
 # Start the display daemon now on upgrades (SPI/I2C overlays are already active).
 # On a fresh install the overlays need a reboot first, so it starts on next boot.
 if [ "${IS_UPGRADE}" = true ] && [ -f /etc/systemd/system/iosbackupmachine.service ]; then
@@ -1,4 +1,6 @@
-"""Tests for config_schema: defaults, migration, and atomic save/load round-trip."""
+"""Tests for config_schema: defaults, migration, atomic save/load round-trip,
+and the stat-validated config cache."""
+import pytest
 import yaml
 
 import config_schema
@@ -76,3 +78,26 @@ def test_wireguard_full_tunnel_defaults_off():
     # existing value preserved
     cfg2 = config_schema.apply_defaults({"wireguard": {"full_tunnel": True}})
     assert cfg2["wireguard"]["full_tunnel"] is True
+
+
+def test_config_cache_parses_once_until_the_file_changes(tmp_path, monkeypatch):
+    p = tmp_path / "config.yaml"
+    config_schema.atomic_save({"owner_lines": ["X"], "sync": {"enabled": True}}, str(p))
+    loads = []
+    real = config_schema.load_config
+    monkeypatch.setattr(config_schema, "load_config", lambda path: loads.append(path) or real(path))
+    cache = config_schema.ConfigCache()
+    view = cache.view(str(p))
+    assert view["sync"]["enabled"] is True and view["owner_lines"] == ("X",)
+    assert cache.view(str(p)) is view and len(loads) == 1
+    with pytest.raises(TypeError):
+        view["sync"]["enabled"] = False
+
+    cfg = cache.copy(str(p))                             # a private, mutable copy
+    cfg["sync"]["enabled"] = False
+    assert cache.view(str(p))["sync"]["enabled"] is True and len(loads) == 1
+    config_schema.atomic_save(cfg, str(p))               # a new inode: parsed again
+    assert cache.view(str(p))["sync"]["enabled"] is False and len(loads) == 2
+    cache.invalidate()
+    cache.view(str(p))
+    assert len(loads) == 3
@@ -0,0 +1,96 @@
+"""Tests for datausage: profile matching, bwlimit flags, monthly accounting,
+the cap admission check and the /proc/net/dev meter."""
+import datausage
+import netutil
+
+PROFILES = [
+    {"network": "usb_iphone", "bwlimit": "2M", "monthly_cap_mb": 100},
+    {"network": "wifi", "bwlimit": "500K", "monthly_cap_mb": 0},
+    {"network": "wifi:Home", "bwlimit": "", "monthly_cap_mb": 0},
+    {"network": "*", "bwlimit": "1M", "monthly_cap_mb": 0},
+]
+
+
+def test_match_profile_prefers_the_most_specific_entry():
+    assert datausage.match_profile(PROFILES, "wifi:Home")["bwlimit"] == ""
+    assert datausage.match_profile(PROFILES, "wifi:Cafe")["bwlimit"] == "500K"
+    assert datausage.match_profile(PROFILES, "usb_iphone")["monthly_cap_mb"] == 100
+    assert datausage.match_profile(PROFILES, "eth0")["network"] == "*"
+    assert datausage.match_profile(PROFILES, None) is None
+
+
+def test_bwlimit_flags():
+    assert datausage.bwlimit_flags({"bwlimit": "2M"}) == ["--bwlimit=2M"]
+    assert datausage.bwlimit_flags({"bwlimit": ""}) == []
+    assert datausage.bwlimit_flags({"bwlimit": "0"}) == []
+    assert datausage.bwlimit_flags({"bwlimit": "fast; rm -rf /"}) == []
+    assert datausage.bwlimit_flags(None) == []
+    assert not datausage.valid_bwlimit("2 MB")
+
+
+def test_usage_accumulates_and_cap_refuses(tmp_path):
+    path = str(tmp_path / "usage.json")
+    datausage.add_usage("usb_iphone", 60_000_000, path)
+    data = datausage.load(path)
+    assert datausage.admission(PROFILES, "usb_iphone", data)[0]
+    datausage.add_usage("usb_iphone", 50_000_000, path)
+    ok, reason = datausage.admission(PROFILES, "usb_iphone", datausage.load(path))
+    assert not ok and "unmetered" in reason
+    # An uncapped network is always admitted.
+    assert datausage.admission(PROFILES, "wifi:Home", datausage.load(path))[0]
+
+
+def test_old_months_are_trimmed(tmp_path):
+    path = str(tmp_path / "usage.json")
+    data = {"months": {f"2020-{m:02d}": {"wifi": 1} for m in range(1, 13)}, "paused": None}
+    data["months"]["2021-01"] = {"wifi": 1}
+    datausage.save(data, path)
+    months = datausage.load(path)["months"]
+    assert len(months) == datausage.MONTHS_KEEP
+    assert "2020-01" not in months
+
+
+def test_pause_marker_round_trip(tmp_path):
+    path = str(tmp_path / "usage.json")
+    datausage.mark_paused("usb_iphone", "cap", path)
+    assert datausage.paused_info(datausage.load(path))["network"] == "usb_iphone"
+    datausage.clear_paused(path)
+    assert datausage.paused_info(datausage.load(path)) is None
+
+
+def test_meter_counts_deltas_and_detects_cap(tmp_path):
+    path = str(tmp_path / "usage.json")
+    counters = iter([(1000, 500), (40_001_000, 20_000_500), (100, 200)])
+    meter = datausage.UsageMeter("usb_iphone", "usb0", PROFILES[0], path=path,
+                                 read_counters=lambda: {"usb0": next(counters)})
+    meter.poll()
+    assert meter.run_bytes == 60_000_000
+    assert not meter.over_cap()
+    meter.poll()                      # counter reset: the new reading is the delta
+    assert meter.run_bytes == 60_000_300
+    meter.flush()
+    assert datausage.month_usage("usb_iphone", datausage.load(path)) == 60_000_300
+
+    meter.run_bytes = 100_000_000
+    assert meter.over_cap()
+
+
+def test_read_net_dev(tmp_path):
+    dev = tmp_path / "dev"
+    dev.write_text(
+        "Inter-|   Receive                                                |  Transmit\n"
+        " face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets\n"
+        "    lo:  1234      10    0    0    0     0          0         0     1234      10    0    0    0     0       0          0\n"
+        "  usb0: 987654   800    0    0    0     0          0         0   123456     700    0    0    0     0       0          0\n"
+    )
+    assert netutil.read_net_dev(str(dev)) == {"lo": (1234, 1234), "usb0": (987654, 123456)}
+    assert netutil.read_net_dev(str(tmp_path / "missing")) == {}
+
+
+def test_target_bwlimit_splits_the_network_limit():
+    assert datausage.bwlimit_kib("2M") == 2048
+    assert datausage.bwlimit_kib("0") is None
+    assert datausage.target_bwlimit_flags({"bwlimit": "2M"}, "", shares=2) == ["--bwlimit=1024"]
+    assert datausage.target_bwlimit_flags({"bwlimit": "2M"}, "500K", shares=2) == ["--bwlimit=500"]
+    assert datausage.target_bwlimit_flags(None, "300") == ["--bwlimit=300"]
+    assert datausage.target_bwlimit_flags({"bwlimit": ""}, "") == []
@@ -0,0 +1,47 @@
+"""Tests for filewatch: inotify event parsing, FileWatch waking on an atomic
+replace and on a write of the watched file only, and its stat-polling
+fallback."""
+import os
+import struct
+
+import filewatch
+
+
+def _replace(path, text):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def test_parse_events():
+    buf = (struct.pack("iIII", 1, 0x80, 0, 16) + b"status.json\0\0\0\0\0"
+           + struct.pack("iIII", 1, 0x8, 0, 0))
+    assert filewatch.parse_events(buf) == [(0x80, "status.json"), (0x8, "")]
+
+
+def test_watch_wakes_on_replace_and_write_of_its_file(tmp_path):
+    path = str(tmp_path / "status.json")
+    watch = filewatch.FileWatch(path)
+    assert watch.mode == "inotify"
+    v = watch.version
+    assert watch.wait(v, 0.2) == v                   # nothing happened
+    _replace(path, '{"state": "syncing"}')
+    v2 = watch.wait(v, 5)
+    assert v2 != v
+    with open(tmp_path / "other.json", "w") as f:
+        f.write("x")
+    assert watch.wait(v2, 0.3) == v2                 # another file wakes nobody
+    with open(path, "w") as f:
+        f.write("{}")
+    assert watch.wait(v2, 5) != v2
+
+
+def test_poll_fallback(tmp_path, monkeypatch):
+    monkeypatch.setattr(filewatch, "POLL_SEC", 0.05)
+    path = str(tmp_path / "status.json")
+    watch = filewatch.FileWatch(path, use_inotify=False)
+    assert watch.mode == "poll"
+    v = watch.version
+    _replace(path, "{}")
+    assert watch.wait(v, 5) != v
@@ -0,0 +1,56 @@
+"""Tests for logindex: the line index and its pages, indexing on from the
+last line of a log that grew and again after a rotation, and level and
+text search over the map."""
+import os
+
+import logindex
+
+
+def _log(path, n, start=0):
+    with open(path, "a") as f:
+        for i in range(start, start + n):
+            tag = "ERROR" if i % 10 == 7 else "SYNC"
+            f.write(f"[2026-10-19 10:00:00] [{tag}] line {i}\n")
+
+
+def test_pages_of_lines(tmp_path):
+    path = tmp_path / "sync-1.log"
+    _log(path, 25)
+    with open(path, "ab") as f:
+        f.write(b"tail \xc3")                       # unfinished line, split character
+    idx = logindex.index(str(path))
+    assert idx.count == 26 and idx.size == os.path.getsize(path)
+    page = idx.lines(20, 10)
+    assert [n for n, _ in page] == [20, 21, 22, 23, 24, 25]
+    assert page[0][1].endswith("[SYNC] line 20") and page[-1][1] == "tail �"
+    assert idx.lines(30) == [] and idx.line_of(0) == 0
+    assert idx.line_of(idx.starts[3] + 5) == 3
+
+
+def test_index_extends_a_growing_log_and_rebuilds_a_rotated_one(tmp_path):
+    path = tmp_path / "sync-1.log"
+    _log(path, 10)
+    idx = logindex.index(str(path))
+    starts = list(idx.starts)
+    _log(path, 5, start=10)
+    assert logindex.index(str(path)) is idx
+    assert list(idx.starts[:len(starts)]) == starts and idx.count == 15
+    os.rename(path, tmp_path / "old.log")
+    _log(path, 3, start=100)
+    assert logindex.index(str(path)).count == 3
+    assert idx.lines(0, 1)[0][1].endswith("line 100")
+
+
+def test_search_levels_and_text(tmp_path):
+    path = tmp_path / "sync-1.log"
+    _log(path, 100)
+    idx = logindex.index(str(path))
+    errors = logindex.level_regex(logindex.ERROR_LEVELS)
+    found, more = idx.search(errors, limit=3)
+    assert [n for n, _ in found] == [7, 17, 27] and more
+    found, more = idx.search(errors, start=90)
+    assert [n for n, _ in found] == [97] and not more
+    text = logindex.text_regex(r"LINE \d?5$")
+    assert [n for n, _ in idx.search(text)[0]] == [5, 15, 25, 35, 45, 55, 65, 75, 85, 95]
+    both = idx.search(logindex.level_regex(["SYNC"]), logindex.text_regex(r"line 1\d$"))[0]
+    assert [n for n, _ in both] == [10, 11, 12, 13, 14, 15, 16, 18, 19]
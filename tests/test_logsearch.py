@@ -0,0 +1,66 @@
+"""Tests for logsearch: indexing only what a log appended, re-indexing a
+rotated one and forgetting deleted ones, and search with its plain-word
+fallback, newest-first order and context lines."""
+import os
+
+import logsearch
+import logutil
+
+
+def _write(path, lines, mode="a"):
+    with open(path, mode) as f:
+        f.writelines(f"{line}\n" for line in lines)
+
+
+def test_update_indexes_appended_lines_and_rotation(tmp_path):
+    conn = logsearch.connect(str(tmp_path / "idx.db"))
+    log = tmp_path / "sync-20260101-000000.log"
+    _write(log, ["[SYNC] starting", "[ERROR] rsync exited with error 23"])
+    (tmp_path / "webui.log").write_text("[ERROR] not a per-run log\n")
+    assert logsearch.update(str(tmp_path), conn) == 2
+    assert logsearch.update(str(tmp_path), conn) == 0
+    with open(log, "a") as f:
+        f.write("[STALL] no progress\n[SYNC] half a li")
+    assert logsearch.update(str(tmp_path), conn) == 1
+    hits, _ = logsearch.search("stall", conn=conn)
+    assert [(h["log"], h["line"]) for h in hits] == [(log.name, 2)]
+    assert logsearch.search("not", conn=conn)[0] == []
+
+    os.rename(log, tmp_path / "old")                        # rotated: a new file, same name
+    _write(log, ["[SYNC] fresh"])
+    assert logsearch.update(str(tmp_path), conn) == 1
+    assert logsearch.search("error", conn=conn)[0] == []
+    assert logsearch.search("fresh", conn=conn)[0][0]["line"] == 0
+
+
+def test_deleted_and_pruned_logs_are_forgotten(tmp_path, monkeypatch):
+    monkeypatch.setattr(logutil, "LOG_DIR", str(tmp_path))
+    monkeypatch.setattr(logutil, "STATE_DIR", str(tmp_path / "state"))
+    for i in range(3):
+        _write(tmp_path / f"backup-2026010{i}-000000.log", [f"[OK] backup {i} done"])
+        os.utime(tmp_path / f"backup-2026010{i}-000000.log", (1e9 + i, 1e9 + i))
+    assert logsearch.update() == 3
+    logutil.prune_logs(keep_per_kind=2, max_age_days=0)
+    conn = logsearch.connect()
+    assert [h["log"] for h in logsearch.search("done", order="newest", conn=conn)[0]] == [
+        "backup-20260102-000000.log", "backup-20260101-000000.log"]
+    os.remove(tmp_path / "backup-20260102-000000.log")
+    logsearch.update(conn=conn)
+    assert [name for name, in conn.execute("SELECT name FROM logs")] == ["backup-20260101-000000.log"]
+
+
+def test_search_fallback_order_and_context(tmp_path):
+    conn = logsearch.connect(str(tmp_path / "idx.db"))
+    for day in (1, 2):
+        log = tmp_path / f"backup-2026010{day}-000000.log"
+        _write(log, [f"line {i}" for i in range(5)] + ["idevicebackup2: error 208"]
+               + [f"after {i}" for i in range(3)])
+        os.utime(log, (1e9 + day, 1e9 + day))
+    logsearch.update(str(tmp_path), conn)
+    hits, more = logsearch.search("error-208:", order="newest", conn=conn, limit=1)
+    assert more and hits[0]["log"] == "backup-20260102-000000.log" and hits[0]["line"] == 5
+    assert hits[0]["before"] == ["line 3", "line 4"] and hits[0]["after"] == ["after 0", "after 1"]
+    assert ("error", True) in hits[0]["segments"] and ("208", True) in hits[0]["segments"]
+    top = logsearch.search("line", conn=conn, context=1)[0]
+    assert len(top) == 10 and all(h["line"] < 5 for h in top)
+    assert logsearch.search("  ", conn=conn) == ([], False)
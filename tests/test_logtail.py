@@ -0,0 +1,43 @@
+"""Tests for logtail.read_tail: appended lines only, a partial line held
+back, rotation and truncation resetting, and a large backlog capped at a
+line start."""
+import os
+
+import logtail
+
+
+def test_reads_only_appended_complete_lines(tmp_path):
+    path = tmp_path / "sync.log"
+    path.write_bytes(b"one\ntwo\n")
+    first = logtail.read_tail(str(path))
+    assert first["reset"] and first["data"] == "one\ntwo\n" and first["offset"] == 8
+    with open(path, "ab") as f:
+        f.write("thrée\nfo".encode())
+    r = logtail.read_tail(str(path), first["offset"], first["inode"])
+    assert not r["reset"] and r["data"] == "thrée\n"
+    with open(path, "ab") as f:
+        f.write(b"ur\r")
+    r = logtail.read_tail(str(path), r["offset"], r["inode"])
+    assert r["data"] == "four\r" and r["offset"] == os.path.getsize(path)
+    assert logtail.read_tail(str(path), r["offset"], r["inode"])["data"] == ""
+
+
+def test_rotation_and_truncation_reset(tmp_path):
+    path = tmp_path / "sync.log"
+    path.write_bytes(b"old line\n" * 10)
+    r = logtail.read_tail(str(path))
+    os.rename(path, tmp_path / "sync.log.1")
+    path.write_bytes(b"new\n" * 30)                   # longer than before, other inode
+    rotated = logtail.read_tail(str(path), r["offset"], r["inode"])
+    assert rotated["reset"] and rotated["data"] == "new\n" * 30
+    path.write_bytes(b"short\n")                      # truncated in place
+    cut = logtail.read_tail(str(path), rotated["offset"], rotated["inode"])
+    assert cut["reset"] and cut["data"] == "short\n"
+
+
+def test_backlog_capped_at_a_line_start(tmp_path):
+    path = tmp_path / "sync.log"
+    path.write_bytes(b"".join(b"line %03d\n" % i for i in range(100)))   # 9 bytes a line
+    r = logtail.read_tail(str(path), 0, None, limit=40)
+    assert r["data"] == "line 096\nline 097\nline 098\nline 099\n"
+    assert r["skipped"] == 96 * 9 and r["offset"] == 900
@@ -30,3 +30,22 @@ def test_sync_allowed_low_battery_refuses():
 def test_sync_allowed_above_threshold():
     ok, _ = power.sync_allowed(35, battery={"percent": 80, "charging": False})
     assert ok is True
+
+
+def test_sync_allowed_refuses_a_sync_the_battery_wont_last():
+    battery = {"percent": 50, "charging": False}
+    ok, reason = power.sync_allowed(35, battery=battery, need_pct=20)
+    assert ok is False and "needs about 20%" in reason
+    assert power.sync_allowed(35, battery=battery, need_pct=10)[0] is True
+    assert power.sync_allowed(35, battery={"percent": 50, "charging": True}, need_pct=90)[0] is True
+
+
+def test_on_mains_falls_back_to_charging(monkeypatch):
+    replies = {"get battery_power_plugged": "battery_power_plugged: true",
+               "get battery_charging": "battery_charging: false"}
+    monkeypatch.setattr(power, "_query", lambda command: replies.get(command))
+    assert power.on_mains() is True                  # full battery on mains: not charging
+    del replies["get battery_power_plugged"]
+    assert power.on_mains() is False
+    replies.clear()
+    assert power.on_mains() is None
@@ -0,0 +1,105 @@
+"""Tests for probes: probes running concurrently with per-probe deadlines
+and fallbacks, and Shared's TTL and single-flight collection."""
+import threading
+import time
+
+import probes
+
+
+def _sleep(sec, value):
+    def fn():
+        time.sleep(sec)
+        return value
+    return fn
+
+
+def _boom():
+    raise OSError("no such tool")
+
+
+def test_run_concurrently_with_deadlines_and_fallbacks():
+    start = time.monotonic()
+    values, timings = probes.run({
+        "a": probes.Probe(_sleep(0.2, "A"), 2),
+        "b": probes.Probe(_sleep(0.2, "B"), 2),
+        "slow": probes.Probe(_sleep(3, "late"), 0.3, "fallback"),
+        "broken": probes.Probe(_boom, 2, {}),
+    })
+    assert time.monotonic() - start < 1                  # not 0.4 + 3
+    assert values == {"a": "A", "b": "B", "slow": "fallback", "broken": {}}
+    assert {n: t["status"] for n, t in timings.items()} == {
+        "a": "ok", "b": "ok", "slow": "timeout", "broken": "error"}
+    assert 150 < timings["a"]["ms"] < 900 and timings["slow"]["ms"] >= 300
+    assert probes.run({}) == ({}, {})
+
+
+def test_run_does_not_restart_a_probe_still_running():
+    calls = []
+    release = threading.Event()
+
+    def hung():
+        calls.append(1)
+        release.wait(5)
+        return "done"
+
+    for _ in range(3):
+        values, timings = probes.run({"hung": probes.Probe(hung, 0.1, "fallback")})
+        assert values == {"hung": "fallback"} and timings["hung"]["status"] == "timeout"
+    assert len(calls) == 1
+    release.set()
+    time.sleep(0.1)
+    assert probes.run({"hung": probes.Probe(hung, 2)})[0] == {"hung": "done"}
+    assert len(calls) == 2
+
+
+def test_shared_single_flight_and_ttl():
+    calls = []
+    release = threading.Event()
+
+    def collect():
+        calls.append(1)
+        release.wait(5)
+        return len(calls)
+
+    shared = probes.Shared(collect, ttl=60)
+    got = []
+    callers = [threading.Thread(target=lambda: got.append(shared.get()[0])) for _ in range(8)]
+    for t in callers:
+        t.start()
+    time.sleep(0.2)
+    release.set()
+    for t in callers:
+        t.join(5)
+    assert got == [1] * 8 and len(calls) == 1
+    value, age = shared.get()
+    assert value == 1 and age >= 0 and len(calls) == 1   # within the TTL
+    shared.clear()
+    assert shared.get()[0] == 2
+
+
+def test_shared_failure_reaches_waiters_and_is_not_cached():
+    attempts = []
+
+    def collect():
+        attempts.append(1)
+        if len(attempts) == 1:
+            time.sleep(0.2)
+            raise RuntimeError("probe pool failed")
+        return "ok"
+
+    shared = probes.Shared(collect, ttl=60)
+    errors = []
+
+    def call():
+        try:
+            shared.get()
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    callers = [threading.Thread(target=call) for _ in range(3)]
+    for t in callers:
+        t.start()
+    for t in callers:
+        t.join(5)
+    assert errors == ["probe pool failed"] * 3
+    assert shared.get()[0] == "ok" and len(attempts) == 2
@@ -0,0 +1,68 @@
+"""Tests for the backup size index: size_index counting a device folder,
+the cheap currency check, an update counting again only the subfolders a
+backup changed, and iter_sizes streaming current folders first."""
+import os
+
+import size_index
+
+
+def _device(root):
+    d = root / "udid1"
+    for sub in ("00", "ab", "ff"):
+        (d / sub).mkdir(parents=True)
+        for i in range(3):
+            (d / sub / f"{sub}{i}").write_bytes(b"x" * 100)
+    (d / "Info.plist").write_bytes(b"i" * 10)
+    (d / "Manifest.db").write_bytes(b"m" * 50)
+    return d
+
+
+def test_update_counts_and_is_then_current(tmp_path):
+    d = _device(tmp_path)
+    path = str(tmp_path / "idx.json")
+    data = size_index.update(str(d), path=path)
+    assert (data["bytes"], data["files"], data["rescanned"]) == (960, 11, 3)
+    assert size_index.is_current(str(d), size_index.load("udid1", path))
+    assert size_index.update(str(d), path=path)["updated"] == data["updated"]
+
+
+def test_update_rescans_only_changed_subfolders(tmp_path):
+    d = _device(tmp_path)
+    path = str(tmp_path / "idx.json")
+    size_index.update(str(d), path=path)
+    # A backup: one file re-created bigger, a new one, Manifest.db rewritten.
+    os.remove(d / "ab" / "ab0")
+    (d / "ab" / "ab0").write_bytes(b"y" * 300)
+    (d / "ab" / "ab9").write_bytes(b"z" * 40)
+    (d / "Manifest.db").write_bytes(b"m" * 60)
+    st = os.stat(d / "Manifest.db")
+    os.utime(d / "Manifest.db", ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    os.utime(d / "ab", ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert not size_index.is_current(str(d), size_index.load("udid1", path))
+    data = size_index.update(str(d), path=path)
+    assert data["rescanned"] == 1
+    assert (data["bytes"], data["files"]) == (960 + 200 + 40 + 10, 12)
+
+
+def test_update_all_indexes_device_folders_only(tmp_path, monkeypatch):
+    monkeypatch.setattr(size_index, "_index_path", lambda device: str(tmp_path / f"{device}.json"))
+    backup = tmp_path / "backup"
+    _device(backup)
+    (backup / ".restore").mkdir()
+    (backup / "notes").mkdir()
+    size_index.update_all(str(backup))
+    assert size_index.load("udid1")["files"] == 11
+    assert size_index.load("notes") is None and size_index.load(".restore") is None
+
+
+def test_iter_sizes_yields_current_folders_first(tmp_path, monkeypatch):
+    monkeypatch.setattr(size_index, "_index_path", lambda device: str(tmp_path / f"{device}.json"))
+    backup = tmp_path / "backup"
+    _device(backup)
+    other = _device(backup / "x").rename(backup / "udid0")
+    size_index.update(str(backup / "udid1"))
+    order = [(name, data["rescanned"]) for name, data in size_index.iter_sizes(str(backup))]
+    assert order == [("udid1", 3), ("udid0", 3)]
+    data = size_index.load("udid0")
+    assert data["allocated"] >= 0 and data["dirs"]["ab"][3] == 3
+    assert size_index.refresh(str(other), workers=1)["bytes"] == data["bytes"]
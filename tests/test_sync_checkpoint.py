@@ -0,0 +1,112 @@
+"""Tests for sync_checkpoint: backup generation IDs, complete-backup detection,
+the resume plan and the shared file list."""
+import plistlib
+import time
+
+import sync_checkpoint
+
+
+def _device(root, name, uuid="A", payload=b"x" * 1000, state="finished", manifest=True):
+    d = root / name
+    (d / "ab").mkdir(parents=True)
+    (d / "ab" / "ab12").write_bytes(payload)
+    (d / "Status.plist").write_bytes(plistlib.dumps({"UUID": uuid, "SnapshotState": state}))
+    (d / "Manifest.db").write_bytes(b"db")
+    if manifest:
+        (d / "Manifest.plist").write_bytes(plistlib.dumps({"IsEncrypted": False}))
+    return d
+
+
+def test_generation_changes_with_a_new_backup(tmp_path):
+    d = _device(tmp_path, "udid1")
+    gen = sync_checkpoint.generation_id(str(d))
+    assert gen and gen == sync_checkpoint.generation_id(str(d))
+    (d / "Status.plist").write_bytes(plistlib.dumps({"UUID": "B", "SnapshotState": "finished"}))
+    assert sync_checkpoint.generation_id(str(d)) != gen
+    assert sync_checkpoint.generation_id(str(tmp_path)) is None
+
+
+def test_plan_skips_confirmed_shards_and_reports_resume_point(tmp_path):
+    backup = tmp_path / "backup"
+    _device(backup, "udid1", payload=b"x" * 3000)
+    _device(backup, "udid2", payload=b"y" * 1000)
+    (backup / ".rsync-partial").mkdir()
+    ck = str(tmp_path / "ck.json")
+
+    plan = sync_checkpoint.plan_targets(str(backup), ["t"], ck)
+    assert [s["name"] for s in plan["shards"]] == ["udid1", "udid2"]
+    assert plan["targets"]["t"]["resume_pct"] == 0
+    assert not sync_checkpoint.begin("t", ck)
+
+    # The run is cut short after the first shard.
+    first = plan["shards"][0]
+    sync_checkpoint.confirm("t", first["name"], first["gen"], first["size"], ck)
+    plan = sync_checkpoint.plan_targets(str(backup), ["t", "other"], ck)
+    assert plan["targets"]["t"]["done"] == {"udid1"}
+    assert 60 <= plan["targets"]["t"]["resume_pct"] < 100
+    assert sync_checkpoint.begin("t", ck)
+
+    # Another remote target does not inherit the checkpoint.
+    assert plan["targets"]["other"]["resume_pct"] == 0
+
+    # A finished run is not a resume, but unchanged shards stay skipped.
+    sync_checkpoint.finish("t", ck)
+    t = sync_checkpoint.plan_targets(str(backup), ["t"], ck)["targets"]["t"]
+    assert t["resume_pct"] == 0 and "udid1" in t["done"]
+
+
+def test_plan_targets_scans_once_for_every_target(tmp_path):
+    backup = tmp_path / "backup"
+    _device(backup, "udid1")
+    _device(backup, "udid2")
+    ck = str(tmp_path / "ck.json")
+    plan = sync_checkpoint.plan_targets(str(backup), ["a", "b"], ck)
+    for s in plan["shards"]:
+        sync_checkpoint.confirm("a", s["name"], s["gen"], s["size"], ck)
+    sync_checkpoint.confirm("b", "udid1", plan["shards"][0]["gen"], plan["shards"][0]["size"], ck)
+
+    plan = sync_checkpoint.plan_targets(str(backup), ["a", "b"], ck)
+    assert plan["targets"]["a"]["done"] == {"udid1", "udid2"}
+    assert plan["targets"]["b"]["done"] == {"udid1"}
+
+    # Past FULL_VERIFY_SEC every shard is sent again.
+    later = time.time() + sync_checkpoint.FULL_VERIFY_SEC + 1
+    assert sync_checkpoint.plan_targets(str(backup), ["a"], ck, now=later)["targets"]["a"]["done"] == set()
+
+
+def test_new_backup_invalidates_its_shard(tmp_path):
+    backup = tmp_path / "backup"
+    d = _device(backup, "udid1")
+    ck = str(tmp_path / "ck.json")
+    s = sync_checkpoint.plan_targets(str(backup), ["t"], ck)["shards"][0]
+    sync_checkpoint.confirm("t", s["name"], s["gen"], s["size"], ck)
+    (d / "Manifest.db").write_bytes(b"newer database")
+    assert sync_checkpoint.plan_targets(str(backup), ["t"], ck)["targets"]["t"]["done"] == set()
+    sync_checkpoint.clear(ck)
+    assert sync_checkpoint.load("t", ck) == {}
+
+
+def test_backup_state_and_plan_skip_incomplete_folders(tmp_path):
+    backup = tmp_path / "backup"
+    _device(backup, "done")
+    _device(backup, "busy", state="uploading")
+    _device(backup, "broken", manifest=False)
+    assert sync_checkpoint.backup_state(str(backup / "done")) == "complete"
+    assert sync_checkpoint.backup_state(str(backup / "busy")) == "backing_up"
+    assert sync_checkpoint.backup_state(str(backup / "broken")) == "interrupted"
+
+    plan = sync_checkpoint.plan_targets(str(backup), ["t"], str(tmp_path / "ck.json"))
+    assert [s["name"] for s in plan["shards"]] == ["done"]
+    assert {s["name"]: s["state"] for s in plan["skipped"]} == {
+        "broken": "interrupted", "busy": "backing_up"}
+
+
+def test_file_list_walks_once_parents_first(tmp_path):
+    d = _device(tmp_path, "udid1")
+    (d / "ab" / "link").symlink_to("ab12")
+    entries = sync_checkpoint.file_list(str(d))
+    rels = [rel for rel, _, _ in entries]
+    assert rels == ["Manifest.db", "Manifest.plist", "Status.plist", "ab", "ab/ab12", "ab/link"]
+    assert all(path == str(d / rel) for rel, path, _ in entries)
+    assert entries[-1][2].st_size == len("ab12")          # the link itself, not followed
+    assert sync_checkpoint.file_list(str(tmp_path / "missing")) == []
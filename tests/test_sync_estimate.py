@@ -0,0 +1,143 @@
+"""Tests for the pre-sync estimate: sync_estimate's change scan against the
+checkpoints, the data rate and battery drain it learns, the estimate itself,
+and sync_manager's battery admission and config-only checkpoint keys."""
+import json
+import os
+import plistlib
+import time
+
+import sync_checkpoint
+import sync_estimate
+import sync_local
+import sync_manager
+
+
+def _device(root, name, files, mtime):
+    d = root / name
+    d.mkdir(parents=True)
+    (d / "Status.plist").write_bytes(plistlib.dumps({"SnapshotState": "finished"}))
+    (d / "Manifest.plist").write_bytes(plistlib.dumps({"IsEncrypted": False}))
+    for rel, size in files.items():
+        (d / rel).write_bytes(b"x" * size)
+    for f in d.iterdir():
+        os.utime(f, (mtime, mtime))
+    return d
+
+
+def test_changed_since_counts_files_written_after():
+    scan = ([10.0, 20.0, 30.0], [7, 6, 4, 0])
+    assert sync_estimate.changed_since(scan) == (7, 3)
+    assert sync_estimate.changed_since(scan, 20.0) == (4, 1)
+    assert sync_estimate.changed_since(scan, 99.0) == (0, 0)
+
+
+def test_scan_changes_uses_ctime_too(tmp_path):
+    (tmp_path / "a").write_bytes(b"x" * 10)
+    os.utime(tmp_path / "a", (1, 1))                 # old mtime, but just written
+    scan = sync_estimate.scan_changes(str(tmp_path))
+    assert sync_estimate.changed_since(scan) == (10, 1) and scan[0][0] > 1000
+
+
+def test_pending_per_target(tmp_path):
+    backup = tmp_path / "backup"
+    _device(backup, "udid1", {"f1": 100, "f2": 50}, 1000)
+    _device(backup, "udid2", {"g1": 70}, 1000)
+    ckpt = str(tmp_path / "ckpt.json")
+    gen1 = sync_checkpoint.generation_id(str(backup / "udid1"))
+    later = time.time() + 100
+    with open(ckpt, "w") as f:
+        json.dump({"targets": {"a": {"shards": {
+            "udid1": {"gen": gen1, "size": 150, "verified": int(time.time())},   # in sync
+            # An older generation, confirmed after every file was written.
+            "udid2": {"gen": "old", "size": 60, "verified": later}}}}}, f)
+    out = sync_estimate.pending(str(backup), {"a": "a", "b": "b", "c": None}, ckpt)
+    assert out["a"] == {"bytes": 0, "files": 0, "shards": 1}
+    assert out["b"] == out["c"]
+    assert out["b"]["shards"] == 2 and out["b"]["files"] == 7
+    assert out["b"]["bytes"] > 220
+
+
+def test_pending_walks_each_backup_generation_once(tmp_path, monkeypatch):
+    backup = tmp_path / "backup"
+    d = _device(backup, "udid1", {"f1": 100}, 1000)
+    ckpt = str(tmp_path / "ckpt.json")
+    walks = []
+
+    def counted(walk):
+        def wrapper(folder):
+            walks.append(folder)
+            return walk(folder)
+        return wrapper
+
+    monkeypatch.setattr(sync_estimate, "scan_changes", counted(sync_estimate.scan_changes))
+    monkeypatch.setattr(sync_checkpoint, "tree_size", counted(sync_checkpoint.tree_size))
+    for _ in range(3):
+        assert sync_estimate.pending(str(backup), {"a": "a"}, ckpt)["a"]["files"] == 3
+    assert len(walks) == 2                          # one size walk, one change scan
+    (d / "f2").write_bytes(b"x" * 10)
+    (d / "Status.plist").write_bytes(plistlib.dumps({"SnapshotState": "finished", "UUID": "B"}))
+    assert sync_estimate.pending(str(backup), {"a": "a"}, ckpt)["a"]["files"] == 4
+    assert len(walks) == 4
+
+
+def test_data_rate_fallbacks():
+    run = lambda net, mbs: {"network": net, "data_bytes": 100_000_000, "seconds": 100 / mbs}
+    history = [run("wifi:home", 2), run("wifi:home", 4), run("wifi:office", 1)]
+    assert sync_estimate.data_rate(history, "wifi:home") == 3e6
+    assert sync_estimate.data_rate(history, "wifi:cafe") == 2e6
+    assert sync_estimate.data_rate([], "usb_iphone") == sync_estimate.sync_watchdog.DEFAULT_RATES["usb_iphone"]
+
+
+def test_record_drain_keeps_only_usable_runs(tmp_path):
+    path = str(tmp_path / "energy.json")
+    on_batt = lambda pct: {"percent": pct, "charging": False}
+    assert sync_estimate.drain_rate(path) == sync_estimate.DEFAULT_DRAIN_PER_HOUR
+    sync_estimate.record_drain(on_batt(80), on_batt(70), 3600, path)
+    sync_estimate.record_drain(on_batt(80), on_batt(60), 3600, path)
+    sync_estimate.record_drain(on_batt(80), on_batt(79), 60, path)                # too short
+    sync_estimate.record_drain(on_batt(80), {"percent": 90, "charging": True}, 3600, path)
+    sync_estimate.record_drain({"percent": None, "charging": None}, on_batt(70), 3600, path)
+    assert sync_estimate.load_drain(path) == [10.0, 20.0]
+    assert sync_estimate.drain_rate(path) == 15.0
+
+
+def test_estimate_eta_and_battery(tmp_path):
+    backup = tmp_path / "backup"
+    _device(backup, "udid1", {"f1": 2_000_000}, 1000)
+    history = [{"network": "wifi:home", "data_bytes": 10_000_000, "seconds": 10}]
+    targets = [{"name": "primary", "key": "p", "uplink": True},
+               {"name": "usb", "key": "u", "uplink": False}]
+    est = sync_estimate.estimate(str(backup), targets, history, "wifi:home", drain=36.0,
+                                 checkpoint_path=str(tmp_path / "ckpt.json"))
+    files = est["targets"]["primary"]["files"]
+    assert est["rate"] == 1e6 and est["files"] == 2 * files
+    expected = est["targets"]["primary"]["bytes"] / 1e6 + files * sync_estimate.PER_FILE_SEC
+    assert est["eta_sec"] == int(expected)
+    assert est["battery_pct"] == round(int(expected) / 100, 1)
+    assert "MB in" in sync_estimate.describe(est)
+
+
+def test_admission_uses_the_estimate(monkeypatch):
+    monkeypatch.setattr(sync_manager.power, "get_battery",
+                        lambda: {"percent": 50, "charging": False})
+    monkeypatch.setattr(sync_manager, "estimate_sync", lambda: {
+        "bytes": 1, "files": 1, "eta_sec": 3600, "battery_pct": 14.0, "rate": 1e6,
+        "network": None, "targets": {}})
+    ok, reason = sync_manager.admission(35)
+    assert not ok and "too low to finish" in reason
+    assert sync_manager.admission(35, forecast=False)[0]
+    assert sync_manager.admission(30)[0]
+    assert sync_manager.admission(0)[0]
+
+
+def test_estimate_key_matches_the_open_target(tmp_path):
+    disk = tmp_path / "disk"
+    disk.mkdir()
+    sync_local.target_id(str(disk))
+    ctx = sync_manager._LocalContext(str(tmp_path / "b"), str(disk), sync_local.target_id(str(disk)))
+    tcfg = {"type": "local", "path": str(disk) + "/"}
+    assert sync_manager._estimate_key(tcfg, None) == sync_manager._checkpoint_target(ctx)
+    assert sync_manager._estimate_key({"type": "local", "path": str(tmp_path)}, None) is None
+    ssh = {"type": "ssh", "username": "u", "host": "h", "port": 22, "remote_path": "/srv/b"}
+    assert sync_manager._estimate_key(ssh, {"enabled": True}) == "u@h:22:/srv/b:snapshots"
+    assert sync_manager._estimate_key({**ssh, "encrypt": True}, None) == "vault:u@h:22:/srv/b"
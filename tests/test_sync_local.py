@@ -0,0 +1,133 @@
+"""Tests for the local-disk sync target: sync_local's tree copier (quick check,
+hard links against the previous copy, --delete, stop), the target checks, and
+a whole run through sync_manager._run_target in both layouts."""
+import os
+import plistlib
+
+import sync_checkpoint
+import sync_local
+import sync_manager
+import sync_snapshots
+
+
+def _tree(root):
+    (root / "ab").mkdir(parents=True)
+    (root / "ab" / "ab12").write_bytes(b"x" * 5000)
+    (root / "cd").mkdir()
+    (root / "cd" / "cd34").write_bytes(b"y" * 300)
+    (root / "Manifest.db").write_bytes(b"db")
+    return root
+
+
+def test_copy_tree_copies_then_skips_then_links(tmp_path):
+    src = _tree(tmp_path / "src")
+    res = sync_local.TreeCopier(workers=2).copy_tree(str(src), str(tmp_path / "a"))
+    assert res["copied"] == 3 and res["copied_bytes"] == 5302
+    a = tmp_path / "a" / "ab" / "ab12"
+    assert a.read_bytes() == b"x" * 5000
+    assert a.stat().st_mtime_ns == (src / "ab" / "ab12").stat().st_mtime_ns
+
+    # A resumed run finds everything in place.
+    res = sync_local.TreeCopier().copy_tree(str(src), str(tmp_path / "a"))
+    assert res["skipped"] == 3 and res["copied"] == 0
+
+    # A new copy against the previous one: unchanged files are hard links.
+    (src / "cd" / "cd34").write_bytes(b"changed")
+    (tmp_path / "a" / "stale").write_bytes(b"gone locally")
+    res = sync_local.TreeCopier().copy_tree(str(src), str(tmp_path / "b"), str(tmp_path / "a"))
+    assert res["linked"] == 2 and res["copied"] == 1
+    assert (tmp_path / "b" / "ab" / "ab12").stat().st_ino == a.stat().st_ino
+    assert (tmp_path / "b" / "cd" / "cd34").read_bytes() == b"changed"
+
+
+def test_copy_tree_deletes_extras_and_stops(tmp_path):
+    src = _tree(tmp_path / "src")
+    dst = tmp_path / "dst"
+    (dst / "old").mkdir(parents=True)
+    (dst / "old" / "f").write_bytes(b"1")
+    sync_local.TreeCopier().copy_tree(str(src), str(dst))
+    assert not (dst / "old").exists()
+
+    res = sync_local.TreeCopier(should_stop=lambda: ("battery", "low")).copy_tree(
+        str(src), str(tmp_path / "other"))
+    assert res["stopped"] == ("battery", "low") and res["copied"] == 0
+
+
+def test_check_target(tmp_path):
+    assert "absolute" in sync_local.check_target("relative/path")
+    assert "not found" in sync_local.check_target(str(tmp_path / "missing"))
+    assert "not a mounted disk" in sync_local.check_target(str(tmp_path), root=str(tmp_path))
+    ident = sync_local.target_id(str(tmp_path))
+    assert ident and sync_local.target_id(str(tmp_path)) == ident
+
+
+def _backup(root):
+    d = root / "udid1"
+    _tree(d)
+    (d / "Status.plist").write_bytes(plistlib.dumps({"UUID": "A", "SnapshotState": "finished"}))
+    (d / "Manifest.plist").write_bytes(b"m")
+    (root / "top.txt").write_bytes(b"top")
+    return root
+
+
+def _run(tmp_path, disk, snapshots=None):
+    ctx = sync_manager._LocalContext(str(tmp_path / "backup") + "/", str(disk), "disk1",
+                                     snapshots=snapshots, workers=2, name="usb")
+    plan = sync_checkpoint.plan_targets(ctx.backup_dir, [sync_manager._checkpoint_target(ctx)])
+    seen = []
+    progress = sync_manager._ProgressAggregator(seen.append, 0, plan["total"], ["usb"])
+    res = sync_manager._run_target(ctx, plan, progress)
+    progress.finish("usb", "done" if res["success"] else "failed")
+    return res, seen
+
+
+def test_local_run_mirror_publishes_and_resumes(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_checkpoint, "_checkpoint_path", lambda: str(tmp_path / "ck.json"))
+    _backup(tmp_path / "backup")
+    disk = tmp_path / "disk"
+    disk.mkdir()
+    (disk / "gone-device").mkdir()
+    res, seen = _run(tmp_path, disk)
+    assert res["success"], res
+    assert (disk / "udid1" / "ab" / "ab12").exists() and (disk / "top.txt").exists()
+    assert not (disk / "gone-device").exists()
+    assert not os.listdir(disk / ".staging")
+    assert seen[-1]["pct"] == 100
+
+    # Nothing changed: the device folder is not copied again.
+    (disk / "udid1" / "ab" / "ab12").unlink()
+    assert _run(tmp_path, disk)[0]["success"]
+    assert not (disk / "udid1" / "ab" / "ab12").exists()
+
+
+def test_publish_cut_short_is_recovered(tmp_path):
+    staged, live = sync_local.stage_dirs(str(tmp_path), "udid1")
+    os.makedirs(staged + ".old")                  # live renamed aside, then a crash
+    sync_local.recover_staged(str(tmp_path), "udid1")
+    assert os.path.isdir(live) and not os.path.exists(staged + ".old")
+
+
+def test_local_run_snapshots(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_checkpoint, "_checkpoint_path", lambda: str(tmp_path / "ck.json"))
+    _backup(tmp_path / "backup")
+    disk = tmp_path / "disk"
+    disk.mkdir()
+    res, _ = _run(tmp_path, disk, snapshots={"enabled": True, "keep_last": 7})
+    assert res["success"], res
+    latest = disk / "udid1" / "latest"
+    assert latest.is_symlink() and (latest / "ab" / "ab12").exists()
+    assert not (disk / "udid1" / ".incomplete").exists()
+
+
+def test_local_snapshots_replace_an_existing_mirror(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_checkpoint, "_checkpoint_path", lambda: str(tmp_path / "ck.json"))
+    _backup(tmp_path / "backup")
+    disk = tmp_path / "disk"
+    disk.mkdir()
+    assert _run(tmp_path, disk)[0]["success"]                     # mirror first
+    mirrored = os.stat(disk / "udid1" / "ab" / "ab12").st_ino
+    res, _ = _run(tmp_path, disk, snapshots={"enabled": True, "keep_last": 7})
+    assert res["success"], res
+    entries = sorted(os.listdir(disk / "udid1"))
+    assert len(entries) == 2 and entries[1] == "latest" and sync_snapshots.is_snapshot(entries[0])
+    assert os.stat(disk / "udid1" / "latest" / "ab" / "ab12").st_ino == mirrored   # linked
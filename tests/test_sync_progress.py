@@ -1,4 +1,8 @@
-"""Unit tests for rsync --info=progress2 parsing (sync_manager.parse_progress_line)."""
+"""Unit tests for rsync --info=progress2 parsing (sync_manager.parse_progress_line
+and the incremental sync_manager._RsyncOutput stream parser)."""
+import io
+import os
+
 import sync_manager
 
 
@@ -35,3 +39,52 @@ def test_no_match_returns_none():
     assert sync_manager.parse_progress_line("sending incremental file list") is None
     assert sync_manager.parse_progress_line("") is None
     assert sync_manager.parse_progress_line(None) is None
+
+
+def test_stream_keeps_split_record_until_complete():
+    out = sync_manager._RsyncOutput()
+    assert out.feed(b"      1,234,5") is None
+    info = out.feed(b"67  45%  1.20MB/s    0:00:12\r")
+    assert info["bytes"] == 1234567
+    assert info["pct"] == 45
+
+
+def test_stream_returns_newest_progress_and_logs_other_lines():
+    log = io.StringIO()
+    out = sync_manager._RsyncOutput(log)
+    info = out.feed(b"Documents/a.txt\n   100  10%  1.00kB/s  0:00:01\r"
+                    b"   500  50%  2.00kB/s  0:00:01\r   900  90%  3.00kB/s  0:00:00\r"
+                    b"Total bytes sent: 1,000\nrsync error: pa")
+    assert info["pct"] == 90
+    assert info["speed"] == "3.00kB/s"
+    assert out.stats == {"Total bytes sent": 1000}
+    assert out.flush() is None
+    assert log.getvalue().splitlines() == ["Documents/a.txt", "Total bytes sent: 1,000", "rsync error: pa"]
+
+
+def test_stream_reads_from_fd_into_reused_buffer():
+    r, w = os.pipe()
+    try:
+        out = sync_manager._RsyncOutput()
+        os.write(w, b"32,768 100% 512.00kB/s 0:00:00 (xfr#1, to-chk=0/3)\n")
+        n, info = out.read(r)
+        assert n > 0 and info["total"] == 32768
+        os.close(w)
+        w = None
+        assert out.read(r) == (0, None)
+    finally:
+        os.close(r)
+        if w is not None:
+            os.close(w)
+
+
+def test_supervisor_reports_progress_and_exit_code():
+    seen = []
+    script = ("printf 'a.txt\\n  500  50%%  1.00MB/s  0:00:01\\r"
+              "  1,000 100%%  2.00MB/s  0:00:00\\nTotal bytes sent: 1,200\\n'; exit 23")
+    log = io.StringIO()
+    res = sync_manager._supervise_rsync(["sh", "-c", script], None, seen.append, log)
+    assert res["rc"] == 23 and res["abort"] is None
+    assert seen[-1]["pct"] == 100
+    assert res["stats"] == {"Total bytes sent": 1200}
+    assert "a.txt" in log.getvalue()
@@ -0,0 +1,130 @@
+"""Tests for restoring a device backup from a sync target: sync_restore's stream
+split, Manifest.db verification and swap, the remote listing parser, and a
+whole restore from a local-disk target through sync_manager."""
+import plistlib
+import sqlite3
+
+import sync_local
+import sync_manager
+import sync_restore
+
+
+def _device(root, files, encrypted=False):
+    """A minimal unencrypted device backup: top-level plists plus a Manifest.db
+    listing ``files`` ({fileID: bytes}) with their sizes."""
+    root.mkdir(parents=True)
+    (root / "Info.plist").write_bytes(plistlib.dumps({"Device Name": "phone"}))
+    (root / "Status.plist").write_bytes(plistlib.dumps({"SnapshotState": "finished"}))
+    (root / "Manifest.plist").write_bytes(plistlib.dumps({"IsEncrypted": encrypted}))
+    db = sqlite3.connect(str(root / "Manifest.db"))
+    db.execute("CREATE TABLE Files (fileID TEXT PRIMARY KEY, domain TEXT, relativePath TEXT, "
+               "flags INTEGER, file BLOB)")
+    for file_id, data in files.items():
+        blob = plistlib.dumps({"$objects": ["$null", {"Size": len(data)}]},
+                              fmt=plistlib.FMT_BINARY)
+        db.execute("INSERT INTO Files VALUES (?, 'HomeDomain', ?, 1, ?)",
+                   (file_id, f"Library/{file_id}", blob))
+        (root / file_id[:2]).mkdir(exist_ok=True)
+        (root / file_id[:2] / file_id).write_bytes(data)
+    db.execute("INSERT INTO Files VALUES ('dd00', 'HomeDomain', 'Library', 2, NULL)")
+    db.commit()
+    db.close()
+    return root
+
+
+_FILES = {"ab12": b"x" * 5000, "cd34": b"y" * 300, "ef56": b""}
+
+
+def test_split_streams_balances_bytes():
+    files = [("a", 100), ("b", 60), ("c", 50), ("d", 30), ("e", 10)]
+    lists = sync_restore.split_streams(files, 2)
+    sizes = dict(files)
+    assert sorted(sum(sizes[f] for f in names) for names in lists) == [120, 130]
+    assert sorted(sum(lists, [])) == ["a", "b", "c", "d", "e"]
+    assert len(sync_restore.split_streams(files[:1], 4)) == 1
+    assert sync_restore.split_streams([], 4) == []
+
+
+def test_present_bytes_counts_complete_files_only(tmp_path):
+    (tmp_path / "a").write_bytes(b"1234")
+    (tmp_path / "b").write_bytes(b"12")
+    assert sync_restore.present_bytes(str(tmp_path), [("a", 4), ("b", 4), ("c", 9)]) == 4
+
+
+def test_verify_backup_checks_files_and_sizes(tmp_path):
+    dev = _device(tmp_path / "udid1", _FILES)
+    res = sync_restore.verify_backup(str(dev))
+    assert res["ok"] and res["checked"] == 3 and not res["encrypted"]
+
+    (dev / "cd" / "cd34").write_bytes(b"short")
+    (dev / "ab" / "ab12").unlink()
+    res = sync_restore.verify_backup(str(dev))
+    assert not res["ok"]
+    assert res["missing"] == ["Library/ab12"] and res["wrong_size"] == ["Library/cd34"]
+
+    (dev / "Status.plist").unlink()
+    res = sync_restore.verify_backup(str(dev))
+    assert not res["ok"] and "Status.plist" in res["message"]
+
+
+def test_verify_backup_encrypted_checks_top_level_only(tmp_path):
+    dev = _device(tmp_path / "udid1", {}, encrypted=True)
+    (dev / "Manifest.db").write_bytes(b"ciphertext")
+    res = sync_restore.verify_backup(str(dev))
+    assert res["ok"] and res["encrypted"] and res["checked"] == 0
+
+
+def test_publish_swaps_staged_folder(tmp_path):
+    staged = tmp_path / ".restore" / "udid1"
+    staged.mkdir(parents=True)
+    (staged / "new").write_text("new")
+    (tmp_path / "udid1").mkdir()
+    (tmp_path / "udid1" / "old").write_text("old")
+    sync_restore.publish(str(tmp_path), "udid1")
+    assert (tmp_path / "udid1" / "new").exists() and not (tmp_path / "udid1" / "old").exists()
+    assert not staged.exists() and not (tmp_path / ".restore" / "udid1.replaced").exists()
+
+
+def test_parse_backup_list():
+    lines = ["D udid1", "S udid1/20260102-030405", "S udid1/20260301-000000",
+             "S udid1/not-a-snapshot", "D udid2", "D ..", "S other/20260102-030405"]
+    assert sync_manager._parse_backup_list(lines) == [
+        {"name": "udid1", "snapshots": ["20260301-000000", "20260102-030405"]},
+        {"name": "udid2", "snapshots": []},
+    ]
+
+
+def test_restore_from_local_target(tmp_path, monkeypatch):
+    disk = tmp_path / "disk"
+    _device(disk / "udid1", _FILES)
+    backup = tmp_path / "backup"
+    _device(backup / "udid1", {"ab12": b"x" * 5000, "gone": b"old"})
+    cfg = {"targets": [{"name": "usb", "type": "local", "path": str(disk)}]}
+    run = {"cfg": cfg, "sync_cfg": {}, "network": None, "iface": None, "profile": None}
+    monkeypatch.setattr(sync_manager, "_prepare_run", lambda passphrase=None: (run, None))
+    monkeypatch.setattr(sync_manager, "_load_backup_dir", lambda: str(backup))
+    monkeypatch.setattr(sync_local, "check_target", lambda path, root="/": "")
+    seen = []
+
+    res = sync_manager.restore_with_progress("udid1", target="usb", on_progress=seen.append,
+                                             min_battery=0)
+    assert res["success"], res
+    assert (backup / "udid1" / "cd" / "cd34").read_bytes() == b"y" * 300
+    assert not (backup / "udid1" / "go" / "gone").exists()
+    assert not (backup / ".restore" / "udid1").exists()
+    assert seen[-1]["pct"] == 100
+
+    # A copy that fails verification is kept staged, not swapped in.
+    (disk / "udid1" / "ab" / "ab12").unlink()
+    res = sync_manager.restore_with_progress("udid1", target="usb", min_battery=0)
+    assert not res["success"] and "verification" in res["message"]
+    assert (backup / "udid1" / "ab" / "ab12").exists()
+    assert (backup / ".restore" / "udid1").exists()
+
+
+def test_restore_refuses_encrypted_and_bad_names():
+    cfg = {"targets": [{"name": "vault", "type": "local", "path": "/mnt/x", "encrypt": True}]}
+    assert "encrypted" in sync_manager._pick_target(cfg, "vault")[1]
+    assert sync_manager._pick_target(cfg, "nope")[0] is None
+    res = sync_manager.restore_with_progress("../etc")
+    assert not res["success"] and "Invalid" in res["message"]
@@ -0,0 +1,212 @@
+"""Tests for the S3 sync target: sync_s3's client (single PUT and streamed
+multipart uploads, signed), the manifest-driven incremental upload and a whole
+run through sync_manager._run_target, against an in-process S3 stand-in."""
+import hashlib
+import plistlib
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import sync_checkpoint
+import sync_manager
+import sync_s3
+
+
+class _S3Handler(BaseHTTPRequestHandler):
+    """Just enough of the S3 REST API for sync_s3, on path-style URLs."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _parse(self):
+        u = urllib.parse.urlsplit(self.path)
+        bucket, _, key = urllib.parse.unquote(u.path).lstrip("/").partition("/")
+        query = dict(urllib.parse.parse_qsl(u.query, keep_blank_values=True))
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        store = self.server.store
+        store["requests"].append((self.command, key, query))
+        auth = self.headers.get("Authorization", "")
+        if not auth.startswith(f"AWS4-HMAC-SHA256 Credential={store['access_key']}/"):
+            self._reply(403, b"<Error><Code>AccessDenied</Code></Error>")
+            return None
+        if bucket != store["bucket"]:
+            self._reply(404, b"<Error><Code>NoSuchBucket</Code></Error>")
+            return None
+        return key, query, body
+
+    def do_HEAD(self):
+        if self._parse() is not None:
+            self._reply(200)
+
+    def do_PUT(self):
+        req = self._parse()
+        if req is None:
+            return
+        key, query, body = req
+        etag = hashlib.md5(body).hexdigest()
+        if "uploadId" in query:
+            self.server.store["uploads"][query["uploadId"]][int(query["partNumber"])] = body
+        else:
+            self.server.store["objects"][key] = body
+        self._reply(200, headers={"ETag": f'"{etag}"'})
+
+    def do_POST(self):
+        req = self._parse()
+        if req is None:
+            return
+        key, query, body = req
+        store = self.server.store
+        if "uploads" in query:
+            upload_id = f"up{len(store['uploads'])}"
+            store["uploads"][upload_id] = {}
+            self._reply(200, f"<InitiateMultipartUploadResult><UploadId>{upload_id}"
+                             "</UploadId></InitiateMultipartUploadResult>".encode())
+            return
+        parts = store["uploads"].pop(query["uploadId"])
+        store["objects"][key] = b"".join(parts[n] for n in sorted(parts))
+        self._reply(200, b"<CompleteMultipartUploadResult><ETag>\"x-2\"</ETag>"
+                         b"</CompleteMultipartUploadResult>")
+
+    def do_DELETE(self):
+        req = self._parse()
+        if req is None:
+            return
+        key, query, _ = req
+        if "uploadId" in query:
+            self.server.store["uploads"].pop(query["uploadId"], None)
+        else:
+            self.server.store["objects"].pop(key, None)
+        self._reply(204)
+
+
+@pytest.fixture
+def s3():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _S3Handler)
+    server.store = {"bucket": "bk", "access_key": "AK", "objects": {}, "uploads": {},
+                    "requests": []}
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _client(server, access_key="AK"):
+    return sync_s3.S3Client(f"http://127.0.0.1:{server.server_address[1]}", "bk",
+                            access_key, "secret")
+
+
+def _tree(root):
+    (root / "ab").mkdir(parents=True)
+    (root / "ab" / "ab12").write_bytes(b"x" * 5000)
+    (root / "cd").mkdir()
+    (root / "cd" / "cd34").write_bytes(b"y" * 300)
+    (root / "Manifest.db").write_bytes(b"db")
+    return root
+
+
+def test_signature_is_deterministic():
+    c = sync_s3.S3Client("http://minio:9000", "bk", "AK", "secret", "eu-1")
+    a = c._headers("PUT", "/bk/a b", {}, sync_s3._EMPTY_SHA256, now=0)
+    assert a == c._headers("PUT", "/bk/a b", {}, sync_s3._EMPTY_SHA256, now=0)
+    assert a["authorization"].startswith("AWS4-HMAC-SHA256 Credential=AK/19700101/eu-1/s3/")
+    assert a["host"] == "minio:9000"
+
+
+def test_upload_single_and_multipart(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_s3, "PART_SIZE", 1000)
+    monkeypatch.setattr(sync_s3, "MULTIPART_THRESHOLD", 1000)
+    client = _client(s3)
+    (tmp_path / "small").write_bytes(b"s" * 10)
+    (tmp_path / "big").write_bytes(bytes(range(256)) * 10)
+    assert client.upload_file("k/small", str(tmp_path / "small"), 10)
+    assert client.upload_file("k/big", str(tmp_path / "big"), 2560) == "x-2"
+    objects = s3.store["objects"]
+    assert objects["k/small"] == b"s" * 10
+    assert objects["k/big"] == bytes(range(256)) * 10
+    parts = [q for m, _, q in s3.store["requests"] if "partNumber" in q]
+    assert len(parts) == 3 and not s3.store["uploads"]
+
+
+def test_bad_credentials_surface_as_s3_error(s3):
+    client = _client(s3, access_key="nope")
+    with pytest.raises(sync_s3.S3Error) as e:
+        client.head_bucket()
+    assert e.value.status == 403
+    with pytest.raises(sync_s3.S3Error) as e:
+        client.put_object("k", b"data")
+    assert e.value.code == "AccessDenied"
+
+
+def test_upload_tree_is_incremental_and_deletes(s3, tmp_path):
+    src = _tree(tmp_path / "src")
+    manifest = sync_s3.Manifest(str(tmp_path / "m.json"))
+    up = sync_s3.TreeUploader(_client(s3), manifest, workers=2)
+    res = up.upload_tree(str(src), "p/udid1")
+    assert res["copied"] == 3 and res["copied_bytes"] == 5302
+    assert s3.store["objects"]["p/udid1/ab/ab12"] == b"x" * 5000
+
+    # A new run (fresh manifest object from disk) uploads only what changed.
+    (src / "cd" / "cd34").write_bytes(b"changed")
+    (src / "ab" / "ab12").unlink()
+    manifest = sync_s3.Manifest(str(tmp_path / "m.json"))
+    res = sync_s3.TreeUploader(_client(s3), manifest).upload_tree(str(src), "p/udid1")
+    assert res["copied"] == 1 and res["skipped"] == 1 and res["deleted"] == 1
+    assert "p/udid1/ab/ab12" not in s3.store["objects"]
+    assert s3.store["objects"]["p/udid1/cd/cd34"] == b"changed"
+
+
+def test_upload_tree_stop_keeps_remote_objects(s3, tmp_path):
+    src = _tree(tmp_path / "src")
+    manifest = sync_s3.Manifest(str(tmp_path / "m.json"))
+    manifest.entries["p/udid1/old"] = [1, 1, "e"]
+    res = sync_s3.TreeUploader(_client(s3), manifest,
+                               should_stop=lambda: ("battery", "low")).upload_tree(str(src), "p/udid1")
+    assert res["stopped"] == ("battery", "low") and res["copied"] == 0
+    assert "p/udid1/old" in manifest.entries
+
+
+def test_s3_run_uploads_then_skips_unchanged(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_checkpoint, "_checkpoint_path", lambda: str(tmp_path / "ck.json"))
+    backup = tmp_path / "backup"
+    d = _tree(backup / "udid1")
+    (d / "Status.plist").write_bytes(plistlib.dumps({"UUID": "A", "SnapshotState": "finished"}))
+    (d / "Manifest.plist").write_bytes(b"m")
+    (backup / "top.txt").write_bytes(b"top")
+    s3.store["objects"]["pre/gone-device/f"] = b"old"
+
+    def run():
+        manifest = sync_s3.Manifest(str(tmp_path / "m.json"))
+        manifest.entries.setdefault("pre/gone-device/f", [3, 1, "e"])
+        ctx = sync_manager._S3Context(str(backup) + "/", _client(s3), "pre", manifest,
+                                      workers=2, name="minio")
+        plan = sync_checkpoint.plan_targets(ctx.backup_dir, [sync_manager._checkpoint_target(ctx)])
+        seen = []
+        progress = sync_manager._ProgressAggregator(seen.append, 0, plan["total"], ["minio"])
+        res = sync_manager._run_target(ctx, plan, progress)
+        progress.finish("minio", "done" if res["success"] else "failed")
+        return res, seen
+
+    res, seen = run()
+    assert res["success"], res
+    objects = s3.store["objects"]
+    assert objects["pre/udid1/ab/ab12"] == b"x" * 5000 and objects["pre/top.txt"] == b"top"
+    assert "pre/gone-device/f" not in objects
+    assert seen[-1]["pct"] == 100 and seen[-1]["targets"]["minio"]["state"] == "done"
+
+    # Nothing changed: the device folder is not uploaded again.
+    del objects["pre/udid1/ab/ab12"]
+    assert run()[0]["success"]
+    assert "pre/udid1/ab/ab12" not in objects
@@ -0,0 +1,110 @@
+"""Tests for sync_snapshots: the retention policy, and the staged publish,
+snapshot publish and prune commands (run through a local shell standing in for the SSH session)."""
+import os
+import subprocess
+
+import sync_snapshots
+
+
+class LocalSession:
+    """Runs the 'remote' commands in a local shell."""
+
+    def run(self, remote_command, timeout=30):
+        return subprocess.run(["sh", "-c", remote_command], capture_output=True,
+                              text=True, timeout=timeout)
+
+
+def test_prune_plan_keeps_last_daily_and_monthly():
+    names = [f"202610{d:02d}-120000" for d in range(1, 20)]      # one a day, Oct 1-19
+    names += ["20260915-120000", "20260815-120000", "latest", ".incomplete"]
+    doomed = sync_snapshots.prune_plan(names, keep_last=3, keep_daily=5, keep_monthly=3)
+    kept = set(n for n in names if sync_snapshots.is_snapshot(n)) - set(doomed)
+    assert {"20261019-120000", "20261015-120000"} <= kept          # last 3 / daily 5
+    assert "20261014-120000" not in kept
+    assert {"20260915-120000", "20260815-120000"} <= kept          # monthly
+    assert doomed == sorted(doomed)
+    assert "latest" not in doomed
+
+
+def test_prune_plan_never_deletes_the_newest():
+    assert sync_snapshots.prune_plan(["20261019-120000", "20261018-120000"], 0, 0, 0) == ["20261018-120000"]
+
+
+def test_commit_publishes_and_swaps_latest(tmp_path):
+    session = LocalSession()
+    device = str(tmp_path / "remote" / "udid1")
+    assert sync_snapshots.prepare(session, device) == ("", "")
+    assert sync_snapshots.link_dest_flags("") == []
+
+    os.makedirs(os.path.join(device, sync_snapshots.INCOMPLETE))
+    assert sync_snapshots.commit(session, device, "20261018-120000") == (True, "")
+    os.makedirs(os.path.join(device, sync_snapshots.INCOMPLETE))
+    assert sync_snapshots.commit(session, device, "20261019-120000") == (True, "")
+
+    assert os.readlink(os.path.join(device, "latest")) == "20261019-120000"
+    assert sync_snapshots.prepare(session, device) == ("latest", "")
+    assert sync_snapshots.link_dest_flags("latest") == ["--link-dest=../latest/"]
+
+    # Nothing to publish: commit fails and latest is untouched.
+    ok, err = sync_snapshots.commit(session, device, "20261020-120000")
+    assert not ok and err
+    assert os.readlink(os.path.join(device, "latest")) == "20261019-120000"
+
+
+def test_first_snapshot_is_seeded_from_the_mirror(tmp_path):
+    session = LocalSession()
+    device = tmp_path / "udid1"
+    (device / "ab").mkdir(parents=True)
+    (device / "Manifest.plist").write_text("m")
+    (device / ".rsync-partial").mkdir()
+    assert sync_snapshots.prepare(session, str(device)) == (".mirror", "")
+    assert sorted(os.listdir(device)) == [".mirror"]
+    assert sorted(os.listdir(device / ".mirror")) == [".rsync-partial", "Manifest.plist", "ab"]
+    assert sync_snapshots.link_dest_flags(".mirror") == ["--link-dest=../.mirror/"]
+    assert sync_snapshots.prepare(session, str(device)) == (".mirror", "")   # resumed run
+
+    (device / ".incomplete").mkdir()
+    assert sync_snapshots.commit(session, str(device), "20261019-120000") == (True, "")
+    assert sorted(os.listdir(device)) == ["20261019-120000", "latest"]
+
+
+def test_prune_removes_old_snapshots(tmp_path):
+    device = tmp_path / "udid1"
+    for name in ("20261017-120000", "20261018-120000", "20261019-120000"):
+        (device / name).mkdir(parents=True)
+    os.symlink("20261019-120000", str(device / "latest"))
+    pruned, err = sync_snapshots.prune(LocalSession(), str(device),
+                                       {"keep_last": 2, "keep_daily": 0, "keep_monthly": 0})
+    assert (pruned, err) == (["20261017-120000"], "")
+    assert sorted(os.listdir(device)) == ["20261018-120000", "20261019-120000", "latest"]
+
+
+def test_staged_publish_replaces_live_copy(tmp_path):
+    session = LocalSession()
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    assert sync_snapshots.stage_prepare(session, str(remote), "udid1") == (False, "")
+    staged = remote / sync_snapshots.STAGING / "udid1"
+    staged.mkdir()
+    (staged / "Manifest.plist").write_text("v1")
+    assert sync_snapshots.publish_staged(session, str(remote), "udid1") == (True, "")
+    assert (remote / "udid1" / "Manifest.plist").read_text() == "v1"
+
+    assert sync_snapshots.stage_prepare(session, str(remote), "udid1") == (True, "")
+    assert sync_snapshots.stage_link_dest_flags("udid1", True) == ["--link-dest=../../udid1/"]
+    staged.mkdir()
+    (staged / "Manifest.plist").write_text("v2")
+    assert sync_snapshots.publish_staged(session, str(remote), "udid1") == (True, "")
+    assert (remote / "udid1" / "Manifest.plist").read_text() == "v2"
+    assert os.listdir(remote / sync_snapshots.STAGING) == []
+
+
+def test_staged_publish_cut_short_is_recovered(tmp_path):
+    session = LocalSession()
+    remote = tmp_path / "remote"
+    old = remote / sync_snapshots.STAGING / "udid1.old"      # live renamed aside, then a crash
+    old.mkdir(parents=True)
+    (old / "Manifest.plist").write_text("v1")
+    assert sync_snapshots.stage_prepare(session, str(remote), "udid1") == (True, "")
+    assert (remote / "udid1" / "Manifest.plist").read_text() == "v1"
+    assert not old.exists()
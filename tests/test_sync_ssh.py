@@ -0,0 +1,103 @@
+"""Tests for sync_manager._SshSession: ControlMaster argv, credential handling
+(never in argv, key file 0600 and removed on close) and master ownership."""
+import os
+import stat
+
+import sync_manager
+
+
+class _Done:
+    def __init__(self, returncode=0, stdout="", stderr=""):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+def _key_cfg():
+    return {"host": "nas.example", "port": 2222, "username": "bk",
+            "auth_method": "key", "ssh_key": "-----BEGIN KEY-----\r\nabc\r\n-----END KEY-----"}
+
+
+def test_open_starts_owned_master_and_close_tears_it_down(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_manager, "SSH_RUNTIME_DIR", str(tmp_path))
+    calls = []
+
+    def fake_run(cmd, **kw):
+        calls.append(cmd)
+        return _Done(returncode=0)
+
+    monkeypatch.setattr(sync_manager.subprocess, "run", fake_run)
+    s = sync_manager._SshSession(_key_cfg())
+    ok, err = s.open()
+    assert ok and err == ""
+    assert s.owned
+    assert s.control_path.startswith(str(tmp_path))
+    master = calls[-1]
+    assert "ControlMaster=yes" in master and "-N" in master and "-f" in master
+
+    # Key file: private, normalised line endings, referenced by every ssh argv.
+    mode = stat.S_IMODE(os.stat(s.key_file).st_mode)
+    assert mode == 0o600
+    with open(s.key_file) as f:
+        assert "\r" not in f.read()
+    assert f"ControlPath={s.control_path}" in s.rsync_rsh()
+    assert s.key_file in s.ssh_args()
+
+    key_file = s.key_file
+    s.close()
+    assert not os.path.exists(key_file)
+    assert any("-O" in c and "exit" in c for c in calls)
+
+
+def test_password_never_reaches_argv(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_manager, "SSH_RUNTIME_DIR", str(tmp_path))
+    cfg = {"host": "h", "username": "u", "auth_method": "password", "password": "hunter2"}
+    s = sync_manager._SshSession(cfg)
+    cmd = s.ssh_cmd("echo ok")
+    assert cmd[:2] == ["sshpass", "-e"]
+    assert "hunter2" not in " ".join(cmd)
+    assert s.env["SSHPASS"] == "hunter2"
+    assert "BatchMode=yes" not in cmd       # would block sshpass from answering
+
+
+def test_borrowed_master_is_not_torn_down(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_manager, "SSH_RUNTIME_DIR", str(tmp_path))
+    s = sync_manager._SshSession(_key_cfg())
+    other = tmp_path / f"cm-{s._tag()}-1"
+    other.write_text("")
+    calls = []
+
+    def fake_run(cmd, **kw):
+        calls.append(cmd)
+        return _Done(returncode=0)          # -O check: the other master is alive
+
+    monkeypatch.setattr(sync_manager.subprocess, "run", fake_run)
+    ok, _ = s.open(borrow=True)
+    assert ok and not s.owned
+    assert s.control_path == str(other)
+    s.close()
+    assert not any("exit" in c for c in calls)
+
+    # A sync never borrows: it starts and owns its own master.
+    ok, _ = s.open()
+    assert ok and s.owned and s.control_path != str(other)
+    s.close()
+
+
+def test_socket_tag_follows_the_credentials():
+    cfg = _key_cfg()
+    tag = sync_manager._SshSession(cfg)._tag()
+    assert sync_manager._SshSession(dict(cfg))._tag() == tag
+    assert sync_manager._SshSession({**cfg, "ssh_key": "other key"})._tag() != tag
+    pw = {**cfg, "auth_method": "password", "password": "a"}
+    assert sync_manager._SshSession(pw)._tag() != sync_manager._SshSession({**pw, "password": "b"})._tag()
+
+
+def test_stale_keys_of_dead_pids_are_swept(tmp_path):
+    dead = tmp_path / "key-999999999-abc"
+    mine = tmp_path / f"key-{os.getpid()}-abc"
+    dead.write_text("x")
+    mine.write_text("x")
+    sync_manager._sweep_stale_keys(str(tmp_path))
+    assert not dead.exists()
+    assert mine.exists()
@@ -0,0 +1,210 @@
+"""Tests for multi-target sync: target list parsing, the progress aggregate
+with its per-target breakdown, prefixed logging and the concurrent fan-out
+(sync_manager._run_target) against local stand-in targets, and the targets
+sharing one walk of each device folder."""
+import io
+import plistlib
+import subprocess
+import threading
+
+import sync_checkpoint
+import sync_manager
+import sync_restore
+
+
+def test_sync_targets_primary_first_and_disabled_left_out():
+    cfg = {"host": "a", "username": "u", "remote_path": "/p",
+           "targets": [{"name": "nas", "host": "b"}, {"name": "off", "enabled": False}, {"host": "c"}]}
+    targets = sync_manager._sync_targets(cfg)
+    assert [t["name"] for t in targets] == ["primary", "nas", "target4"]
+    assert all(t["type"] == "ssh" for t in targets)
+    assert "targets" not in targets[0]
+
+
+def test_aggregate_sums_targets_and_keeps_breakdown():
+    seen = []
+    agg = sync_manager._ProgressAggregator(seen.append, 0, 1000, ["a", "b"])
+    agg.EMIT_MIN_SEC = 0
+    agg.begin("a", 0, 0)
+    agg.begin("b", 400, 40)
+    agg.update("a", {"pct": 50, "bytes": 500, "total": 1000, "speed": "1.00MB/s"})
+    agg.update("b", {"pct": 60, "bytes": 600, "total": 1000, "speed": "1.00MB/s"})
+    info = seen[-1]
+    assert info["pct"] == 55 and info["bytes"] == 1100 and info["total"] == 2000
+    assert info["speed"] == "2.00MB/s"
+    assert info["resume_pct"] == 20
+    assert info["targets"]["b"]["pct"] == 60
+
+    agg.finish("a", "done")
+    agg.finish("b", "failed", "rsync failed")
+    info = seen[-1]
+    assert info["targets"]["a"]["pct"] == 100
+    assert info["targets"]["b"] == {"pct": 60, "bytes": 600, "total": 1000, "speed": "",
+                                    "state": "failed", "message": "rsync failed"}
+    assert info["pct"] == 80
+
+
+def test_aggregate_is_stalled_only_when_every_running_target_is():
+    agg = sync_manager._ProgressAggregator(None, 0, 100, ["a", "b"])
+    agg.begin("a", 0, 0)
+    agg.begin("b", 0, 0)
+    agg.update("a", {"pct": 10, "bytes": 10, "total": 100, "stalled": True, "stalled_seconds": 400})
+    agg.update("b", {"pct": 10, "bytes": 10, "total": 100, "stalled": False})
+    assert not agg.snapshot()["stalled"]
+    agg.finish("b", "done")
+    info = agg.snapshot()
+    assert info["stalled"] and info["stalled_seconds"] == 400
+
+
+def test_target_log_prefixes_every_line():
+    out = io.StringIO()
+    log = sync_manager._TargetLog(out, "nas", threading.Lock())
+    log.write("one\ntwo\n")
+    log.write("par")
+    log.write("tial\n")
+    assert out.getvalue() == "[nas] one\n[nas] two\n[nas] partial\n"
+
+
+def test_supervisor_stops_on_cancel():
+    cancel = threading.Event()
+    cancel.set()
+    res = sync_manager._supervise_rsync(["sh", "-c", "sleep 30"], None, cancel=cancel)
+    assert res["abort"] == "cancelled"
+
+
+class _LocalSession:
+    """Stand-in SSH session: 'remote' commands run in a local shell."""
+    env = None
+    port = 22
+
+    def __init__(self, dest):
+        self.dest = dest
+
+    def run(self, remote_command, timeout=30, input=None):
+        return subprocess.run(["sh", "-c", remote_command], capture_output=True,
+                              text=True, timeout=timeout, input=input)
+
+
+class _Ctx(sync_manager._SyncContext):
+    """Target whose 'rsync' is a shell script exiting with ``rc``."""
+
+    def __init__(self, name, backup_dir, remote_path, rc):
+        super().__init__(_LocalSession(name), backup_dir, remote_path, [], {}, name=name)
+        self.rc = rc
+
+    def remote(self, path=""):
+        return f"{self.remote_path}/{path}"
+
+    def rsync_cmd(self, src=None, dst=None, extra=()):
+        dst = self.remote() if dst is None else dst
+        return ["sh", "-c", f"mkdir -p '{dst}' && printf '  100 100%%  1.00MB/s  0:00:00\\n'; "
+                            f"exit {self.rc}"]
+
+
+def test_fan_out_fails_one_target_without_the_others(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_checkpoint, "_checkpoint_path", lambda: str(tmp_path / "ck.json"))
+    backup = tmp_path / "backup"
+    d = backup / "udid1"
+    d.mkdir(parents=True)
+    (d / "Status.plist").write_bytes(plistlib.dumps({"UUID": "A", "SnapshotState": "finished"}))
+    (d / "Manifest.plist").write_bytes(b"m")
+    contexts = [_Ctx("good", str(backup) + "/", str(tmp_path / "good"), 0),
+                _Ctx("bad", str(backup) + "/", str(tmp_path / "bad"), 23)]
+    (tmp_path / "good").mkdir()
+    (tmp_path / "bad").mkdir()
+    plan = sync_checkpoint.plan_targets(str(backup), [sync_manager._checkpoint_target(c)
+                                                      for c in contexts])
+    seen = []
+    progress = sync_manager._ProgressAggregator(seen.append, 0, plan["total"], ["good", "bad"])
+    results = {c.name: sync_manager._run_target(c, plan, progress) for c in contexts}
+
+    assert results["good"]["success"]
+    assert (tmp_path / "good" / "udid1").is_dir()       # published from staging
+    assert "exit 23" in results["bad"]["message"]
+    summary = sync_manager._summarize(results, 3)
+    assert not summary["success"]
+    assert summary["message"].startswith("Synced to good; failed on bad: rsync failed (exit 23")
+
+    # The next run only has work left on the target that failed.
+    keys = [sync_manager._checkpoint_target(c) for c in contexts]
+    plan = sync_checkpoint.plan_targets(str(backup), keys)
+    assert plan["targets"][keys[0]]["done"] == {"udid1"}
+    assert plan["targets"][keys[1]]["done"] == set()
+
+
+def test_top_level_pass_excludes_staging_and_restores(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_checkpoint, "_checkpoint_path", lambda: str(tmp_path / "ck.json"))
+    backup = tmp_path / "backup"
+    (backup / sync_restore.RESTORE_DIR / "udid1").mkdir(parents=True)
+    ctx = _Ctx("nas", str(backup) + "/", str(tmp_path / "nas"), 0)
+    (tmp_path / "nas").mkdir()
+    extras = []
+    rsync_cmd = ctx.rsync_cmd
+
+    def recording(src=None, dst=None, extra=()):
+        extras.append(list(extra))
+        return rsync_cmd(src, dst, extra)
+
+    ctx.rsync_cmd = recording
+    plan = sync_checkpoint.plan_targets(str(backup), [sync_manager._checkpoint_target(ctx)])
+    progress = sync_manager._ProgressAggregator(None, 0, plan["total"], ["nas"])
+    assert sync_manager._run_target(ctx, plan, progress)["success"]
+    assert f"--exclude=/{sync_restore.RESTORE_DIR}/" in extras[0]
+    assert "--exclude=/.staging/" in extras[0]
+
+
+def test_targets_share_one_walk_of_each_device_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_checkpoint, "_checkpoint_path", lambda: str(tmp_path / "ck.json"))
+    backup = tmp_path / "backup"
+    d = backup / "udid1"
+    (d / "ab").mkdir(parents=True)
+    (d / "ab" / "ab01").write_bytes(b"x" * 100)
+    (d / "Status.plist").write_bytes(plistlib.dumps({"UUID": "A", "SnapshotState": "finished"}))
+    (d / "Manifest.plist").write_bytes(b"m")
+    walks = []
+    file_list = sync_checkpoint.file_list
+    monkeypatch.setattr(sync_checkpoint, "file_list",
+                        lambda folder: walks.append(folder) or file_list(folder))
+    ssh = _Ctx("nas", str(backup) + "/", str(tmp_path / "nas"), 0)
+    # An interrupted run left a file in staging that is gone locally since.
+    (tmp_path / "nas" / ".staging" / "udid1" / "ab").mkdir(parents=True)
+    (tmp_path / "nas" / ".staging" / "udid1" / "ab" / "gone").write_bytes(b"old")
+    sent = []
+    rsync_cmd = ssh.rsync_cmd
+
+    def recording(src=None, dst=None, extra=()):
+        lists = [a.split("=", 1)[1] for a in extra if a.startswith("--files-from=")]
+        if lists:
+            with open(lists[0]) as f:
+                sent.append(f.read().split("\0")[:-1])
+            assert "--from0" in extra
+        return rsync_cmd(src, dst, extra)
+
+    ssh.rsync_cmd = recording
+    disk = sync_manager._LocalContext(str(backup) + "/", str(tmp_path / "disk"), "disk1",
+                                      workers=2, name="usb")
+    (tmp_path / "disk").mkdir()
+    contexts = [ssh, disk]
+    plan = sync_checkpoint.plan_targets(str(backup), [sync_manager._checkpoint_target(c)
+                                                      for c in contexts])
+    progress = sync_manager._ProgressAggregator(None, 0, plan["total"], ["nas", "usb"])
+    lists = sync_manager._FileLists(str(backup) + "/", plan)
+    try:
+        for c in contexts:
+            assert sync_manager._run_target(c, plan, progress, lists=lists)["success"]
+    finally:
+        lists.close()
+
+    assert walks == [str(backup) + "/udid1"]             # one walk for both targets
+    assert sent == [["Manifest.plist", "Status.plist", "ab", "ab/ab01"]]
+    assert not (tmp_path / "nas" / "udid1" / "ab" / "gone").exists()
+    assert (tmp_path / "disk" / "udid1" / "ab" / "ab01").read_bytes() == b"x" * 100
+    assert not lists._lists and not lists._files         # dropped once both sent it
+
+
+def test_run_sync_goes_through_the_target_runner(monkeypatch):
+    calls = []
+    monkeypatch.setattr(sync_manager, "run_sync_with_progress",
+                        lambda **kw: calls.append(kw) or {"success": True, "message": "", "duration": 0})
+    assert sync_manager.run_sync(backup_dir="/b")["success"]
+    assert calls == [{"passphrase": None, "backup_dir": "/b"}]
@@ -0,0 +1,98 @@
+"""Tests for sync_tuner: the compression decision, rsync --version parsing,
+encryption detection and the run history it learns from."""
+import plistlib
+
+import sync_tuner
+
+ALL = ["zstd", "lz4", "zlib"]
+
+
+def test_encrypted_backups_are_never_compressed():
+    s = sync_tuner.choose(0.5, 4.0, ALL, encrypted=True)
+    assert s["compress"] == ""
+
+
+def test_slow_link_compresses_with_zstd():
+    s = sync_tuner.choose(1.0, 3.5, ALL)            # ~8 Mbit/s hotspot
+    assert s["compress"] == "zstd"
+    assert s["level"] == 3
+    assert sync_tuner.flags_for(s)[:2] == ["--compress", "--compress-choice=zstd"]
+
+
+def test_gigabit_link_is_cpu_bound_and_stays_off():
+    s = sync_tuner.choose(110.0, 3.5, ALL)
+    assert s["compress"] == ""
+    assert sync_tuner.flags_for(s) == []
+
+
+def test_busy_cpu_turns_compression_off():
+    s = sync_tuner.choose(10.0, 0.05, ["zlib"])      # old rsync, no headroom
+    assert s["compress"] == ""
+
+
+def test_unknown_link_without_history_stays_off():
+    assert sync_tuner.choose(None, 4.0, ALL)["compress"] == ""
+
+
+def _run(network, compress, mbs, n=3):
+    return [{"network": network, "compress": compress, "seconds": 10,
+             "data_bytes": int(mbs * 10e6), "wire_bytes": int(mbs * 10e6)}
+            for _ in range(n)]
+
+
+def test_history_overrides_the_model():
+    hist = _run("wifi:Home", "", 5.0) + _run("wifi:Home", "zstd", 2.0)
+    # The model alone would compress on a 1 MB/s probe; history says no.
+    assert sync_tuner.choose(1.0, 4.0, ALL, history=hist, network="wifi:Home")["compress"] == ""
+    # A different network is unaffected.
+    assert sync_tuner.choose(1.0, 4.0, ALL, history=hist, network="usb_iphone")["compress"] == "zstd"
+
+
+def test_history_verdict_is_retried_every_nth_run():
+    hist = _run("wifi:Home", "", 5.0, n=4) + _run("wifi:Home", "zstd", 2.0, n=5)
+    s = sync_tuner.choose(1.0, 4.0, ALL, history=hist, network="wifi:Home")
+    assert s["compress"] == "zstd" and s["reason"].startswith("exploring")
+    hist += _run("wifi:Home", "zstd", 2.0, n=1)
+    assert sync_tuner.choose(1.0, 4.0, ALL, history=hist, network="wifi:Home")["compress"] == ""
+    # Recent runs decide: compression has become faster on this network.
+    hist += _run("wifi:Home", "zstd", 9.0, n=sync_tuner.LEARN_WINDOW)
+    assert sync_tuner.learned_preference(hist, "wifi:Home") == "on"
+
+
+def test_metered_network_is_not_probed(monkeypatch):
+    monkeypatch.setattr(sync_tuner, "available_compressors", lambda session: (ALL, True))
+    monkeypatch.setattr(sync_tuner, "backups_encrypted", lambda backup_dir: False)
+    monkeypatch.setattr(sync_tuner, "load_history", lambda: [])
+    monkeypatch.setattr(sync_tuner, "cpu_idle_cores", lambda: 4.0)
+    monkeypatch.setattr(sync_tuner, "probe_link", lambda session: 1 / 0)
+    s = sync_tuner.tune(None, "/nonexistent", network="usb_iphone", metered=True)
+    assert s["probe_mbs"] is None and s["compress"] == ""
+
+
+def test_parse_compressors():
+    out = ("rsync  version 3.2.7  protocol version 31\n"
+           "Compress list:\n    zstd lz4 zlibx zlib none\n\n"
+           "Daemon auth list:\n    sha512\n")
+    assert sync_tuner.parse_compressors(out) == ["zstd", "lz4", "zlibx", "zlib"]
+    assert sync_tuner.parse_compressors("rsync  version 3.1.3  protocol version 31\n") == []
+
+
+def test_backups_encrypted(tmp_path):
+    assert sync_tuner.backups_encrypted(str(tmp_path)) is None
+    for name, enc in (("a", True), ("b", True)):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "Manifest.plist").write_bytes(plistlib.dumps({"IsEncrypted": enc}))
+    assert sync_tuner.backups_encrypted(str(tmp_path)) is True
+    (tmp_path / "c").mkdir()
+    (tmp_path / "c" / "Manifest.plist").write_bytes(plistlib.dumps({"IsEncrypted": False}))
+    assert sync_tuner.backups_encrypted(str(tmp_path)) is False
+
+
+def test_history_round_trip_is_capped(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_tuner, "HISTORY_KEEP", 3)
+    path = str(tmp_path / "h.json")
+    for i in range(5):
+        sync_tuner.record_run({"i": i}, path=path)
+    hist = sync_tuner.load_history(path)
+    assert [h["i"] for h in hist] == [2, 3, 4]
+    assert sync_tuner.load_history(str(tmp_path / "missing.json")) == []
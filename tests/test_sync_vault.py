@@ -0,0 +1,169 @@
+"""Tests for client-side encrypted sync: sync_vault's sealing and keys, the
+chunked upload (dedupe, resume, bounded pipeline), restore, the SSH tar
+stream store, and a whole run through sync_manager._run_target."""
+import os
+import plistlib
+
+import pytest
+
+import sync_checkpoint
+import sync_manager
+import sync_vault
+
+pytest.importorskip("cryptography")
+
+
+def _keys():
+    return sync_vault.VaultKeys.derive("pw", b"salt" * 4, iterations=1000)
+
+
+def _tree(root):
+    (root / "ab").mkdir(parents=True)
+    (root / "ab" / "ab12").write_bytes(b"secret-message " * 2000)
+    (root / "cd").mkdir()
+    (root / "cd" / "cd34").write_bytes(os.urandom(5000))
+    (root / "cd" / "copy").write_bytes(b"secret-message " * 2000)
+    (root / "empty").write_bytes(b"")
+    return root
+
+
+def _read_all(root):
+    out = b""
+    for dirpath, _, names in os.walk(root):
+        for n in names:
+            with open(os.path.join(dirpath, n), "rb") as f:
+                out += f.read()
+    return out
+
+
+def test_seal_round_trip_compresses_and_authenticates():
+    keys = _keys()
+    text = b"hello " * 10000
+    blob = keys.seal(text, b"id1")
+    assert len(blob) < len(text) // 10 and b"hello" not in blob
+    assert keys.unseal(blob, b"id1") == text
+    noise = os.urandom(4096)
+    assert len(keys.seal(noise, b"x")) == len(noise) + 33      # stored, not compressed
+    with pytest.raises(sync_vault.VaultError):
+        keys.unseal(blob, b"id2")                               # moved to another name
+    with pytest.raises(sync_vault.VaultError):
+        keys.unseal(blob[:-1] + bytes([blob[-1] ^ 1]), b"id1")
+
+
+def test_open_vault_creates_then_checks_password(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_vault, "KDF_ITERATIONS", 1000)
+    store = sync_vault.DirStore(str(tmp_path))
+    keys = sync_vault.open_vault(store, "pw")
+    assert (tmp_path / "vault.json").exists()
+    assert sync_vault.open_vault(store, "pw").check == keys.check
+    with pytest.raises(sync_vault.VaultError):
+        sync_vault.open_vault(store, "other")
+
+
+def test_upload_dedupes_resumes_and_restores(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_vault, "CHUNK_SIZE", 4096)
+    keys = _keys()
+    src = _tree(tmp_path / "src")
+    store = sync_vault.DirStore(str(tmp_path / "vault"))
+    index = sync_vault.Index(str(tmp_path / "index.json"), keys.check)
+    res = sync_vault.VaultUploader(keys, store, index, workers=3).upload_tree(str(src), "udid1")
+    assert res["copied"] == 4 and not res["stopped"]
+    assert res["done_bytes"] == 65000
+    # ab12 and copy share every chunk; ab12 is 30000 bytes = 8 chunks.
+    files = index.trees["udid1"]
+    assert files["cd/copy"][3] == files["ab/ab12"][3] and len(files["ab/ab12"][3]) == 8
+    assert files["empty"][3] == []
+    assert b"secret-message" not in _read_all(tmp_path / "vault")
+
+    # Next run: a fresh index from disk, one file changed.
+    (src / "cd" / "cd34").write_bytes(b"new")
+    index = sync_vault.Index(str(tmp_path / "index.json"), keys.check)
+    res = sync_vault.VaultUploader(keys, store, index).upload_tree(str(src), "udid1")
+    assert res["copied"] == 1 and res["skipped"] == 3
+
+    dest = tmp_path / "restored"
+    assert sync_vault.restore(store, keys, str(dest)) == {"udid1": 4}
+    assert (dest / "udid1" / "ab" / "ab12").read_bytes() == (src / "ab" / "ab12").read_bytes()
+    assert (dest / "udid1" / "cd" / "cd34").read_bytes() == b"new"
+    assert (dest / "udid1" / "ab" / "ab12").stat().st_mtime_ns == \
+        (src / "ab" / "ab12").stat().st_mtime_ns
+
+
+def test_stop_keeps_sent_chunks_but_writes_no_tree(tmp_path):
+    keys = _keys()
+    src = _tree(tmp_path / "src")
+    store = sync_vault.DirStore(str(tmp_path / "vault"))
+    index = sync_vault.Index(str(tmp_path / "index.json"), keys.check)
+    calls = []
+
+    def stop():
+        calls.append(1)
+        return ("battery", "low") if len(calls) > 2 else None
+
+    res = sync_vault.VaultUploader(keys, store, index, should_stop=stop).upload_tree(str(src), "d")
+    assert res["stopped"] == ("battery", "low")
+    assert "d" not in index.trees and not store.list("trees")
+    assert index.chunks          # what arrived counts for the next run
+
+
+class _ShellSession:
+    """Stand-in SSH session: 'remote' commands run in a local shell."""
+    env = None
+
+    def ssh_cmd(self, remote_command):
+        return ["sh", "-c", remote_command]
+
+
+def test_ssh_store_streams_tar_and_deletes(tmp_path):
+    store = sync_vault.SshStore(_ShellSession(), str(tmp_path / "remote"))
+    store.put("chunks/ab/ab1", b"one")
+    store.put("trees/t1", b"two")
+    store.flush()
+    assert (tmp_path / "remote" / "chunks" / "ab" / "ab1").read_bytes() == b"one"
+    assert store.get("trees/t1") == b"two"
+    assert store.get("trees/missing") is None
+    store.delete(["trees/t1"])
+    assert not (tmp_path / "remote" / "trees" / "t1").exists()
+
+
+def test_vault_run_mirrors_and_collects_garbage(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_checkpoint, "_checkpoint_path", lambda: str(tmp_path / "ck.json"))
+    backup = tmp_path / "backup"
+    for udid in ("udid1", "udid2"):
+        d = _tree(backup / udid)
+        (d / "Status.plist").write_bytes(plistlib.dumps({"UUID": udid, "SnapshotState": "finished"}))
+        (d / "Manifest.plist").write_bytes(udid.encode())
+    (backup / "top.txt").write_bytes(b"top")
+    keys = _keys()
+
+    def run():
+        store = sync_vault.DirStore(str(tmp_path / "vault"))
+        index = sync_vault.Index(str(tmp_path / "index.json"), keys.check)
+        ctx = sync_manager._VaultContext(str(backup) + "/", store, keys, index, "vault:local:x",
+                                         workers=2, name="enc")
+        plan = sync_checkpoint.plan_targets(ctx.backup_dir, [sync_manager._checkpoint_target(ctx)])
+        progress = sync_manager._ProgressAggregator(None, 0, plan["total"], ["enc"])
+        res = sync_manager._run_target(ctx, plan, progress)
+        ctx.close()
+        return res, index
+
+    res, index = run()
+    assert res["success"], res
+    assert set(index.trees) == {".", "udid1", "udid2"}
+    n_chunks = len(index.chunks)
+
+    # udid2 removed locally: its tree goes, and chunks only it used are deleted.
+    for p in sorted((backup / "udid2").rglob("*"), reverse=True):
+        p.rmdir() if p.is_dir() else p.unlink()
+    (backup / "udid2").rmdir()
+    res, index = run()
+    assert res["success"], res
+    assert set(index.trees) == {".", "udid1"}
+    assert len(index.chunks) < n_chunks
+    on_disk = {p.name for p in (tmp_path / "vault" / "chunks").rglob("*") if p.is_file()}
+    assert on_disk == index.chunks
+
+    dest = tmp_path / "restored"
+    sync_vault.restore(sync_vault.DirStore(str(tmp_path / "vault")), keys, str(dest))
+    assert (dest / "top.txt").read_bytes() == b"top"
+    assert (dest / "udid1" / "Manifest.plist").read_bytes() == b"udid1"
@@ -0,0 +1,142 @@
+"""Tests for throughput-model stall detection: sync_watchdog's expected link
+rate from the history, its /proc readers (process tree I/O, TCP queues), the
+StallWatch verdicts, and a dead link killing rsync through the supervisor."""
+import io
+
+import sync_manager
+import sync_watchdog
+
+
+def _run(network, mbs):
+    return {"network": network, "wire_bytes": 100_000_000, "seconds": 100 / mbs}
+
+
+def test_expected_rate_falls_back_by_network_kind():
+    history = [_run("wifi:home", 4), _run("wifi:home", 6), _run("wifi:office", 1),
+               _run("usb_iphone", 0.5), {"network": "wifi:tiny", "wire_bytes": 10, "seconds": 1}]
+    assert sync_watchdog.expected_rate(history, "wifi:home") == 5e6
+    assert sync_watchdog.expected_rate(history, "wifi:cafe") == 3e6     # median of home, office
+    assert sync_watchdog.expected_rate(history, "usb_iphone") == 0.5e6
+    assert sync_watchdog.expected_rate([], "wifi:cafe") == sync_watchdog.DEFAULT_RATES["wifi"]
+    assert sync_watchdog.expected_rate(history, None) == sync_watchdog.DEFAULT_RATE
+
+
+def test_process_tree_and_io(tmp_path):
+    for pid, ppid, rchar in ((10, 1, 100), (11, 10, 20), (12, 11, 3), (13, 1, 999)):
+        d = tmp_path / str(pid)
+        d.mkdir()
+        (d / "stat").write_text(f"{pid} (rsync (x)) S {ppid} 0 0\n")
+        (d / "io").write_text(f"rchar: {rchar}\nwchar: 1\nread_bytes: 5000\n")
+    (tmp_path / "self").mkdir()
+    tree = sync_watchdog.process_tree(10, proc=str(tmp_path))
+    assert sorted(tree) == [10, 11, 12]
+    assert sync_watchdog.read_io(tree + [99], proc=str(tmp_path)) == 126
+
+
+def test_read_tcp_matches_target_connections(tmp_path):
+    (tmp_path / "net").mkdir()
+    head = "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt\n"
+    (tmp_path / "net" / "tcp").write_text(head +
+        "   0: 0100007F:9C40 0100007F:0016 01 00000010:00000002 01:00000014 00000004\n"
+        "   1: 0100007F:9C41 0100007F:0016 06 00000000:00000000 00:00000000 00000000\n"
+        "   2: 0100007F:9C42 0100007F:0050 01 00000000:00000000 00:00000000 00000000\n")
+    (tmp_path / "net" / "tcp6").write_text(head +
+        "   0: 0000000000000000FFFF00000100007F:9C43 "
+        "0000000000000000FFFF00000100007F:0016 01 00000000:00000001 00:00000000 00000000\n")
+    conns = sync_watchdog.read_tcp({"127.0.0.1"}, 22, proc=str(tmp_path))
+    assert conns == [(16, 2, 4), (0, 1, 0)]
+    assert sync_watchdog.read_tcp({"10.0.0.1"}, 22, proc=str(tmp_path)) == []
+
+
+class _Clock:
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+
+def _watch(clock, io_vals=None, conns=None, rate=1e6):
+    io_vals = io_vals if io_vals is not None else [0]
+    conns = conns if conns is not None else [[]]
+    w = sync_watchdog.StallWatch(rate, None, hard_kill_sec=600, clock=clock,
+                                 io_reader=lambda pids: io_vals[0],
+                                 tcp_reader=lambda ips, port: conns[0],
+                                 tree=lambda pid: [pid])
+    w.start(1234)
+    return w
+
+
+def test_watch_warns_from_the_expected_rate_and_io_keeps_it_alive():
+    clock = _Clock()
+    io_vals = [0]
+    w = _watch(clock, io_vals, rate=0.5e6)          # 8 MiB at 0.5 MB/s: ~16s
+    assert 16 <= w.warn_after() <= 17
+    assert w.check()["state"] == "ok"
+    clock.t += 20
+    v = w.check()
+    assert v["state"] == "stalled" and not v["kill"]
+    io_vals[0] = 5000                               # rsync is writing a big file
+    clock.t += 1
+    assert w.check()["state"] == "ok"
+    # Slow, but moving every minute: never killed.
+    for _ in range(30):
+        clock.t += 60
+        io_vals[0] += 1
+        assert not w.check()["kill"]
+    clock.t += 600
+    v = w.check()
+    assert v["kill"] and "activity" in v["reason"]
+
+
+def test_watch_uses_the_observed_rate_when_slower():
+    clock = _Clock()
+    w = _watch(clock, rate=10e6)
+    assert w.warn_after() == sync_watchdog.STALL_MIN_SEC
+    w.output(0)
+    clock.t += 20
+    w.output(200_000)                               # 10 kB/s
+    assert w.warn_after() == sync_watchdog.STALL_MAX_SEC
+
+
+def test_watch_kills_dead_link_within_seconds():
+    clock = _Clock()
+    conns = [[(4096, 0, 0)]]
+    w = _watch(clock, conns=conns)
+    w.ips, w.port = {"192.0.2.1"}, 22
+    assert w.check()["state"] == "ok"
+    conns[0] = [(4096, 0, 5)]                       # the kernel keeps retransmitting
+    clock.t += 5
+    assert not w.check()["kill"]
+    clock.t += sync_watchdog.DEAD_LINK_SEC
+    v = w.check()
+    assert v["state"] == "dead" and v["kill"] and "retransmits" in v["reason"]
+
+    # A connection that disappears is dead too.
+    w = _watch(clock, conns=conns)
+    w.ips, w.port = {"192.0.2.1"}, 22
+    conns[0] = [(0, 0, 0)]
+    w.check()
+    conns[0] = []
+    clock.t += sync_watchdog.DEAD_LINK_SEC
+    assert w.check()["state"] == "dead"
+
+
+class _DeadWatch:
+    def start(self, pid):
+        pass
+
+    def output(self, nbytes=None):
+        pass
+
+    def check(self):
+        return {"state": "dead", "idle": 20, "kill": True, "reason": "link dead (test)"}
+
+
+def test_supervisor_kills_on_dead_link():
+    log = io.StringIO()
+    script = "printf '  500  50%%  1.00MB/s  0:00:01\\r'; sleep 30"
+    res = sync_manager._supervise_rsync(["sh", "-c", script], None, lambda info: None, log,
+                                        watch=_DeadWatch())
+    assert res["abort"] == "stall" and res["reason"] == "link dead (test)"
+    assert "[STALL] link dead (test)" in log.getvalue()
@@ -0,0 +1,222 @@
+"""Tests for the sync worker: sync_worker's queue (order, dedupe, limits),
+graceful cancel of the running job (and of an audit a sync preempts), the
+control socket and event stream, the job guards in run_job, and
+sync_manager's stop event and SIGTERM kill."""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+import sync_manager
+import sync_worker
+
+
+class _Runner:
+    """Stand-in for run_job: records jobs, reports progress, and blocks until
+    released or cancelled."""
+
+    def __init__(self):
+        self.jobs = []
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def __call__(self, job, args, cancel=None, on_progress=None, source=""):
+        self.jobs.append((job, args, source))
+        self.started.set()
+        on_progress({"pct": 50})
+        while not self.release.wait(0.01):
+            if cancel.is_set():
+                return {"success": False, "message": "Cancelled by user.", "cancelled": True}
+        return {"success": True, "message": "ok", "duration": 0}
+
+
+def _start(worker):
+    t = threading.Thread(target=worker.run, daemon=True)
+    t.start()
+    return t
+
+
+def _wait(cond, timeout=5):
+    end = time.time() + timeout
+    while not cond():
+        assert time.time() < end, "timed out"
+        time.sleep(0.01)
+
+
+def test_queue_order_dedupe_and_limits(monkeypatch):
+    monkeypatch.setattr(sync_worker, "QUEUE_MAX", 3)
+    runner = _Runner()
+    w = sync_worker.Worker(runner)
+    assert w.enqueue("sync")["position"] == 0
+    t = _start(w)
+    runner.started.wait(5)
+    r = w.enqueue("restore", {"device": "udid1", "bogus": "x"})
+    assert r["position"] == 1
+    assert w.enqueue("restore", {"device": "udid1"})["duplicate"]
+    assert not w.enqueue("restore", {})["ok"]
+    assert not w.enqueue("format")["ok"]
+    w.enqueue("sync")
+    w.enqueue("restore", {"device": "udid2"})
+    assert "full" in w.enqueue("restore", {"device": "udid3"})["error"]
+    assert [e["job"] for e in w.status()["queue"]] == ["restore", "sync", "restore"]
+
+    runner.release.set()
+    _wait(lambda: len(runner.jobs) == 4 and w.status()["running"] is None)
+    assert runner.jobs[1][1] == {"device": "udid1"}
+    assert w.status()["last"]["result"]["success"]
+    w.stop()
+    t.join(5)
+
+
+def test_cancel_running_and_queued():
+    runner = _Runner()
+    w = sync_worker.Worker(runner)
+    t = _start(w)
+    w.enqueue("sync")
+    runner.started.wait(5)
+    queued = w.enqueue("restore", {"device": "udid1"})["id"]
+    assert w.cancel(queued)["ok"]
+    assert not w.cancel(99)["ok"]
+    assert w.cancel()["ok"]
+    _wait(lambda: w.status()["last"] is not None)
+    assert w.status()["last"]["result"]["cancelled"]
+    assert len(runner.jobs) == 1
+    assert not w.cancel()["ok"]
+    w.stop()
+    t.join(5)
+
+
+def test_sync_request_preempts_a_running_audit():
+    runner = _Runner()
+    w = sync_worker.Worker(runner)
+    t = _start(w)
+    w.enqueue("audit", {"target": "nas"}, source="schedule")
+    runner.started.wait(5)
+    w.enqueue("sync")
+    _wait(lambda: len(runner.jobs) == 2)
+    assert w.status()["last"]["result"]["cancelled"]
+    assert [j[0] for j in runner.jobs] == ["audit", "sync"]
+    runner.release.set()
+    w.stop()
+    t.join(5)
+
+
+@pytest.fixture
+def sock_path():
+    d = tempfile.mkdtemp(prefix="sw")     # short: AF_UNIX paths are limited to ~108 bytes
+    yield os.path.join(d, "w.sock")
+    shutil.rmtree(d, ignore_errors=True)
+
+
+def test_socket_commands_and_events(sock_path, monkeypatch):
+    monkeypatch.setattr(sync_worker, "SOCKET_PATH", sock_path)
+    assert sync_worker.status() is None and not sync_worker.busy()
+    runner = _Runner()
+    w = sync_worker.Worker(runner)
+    server = threading.Thread(target=w.serve, daemon=True)
+    server.start()
+    _wait(lambda: os.path.exists(sock_path))
+    assert oct(os.stat(sock_path).st_mode & 0o777) == "0o600"
+    with pytest.raises(RuntimeError):
+        sync_worker.Worker().serve(sock_path)      # one worker per socket
+
+    events = []
+    stream = sync_worker.subscribe(timeout=5)
+    events.append(next(stream))                     # the initial status
+    reader = threading.Thread(target=lambda: [events.append(e) for e in stream
+                                              if events[-1]["event"] != "finished"],
+                              daemon=True)
+    reader.start()
+    reply = sync_worker.enqueue("sync", source="test")
+    assert reply["ok"] and reply["id"] == 1
+    jobs = _start(w)
+    runner.started.wait(5)
+    assert sync_worker.busy()
+    assert runner.jobs[0][2] == "test"
+    runner.release.set()
+    _wait(lambda: events[-1]["event"] == "finished")
+    assert [e["event"] for e in events] == ["status", "queued", "started", "progress", "finished"]
+    assert events[3]["info"] == {"pct": 50}
+
+    w.stop()
+    jobs.join(5)
+    server.join(5)
+    assert not os.path.exists(sock_path)
+
+
+def test_run_job_guards_skip_without_touching_status(tmp_path, monkeypatch):
+    cfg = tmp_path / "config.yaml"
+    cfg.write_text("sync:\n  enabled: false\n")
+    monkeypatch.setattr(sync_worker, "CONFIG_PATH", str(cfg))
+    monkeypatch.setattr(sync_worker, "LOG_DIR", str(tmp_path / "logs"))
+    monkeypatch.setattr(sync_worker.logutil, "LOG_DIR", str(tmp_path / "logs"))
+    monkeypatch.setattr(sync_worker.logutil, "STATE_DIR", str(tmp_path / "state"))
+    monkeypatch.setattr(sync_worker, "RUNTIME_DIR", str(tmp_path))
+    monkeypatch.setattr(sync_worker, "JOB_LOCK", str(tmp_path / "sync_job.lock"))
+    monkeypatch.setattr(sync_worker, "STATUS_FILE", str(tmp_path / "status.json"))
+    indexed = []
+    monkeypatch.setattr(sync_worker, "_index_logs", lambda *paths: indexed.append(paths))
+    res = sync_worker.run_job("sync")
+    assert res["skipped"] and "disabled" in res["message"]
+    assert indexed == [(str(tmp_path / "logs"), str(tmp_path / "state" / "logsearch.db"))]
+    assert '"sync_error"' in (tmp_path / "status.json").read_text()
+
+    # The config is re-read once the file changes.
+    time.sleep(0.01)
+    cfg.write_text("sync:\n  enabled: true\n")
+    assert sync_worker.load_config()["sync"]["enabled"]
+    monkeypatch.setattr(sync_worker, "backup_running", lambda: True)
+    res = sync_worker.run_job("sync")
+    assert res["skipped"] and "Backup in progress" in res["message"]
+
+
+def test_run_job_skips_while_another_process_holds_the_slot(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_worker, "LOG_DIR", str(tmp_path / "logs"))
+    monkeypatch.setattr(sync_worker.logutil, "LOG_DIR", str(tmp_path / "logs"))
+    monkeypatch.setattr(sync_worker.logutil, "STATE_DIR", str(tmp_path / "state"))
+    monkeypatch.setattr(sync_worker, "RUNTIME_DIR", str(tmp_path))
+    monkeypatch.setattr(sync_worker, "JOB_LOCK", str(tmp_path / "sync_job.lock"))
+    monkeypatch.setattr(sync_worker, "STATUS_FILE", str(tmp_path / "status.json"))
+    monkeypatch.setattr(sync_worker, "_index_logs", lambda *paths: None)
+    # The lock is held by another process, as a one-shot backup-sync.py would.
+    holder = subprocess.Popen(
+        [sys.executable, "-c", "import fcntl, sys, time; f = open(sys.argv[1], 'a'); "
+         "fcntl.flock(f, fcntl.LOCK_EX); print('held', flush=True); time.sleep(30)",
+         str(tmp_path / "sync_job.lock")], stdout=subprocess.PIPE, text=True)
+    try:
+        assert holder.stdout.readline().strip() == "held"
+        assert sync_worker.slot_taken()
+        res = sync_worker.run_job("sync")
+        assert res["skipped"] and "another sync" in res["message"]
+        assert not (tmp_path / "status.json").exists()      # nothing overwritten
+    finally:
+        holder.kill()
+        holder.wait()
+    # The kernel dropped the lock with its holder: no stale slot.
+    assert not sync_worker.slot_taken()
+    slot = sync_worker.claim_slot()
+    assert slot is not None and sync_worker.slot_taken()
+    slot.close()
+
+
+def test_run_stop_reads_outer_cancel_without_setting_it():
+    outer = threading.Event()
+    stop = sync_manager._RunStop(outer)
+    assert not stop.is_set()
+    outer.set()
+    assert stop.is_set()
+    inner = sync_manager._RunStop(threading.Event())
+    inner.set()
+    assert inner.is_set() and not inner._outer.is_set()
+
+
+def test_kill_with_grace_sends_sigterm():
+    proc = subprocess.Popen(["sh", "-c", "trap 'exit 7' TERM; while :; do sleep 0.05; done"])
+    time.sleep(0.2)
+    sync_manager._kill(proc, grace=5)
+    assert proc.returncode == 7
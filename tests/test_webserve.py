@@ -0,0 +1,61 @@
+"""Tests for webserve: compression by Accept-Encoding, an ETag per
+representation answered 304, streamed and small responses left alone, and
+static files made cacheable."""
+import gzip
+import os
+
+from flask import Flask, Response, jsonify
+
+import webserve
+
+STATIC = os.path.join(os.path.dirname(__file__), "..", "app", "webui_static")
+
+
+def _client(monkeypatch, brotli=None):
+    monkeypatch.setattr(webserve, "brotli", brotli)
+    app = Flask(__name__, static_folder=os.path.abspath(STATIC), static_url_path="/static")
+    webserve.install(app)
+    app.add_url_rule("/big", "big", lambda: jsonify({"x": "y" * 4000}))
+    app.add_url_rule("/small", "small", lambda: "ok")
+    app.add_url_rule("/events", "events", lambda: Response(iter(["data: 1\n\n"] * 300),
+                                                           mimetype="text/event-stream"))
+    return app.test_client()
+
+
+def test_gzip_and_etag_per_representation(monkeypatch):
+    c = _client(monkeypatch)
+    r = c.get("/big", headers={"Accept-Encoding": "gzip, br"})
+    assert r.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(r.data).startswith(b'{"x":"yyy')
+    assert r.headers["ETag"].endswith('-gzip"')
+    assert r.headers["Cache-Control"] == "private, no-cache"
+    assert "Accept-Encoding" in r.headers["Vary"]
+    again = c.get("/big", headers={"Accept-Encoding": "gzip", "If-None-Match": r.headers["ETag"]})
+    assert again.status_code == 304 and again.data == b""
+    plain = c.get("/big", headers={"Accept-Encoding": "identity",
+                                   "If-None-Match": r.headers["ETag"]})
+    assert plain.status_code == 200 and "Content-Encoding" not in plain.headers
+    assert len(plain.data) > 4000
+
+
+def test_brotli_when_installed(monkeypatch):
+    class FakeBrotli:
+        @staticmethod
+        def compress(body, quality):
+            return b"br:" + body[:4]
+    c = _client(monkeypatch, FakeBrotli)
+    r = c.get("/big", headers={"Accept-Encoding": "gzip, br"})
+    assert r.headers["Content-Encoding"] == "br" and r.data == b'br:{"x"'
+    assert c.get("/big", headers={"Accept-Encoding": "gzip"}).headers["Content-Encoding"] == "gzip"
+
+
+def test_streamed_small_and_static_responses(monkeypatch):
+    c = _client(monkeypatch)
+    small = c.get("/small", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers and small.headers["ETag"]
+    events = c.get("/events", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in events.headers and "ETag" not in events.headers
+    icon = c.get("/static/icon.svg", headers={"Accept-Encoding": "gzip"})
+    assert icon.status_code == 200 and "Content-Encoding" not in icon.headers
+    assert icon.cache_control.public and icon.cache_control.max_age == webserve.STATIC_MAX_AGE
+    assert c.get("/static/icon.svg", headers={"If-None-Match": icon.headers["ETag"]}).status_code == 304
@@ -56,3 +56,11 @@ def test_resolve_passphrase_modes(monkeypatch):
     # custom mode (no passphrase given) yields None.
     assert wg_crypto.resolve_passphrase(
         None, {"credential_encryption": {"passphrase_mode": "custom"}}) is None
+
+
+def test_file_key_cache_holds_no_passphrase():
+    key = wg_crypto._file_key("secret-pass")
+    assert key == wg_crypto.derive_key("secret-pass")
+    assert wg_crypto._file_key("secret-pass") is key
+    assert "secret-pass" not in repr(wg_crypto._key_cache)
+    assert wg_crypto._file_key("other") == wg_crypto.derive_key("other")
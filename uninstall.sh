@@ -44,6 +44,25 @@ APP_FILES=(
     wifi_manager.py
     sync_crypto.py
     sync_manager.py
+    sync_tuner.py
+    datausage.py
+    sync_checkpoint.py
+    sync_snapshots.py
+    sync_local.py
+    sync_s3.py
+    sync_vault.py
+    sync_restore.py
+    sync_worker.py
+    sync_watchdog.py
+    sync_estimate.py
+    sync_audit.py
+    size_index.py
+    filewatch.py
+    logtail.py
+    logindex.py
+    logsearch.py
+    webserve.py
+    probes.py
     epdconfig.py
     config.yaml
     UbuntuMono-Regular.ttf
@@ -70,6 +89,7 @@ SERVICES=(
     unplug-notify.service
     button-info.service
     backup-sync.service
+    sync-worker.service
     wg-autoconnect.service
 )
 